@@ -32,6 +32,82 @@ DEFAULT_HYBRID_TABLE_NAME = 'hybrid'
 # List of required SQL fields in the hybrid PG/JSON database table (excluding JSON fields):
 SQL_FIELDS_HYBRID = [ 's_dec', 's_ra', 'obs_collection', 'is_public' ]
 
+# Maximum number of image IDs which may be looked up in a single batch metadata request.
+MAX_BATCH_IDS = 1000
+
+# Maximum number of positions for which cutouts may be made in a single batch cutout request.
+MAX_BATCH_CUTOUTS = 1000
+
+# Seconds for which the lists of collections, filters, and image paths are cached (0 disables).
+LIST_CACHE_TTL = 300
+
+# PostgreSQL channel on which image ingestion announces new images (NOTIFY), invalidating
+# the cached lists of collections, filters, and image paths. Set to None to disable listening.
+LIST_CACHE_NOTIFY_CHANNEL = 'cuts_image_metadata'
+
+# Maximum total size, in bytes, of the image cutouts cache directory (None or 0 for no limit).
+CO_CACHE_MAX_BYTES = 10 * 1024 * 1024 * 1024
+
+# Maximum number of image cutout files in the cutouts cache directory (None or 0 for no limit).
+CO_CACHE_MAX_ENTRIES = 10000
+
+# Maximum total size, in bytes, and number of the decompressed copies of gzipped (.fits.gz) images,
+# which are memory mapped to make cutouts, instead of inflating an image for each cutout.
+DECOMPRESSED_CACHE_MAX_BYTES = 50 * 1024 * 1024 * 1024
+DECOMPRESSED_CACHE_MAX_ENTRIES = 100
+
+# Seconds between sweeps of the cutouts cache directory, evicting least recently used cutouts.
+CO_CACHE_SWEEP_INTERVAL = 60
+
+# Maximum seconds a request waits for another request to produce the same image cutout.
+CO_CACHE_LOCK_TIMEOUT = 60
+
+# Fraction of an image pixel to which cutout centers are quantized, so that requests with
+# slightly different centers share a cached cutout (cut at the quantized center).
+# Set to None to use the requested centers (rounded to about 4 micro-arcseconds).
+CO_KEY_PIXEL_FRACTION = None
+
+# Maximum number of opened (memory mapped) images, with their parsed WCS, cached by each
+# worker process for making cutouts. Each cached image holds an open file descriptor.
+HDU_CACHE_MAX_ENTRIES = 16
+
+# Number of worker processes, per web (or Celery) worker process, which make and write cached
+# cutouts and the cutouts of multi-filter cubes, so that CPU-bound cutouts do not block the
+# other requests served by a gevent worker.
+# Also the maximum number of such cutouts made concurrently. Set to 0 to make cutouts in-process.
+CO_POOL_MAX_WORKERS = 2
+
+# Default quantization level of floating-point cutouts which are tile compressed on request.
+# Higher levels preserve more precision: 0 requests lossless compression (GZIP_2 only).
+CO_COMPRESSION_QUANTIZE_LEVEL = 16.0
+
+# Whether to send cutouts gzipped (with 'Content-Encoding: gzip') to clients which accept it,
+# and the compression level (1 to 9) of the gzipped copies of cutouts kept in the cache.
+CO_GZIP_ENCODING = True
+CO_GZIP_LEVEL = 6
+
+# Default and largest maximum dimensions (in pixels) of the PNG/JPEG preview images of cutouts,
+# and the default percentile interval to which preview intensities are clipped.
+PREVIEW_MAX_DIM = 512
+PREVIEW_MAX_DIM_LIMIT = 4096
+PREVIEW_PERCENT_INTERVAL = (0.5, 99.5)
+
+# Largest factor by which cutouts and images may be binned (block averaged) on request.
+CO_BIN_MAX_FACTOR = 64
+
+# Largest number of image extensions (e.g., SCI, ERR, and DQ) which may be cut in one request.
+CO_MAX_EXTENSIONS = 8
+
+# How image and cutout files are delivered to clients: 'direct' (sent by the web worker),
+# 'x-accel' (handed to an nginx front proxy with an X-Accel-Redirect header), or 'x-sendfile'
+# (handed to an Apache or lighttpd front proxy with an X-Sendfile header). The front proxy then
+# handles conditional and range requests, and it may compress the files it sends.
+FILE_DELIVERY_MODE = 'direct'
+
+# For 'x-accel' delivery: the internal location of the nginx front proxy which serves the files
+# in each directory. Files outside these directories are sent directly.
+FILE_DELIVERY_LOCATIONS = { DATA_ROOT: '/protected' }
+
 
 #
 # Celery worker service
@@ -42,3 +118,5 @@ accept_content = ['json']
 task_serializer = 'json'
 result_serializer = 'json'
 redis_max_connections = 5
+task_track_started = True                   # report when a worker starts a (cutout) job
+result_expires = 86400                      # seconds for which job results are kept
@@ -0,0 +1,259 @@
+#
+# Methods to package many image cutouts into a single archive or multi-extension FITS file,
+# or to stack them into a single raw (npy or Arrow) tensor.
+#   Last Modified: Drop the stale note that Arrow batches need an optional package.
+#
+import io
+import json
+import tarfile
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+
+from astropy.io import fits
+from astropy.table import Table
+
+from cuts.blueprints.img.array_utils import ARRAY_MIME_TYPES, TENSOR_COLUMN, array_data
+from cuts.blueprints.img.array_utils import encode_arrow, wcs_metadata, write_arrow
+from cuts.blueprints.img.fits_utils import FITS_MIME_TYPE
+
+
+# MIME types of the archive formats for batches of cutouts (see arg_utils.ARCHIVE_FORMATS):
+# a stacked npy batch is a NumPy .npz (zip) archive, since a .npy file cannot hold its manifest
+ARCHIVE_MIME_TYPES = { 'zip': 'application/zip', 'tar': 'application/x-tar', 'fits': FITS_MIME_TYPE,
+                       'npy': 'application/zip', 'arrow': ARRAY_MIME_TYPES['arrow'] }
+
+# Filename extensions of the archive formats for batches of cutouts
+ARCHIVE_EXTENSIONS = { 'zip': '.zip', 'tar': '.tar', 'fits': '.fits', 'npy': '.npz', 'arrow': '.arrow' }
+
+# Name of the archive member listing the cutouts (and errors) in an archive
+MANIFEST_NAME = 'manifest.json'
+
+# Name of the member of a stacked npy batch (.npz archive) holding the stack of cutouts
+STACK_NAME = 'cutouts.npy'
+
+# Maximum size of an archive kept in memory, before it is spooled to a temporary file
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+# Keys of a position dictionary copied to its entry in a manifest
+MANIFEST_KEYS = [ 'row', 'ra', 'dec', 'size', 'image', 'error' ]
+
+
+def array_manifest_entry (pos, hdu):
+    """
+    Return a manifest entry for the given position and its cutout HDU, if any, in a stack of
+    cutouts, giving the shape of the cutout within its (NaN padded) plane of the stack
+    ('shape') and the WCS of the cutout ('wcs', see wcs_metadata).
+    """
+    entry = manifest_entry(pos)
+    if (hdu is not None):
+        entry['shape'] = list(hdu.data.shape)
+        entry['wcs'] = wcs_metadata(hdu.header)
+    return entry
+
+
+def hdu_bytes (hdu):
+    """ Return the bytes of a FITS file containing the given primary HDU. """
+    buf = io.BytesIO()
+    hdu.writeto(buf)
+    return buf.getvalue()
+
+
+def manifest_bytes (manifest, units=None):
+    """ Return the JSON encoding of the given manifest entries and size units. """
+    return json.dumps({ 'units': str(units) if units else None, 'cutouts': manifest },
+                      indent=2).encode('utf-8')
+
+
+def manifest_entry (pos, name=None):
+    """ Return a manifest entry for the given position and the name of its cutout, if any. """
+    entry = { key: pos[key] for key in MANIFEST_KEYS if (key in pos) }
+    if (name is not None):
+        entry['name'] = name
+    return entry
+
+
+def manifest_table_hdu (manifest):
+    """ Return a binary table HDU ('MANIFEST') listing the given manifest entries. """
+    def column (key, default, dtype=None):
+        values = [ entry.get(key) for entry in manifest ]
+        return np.array([ default if (val is None) else val for val in values ], dtype=dtype)
+    table = Table({ 'row': column('row', -1, 'i8'),
+                    'ra': column('ra', np.nan, 'f8'),
+                    'dec': column('dec', np.nan, 'f8'),
+                    'size': column('size', np.nan, 'f8'),
+                    'extname': column('name', '', 'U') if manifest else np.array([], 'U1'),
+                    'image': column('image', '', 'U') if manifest else np.array([], 'U1'),
+                    'error': column('error', '', 'U') if manifest else np.array([], 'U1') })
+    return fits.BinTableHDU(table, name='MANIFEST')
+
+
+def stack_layout (stamps):
+    """
+    Return a (stamps, shape, dtype) triple for stacking the given (position, cutout HDU)
+    pairs into a single array: a list of the pairs, the smallest shape holding any of their
+    cutouts, and a floating point data type, of the native byte order, holding any of their
+    values, so that smaller (e.g., trimmed) cutouts are padded with NaN. A cutout with a
+    different number of dimensions than the first cutout is replaced by an error.
+    """
+    stamps = list(stamps)
+    arrays = [ hdu.data for (pos, hdu) in stamps if (hdu is not None) ]
+    ndim = arrays[0].ndim if arrays else 2
+    shape = (0,) * ndim
+    dtype = np.dtype(np.float32)
+    for (pos, hdu) in stamps:
+        if ((hdu is not None) and (hdu.data.ndim != ndim)):
+            pos['error'] = f"The cutout has {hdu.data.ndim} dimensions, unlike the {ndim} dimensions of the other cutouts"
+        elif (hdu is not None):
+            shape = tuple(max(size, dim) for (size, dim) in zip(shape, hdu.data.shape))
+            dtype = np.result_type(dtype, hdu.data.dtype)
+    stamps = [ (pos, None if ('error' in pos) else hdu) for (pos, hdu) in stamps ]
+    return (stamps, shape, dtype.newbyteorder('='))
+
+
+def stack_plane (hdu, shape, dtype):
+    """
+    Return the plane, of the given shape and data type, of a stack of cutouts for the given
+    cutout HDU: its data, padded with NaN after its last rows and columns, or only NaN if
+    there is no cutout.
+    """
+    if ((hdu is not None) and (hdu.data.shape == shape)):
+        return array_data(hdu).astype(dtype, copy=False)
+    plane = np.full(shape, np.nan, dtype=dtype)
+    if (hdu is not None):
+        plane[tuple(slice(0, dim) for dim in hdu.data.shape)] = array_data(hdu)
+    return plane
+
+
+def stamp_name (pos):
+    """ Return the archive member name for the cutout at the given position. """
+    return f"cutout_{pos['row']:06d}.fits"
+
+
+def write_archive (stamps, fmt, units=None):
+    """
+    Write the given (position, cutout HDU) pairs to a new archive of the given format and
+    return the archive as a file object positioned at its start. Positions without a cutout
+    (i.e., with errors) are listed, with their errors, in the archive manifest.
+    :param units: the units of the position sizes, recorded in the manifest.
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    if (fmt == 'fits'):
+        write_mef(stamps, out, units=units)
+    elif (fmt == 'npy'):
+        write_npz(stamps, out, units=units)
+    elif (fmt == 'arrow'):
+        write_arrow_stack(stamps, out, units=units)
+    elif (fmt == 'tar'):
+        write_tar(stamps, out, units=units)
+    else:
+        write_zip(stamps, out, units=units)
+    out.seek(0)
+    return out
+
+
+def write_arrow_stack (stamps, out, units=None):
+    """
+    Write the given (position, cutout HDU) pairs to the given file object as an Arrow IPC
+    file holding a table with a row for each position: the manifest entry of the position
+    (see array_manifest_entry), with its WCS and shape as JSON, and its cutout as a plane of
+    a fixed shape tensor column ('cutout'), stacked as for an npy batch (see write_npz). The
+    units of the sizes are given in the schema metadata ('units').
+    """
+    (stamps, shape, dtype) = stack_layout(stamps)
+    stack = np.empty((len(stamps),) + shape, dtype=dtype)
+    manifest = []
+    for (index, (pos, hdu)) in enumerate(stamps):
+        stack[index] = stack_plane(hdu, shape, dtype)
+        manifest.append(array_manifest_entry(pos, hdu))
+
+    columns = { key: [ entry.get(key) for entry in manifest ]
+                for key in MANIFEST_KEYS + [ 'shape' ] }
+    columns['wcs'] = [ json.dumps(entry['wcs']) if ('wcs' in entry) else None for entry in manifest ]
+    columns[TENSOR_COLUMN] = stack
+    table = encode_arrow(columns, metadata={ 'units': str(units) if units else None })
+    write_arrow(table, out)
+
+
+def write_mef (stamps, out, units=None):
+    """
+    Write the given (position, cutout HDU) pairs to the given file object as a multi-extension
+    FITS file: an empty primary HDU, an image extension for each cutout (named by its row),
+    and a final binary table extension ('MANIFEST') listing all the positions and errors.
+    """
+    hdus = fits.HDUList([ fits.PrimaryHDU() ])
+    manifest = []
+    for (pos, hdu) in stamps:
+        name = None
+        if (hdu is not None):
+            name = f"CUTOUT_{pos['row']}"
+            ext = fits.ImageHDU(data=hdu.data, header=hdu.header, name=name)
+            ext.header['CO_ROW'] = (pos['row'], 'Row of the cutout position in the request')
+            hdus.append(ext)
+        manifest.append(manifest_entry(pos, name))
+
+    hdus[0].header['CO_UNITS'] = (str(units) if units else '', 'Units of the cutout sizes')
+    hdus[0].header['CO_COUNT'] = (len(hdus) - 1, 'Number of cutout extensions')
+    hdus.append(manifest_table_hdu(manifest))
+    buf = io.BytesIO()                      # astropy cannot write to a spooled temporary file
+    hdus.writeto(buf)
+    out.write(buf.getbuffer())
+
+
+def write_npz (stamps, out, units=None):
+    """
+    Write the given (position, cutout HDU) pairs to the given file object as an uncompressed
+    NumPy .npz archive, which numpy.load reads, holding the cutouts stacked into a single
+    (N, H, W) array ('cutouts.npy'), one plane per position, in order, and a manifest giving
+    the WCS and shape of each cutout (see array_manifest_entry). Smaller cutouts are padded
+    with NaN, as are the planes of the positions with errors (see stack_layout). The stack
+    is written plane by plane, without first being assembled in memory.
+    """
+    (stamps, shape, dtype) = stack_layout(stamps)
+    header = { 'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+               'shape': (len(stamps),) + shape }
+    manifest = []
+    with zipfile.ZipFile(out, mode='w', compression=zipfile.ZIP_STORED) as zfile:
+        with zfile.open(STACK_NAME, mode='w', force_zip64=True) as member:
+            np.lib.format.write_array_header_1_0(member, header)
+            for (pos, hdu) in stamps:
+                member.write(np.ascontiguousarray(stack_plane(hdu, shape, dtype)).data)
+                manifest.append(array_manifest_entry(pos, hdu))
+        zfile.writestr(MANIFEST_NAME, manifest_bytes(manifest, units))
+
+
+def write_tar (stamps, out, units=None):
+    """ Write the given (position, cutout HDU) pairs, and a manifest, to the given file as a tar archive. """
+    now = time.time()
+    manifest = []
+    with tarfile.open(fileobj=out, mode='w') as tar:
+        for (pos, hdu) in stamps:
+            name = None
+            if (hdu is not None):
+                name = stamp_name(pos)
+                _add_tar_member(tar, name, hdu_bytes(hdu), now)
+            manifest.append(manifest_entry(pos, name))
+        _add_tar_member(tar, MANIFEST_NAME, manifest_bytes(manifest, units), now)
+
+
+def write_zip (stamps, out, units=None):
+    """ Write the given (position, cutout HDU) pairs, and a manifest, to the given file as a zip archive. """
+    manifest = []
+    with zipfile.ZipFile(out, mode='w', compression=zipfile.ZIP_DEFLATED) as zfile:
+        for (pos, hdu) in stamps:
+            name = None
+            if (hdu is not None):
+                name = stamp_name(pos)
+                zfile.writestr(name, hdu_bytes(hdu))
+            manifest.append(manifest_entry(pos, name))
+        zfile.writestr(MANIFEST_NAME, manifest_bytes(manifest, units))
+
+
+def _add_tar_member (tar, name, data, mtime):
+    """ Add a member with the given name, contents, and modification time to the given tar archive. """
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    tar.addfile(info, io.BytesIO(data))
@@ -2,14 +2,120 @@
 # Utilities for argument parsing and validataion.
 #
 #   Written by: Tom Hicks. 12/28/2020.
-#   Last Modified: Allow ObsCore RA & DEC arguments.
+#   Last Modified: Check the coordinate frame argument.
 #
-from flask import current_app
+import math
+import re
+
+from flask import current_app, request
 
 from astropy import units as u
 from astropy.coordinates import SkyCoord
 
+from config.settings import MAX_BATCH_IDS, CO_BIN_MAX_FACTOR, CO_COMPRESSION_QUANTIZE_LEVEL
+from config.settings import CO_MAX_EXTENSIONS
+from config.settings import PREVIEW_MAX_DIM, PREVIEW_MAX_DIM_LIMIT, PREVIEW_PERCENT_INTERVAL
 from cuts.blueprints.img import exceptions
+from cuts.blueprints.img.array_utils import ARRAY_EXTENSIONS
+from cuts.blueprints.img.packing_utils import OUTPUT_DTYPES
+from cuts.blueprints.img.preview_utils import PREVIEW_STRETCHES
+
+
+# Formats for batches of cutouts: zip or tar archives, a multi-extension FITS file, or stacked raw arrays
+ARCHIVE_FORMATS = [ 'zip', 'tar', 'fits', 'npy', 'arrow' ]
+
+# Raw array formats of cutouts, by 'format' argument value (see array_utils)
+ARRAY_FORMATS = list(ARRAY_EXTENSIONS)
+
+# Tile compression types of cutouts: astropy compression types by 'compression' argument value
+COMPRESSION_TYPES = { 'rice': 'RICE_1', 'rice_1': 'RICE_1', 'gzip2': 'GZIP_2', 'gzip_2': 'GZIP_2' }
+
+# Argument values which request uncompressed cutouts
+COMPRESSION_NONE_VALUES = [ 'none', 'false', 'no', '0' ]
+
+# Argument values which request the data type of the image (no conversion) for cutouts
+DTYPE_NATIVE_VALUES = [ 'native', 'none' ]
+
+# Pattern of the image extension names (EXTNAME values) of the extensions argument
+EXTENSION_NAME_PATTERN = re.compile(r'^[A-Za-z][A-Za-z0-9_\-]*$')
+
+# Preview image formats of cutouts, by 'format' argument value ('fits' requests no preview)
+PREVIEW_FORMATS = { 'png': 'png', 'jpeg': 'jpeg', 'jpg': 'jpeg' }
+
+# Formats for streamed results: JSON array or newline-delimited JSON
+STREAM_FORMATS = [ 'json', 'ndjson' ]
+
+# Argument values which request streaming in the default (JSON array) format
+STREAM_TRUE_VALUES = [ 'true', 'yes', '1' ]
+
+
+def parse_after_id_arg (args):
+    """
+    Parse out the optional keyset paging cursor argument (the ID of the last record of the
+    previous page), returning the ID or None, if no after_id argument is given.
+    :raises: RequestException if the after_id argument is not a non-negative integer.
+    """
+    return _parse_int_arg(args, 'after_id', 0, "A paging cursor ('after_id') must be an integer >= 0")
+
+
+def parse_archive_format_arg (args, default='zip'):
+    """
+    Parse out the format argument for a batch of cutouts, returning one of the archive
+    formats ('zip', 'tar', or 'fits') or raw array formats ('npy' or 'arrow'), or the given
+    default, if no format is specified.
+    :raises: RequestException if the format argument names an unsupported format.
+    """
+    fmt = args.get('format')
+    if ((fmt is None) or (not str(fmt).strip())):  # if no format or empty format argument
+        return default
+
+    fmt = str(fmt).strip().lower()
+    if (fmt in ARCHIVE_FORMATS):
+        return fmt
+
+    errMsg = f"The 'format' argument must be one of: {', '.join(ARCHIVE_FORMATS)}"
+    current_app.logger.error(errMsg)
+    raise exceptions.RequestException(errMsg)
+
+
+def parse_array_format_arg (args):
+    """
+    Parse out the optional format argument of a cutout, returning the raw array format it
+    names ('npy' or 'arrow') or None, if it names no array format (e.g., 'fits' or a preview
+    format, see parse_preview_args, which rejects unsupported formats).
+    """
+    fmt = str(args.get('format') or '').strip().lower()
+    return fmt if (fmt in ARRAY_FORMATS) else None
+
+
+def parse_binning_args (args):
+    """
+    Parse out the optional binning arguments of a cutout or image: either a binning factor
+    ('bin': the number of pixels on a side of the blocks averaged into each binned pixel) or
+    the maximum number of pixels along each side of the binned result ('maxPixels'). Return
+    None if no binning is requested (or a factor of 1) or else a dictionary with either a
+    'factor' or a 'max_pixels' value.
+    :raises: RequestException if both arguments are given or either is not valid.
+    """
+    errMsg = f"The 'bin' argument must be an integer between 1 and {CO_BIN_MAX_FACTOR}"
+    factor = _parse_int_arg(args, 'bin', 1, errMsg)
+    if ((factor is not None) and (factor > CO_BIN_MAX_FACTOR)):
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+
+    errMsg = "The 'maxPixels' argument must be a positive integer"
+    max_pixels = _parse_int_arg(args, 'maxPixels', 1, errMsg)
+
+    if ((factor is not None) and (max_pixels is not None)):
+        errMsg = "Only one of the 'bin' and 'maxPixels' arguments may be specified"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+
+    if (max_pixels is not None):
+        return { 'max_pixels': max_pixels }
+    if ((factor is not None) and (factor > 1)):
+        return { 'factor': factor }
+    return None
 
 
 def parse_collection_arg (args, required=False):
@@ -29,6 +135,43 @@ def parse_collection_arg (args, required=False):
     return coll.strip()
 
 
+def parse_compression_args (args):
+    """
+    Parse out the optional tile compression ('compression') and quantization level ('quantize')
+    arguments, returning None if no compression is requested or a dictionary containing the
+    astropy compression type ('compression_type') and the floating-point quantization level
+    ('quantize_level'). A quantization level of 0 (lossless) is allowed only for GZIP_2.
+    :raises: RequestException if the compression type is not supported or the quantization
+             level is not a finite number.
+    """
+    comp = args.get('compression')
+    if ((comp is None) or (not str(comp).strip())):  # if no compression or empty argument
+        return None
+
+    comp = str(comp).strip().lower()
+    if (comp in COMPRESSION_NONE_VALUES):
+        return None
+    if (comp not in COMPRESSION_TYPES):
+        errMsg = "The 'compression' argument must be one of: rice, gzip2, none"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+    compression_type = COMPRESSION_TYPES[comp]
+
+    level = args.get('quantize')
+    if ((level is None) or (not str(level).strip())):
+        return { 'compression_type': compression_type,
+                 'quantize_level': float(CO_COMPRESSION_QUANTIZE_LEVEL) }
+    try:
+        level = float(level)
+    except ValueError:
+        level = math.nan
+    if ((not math.isfinite(level)) or ((level == 0) and (compression_type != 'GZIP_2'))):
+        errMsg = "The 'quantize' argument must be a non-zero number (or 0, for lossless gzip2 compression)"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+    return { 'compression_type': compression_type, 'quantize_level': level }
+
+
 def parse_coordinate_args (args):
     """ Parse, convert, and check the given coordinate arguments, returning a dictionary
         of coordinate arguments. """
@@ -62,7 +205,7 @@ def parse_coordinate_args (args):
         current_app.logger.error(errMsg)
         raise exceptions.RequestException(errMsg)
 
-    frame = args.get('frame', 'icrs')       # get optional coordinate reference system
+    frame = parse_frame_arg(args)           # get optional coordinate reference system
 
     co_args['center'] = SkyCoord(ra=ra*u.degree, dec=dec*u.degree, frame=frame)
 
@@ -117,6 +260,63 @@ def parse_cutout_size (args, required=False):
     return co_args                          # return parsed, converted cutout arguments
 
 
+def parse_dtype_arg (args):
+    """
+    Parse out the optional output data type argument ('dtype': float32 or int16) of a cutout.
+    Return None if no conversion is requested (no data type or 'native') or else the name
+    of the output data type.
+    :raises: RequestException if the data type is not supported.
+    """
+    dtype = args.get('dtype')
+    if ((dtype is None) or (not str(dtype).strip()) or
+        (str(dtype).strip().lower() in DTYPE_NATIVE_VALUES)):
+        return None
+
+    dtype = str(dtype).strip().lower()
+    if (dtype not in OUTPUT_DTYPES):
+        errMsg = f"The 'dtype' argument must be one of: native, {', '.join(OUTPUT_DTYPES)}"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+    return dtype
+
+
+def parse_extension_arg (args):
+    """
+    Parse out the optional image extensions argument ('ext') of a cutout: a comma-separated
+    list of the names (e.g., 'SCI,ERR,DQ') or indices of the FITS extensions to cut. Return
+    None if no extension (or only the primary HDU) is requested, or else a list of upper case
+    extension names and integer indices, without duplicates.
+    :raises: RequestException if an extension is not valid or too many are given.
+    """
+    ext = args.get('ext')
+    if ((ext is None) or (not str(ext).strip())):
+        return None
+
+    extensions = []
+    for spec in str(ext).split(','):
+        spec = spec.strip()
+        if (not spec):
+            continue
+        if (spec.isdigit()):
+            spec = int(spec)
+        elif (EXTENSION_NAME_PATTERN.match(spec)):
+            spec = spec.upper()
+        else:
+            errMsg = "The 'ext' argument must list image extension names or non-negative indices"
+            current_app.logger.error(errMsg)
+            raise exceptions.RequestException(errMsg)
+        if (spec not in extensions):
+            extensions.append(spec)
+
+    if (len(extensions) > CO_MAX_EXTENSIONS):
+        errMsg = f"At most {CO_MAX_EXTENSIONS} image extensions may be specified by the 'ext' argument"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+    if ((not extensions) or (extensions in ([0], ['PRIMARY']))):
+        return None
+    return extensions
+
+
 def parse_filter_arg (args, required=False):
     """
     Parse out the filter argument, returning the filter name string or None.
@@ -133,6 +333,21 @@ def parse_filter_arg (args, required=False):
     return filt.strip()
 
 
+def parse_frame_arg (args):
+    """
+    Parse out the optional coordinate frame argument, returning the name of a celestial frame
+    whose coordinates are given as RA and DEC (e.g., 'icrs' or 'fk5'), by default 'icrs'.
+    """
+    frame = str(args.get('frame') or 'icrs').strip().lower()
+    try:
+        SkyCoord(ra=0*u.degree, dec=0*u.degree, frame=frame)  # the frame must take RA and DEC
+    except (ValueError, TypeError):
+        errMsg = f"The coordinate frame '{frame}' is not a known frame of RA and DEC coordinates"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+    return frame
+
+
 def parse_id_arg (args, required=True):
     """
     Parse out the unique ID argument, returning the ID or None, if no ID
@@ -156,6 +371,53 @@ def parse_id_arg (args, required=True):
         raise exceptions.RequestException(errMsg)
 
 
+def parse_ids_arg (args, max_ids=MAX_BATCH_IDS):
+    """
+    Parse out a list of unique IDs, given either by an 'ids' argument or by an 'id'
+    argument which contains a list or a comma-separated string of IDs. Returns the list
+    of IDs, in the order given with duplicates removed, or None, if no list of IDs was given.
+    :raises: RequestException if any ID is not a positive integer or if too many are given.
+    """
+    uids = args.get('ids')
+    if (uids is None):
+        uid = args.get('id')
+        if (isinstance(uid, (list, tuple)) or (isinstance(uid, str) and (',' in uid))):
+            uids = uid
+        else:
+            return None                     # not a list: a single ID request
+
+    if (isinstance(uids, str)):
+        uids = [ uid for uid in uids.split(',') if uid.strip() ]
+    if (not isinstance(uids, (list, tuple))):
+        uids = [ uids ]
+
+    nums = []
+    for uid in uids:
+        num = 0
+        if (not isinstance(uid, (bool, float))):  # do not truncate JSON numbers
+            try:
+                num = int(uid)
+            except (TypeError, ValueError):
+                pass                        # drop through to error
+        if (num <= 0):
+            errMsg = f"Record IDs must be positive integers: '{uid}' is not valid"
+            current_app.logger.error(errMsg)
+            raise exceptions.RequestException(errMsg)
+        nums.append(num)
+
+    nums = list(dict.fromkeys(nums))        # remove duplicates, preserving order
+    if (not nums):
+        errMsg = "A list of record IDs must be specified, via the 'ids' argument"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+    if (len(nums) > max_ids):
+        errMsg = f"Too many record IDs specified: the maximum is {max_ids}"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+
+    return nums
+
+
 def parse_ipath_arg (args, required=False):
     """
     Parse out the image path argument, returning the image path string or None.
@@ -170,3 +432,175 @@ def parse_ipath_arg (args, required=False):
         else:
             return None
     return ipath.strip()
+
+
+def parse_limit_arg (args):
+    """
+    Parse out the optional limit argument (the maximum number of records to return),
+    returning the limit or None, if no limit argument is given.
+    :raises: RequestException if the limit argument is not a positive integer.
+    """
+    return _parse_int_arg(args, 'limit', 1, "A result 'limit' must be an integer > 0")
+
+
+def parse_paging_args (args):
+    """
+    Parse out the optional keyset paging arguments, returning a dictionary containing
+    values (possibly None) for the 'after_id' and 'limit' keys.
+    """
+    return { 'after_id': parse_after_id_arg(args), 'limit': parse_limit_arg(args) }
+
+
+def parse_plane_args (args):
+    """
+    Parse out the optional arguments selecting the planes of the cutout of a data cube: either
+    a range of (0-based) plane indices ('planeMin' and 'planeMax', inclusive) or a range of
+    values of the world coordinate of the cube's third, spectral or time, axis ('zMin' and
+    'zMax', in the SI units of that axis: e.g., m, Hz, or s). Either end of a range may be
+    omitted. Return None if no planes are selected, or else a dictionary with either a
+    'planes' or a 'world' (minimum, maximum) pair.
+    :raises: RequestException if both kinds of range are given or any bound is not valid.
+    """
+    errMsg = "The 'planeMin' and 'planeMax' arguments must be non-negative integers, with planeMin <= planeMax"
+    plane_min = _parse_int_arg(args, 'planeMin', 0, errMsg)
+    plane_max = _parse_int_arg(args, 'planeMax', 0, errMsg)
+    if ((plane_min is not None) and (plane_max is not None) and (plane_min > plane_max)):
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+
+    try:
+        z_min = float(args['zMin']) if (str(args.get('zMin') or '').strip()) else None
+        z_max = float(args['zMax']) if (str(args.get('zMax') or '').strip()) else None
+    except ValueError:
+        z_min = z_max = math.nan
+    if (any(((bound is not None) and (not math.isfinite(bound))) for bound in (z_min, z_max)) or
+        ((z_min is not None) and (z_max is not None) and (z_min > z_max))):
+        errMsg = "The 'zMin' and 'zMax' arguments must be numbers, with zMin <= zMax"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+
+    has_planes = ((plane_min is not None) or (plane_max is not None))
+    has_world = ((z_min is not None) or (z_max is not None))
+    if (has_planes and has_world):
+        errMsg = "Only one of the plane ('planeMin', 'planeMax') and world ('zMin', 'zMax') ranges may be specified"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+    if (has_planes):
+        return { 'planes': (plane_min, plane_max) }
+    if (has_world):
+        return { 'world': (z_min, z_max) }
+    return None
+
+
+def parse_preview_args (args):
+    """
+    Parse out the optional preview image arguments: the image format ('format': png or jpeg),
+    the intensity stretch ('stretch': linear, log, asinh, or zscale), the percentile clipping
+    interval ('minPercent' and 'maxPercent'), and the maximum image dimension ('maxDim').
+    Return None if no preview is requested (no format, 'fits', or a raw array format, see
+    parse_array_format_arg) or else a dictionary of preview arguments ('format', 'stretch',
+    'min_percent', 'max_percent', and 'max_dim').
+    :raises: RequestException if any of the preview arguments is not valid.
+    """
+    fmt = str(args.get('format') or '').strip().lower()
+    if ((not fmt) or (fmt == 'fits') or (fmt in ARRAY_FORMATS)):
+        return None
+
+    fmt = PREVIEW_FORMATS.get(fmt)
+    if (fmt is None):
+        errMsg = f"The 'format' argument must be one of: fits, png, jpeg, {', '.join(ARRAY_FORMATS)}"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+
+    stretch = str(args.get('stretch') or 'linear').strip().lower()
+    if (stretch not in PREVIEW_STRETCHES):
+        errMsg = f"The 'stretch' argument must be one of: {', '.join(PREVIEW_STRETCHES)}"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+
+    try:
+        min_percent = float(args.get('minPercent') or PREVIEW_PERCENT_INTERVAL[0])
+        max_percent = float(args.get('maxPercent') or PREVIEW_PERCENT_INTERVAL[1])
+    except ValueError:
+        min_percent = max_percent = math.nan
+    if (not (0.0 <= min_percent < max_percent <= 100.0)):
+        errMsg = "The 'minPercent' and 'maxPercent' arguments must be percentiles, with minPercent < maxPercent"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+
+    errMsg = f"The 'maxDim' argument must be an integer between 1 and {PREVIEW_MAX_DIM_LIMIT}"
+    max_dim = _parse_int_arg(args, 'maxDim', 1, errMsg)
+    if (max_dim is None):
+        max_dim = PREVIEW_MAX_DIM
+    elif (max_dim > PREVIEW_MAX_DIM_LIMIT):
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+
+    return { 'format': fmt, 'stretch': stretch, 'min_percent': min_percent,
+             'max_percent': max_percent, 'max_dim': max_dim }
+
+
+def parse_stream_arg (args):
+    """
+    Parse out the stream argument, returning the requested stream format ('json' for a
+    JSON array or 'ndjson' for newline-delimited JSON) or None, if streaming was not requested.
+    :raises: RequestException if the stream argument names an unsupported format.
+    """
+    stream = args.get('stream')
+    if ((stream is None) or (not stream.strip())):  # if no stream or empty stream argument
+        return None
+
+    fmt = stream.strip().lower()
+    if (fmt in STREAM_TRUE_VALUES):
+        return 'json'
+    if (fmt in STREAM_FORMATS):
+        return fmt
+
+    errMsg = f"The 'stream' argument must be one of: {', '.join(STREAM_FORMATS)}"
+    current_app.logger.error(errMsg)
+    raise exceptions.RequestException(errMsg)
+
+
+def request_args (req=None):
+    """
+    Return a dictionary of the arguments of the given (or current) request: the URL query
+    arguments, updated by the fields of a JSON object or form posted in the request body.
+    A posted JSON list is returned as the value of an 'ids' argument.
+    :raises: RequestException if the request body contains malformed JSON.
+    """
+    req = req or request
+    args = req.args.to_dict()
+    if (req.is_json):
+        body = req.get_json(silent=True)
+        if (body is None):
+            errMsg = "The request body does not contain valid JSON"
+            current_app.logger.error(errMsg)
+            raise exceptions.RequestException(errMsg)
+        if (isinstance(body, dict)):
+            args.update(body)
+        elif (isinstance(body, list)):
+            args['ids'] = body
+    elif (req.form):
+        args.update(req.form.to_dict())
+    return args
+
+
+def _parse_int_arg (args, arg_name, minimum, errMsg):
+    """
+    Parse out the named optional integer argument, returning the integer or None, if the
+    argument is not given or is empty.
+    :raises: RequestException, with the given message, if the argument is not an integer
+             greater than or equal to the given minimum.
+    """
+    val = args.get(arg_name)
+    if ((val is None) or (not str(val).strip())):
+        return None
+    try:
+        num = int(val)
+        if (num >= minimum):
+            return num
+    except ValueError:
+        pass                                # drop through to error
+
+    current_app.logger.error(errMsg)
+    raise exceptions.RequestException(errMsg)
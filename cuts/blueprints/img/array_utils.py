@@ -0,0 +1,79 @@
+#
+# Methods to write the data of cutouts as raw arrays, without FITS headers or block padding:
+# NumPy (.npy) files or Apache Arrow IPC files holding tensors, with the WCS as JSON metadata.
+#   Last Modified: Import the required pyarrow package at the module level.
+#
+import json
+
+import numpy as np
+import pyarrow as pa
+
+from astropy.wcs import WCS
+
+from cuts.blueprints.img.packing_utils import unscaled_blanks
+
+
+# MIME types of the raw array formats of cutouts
+ARRAY_MIME_TYPES = { 'npy': 'application/x-npy', 'arrow': 'application/vnd.apache.arrow.file' }
+
+# Filename extensions of the raw array formats of cutouts
+ARRAY_EXTENSIONS = { 'npy': '.npy', 'arrow': '.arrow' }
+
+# Name of the response header, and of the Arrow schema metadata key, holding the WCS of a cutout
+WCS_HEADER_NAME = 'X-Cutout-WCS'
+WCS_METADATA_KEY = 'wcs'
+
+# Name of the Arrow column holding the data of a cutout
+TENSOR_COLUMN = 'cutout'
+
+
+def array_data (hdu):
+    """
+    Return the data of the given image HDU as an array of the native byte order (FITS data
+    is big-endian), with its blank pixels as NaN (see unscaled_blanks). Data which is already
+    of the native byte order is returned without a copy.
+    """
+    data = np.asarray(unscaled_blanks(hdu))
+    return data.astype(data.dtype.newbyteorder('='), copy=False)
+
+
+def encode_arrow (columns, metadata=None):
+    """
+    Return an Arrow table with the given columns, a dictionary of column names and either
+    lists of values or stacked arrays of tensors, each stored as a fixed shape tensor column
+    whose rows are the tensors of the stack, without copying the data. The given metadata
+    dictionary, if any, is stored, as JSON, in the schema metadata.
+    """
+    arrays = {}
+    for (name, values) in columns.items():
+        if (isinstance(values, np.ndarray)):   # canonical strides: a length 1 axis may have stride 0
+            stack = np.ascontiguousarray(values).reshape(-1).reshape(values.shape)
+            arrays[name] = pa.FixedShapeTensorArray.from_numpy_ndarray(stack)
+        else:
+            arrays[name] = pa.array(values)
+    schema_metadata = { key: json.dumps(val) for (key, val) in (metadata or {}).items() }
+    return pa.table(arrays, metadata=schema_metadata)
+
+
+def wcs_metadata (header):
+    """
+    Return a dictionary of the WCS keywords and values of the given image header, for the
+    JSON metadata of a raw array, from which a client can rebuild the WCS (e.g., WCS(dict)).
+    """
+    wcs_header = WCS(header).to_header(relax=True)
+    return { key: wcs_header[key] for key in wcs_header }
+
+
+def write_arrow (table, out):
+    """ Write the given Arrow table to the given binary file object as an Arrow IPC file. """
+    with pa.ipc.new_file(out, table.schema) as writer:
+        writer.write_table(table)
+
+
+def write_npy (data, out):
+    """
+    Write the given array to the given binary file object in the NumPy (.npy) format: a short
+    header giving its data type and shape, followed by its raw bytes, written straight from
+    the array's buffer when it is contiguous.
+    """
+    np.lib.format.write_array(out, np.asanyarray(data), allow_pickle=False)
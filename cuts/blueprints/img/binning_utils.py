@@ -0,0 +1,123 @@
+#
+# Methods to bin (block average) image data and to adjust the WCS of binned images.
+#   Last Modified: Read the bands of binned images through their sections and mask blanks per band.
+#
+import math
+import re
+
+import numpy as np
+
+from astropy.io import fits
+
+
+# Header keys of the (primary and alternate) WCS which are rescaled when an image is binned
+CRPIX_KEY_PATTERN = re.compile(r'^CRPIX[12][A-Z]?$')
+SCALE_KEY_PATTERN = re.compile(r'^(CD[12]_[12]|CDELT[12])[A-Z]?$')
+SIP_KEY_PATTERN = re.compile(r'^(A|B|AP|BP)_([0-9])_([0-9])$')
+
+# Header keys of a Digitized Sky Survey plate solution which are rescaled when an image is binned
+DSS_CORNER_KEY_PATTERN = re.compile(r'^CNPIX[12]$')
+DSS_PIXEL_SIZE_KEY_PATTERN = re.compile(r'^[XY]PIXELSZ$')
+
+# Number of unbinned pixels read and averaged at a time, so that binning a large (memory mapped)
+# image does not read the whole image into memory at once
+BLOCK_CHUNK_PIXELS = 16 * 1024 * 1024
+
+# Header keys which do not apply to the (floating point) data of a binned image
+UNBINNED_KEYS = [ 'BSCALE', 'BZERO', 'BLANK', 'CHECKSUM', 'DATASUM', 'DATAMIN', 'DATAMAX' ]
+
+
+def bin_factor (shape, binning):
+    """
+    Return the binning factor for image data of the given shape, given the binning arguments
+    (see parse_binning_args): either the given 'factor' or the smallest factor which reduces
+    the larger image dimension to at most 'max_pixels' pixels.
+    """
+    if (binning.get('factor')):
+        return binning['factor']
+    return max(1, math.ceil(max(shape[-2:]) / binning['max_pixels']))
+
+
+def bin_hdu (hdu, factor):
+    """
+    Return a new primary HDU containing the data of the given 2D image HDU block averaged
+    by the given factor (see block_average) and a copy of its header with the WCS adjusted
+    to match (see bin_header). The data of an HDU read from a file is read in bands, through
+    the HDU's section (which also scales the data and blanks its BLANK pixels), so that the
+    data of a large image is never loaded whole.
+    """
+    data = hdu.section if (hdu.fileinfo() is not None) else hdu.data
+    binned = block_average(data, factor, blank=hdu.header.get('BLANK'))
+    return fits.PrimaryHDU(data=binned, header=bin_header(hdu.header, factor))
+
+
+def bin_header (header, factor):
+    """
+    Return a copy of the given image header with its WCS adjusted for the image binned by
+    the given factor: the reference pixels (CRPIXn) are moved to the binned pixel grid, the
+    pixel scales (CDi_j or CDELTn) and any SIP distortion coefficients are multiplied by the
+    factor (as are the pixel sizes of a DSS plate solution, whose scan corner is divided by
+    it), and the data scaling keys, which do not apply to the binned data, are removed.
+    """
+    header = header.copy()
+    for key in UNBINNED_KEYS:
+        header.remove(key, ignore_missing=True)
+    if (factor <= 1):
+        return header
+
+    has_cd = any(key.startswith('CD1_') or key.startswith('CD2_') for key in header.keys())
+    for key in list(header.keys()):
+        value = header[key]
+        if (not isinstance(value, (int, float))):
+            continue
+        if (CRPIX_KEY_PATTERN.match(key)):
+            header[key] = (value - 0.5) / factor + 0.5
+        elif (SCALE_KEY_PATTERN.match(key) or DSS_PIXEL_SIZE_KEY_PATTERN.match(key)):
+            header[key] = value * factor
+        elif (DSS_CORNER_KEY_PATTERN.match(key)):
+            header[key] = value / factor
+        else:
+            sip = SIP_KEY_PATTERN.match(key)
+            if (sip):
+                power = int(sip.group(2)) + int(sip.group(3))
+                header[key] = value * (factor ** (power - 1))
+
+    if (not has_cd):                        # default pixel scales of 1 must be set
+        for axis in (1, 2):
+            if (f"CDELT{axis}" not in header):
+                header[f"CDELT{axis}"] = float(factor)
+    header['CO_BIN'] = (factor, 'Binning factor of the image pixels')
+    return header
+
+
+def block_average (data, factor, blank=None):
+    """
+    Return the given 2D image data (an array or an HDU's section) reduced by averaging square
+    blocks of the given number of pixels on a side. Rows and columns which do not fill a whole
+    block are trimmed, so that binned pixel i covers unbinned pixels i*factor to (i+1)*factor-1.
+    Blank (NaN) pixels, and integer pixels equal to the given BLANK value, if any, are ignored
+    when averaging: a block of only blank pixels is blank. The data is read, and its blank
+    pixels masked, in bands of rows, of at most about BLOCK_CHUNK_PIXELS pixels each.
+    """
+    dtype = np.float64 if (data.dtype.itemsize >= 8) else np.float32  # of any byte order
+    factor = max(1, factor)
+    ny = data.shape[0] // factor
+    nx = data.shape[1] // factor
+    binned = np.empty((ny, nx), dtype=dtype)
+    band_rows = max(1, BLOCK_CHUNK_PIXELS // max(1, data.shape[1] * factor))
+    for start in range(0, ny, band_rows):
+        stop = min(ny, start + band_rows)
+        band = np.asarray(data[start * factor:stop * factor])[:, :nx * factor]  # whole rows
+        blocks = band.astype(dtype, copy=False)  # a copy, if blanks are to be masked
+        if ((blank is not None) and np.issubdtype(band.dtype, np.integer)):
+            blocks[band == blank] = np.nan  # unscaled blank pixels
+        if (factor == 1):
+            binned[start:stop] = blocks
+            continue
+        blocks = blocks.reshape(stop - start, factor, nx, factor)
+        finite = np.isfinite(blocks)
+        counts = np.sum(finite, axis=(1, 3))
+        sums = np.sum(np.where(finite, blocks, 0), axis=(1, 3), dtype=dtype)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            binned[start:stop] = np.where(counts > 0, sums / counts, np.nan)
+    return binned
@@ -0,0 +1,102 @@
+#
+# Methods to cut data cubes (two celestial axes and a spectral or time axis) by reading only
+# the planes and pixels of a cutout, and to adjust the WCS of the cube to match.
+#   Last Modified: Initial creation.
+#
+import math
+
+import numpy as np
+
+from astropy.nddata import Cutout2D
+
+import cuts.blueprints.img.exceptions as exceptions
+
+
+# Fraction of a plane by which a world coordinate bound may miss the center of a plane and
+# still select it, so that a bound given at a plane's center selects that plane
+PLANE_TOLERANCE = 1.0e-6
+
+
+class CubeCutout ():
+    """
+    Record holding a cutout of a data cube, with the attributes of a two-dimensional cutout
+    (see Cutout2D) used to write it: its data, its WCS, and the slices (plane, row, and
+    column) of the cube from which it was read.
+    """
+    __slots__ = ('data', 'wcs', 'slices_original')
+
+    def __init__ (self, data, wcs, slices_original):
+        self.data = data
+        self.wcs = wcs
+        self.slices_original = slices_original
+
+
+def cut_cube (hdu, co_args, wcs, planes=None, co_mode='trim'):
+    """
+    Make and return a cutout (see CubeCutout) of the given data cube HDU, with the given WCS:
+    the box at the center and of the size given by the 'center' and 'co_size' cutout arguments,
+    in each of the planes selected by the given plane arguments (see plane_range), or in every
+    plane if none are given. Only those planes and pixels are read from the cube, through its
+    section, so that a cube need not fit in memory. The WCS of the cutout is the WCS of the
+    cube with its reference pixel moved along all three axes.
+    :raises: RequestException if the cube does not have two celestial axes followed by a
+        spectral or time axis or the plane range does not overlap the cube, or NoOverlapError
+        if the cutout box does not overlap the cube.
+    """
+    celestial = wcs.celestial
+    if ((wcs.naxis != 3) or (celestial.naxis != 2) or
+        (sorted((wcs.wcs.lng, wcs.wcs.lat)) != [0, 1])):
+        errMsg = "Only data cubes with two celestial axes followed by a spectral or time axis can be cut"
+        raise exceptions.RequestException(errMsg)
+
+    (nplanes, nrows, ncols) = hdu.shape
+    pixels = np.broadcast_to(np.float32(0), (nrows, ncols))  # locate the box without reading
+    box = Cutout2D(pixels, position=co_args['center'], size=co_args['co_size'],
+                   wcs=celestial, mode=co_mode)
+    (first, last) = plane_range(wcs, nplanes, planes)
+    slices = (slice(first, last + 1),) + tuple(box.slices_original)
+
+    cube_wcs = wcs.deepcopy()
+    cube_wcs.wcs.crpix[0] -= slices[2].start
+    cube_wcs.wcs.crpix[1] -= slices[1].start
+    cube_wcs.wcs.crpix[2] -= first
+    return CubeCutout(np.asarray(hdu.section[slices]), cube_wcs, slices)
+
+
+def plane_range (wcs, nplanes, planes=None):
+    """
+    Return the (first, last) pair of the indices of the planes of a cube, with the given WCS
+    and number of planes, selected by the given plane arguments (see parse_plane_args): every
+    plane if none are given, the planes between the given (0-based, inclusive) plane indices,
+    or the planes whose centers lie between the given values of the world coordinate of the
+    third (spectral or time) axis, in the (SI) units of its WCS (e.g., m, Hz, or s). Missing
+    bounds select the first or last plane.
+    :raises: RequestException if no plane of the cube is selected.
+    """
+    (first, last) = (0, nplanes - 1)
+    if (planes and planes.get('planes')):
+        (lo, hi) = planes['planes']
+        first = max(first, lo) if (lo is not None) else first
+        last = min(last, hi) if (hi is not None) else last
+    elif (planes and planes.get('world')):
+        axis = wcs.sub([3])
+        bounds = [ float(axis.world_to_pixel_values(value)) for value in planes['world']
+                   if (value is not None) ]
+        (lo, hi) = planes['world']
+        if (not all(np.isfinite(bounds))):
+            errMsg = "The requested range is outside of the range of the spectral or time axis of the cube"
+            raise exceptions.RequestException(errMsg)
+        if ((lo is not None) and (hi is not None)):
+            first = max(first, math.ceil(min(bounds) - PLANE_TOLERANCE))
+            last = min(last, math.floor(max(bounds) + PLANE_TOLERANCE))
+        else:                               # half open range: find its direction in pixels
+            ascending = (axis.pixel_to_world_values(1.0) >= axis.pixel_to_world_values(0.0))
+            if ((lo is not None) == ascending):
+                first = max(first, math.ceil(bounds[0] - PLANE_TOLERANCE))
+            else:
+                last = min(last, math.floor(bounds[0] + PLANE_TOLERANCE))
+
+    if (first > last):
+        errMsg = f"The requested planes do not overlap the {nplanes} planes of the cube"
+        raise exceptions.RequestException(errMsg)
+    return (first, last)
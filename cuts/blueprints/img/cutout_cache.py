@@ -0,0 +1,352 @@
+#
+# Class to manage the size of the cutouts cache directory, evicting least-recently-used cutouts.
+#   Last Modified: Keep an index file of the parameters of each cutout.
+#
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+import cuts.blueprints.img.exceptions as exceptions
+
+
+# Seconds between the periodic sweeps of the cache directory by the background sweeper
+DEFAULT_SWEEP_INTERVAL = 60
+
+# Maximum seconds to wait for another request (or process) to finish producing a cutout
+DEFAULT_LOCK_TIMEOUT = 60
+
+# Seconds between attempts to take a cutout lock file held by another process
+LOCK_POLL_INTERVAL = 0.05
+
+# Name of the hidden subdirectory, within the cache directory, holding the cutout lock files
+LOCK_DIR_NAME = '.locks'
+
+# Number of lock files, shared (by hashing) between all the cutouts of a cache directory
+LOCK_STRIPES = 64
+
+# Seconds after which an abandoned temporary cutout file (e.g., from a crash) is deleted by a sweep
+STALE_TEMP_AGE = 3600
+
+# Filename suffix of the hidden temporary files to which cutouts are written before renaming
+TEMP_SUFFIX = '.tmp'
+
+# Filename suffix of the hidden index files holding the (readable) parameters of each cutout
+INDEX_SUFFIX = '.json'
+
+
+class CutoutCache ():
+    """
+    Bounds the size of a cutouts cache directory by a maximum total number of bytes and a
+    maximum number of cutout files. When either limit is exceeded, the least recently used
+    cutout files are deleted. The use of a cutout is recorded by setting the access time of
+    its file, so the bookkeeping survives restarts and is shared between worker processes.
+
+    The limits are enforced by a sweep of the directory, run periodically (and when a new
+    cutout is added) by a background thread (a greenlet, under the Gunicorn gevent worker),
+    so that requests never wait for eviction. Hidden files (names beginning with '.'),
+    such as partially written cutouts and the index file describing each cutout, are
+    neither counted nor evicted separately.
+
+    Concurrent requests for the same cutout are coalesced: only one request (in any thread
+    or worker process) produces the cutout while the others wait for it (see 'producing').
+    """
+
+    def __init__ (self, cache_dir, max_bytes=None, max_entries=None,
+                  sweep_interval=DEFAULT_SWEEP_INTERVAL, lock_timeout=DEFAULT_LOCK_TIMEOUT):
+        """
+        Constructor for a cache manager of the given directory. A maximum of None (or zero)
+        means that the corresponding quantity is not limited.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self.lock_timeout = lock_timeout
+
+        self._pid = None                    # process in which the sweeper thread was started
+        self._stop = threading.Event()
+        self._wake = threading.Event()      # set to request an immediate sweep
+        self._sweep_lock = threading.Lock()
+        self._thread = None
+        self._last_sweep = dict()
+        self._key_locks = dict()            # cutout path => [thread lock, number of users]
+        self._key_locks_lock = threading.Lock()
+
+
+    def added (self, co_filepath):
+        """ Record the addition of the given cutout file and ask the sweeper to check quotas. """
+        self.touch(co_filepath)
+        if (self.is_limited()):
+            self.start_sweeper()
+            self._wake.set()
+
+
+    def entries (self):
+        """
+        Return a list of (access time, size, path) tuples for the cutout files in the
+        cache directory, or an empty list if the directory does not exist.
+        """
+        entries = []
+        try:
+            with os.scandir(self.cache_dir) as dir_entries:
+                for entry in dir_entries:
+                    if (entry.name.startswith('.')):
+                        continue
+                    try:
+                        if (entry.is_file(follow_symlinks=False)):
+                            stat = entry.stat(follow_symlinks=False)
+                            entries.append((stat.st_atime, stat.st_size, entry.path))
+                    except FileNotFoundError:
+                        pass                # removed while scanning
+        except FileNotFoundError:
+            pass
+        return entries
+
+
+    def index_path (self, co_filepath):
+        """ Return the path of the hidden index file describing the given cutout file. """
+        (co_dir, co_filename) = os.path.split(co_filepath)
+        return os.path.join(co_dir, f".{co_filename}{INDEX_SUFFIX}")
+
+
+    def is_limited (self):
+        """ Tell whether either the size or the number of the cached cutouts is limited. """
+        return bool(self.max_bytes or self.max_entries)
+
+
+    def is_running (self):
+        """ Tell whether the sweeper thread is running in the current process. """
+        return ((self._thread is not None) and (self._pid == os.getpid()) and
+                self._thread.is_alive())
+
+
+    @contextmanager
+    def producing (self, co_filepath):
+        """
+        Context manager which holds the exclusive right to produce the given cutout file,
+        waiting while another thread or worker process holds it. Within the context, the
+        caller should check whether the cutout was produced while it waited and, if not,
+        produce it. Threads of this process wait on a lock for the cutout, while processes
+        wait on a lock file shared by a subset of all cutouts.
+        :raises: ServerError if the right is not obtained within the lock timeout.
+        """
+        deadline = time.monotonic() + self.lock_timeout
+        key_lock = self._acquire_key_lock(co_filepath)
+        try:
+            if (not key_lock.acquire(timeout=self.lock_timeout)):
+                self._lock_timed_out(co_filepath)
+            try:
+                lock_fd = self._acquire_lock_file(co_filepath, deadline)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_fd, fcntl.LOCK_UN)
+                    os.close(lock_fd)
+            finally:
+                key_lock.release()
+        finally:
+            self._release_key_lock(co_filepath)
+
+
+    def read_index (self, co_filepath):
+        """
+        Return the dictionary of parameters recorded in the index file of the given
+        cutout file, or None if the cutout has no (readable) index file.
+        """
+        try:
+            with open(self.index_path(co_filepath)) as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError):
+            return None
+
+
+    def start_sweeper (self):
+        """
+        Start the sweeper thread, if it is not already running in this process.
+        A cache inherited by a forked child process restarts the sweeper in the child.
+        """
+        if (self.is_running() or (not self.is_limited())):
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='cutout-cache-sweeper')
+        self._thread.start()
+
+
+    def stats (self):
+        """ Return a dictionary describing the current contents and limits of the cache. """
+        entries = self.entries()
+        return {
+            'cache_dir': self.cache_dir,
+            'entries': len(entries),
+            'bytes': sum(entry[1] for entry in entries),
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'last_sweep': dict(self._last_sweep)
+        }
+
+
+    def stop_sweeper (self):
+        """ Ask the sweeper thread to stop. """
+        self._stop.set()
+        self._wake.set()
+
+
+    def sweep (self):
+        """
+        Delete the least recently used cutout files until the cache is within its limits.
+        Return a dictionary containing the number of files and bytes evicted.
+        """
+        evicted = { 'files': 0, 'bytes': 0 }
+        with self._sweep_lock:
+            entries = self.entries()
+            total_bytes = sum(entry[1] for entry in entries)
+            total_files = len(entries)
+            entries.sort()                  # least recently used first
+            for (atime, size, path) in entries:
+                if (not self._over_limits(total_bytes, total_files)):
+                    break
+                try:
+                    os.remove(path)
+                    evicted['files'] += 1
+                    evicted['bytes'] += size
+                except FileNotFoundError:
+                    pass                    # already removed by another process
+                self._remove_quietly(self.index_path(path))
+                total_bytes -= size
+                total_files -= 1
+            self._last_sweep = { 'time': time.time(), 'evicted_files': evicted['files'],
+                                 'evicted_bytes': evicted['bytes'] }
+            self._remove_stale_temps()
+        return evicted
+
+
+    def touch (self, co_filepath):
+        """
+        Record a use of the given cutout file by setting its access time to now (explicitly,
+        since file systems are often mounted to update access times lazily or never).
+        """
+        try:
+            stat = os.stat(co_filepath)
+            os.utime(co_filepath, ns=(time.time_ns(), stat.st_mtime_ns))
+        except OSError:
+            pass                            # evicted or not writable: nothing to record
+
+
+    def _acquire_key_lock (self, co_filepath):
+        """ Return the thread lock for the given cutout, registering this use of it. """
+        with self._key_locks_lock:
+            entry = self._key_locks.setdefault(co_filepath, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+
+    def _acquire_lock_file (self, co_filepath, deadline):
+        """
+        Open and exclusively lock the lock file for the given cutout, returning its file
+        descriptor. The lock is polled, rather than waited for, so that a waiting request
+        does not block the other greenlets of a gevent worker.
+        :raises: ServerError if the lock is not obtained before the given deadline.
+        """
+        lock_dir = os.path.join(os.path.dirname(co_filepath), LOCK_DIR_NAME)
+        os.makedirs(lock_dir, exist_ok=True)
+        stripe = zlib.crc32(os.path.basename(co_filepath).encode('utf-8')) % LOCK_STRIPES
+        lock_fd = os.open(os.path.join(lock_dir, f"{stripe:02d}.lock"), os.O_RDWR | os.O_CREAT, 0o666)
+        while True:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_fd
+            except BlockingIOError:
+                if (time.monotonic() >= deadline):
+                    os.close(lock_fd)
+                    self._lock_timed_out(co_filepath)
+                time.sleep(LOCK_POLL_INTERVAL)
+
+
+    def _lock_timed_out (self, co_filepath):
+        """ Raise a ServerError reporting a timeout waiting for the given cutout. """
+        errMsg = f"Timed out after {self.lock_timeout} seconds waiting for another request to produce the image cutout '{os.path.basename(co_filepath)}'"
+        raise exceptions.ServerError(errMsg)
+
+
+    def write_index (self, co_filepath, co_params):
+        """
+        Write the given dictionary of cutout parameters to the index file of the given cutout
+        file, first writing a temporary file which is then renamed.
+        """
+        index_path = self.index_path(co_filepath)
+        tmp_path = f"{index_path}.{os.getpid()}.{threading.get_ident()}{TEMP_SUFFIX}"
+        try:
+            with open(tmp_path, 'w') as index_file:
+                json.dump(co_params, index_file, sort_keys=True, indent=2)
+            os.replace(tmp_path, index_path)
+        except OSError:
+            self._remove_quietly(tmp_path)  # the index is informational: do not fail
+            return False
+        return True
+
+
+    def _over_limits (self, total_bytes, total_files):
+        """ Tell whether the given totals exceed either of the limits of this cache. """
+        return ((bool(self.max_bytes) and (total_bytes > self.max_bytes)) or
+                (bool(self.max_entries) and (total_files > self.max_entries)))
+
+
+    def _release_key_lock (self, co_filepath):
+        """ Unregister a use of the thread lock for the given cutout, discarding it when unused. """
+        with self._key_locks_lock:
+            entry = self._key_locks.get(co_filepath)
+            if (entry is not None):
+                entry[1] -= 1
+                if (entry[1] <= 0):
+                    del self._key_locks[co_filepath]
+
+
+    def _remove_quietly (self, path):
+        """ Remove the file at the given path, ignoring a file which does not exist. """
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+    def _remove_stale_temps (self):
+        """
+        Delete any hidden temporary files which have been abandoned by their writers, and any
+        index files whose cutout files no longer exist.
+        """
+        stale_time = time.time() - STALE_TEMP_AGE
+        try:
+            with os.scandir(self.cache_dir) as dir_entries:
+                for entry in dir_entries:
+                    if (not entry.name.startswith('.')):
+                        continue
+                    try:
+                        if (entry.name.endswith(TEMP_SUFFIX)):
+                            if (entry.stat(follow_symlinks=False).st_mtime < stale_time):
+                                os.remove(entry.path)
+                        elif (entry.name.endswith(INDEX_SUFFIX)):
+                            co_filename = entry.name[1:-len(INDEX_SUFFIX)]
+                            if (not os.path.exists(os.path.join(self.cache_dir, co_filename))):
+                                os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass                # renamed or removed while scanning
+        except FileNotFoundError:
+            pass
+
+
+    def _run (self):
+        """ Sweep the cache directory periodically, or when woken, until stopped. """
+        while (not self._stop.is_set()):
+            try:
+                self.sweep()
+            except Exception as ex:
+                print(f"(CutoutCache): error sweeping cache directory '{self.cache_dir}': {ex}",
+                      file=sys.stderr)
+            self._wake.wait(self.sweep_interval)
+            self._wake.clear()
@@ -0,0 +1,227 @@
+#
+# Methods to compute canonical, hashed cache keys (and filenames) for image cutouts.
+#   Last Modified: Encode quantization levels exactly, in a form the compressed filename pattern matches.
+#
+import hashlib
+import json
+import math
+import os
+import re
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+
+from cuts.blueprints.img.array_utils import ARRAY_EXTENSIONS
+from cuts.blueprints.img.packing_utils import OUTPUT_DTYPES
+from cuts.blueprints.img.preview_utils import PREVIEW_EXTENSIONS
+
+
+# Version of the canonical cutout parameters: change to invalidate all cached cutouts
+CUTOUT_KEY_VERSION = 1
+
+# Number of hexadecimal digits in a cutout key
+CUTOUT_KEY_LENGTH = 32
+
+# Number of decimal places of degrees to which coordinates and sizes are rounded (about 4 uas)
+DEGREE_DECIMALS = 9
+
+# Filename extension of cached cutout files
+CUTOUT_FILE_EXTENSION = '.fits'
+
+# Filename extension of gzipped copies of cached cutout files
+GZIP_FILE_EXTENSION = '.gz'
+
+# Pattern matching the filenames of compressed (tile compressed, gzipped, or preview) cutout files
+COMPRESSED_FILENAME_PATTERN = re.compile(r'(\.[a-z0-9]+_[0-9]+_q[0-9pme]+\.fits|\.gz|\.png|\.jpg)$')
+
+
+def array_filename (co_filename, fmt):
+    """
+    Return the filename of the raw array variant of the given cached cutout file, in the
+    given array format ('npy' or 'arrow'): the cutout's filename with the extension of the
+    array format (e.g., '<key>.npy' or '<key>.bin4.arrow').
+    """
+    base = co_filename[:-len(CUTOUT_FILE_EXTENSION)] if co_filename.endswith(CUTOUT_FILE_EXTENSION) else co_filename
+    return f"{base}{ARRAY_EXTENSIONS[fmt]}"
+
+
+def binned_cutout_filename (co_filename, binning):
+    """
+    Return the filename of the binned variant of the given cached cutout file, for the given
+    binning arguments (see parse_binning_args): the cutout's filename with the binning factor
+    or maximum size (e.g., '<key>.bin4.fits' or '<key>.max512.fits').
+    """
+    tag = f"bin{binning['factor']}" if binning.get('factor') else f"max{binning['max_pixels']}"
+    base = co_filename[:-len(CUTOUT_FILE_EXTENSION)] if co_filename.endswith(CUTOUT_FILE_EXTENSION) else co_filename
+    return f"{base}.{tag}{CUTOUT_FILE_EXTENSION}"
+
+
+def binned_image_filename (ipath, binning):
+    """
+    Return the fixed-length cache filename of the binned copy of the image at the given path,
+    for the given binning arguments: a hash of the identity of the image (see image_identity)
+    and the binning arguments.
+    """
+    return f"{cutout_key({ 'image': image_identity(ipath), 'binning': binning })}{CUTOUT_FILE_EXTENSION}"
+
+
+def canonical_cutout_params (ipath, co_args, collection=None, filt=None, pixel_fraction=None,
+                             extensions=None, planes=None):
+    """
+    Return a dictionary of the canonical parameters of the cutout of the image at the given
+    path, specified by the given cutout arguments and the optional collection, filter, list
+    of image extensions (see parse_extension_arg), and plane arguments of the cutout of a
+    data cube (see parse_plane_args).
+    The center and size are converted to (rounded) degrees and the image is identified by
+    its path, size, and modification time, so a changed image does not match old cutouts.
+
+    If a pixel fraction is given, the center is also quantized to a grid whose spacing is
+    that fraction of the image's pixel scale, so that requests whose centers differ by
+    less than a grid step share a cutout. The cutout should then be made at the quantized
+    center (see quantized_cutout_args).
+    """
+    ra = float(co_args.get('ra')) % 360.0
+    dec = float(co_args.get('dec'))
+    size_deg = u.Quantity(float(co_args.get('size')), co_args.get('units')).to(u.deg).value
+
+    step_deg = None
+    if (pixel_fraction):
+        pixel_scale = image_pixel_scale(ipath)
+        if (pixel_scale):
+            step_deg = pixel_fraction * pixel_scale
+            (ra, dec) = quantize_center(ra, dec, step_deg)
+
+    center = co_args.get('center')
+    return {
+        'version': CUTOUT_KEY_VERSION,
+        'image': image_identity(ipath),
+        'collection': collection,
+        'filter': filt,
+        'frame': center.frame.name if (center is not None) else 'icrs',
+        'ra': round(ra, DEGREE_DECIMALS),
+        'dec': round(dec, DEGREE_DECIMALS),
+        'size_deg': round(size_deg, DEGREE_DECIMALS),
+        'quantum_deg': round(step_deg, DEGREE_DECIMALS) if step_deg else None,
+        'extensions': list(extensions) if extensions else None,
+        'planes': { kind: list(bounds) for (kind, bounds) in planes.items() } if planes else None
+    }
+
+
+def compressed_cutout_filename (co_filename, compression):
+    """
+    Return the filename of the tile compressed variant of the given cached cutout file, for
+    the given compression arguments (see parse_compression_args): the cutout's filename with
+    the compression type and quantization level (e.g., '<key>.rice_1_q16.fits'). The level
+    is given exactly, by its shortest round-trip form, with 'p' for a decimal point, 'm' for
+    a minus sign, and 'e' for an exponent (e.g., 'q0p5', 'qm2', or 'q1em05').
+    """
+    level = repr(float(compression['quantize_level']))
+    level = level[:-2] if level.endswith('.0') else level
+    level = level.replace('.', 'p').replace('-', 'm').replace('+', '')
+    tag = f"{compression['compression_type'].lower()}_q{level}"
+    base = co_filename[:-len(CUTOUT_FILE_EXTENSION)] if co_filename.endswith(CUTOUT_FILE_EXTENSION) else co_filename
+    return f"{base}.{tag}{CUTOUT_FILE_EXTENSION}"
+
+
+def converted_cutout_filename (co_filename, dtype):
+    """
+    Return the filename of the variant of the given cached cutout file converted to the given
+    output data type (see parse_dtype_arg): the cutout's filename with the data type's tag
+    (e.g., '<key>.f32.fits' or '<key>.i16.fits').
+    """
+    base = co_filename[:-len(CUTOUT_FILE_EXTENSION)] if co_filename.endswith(CUTOUT_FILE_EXTENSION) else co_filename
+    return f"{base}.{OUTPUT_DTYPES[dtype]}{CUTOUT_FILE_EXTENSION}"
+
+
+def cutout_filename (co_params):
+    """ Return the fixed-length cache filename for the cutout with the given canonical parameters. """
+    return f"{cutout_key(co_params)}{CUTOUT_FILE_EXTENSION}"
+
+
+def cutout_key (co_params):
+    """ Return a fixed-length hexadecimal hash of the given canonical cutout parameters. """
+    canonical = json.dumps(co_params, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:CUTOUT_KEY_LENGTH]
+
+
+def decompressed_image_filename (ipath):
+    """
+    Return the fixed-length cache filename of the decompressed copy of the gzipped image at
+    the given path: a hash of the identity of the image (see image_identity).
+    """
+    return f"{cutout_key({ 'image': image_identity(ipath), 'decompressed': True })}{CUTOUT_FILE_EXTENSION}"
+
+
+def gzip_cutout_filename (co_filename):
+    """ Return the filename of the gzipped copy of the given cached cutout file. """
+    return f"{co_filename}{GZIP_FILE_EXTENSION}"
+
+
+def image_identity (ipath):
+    """
+    Return a dictionary identifying the current contents of the image file at the given path:
+    its path, size, and modification time (both None if the file cannot be read).
+    """
+    try:
+        stat = os.stat(ipath)
+        return { 'path': ipath, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns }
+    except (OSError, TypeError):
+        return { 'path': ipath, 'size': None, 'mtime_ns': None }
+
+
+def image_pixel_scale (ipath):
+    """
+    Return the (geometric mean) pixel scale, in degrees per pixel, of the celestial WCS in
+    the primary header of the image at the given path, or None if it cannot be determined.
+    Only the header of the image is read.
+    """
+    try:
+        wcs = WCS(fits.getheader(ipath)).celestial
+        if (not wcs.has_celestial):
+            return None
+        scales = proj_plane_pixel_scales(wcs)
+        return float(math.sqrt(abs(scales[0] * scales[1])))
+    except Exception:
+        return None
+
+
+def is_compressed_cutout_filename (co_filename):
+    """ Tell whether the given filename names a tile compressed, gzipped, or preview cutout file. """
+    return bool(COMPRESSED_FILENAME_PATTERN.search(co_filename))
+
+
+def preview_filename (co_filename, preview):
+    """
+    Return the fixed-length cache filename of the preview image of the given cached cutout
+    file, rendered with the given preview arguments (see parse_preview_args): a hash of the
+    cutout filename and the preview arguments, with the extension of the preview format.
+    """
+    key = cutout_key({ 'cutout': co_filename, 'preview': preview })
+    return f"{key}{PREVIEW_EXTENSIONS[preview['format']]}"
+
+
+def quantize_center (ra, dec, step_deg):
+    """
+    Return the given center, in degrees, snapped to a grid with the given spacing in degrees.
+    The RA spacing is widened by 1/cos(dec), so the grid is (nearly) square on the sky.
+    """
+    qdec = max(-90.0, min(90.0, round(dec / step_deg) * step_deg))
+    ra_step = step_deg / max(math.cos(math.radians(qdec)), 1e-6)
+    qra = (round(ra / ra_step) * ra_step) % 360.0
+    return (qra, qdec)
+
+
+def quantized_cutout_args (co_args, co_params):
+    """
+    Return a copy of the given cutout arguments centered at the (possibly quantized) center
+    given in the canonical cutout parameters.
+    """
+    qargs = dict(co_args)
+    qargs['ra'] = co_params['ra']
+    qargs['dec'] = co_params['dec']
+    qargs['center'] = SkyCoord(ra=co_params['ra']*u.degree, dec=co_params['dec']*u.degree,
+                               frame=co_params['frame'])
+    return qargs
@@ -0,0 +1,191 @@
+#
+# Class implementing a bounded pool of worker processes for CPU-bound cutout work.
+#   Last Modified: Add running many calls of a function concurrently in the pool.
+#
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cuts.blueprints.img.exceptions as exceptions
+
+
+# Default number of worker processes in a cutout pool
+DEFAULT_MAX_WORKERS = 2
+
+# Start method of the worker processes: not forked from a (gevent patched, threaded) web worker
+POOL_START_METHOD = 'spawn'
+
+
+class CutoutPool ():
+    """
+    Runs CPU-bound cutout work (parsing WCS, cutting images, and writing FITS files), which
+    holds the GIL, in a bounded pool of worker processes, so that a large cutout does not
+    block the other requests (greenlets) served by a Gunicorn gevent worker. The caller
+    waits for the result of its work cooperatively, as do the callers beyond the pool's
+    concurrency limit, which wait for a free worker before submitting their work.
+
+    A pool of zero workers runs all work in the calling process, as does a pool used by a
+    daemonic process (which may not have children). The worker processes are started, when
+    first needed, in each process which uses the pool.
+    """
+
+    def __init__ (self, max_workers=DEFAULT_MAX_WORKERS, initializer=None, initargs=()):
+        """
+        Constructor for a pool of at most the given number of worker processes, each of which
+        calls the given initializer function (if any), with the given arguments, when started.
+        """
+        self.max_workers = max(0, max_workers or 0)
+        self.initializer = initializer
+        self.initargs = initargs
+
+        self._executor = None
+        self._pid = None                    # process which started the worker processes
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, self.max_workers))
+
+        # usage statistics
+        self._active = 0
+        self._completed = 0
+        self._failed = 0
+        self._inline = 0
+        self._restarts = 0
+
+
+    def is_enabled (self):
+        """ Tell whether work run by this pool, in this process, is run by worker processes. """
+        return ((self.max_workers > 0) and (not multiprocessing.current_process().daemon))
+
+
+    def run (self, fn, *args, **kwargs):
+        """
+        Call the given (module-level) function with the given (picklable) arguments in a
+        worker process, wait for it to complete, and return its result, or raise its error.
+        If this pool is not enabled, the function is called directly.
+        :raises: ServerError if a worker process dies while running the function.
+        """
+        if (not self.is_enabled()):
+            with self._lock:
+                self._inline += 1
+            return fn(*args, **kwargs)
+
+        with self._slots:                   # wait for a free worker: at most one task each
+            executor = self._get_executor()
+            with self._lock:
+                self._active += 1
+            try:
+                result = executor.submit(fn, *args, **kwargs).result()
+                with self._lock:
+                    self._completed += 1
+                return result
+            except BrokenProcessPool:
+                self._reset(executor)
+                errMsg = "A cutout worker process terminated unexpectedly while making a cutout"
+                raise exceptions.ServerError(errMsg)
+            except Exception:
+                with self._lock:
+                    self._failed += 1
+                raise
+            finally:
+                with self._lock:
+                    self._active -= 1
+
+
+    def map (self, fn, *iterables):
+        """
+        Call the given (module-level) function, as the built-in map does, with each set of
+        (picklable) arguments drawn from the given iterables, in the worker processes, and
+        return the list of the results, in order, or raise the first error. The calls run
+        concurrently, at most one per worker process at once: each call waits for a free
+        worker before it is submitted. If this pool is not enabled, the function is called
+        directly for each set of arguments.
+        :raises: ServerError if a worker process dies while running the function.
+        """
+        arglists = list(zip(*iterables))
+        if (not self.is_enabled()):
+            with self._lock:
+                self._inline += len(arglists)
+            return [ fn(*args) for args in arglists ]
+
+        executor = self._get_executor()
+        futures = []
+        try:
+            for args in arglists:
+                self._slots.acquire()       # wait for a free worker: released when done
+                with self._lock:
+                    self._active += 1
+                try:
+                    future = executor.submit(fn, *args)
+                except BaseException:
+                    self._task_done(None)
+                    raise
+                future.add_done_callback(self._task_done)
+                futures.append(future)
+            return [ future.result() for future in futures ]
+        except BrokenProcessPool:
+            self._reset(executor)
+            errMsg = "A cutout worker process terminated unexpectedly while making a cutout"
+            raise exceptions.ServerError(errMsg)
+
+
+    def shutdown (self):
+        """ Stop the worker processes of this pool, if any, after they finish their work. """
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if ((executor is not None) and (self._pid == os.getpid())):
+            executor.shutdown(wait=True)
+
+
+    def stats (self):
+        """ Return a dictionary describing the configuration and usage of this pool. """
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'enabled': self.is_enabled(),
+                'started': (self._executor is not None) and (self._pid == os.getpid()),
+                'active': self._active,
+                'completed': self._completed,
+                'failed': self._failed,
+                'inline': self._inline,
+                'restarts': self._restarts
+            }
+
+
+    def _get_executor (self):
+        """
+        Return the executor of this process's worker processes, starting it if necessary.
+        An executor inherited by a forked child process is replaced in the child.
+        """
+        with self._lock:
+            if ((self._executor is None) or (self._pid != os.getpid())):
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context(POOL_START_METHOD),
+                    initializer=self.initializer, initargs=self.initargs)
+                self._pid = os.getpid()
+            return self._executor
+
+
+    def _task_done (self, future):
+        """
+        Record the completion (or failure, or failed submission, if None) of the given
+        future of a mapped call, and free its worker for the next call.
+        """
+        with self._lock:
+            self._active -= 1
+            if ((future is None) or future.cancelled() or (future.exception() is not None)):
+                self._failed += 1
+            else:
+                self._completed += 1
+        self._slots.release()
+
+
+    def _reset (self, executor):
+        """ Discard the given (broken) executor, so that the next task starts a new one. """
+        with self._lock:
+            if (self._executor is executor):
+                self._executor = None
+                self._restarts += 1
+        executor.shutdown(wait=False)
@@ -0,0 +1,473 @@
+#
+# Functions to make and write image cutouts, which may run in the worker processes of a cutout
+# pool: they depend on neither the Flask application nor the database.
+#   Last Modified: Reflow long docstrings.
+#
+import gzip
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.nddata import Cutout2D
+from astropy.nddata.utils import NoOverlapError, PartialOverlapError
+from astropy.wcs import WCS
+
+from config.settings import HDU_CACHE_MAX_ENTRIES
+import cuts.blueprints.img.exceptions as exceptions
+from cuts.blueprints.img.array_utils import TENSOR_COLUMN, WCS_METADATA_KEY, array_data
+from cuts.blueprints.img.array_utils import encode_arrow, wcs_metadata, write_arrow, write_npy
+from cuts.blueprints.img.binning_utils import bin_factor, bin_hdu
+from cuts.blueprints.img.cube_utils import cut_cube
+from cuts.blueprints.img.cutout_cache import TEMP_SUFFIX
+from cuts.blueprints.img.hdu_cache import HDUCache
+from cuts.blueprints.img.packing_utils import convert_hdu
+from cuts.blueprints.img.preview_utils import encode_preview, render_preview
+
+
+DEFAULT_CUTOUTS_MODE = 'trim'
+
+# Default compression level of gzipped copies of cutout files (1 is fastest, 9 is smallest)
+DEFAULT_GZIP_LEVEL = 6
+
+# Size of the buffers in which gzipped images are decompressed
+DECOMPRESS_BUFFER_SIZE = 1024 * 1024
+
+# Header keys giving the scaling and blank value of stored integer data, kept by its compressed copy
+STORED_SCALING_KEYS = [ 'BSCALE', 'BZERO', 'BLANK' ]
+
+# Cache of opened images held by a cutout pool worker process (see init_worker)
+_worker_hdu_cache = None
+
+
+def convert_cutout_file (src_filepath, co_filepath, dtype):
+    """
+    Write a copy of the FITS cutout file at the given source path, with its data converted to
+    the given output data type ('float32' or 'int16', see convert_hdu), to the given path.
+    :raises: RequestException if the cutout has no data, or ServerError if the converted
+        file cannot be written.
+    """
+    with fits.open(src_filepath) as hdus:
+        hdu = hdus[0]
+        if (hdu.data is None):
+            errMsg = "The cutout contains no data to convert"
+            raise exceptions.RequestException(errMsg)
+        converted = convert_hdu(hdu, dtype)
+        try:
+            write_hdu_file(converted, co_filepath)
+        except Exception:
+            _write_failed(co_filepath)
+
+
+def cut_image (hdu, co_args, co_mode=DEFAULT_CUTOUTS_MODE, wcs=None, planes=None):
+    """
+    Make and return a cutout of the image HDU, at the center and of the size given by the
+    'center' and 'co_size' cutout arguments. The cutout of a data cube is made in each of
+    the planes selected by the given plane arguments, if any, or else in every plane (see
+    cut_cube). Only the pixels of the cutout are read, through the HDU's section (see
+    read_cutout_data), so the data of the image is never loaded whole. The HDU is not
+    modified. The WCS of the HDU is parsed from its header, if not given.
+    :raises: RequestException if the cutout does not overlap the image, or planes are
+        selected from an image which is not a data cube.
+    """
+    if (wcs is None):
+        wcs = WCS(hdu.header)
+    is_cube = (hdu.header.get('NAXIS') == 3)
+    if (planes and (not is_cube)):
+        errMsg = "Planes can be selected only from the cutouts of data cubes"
+        raise exceptions.RequestException(errMsg)
+    try:
+        if (is_cube):
+            return cut_cube(hdu, co_args, wcs, planes=planes, co_mode=co_mode)
+        pixels = np.broadcast_to(np.float32(0), hdu.shape)  # locate the box without reading
+        cutout = Cutout2D(pixels, position=co_args['center'], size=co_args['co_size'],
+                          wcs=wcs, mode=co_mode)
+        cutout.data = read_cutout_data(hdu, cutout)
+        return cutout
+    except (NoOverlapError, PartialOverlapError):
+        sky = co_args['center']
+        errMsg = f"There is no overlap between the reference image and the given center coordinate: {sky.ra.value}, {sky.dec.value} {sky.ra.unit.name} ({sky.frame.name})"
+        raise exceptions.RequestException(errMsg)
+
+
+def cut_extensions (image, co_args, extensions, co_mode=DEFAULT_CUTOUTS_MODE, planes=None):
+    """
+    Make and return the cutout, at the center and of the size given by the 'center' and
+    'co_size' cutout arguments, and in the planes selected by the given plane arguments, if
+    any (see cut_image), of each of the given extensions (names or indices) of the given
+    opened image (see HDUCache). The cutout of a single extension is returned as a
+    primary HDU (see cutout_hdu). The cutouts of several extensions are returned as an HDU
+    list: a primary HDU, holding a copy of the image's primary header, followed by an image
+    extension for each extension, named by it. The cutout is located by the WCS of the first
+    extension and its pixel slice is reused for the other extensions, which must have the
+    same shape: like the ERR and DQ extensions of a SCI extension, which carry no WCS. Only
+    that slice of each extension is read.
+    :raises: RequestException if an extension is missing, has no image data, or does not have
+        the shape of the first extension, or if the cutout does not overlap the image.
+    """
+    (first, hdu, wcs) = select_extension(image, extensions[0])
+    cutout = cut_image(hdu, co_args, co_mode, wcs=wcs, planes=planes)
+    if (len(extensions) == 1):
+        return cutout_hdu(hdu, cutout)
+
+    primary = fits.PrimaryHDU(header=_cutout_header(image.hdu.header))
+    primary.header['CO_NEXT'] = (len(extensions), 'Number of image extension cutouts')
+    co_hdus = fits.HDUList([ primary ])
+    for ext in extensions:
+        (name, ext_hdu, ext_wcs) = select_extension(image, ext)
+        if (ext_hdu.shape != hdu.shape):
+            errMsg = f"Extension '{name}' has shape {ext_hdu.shape}, unlike the shape {hdu.shape} of extension '{first}'"
+            raise exceptions.RequestException(errMsg)
+        if (ext_hdu is hdu):
+            data = cutout.data
+        else:                               # the same (trimmed) pixel slice of this extension
+            data = np.asarray(ext_hdu.section[tuple(cutout.slices_original)])
+        co_hdus.append(fits.ImageHDU(data=data, header=_cutout_header(ext_hdu.header, cutout),
+                                     name=name))
+    return co_hdus
+
+
+def bin_cutout_file (src_filepath, co_filepath, binning):
+    """
+    Write a binned copy of the 2D FITS image (or cutout) file at the given source path to a
+    FITS file at the given path, block averaged as specified by the given binning arguments
+    (see parse_binning_args), with its WCS adjusted to match. The source image is read in bands,
+    through its section (see bin_hdu), so that a large (or scaled) image is never loaded whole.
+    :raises: RequestException if the image cannot be binned, or ServerError if the binned file
+        cannot be written.
+    """
+    with fits.open(src_filepath, memmap=False) as hdus:  # sections of scaled data are not mapped
+        hdu = hdus[0]
+        if (len(hdu.shape) != 2):
+            errMsg = "Only two-dimensional images and cutouts can be binned"
+            raise exceptions.RequestException(errMsg)
+        factor = bin_factor(hdu.shape, binning)
+        if (factor > min(hdu.shape)):
+            errMsg = f"The binning factor {factor} is larger than the image ({hdu.shape[1]} x {hdu.shape[0]} pixels)"
+            raise exceptions.RequestException(errMsg)
+        binned = bin_hdu(hdu, factor)
+        try:
+            write_hdu_file(binned, co_filepath)
+        except Exception:
+            _write_failed(co_filepath)
+
+
+def compress_cutout_file (src_filepath, co_filepath, compression_type, quantize_level):
+    """
+    Write a tile compressed copy of the FITS cutout file at the given source path to a FITS
+    file at the given path, compressed with the given astropy compression type (e.g., 'RICE_1'
+    or 'GZIP_2') and floating-point quantization level (0 for lossless GZIP_2 compression).
+    Each image extension of a cutout of several image extensions is compressed, keeping its
+    name. Data is compressed as stored, with its scaling, so that scaled integer data (e.g.,
+    data packed into int16, see convert_hdu) is compressed losslessly as integers.
+    :raises: ServerError if the compressed file cannot be written.
+    """
+    with fits.open(src_filepath, do_not_scale_image_data=True) as hdus:
+        try:
+            if (hdus[0].data is not None):
+                comp_hdus = fits.HDUList([ fits.PrimaryHDU() ])
+            else:                           # a primary header and image extensions
+                comp_hdus = fits.HDUList([ fits.PrimaryHDU(header=hdus[0].header) ])
+            for hdu in hdus:
+                if (hdu.is_image and (hdu.data is not None)):
+                    comp_hdu = fits.CompImageHDU(data=hdu.data, header=hdu.header,
+                                                 compression_type=compression_type,
+                                                 quantize_level=quantize_level)
+                    for key in STORED_SCALING_KEYS:   # set after the data: astropy writes them as is
+                        if (key in hdu.header):
+                            comp_hdu.header[key] = hdu.header[key]
+                    comp_hdus.append(comp_hdu)
+            write_hdu_file(comp_hdus, co_filepath)
+        except Exception:
+            _write_failed(co_filepath)
+
+
+def cut_filter_extension (ipath, co_args, filt, co_mode=DEFAULT_CUTOUTS_MODE, hdu_cache=None):
+    """
+    Make the cutout, specified by the 'center' and 'co_size' cutout arguments, of the image
+    at the given path, in the given filter, for a multi-filter cube. Return a pair of an
+    image extension HDU, named by the filter and holding a copy of the cutout data, and None
+    or, if the cutout cannot be made, of None and an error message. Images are opened
+    through the given cache or, by default, through the cache of the worker process.
+    """
+    if (hdu_cache is None):
+        hdu_cache = worker_hdu_cache()
+    try:
+        with hdu_cache.image(ipath) as image:
+            cutout = cut_image(image.hdu, co_args, co_mode, wcs=image.wcs)
+            co_hdu = cutout_hdu(image.hdu, cutout)
+            data = np.array(co_hdu.data)    # not a view of the image file, which may be closed
+    except exceptions.RequestException as rex:
+        return (None, rex.message)
+    except (exceptions.ProcessingError, OSError, TypeError, ValueError) as ex:
+        return (None, f"Unable to make the cutout: {ex}")
+
+    ext = fits.ImageHDU(data=data, header=co_hdu.header, name=str(filt))
+    ext.header['FILTER'] = str(filt)
+    return (ext, None)
+
+
+def cut_position (image, pos, units, frame='icrs'):
+    """
+    Make and return a cutout HDU from the given opened image (see HDUCache) centered at
+    the given position, of the position's size in the given units, holding a copy of the
+    cutout data. Return None, setting an error message in the position, if the cutout
+    cannot be made.
+    """
+    try:
+        co_args = { 'center': SkyCoord(ra=pos['ra']*u.degree, dec=pos['dec']*u.degree, frame=frame),
+                    'co_size': u.Quantity(pos['size'], units) }
+        cutout = cut_image(image.hdu, co_args, wcs=image.wcs)
+        co_hdu = cutout_hdu(image.hdu, cutout)
+        co_hdu.data = np.array(co_hdu.data) # not a view of the image file, which may be closed
+        return co_hdu
+    except exceptions.RequestException as rex:
+        pos['error'] = rex.message
+    except (ValueError, TypeError) as ex:
+        pos['error'] = f"Unable to make the cutout: {ex}"
+    return None
+
+
+def cut_positions (ipath, positions, units, frame='icrs', hdu_cache=None):
+    """
+    Make the cutout centered at each of the given positions (see cut_position) from the image
+    at the given path, which is opened (and its WCS parsed) only once, for a batch of cutouts.
+    Return a list of (position, cutout HDU) pairs, in the order of the positions, or None if
+    the image cannot be read. Images are opened through the given cache or, by default,
+    through the cache of the worker process.
+    """
+    if (hdu_cache is None):
+        hdu_cache = worker_hdu_cache()
+    try:
+        with hdu_cache.image(ipath) as image:
+            return [ (pos, cut_position(image, pos, units, frame)) for pos in positions ]
+    except (exceptions.ProcessingError, OSError, TypeError, ValueError):
+        return None
+
+
+def cutout_hdu (hdu, cutout):
+    """
+    Return a new primary HDU containing the data of the given cutout of the given HDU
+    and a copy of the header of the HDU, updated with the WCS of the cutout.
+    """
+    return fits.PrimaryHDU(data=cutout.data, header=_cutout_header(hdu.header, cutout))
+
+
+def decompress_image_file (src_filepath, co_filepath):
+    """
+    Write a decompressed copy of the gzipped image file at the given source path to the given
+    path, inflating it a buffer at a time, so that the image is never held in memory.
+    :raises: ServerError if the decompressed file cannot be written.
+    """
+    def write_image (tmp_filepath):
+        with gzip.open(src_filepath, 'rb') as src, open(tmp_filepath, 'wb') as dest:
+            shutil.copyfileobj(src, dest, DECOMPRESS_BUFFER_SIZE)
+    try:
+        _write_atomically(co_filepath, write_image)
+    except FileNotFoundError:
+        raise                               # the source image was removed
+    except Exception:
+        _write_failed(co_filepath)
+
+
+def gzip_cutout_file (src_filepath, co_filepath, level=DEFAULT_GZIP_LEVEL):
+    """
+    Write a gzipped copy of the cutout file at the given source path to the given path.
+    :raises: ServerError if the gzipped file cannot be written.
+    """
+    def write_gzip (tmp_filepath):
+        with open(src_filepath, 'rb') as src, gzip.open(tmp_filepath, 'wb', compresslevel=level) as dest:
+            shutil.copyfileobj(src, dest)
+    try:
+        _write_atomically(co_filepath, write_gzip)
+    except FileNotFoundError:
+        raise                               # the source cutout was evicted
+    except Exception:
+        _write_failed(co_filepath)
+
+
+def init_worker (hdu_cache_max_entries=HDU_CACHE_MAX_ENTRIES):
+    """ Initialize a cutout pool worker process with its own cache of opened images. """
+    global _worker_hdu_cache
+    _worker_hdu_cache = HDUCache(hdu_cache_max_entries)
+
+
+def make_cutout_file (ipath, co_args, co_filepath, co_mode=DEFAULT_CUTOUTS_MODE, hdu_cache=None,
+                      extensions=None, planes=None):
+    """
+    Cut out a section of the image at the given image path, as specified by the 'center'
+    and 'co_size' cutout arguments and, for a data cube, the given plane arguments (see
+    cut_image), and write it to a FITS file at the given path. The primary HDU is cut
+    unless a list of extensions (names or indices) is given, when each of them is cut
+    (see cut_extensions). Images are opened through the given cache or, by default,
+    through the cache of the worker process.
+    :raises: RequestException if the cutout does not overlap the image or an extension cannot
+        be cut, ServerError if the cutout file cannot be written, or any error raised while
+        opening the image.
+    """
+    if (hdu_cache is None):
+        hdu_cache = worker_hdu_cache()
+    with hdu_cache.image(ipath) as image:
+        if (extensions):
+            co_hdu = cut_extensions(image, co_args, extensions, co_mode, planes=planes)
+        else:
+            cutout = cut_image(image.hdu, co_args, co_mode, wcs=image.wcs, planes=planes)
+            co_hdu = cutout_hdu(image.hdu, cutout)
+        try:
+            write_hdu_file(co_hdu, co_filepath)
+        except Exception:
+            _write_failed(co_filepath)
+
+
+def read_cutout_data (hdu, cutout):
+    """
+    Return the data of the given 2D image HDU within the box of the given cutout (a Cutout2D
+    located on the shape of the HDU's data), read through the HDU's section. The data of a
+    box extending beyond the image (in 'partial' mode) is padded with NaN.
+    """
+    data = np.asarray(hdu.section[tuple(cutout.slices_original)])
+    if (data.shape == cutout.shape):
+        return data
+    padded = np.full(cutout.shape, np.nan, dtype=np.result_type(data.dtype, np.float32))
+    padded[tuple(cutout.slices_cutout)] = data
+    return padded
+
+
+def render_preview_file (src_filepath, co_filepath, preview):
+    """
+    Render a preview image of the FITS cutout file at the given source path, with the given
+    preview arguments (see parse_preview_args), and write it to the given path. Only the
+    first plane of a cutout with more than two dimensions is rendered.
+    :raises: ServerError if the preview cannot be encoded or written.
+    """
+    data = fits.getdata(src_filepath)
+    if (data.ndim > 2):
+        data = data.reshape((-1,) + data.shape[-2:])[0]
+    image = encode_preview(render_preview(data, preview), preview['format'])
+
+    def write_image (tmp_filepath):
+        with open(tmp_filepath, 'wb') as image_file:
+            image_file.write(image)
+    try:
+        _write_atomically(co_filepath, write_image)
+    except Exception:
+        _write_failed(co_filepath)
+
+
+def select_extension (image, ext):
+    """
+    Return a (name, HDU, WCS) triple for the given extension (name or index) of the given
+    opened image (see HDUCache), loading only that extension. The name is the extension's
+    EXTNAME or, if it has none, the given name or index.
+    :raises: RequestException if the image has no such extension, it holds no image data, or
+        its data cannot be read.
+    """
+    try:
+        (hdu, wcs) = image.extension(ext)
+    except (KeyError, IndexError):
+        errMsg = f"The image has no extension '{ext}'"
+        raise exceptions.RequestException(errMsg)
+    except (OSError, TypeError, ValueError) as ex:
+        errMsg = f"Unable to read extension '{ext}' of the image: {ex}"
+        raise exceptions.RequestException(errMsg)
+    if ((not hdu.is_image) or (not hdu.header.get('NAXIS'))):
+        errMsg = f"Extension '{ext}' of the image contains no image data"
+        raise exceptions.RequestException(errMsg)
+    return (hdu.name or str(ext), hdu, wcs)
+
+
+def worker_hdu_cache ():
+    """ Return the cache of opened images of this process, creating it if necessary. """
+    if (_worker_hdu_cache is None):
+        init_worker()
+    return _worker_hdu_cache
+
+
+def write_array_file (src_filepath, co_filepath, fmt):
+    """
+    Write the data of the FITS cutout file at the given source path, without its header, as a
+    raw array in the given array format to the given path: a NumPy (.npy) file ('npy') or an
+    Arrow IPC file ('arrow') holding a single row tensor column ('cutout') with the WCS of the
+    cutout as JSON schema metadata ('wcs'). The data is written in the native byte order,
+    with its blank pixels as NaN (see array_data).
+    :raises: RequestException if the cutout has no data, or ServerError if the array cannot
+        be encoded or written.
+    """
+    with fits.open(src_filepath) as hdus:
+        hdu = hdus[0]
+        if (hdu.data is None):
+            errMsg = "The cutout contains no data to write as an array"
+            raise exceptions.RequestException(errMsg)
+        data = array_data(hdu)
+        if (fmt == 'arrow'):
+            table = encode_arrow({ TENSOR_COLUMN: data[np.newaxis] },
+                                 metadata={ WCS_METADATA_KEY: wcs_metadata(hdu.header) })
+
+        def write_array (tmp_filepath):
+            with open(tmp_filepath, 'wb') as array_file:
+                if (fmt == 'arrow'):
+                    write_arrow(table, array_file)
+                else:
+                    write_npy(data, array_file)
+        try:
+            _write_atomically(co_filepath, write_array)
+        except Exception:
+            _write_failed(co_filepath)
+
+
+def write_hdu_file (hdu, co_filepath, overwrite=True):
+    """
+    Write the contents of the given HDU to a FITS file at the given path. The contents are
+    written to a hidden temporary file, in the same directory, which is then renamed, so
+    that readers never see a partially written file.
+    :raises: FileExistsError if overwrite is False and the file already exists.
+    """
+    if ((not overwrite) and os.path.exists(co_filepath)):
+        raise FileExistsError(f"Cutout file '{co_filepath}' already exists")
+    _write_atomically(co_filepath, lambda tmp_filepath: hdu.writeto(tmp_filepath, overwrite=True))
+
+
+def _cutout_header (header, cutout=None):
+    """
+    Return a copy of the given image header, updated with the WCS of the given cutout, if
+    any, and without the checksums of the whole image, which do not apply to a cutout.
+    """
+    header = header.copy()
+    if (cutout is not None):
+        header.update(cutout.wcs.to_header())
+    for key in ('CHECKSUM', 'DATASUM'):
+        header.remove(key, ignore_missing=True)
+    return header
+
+
+def _write_atomically (co_filepath, writer):
+    """
+    Call the given writer function with the path of a new, hidden temporary file, in the same
+    directory as the given path, then rename the written temporary file to the given path.
+    The temporary file is removed if the writer fails.
+    """
+    (co_dir, co_filename) = os.path.split(co_filepath)
+    (tmp_fd, tmp_filepath) = tempfile.mkstemp(dir=co_dir, prefix=f".{co_filename}.",
+                                               suffix=TEMP_SUFFIX)
+    os.close(tmp_fd)
+    try:
+        writer(tmp_filepath)
+        os.chmod(tmp_filepath, 0o644)       # mkstemp creates files readable only by the owner
+        os.replace(tmp_filepath, co_filepath)
+    except BaseException:
+        try:
+            os.remove(tmp_filepath)
+        except OSError:
+            pass
+        raise
+
+
+def _write_failed (co_filepath):
+    """ Raise a ServerError reporting a failure to write the given cutout file. """
+    (co_dir, co_filename) = os.path.split(co_filepath)
+    errMsg = f"Unexpected error while writing image cutout to cache file '{co_filename}' in cache directory '{co_dir}'"
+    raise exceptions.ServerError(errMsg)
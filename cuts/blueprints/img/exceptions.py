@@ -2,7 +2,7 @@
 # Implement exceptions used throughout the app.
 #
 #   Written by: Tom Hicks. 11/2/2019.
-#   Last Modified: Add NotYetImplemented exception.
+#   Last Modified: Make exceptions picklable, to be raised by worker processes.
 #
 class ProcessingError (Exception):
     """
@@ -24,6 +24,10 @@ class ProcessingError (Exception):
             self.error_code = self.ERROR_CODE
 
 
+    def __reduce__(self):
+        return (self.__class__, (self.message, self.error_code))
+
+
     def __str__(self):
         return("({}) {}".format(self.error_code, self.message))
 
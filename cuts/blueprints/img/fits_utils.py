@@ -1,7 +1,7 @@
 #
 # Module to provide FITS utility functions for Astrolabe code.
 #   Written by: Tom Hicks. 1/26/2020.
-#   Last Modified: Sync with image/catalog files tests from imdtoolkit project.
+#   Last Modified: Recognize 3D data cubes as image data.
 #
 import fnmatch
 import os
@@ -197,10 +197,10 @@ def has_image_data (ff_hdus_list, which_hdu=0):
     Tell whether the given FITS file has image data the the given HDU
     (defaults to the Primary HDU).
     Assumes: an image extension HDU will be of type IMAGE.
-    NB: we currently recognize only primary HDU "images" with 2D axises.
+    NB: we currently recognize only primary HDU "images" with 2D axises and 3D data cubes.
     """
     if (which_hdu == 0):                    # heuristic for Primary HDU
-        if (ff_hdus_list[which_hdu].header.get('NAXIS') == 2):
+        if (ff_hdus_list[which_hdu].header.get('NAXIS') in (2, 3)):
             return True
         else:
             return False
@@ -219,6 +219,11 @@ def is_fits_filename (filename, extents=FITS_EXTENTS):
     return is_acceptable_filename(filename, extents)
 
 
+def is_gzipped_fits_filename (filename):
+    """ Return True if the given filename string names a gzipped FITS file, else False. """
+    return (isinstance(filename, str) and fnmatch.fnmatch(filename, _GZFITS_PAT))
+
+
 def lookup_pixtype (bitpix, default='UNKNOWN'):
     """
     Return the pixel data type for the given FITS header code value from the BITPIX field.
@@ -0,0 +1,168 @@
+#
+# Methods to rank candidate images by how well their stored footprints cover a requested cutout.
+#   Last Modified: Initial creation: tangent plane coverage of cutout boxes by image corners.
+#
+import math
+
+
+# Metadata fields holding the (RA, DEC) corners of an image's footprint, in order around it
+FOOTPRINT_FIELDS = [ 'im_ra1', 'im_dec1', 'im_ra2', 'im_dec2',
+                     'im_ra3', 'im_dec3', 'im_ra4', 'im_dec4' ]
+
+# Number of decimal places to which coverage fractions are compared (so near-ties are ties)
+COVERAGE_DECIMALS = 6
+
+
+def box_coverage (corners, ra, dec, size_deg):
+    """
+    Return the fraction (0 to 1) of a square cutout box, centered at the given coordinates
+    and of the given width in degrees, which lies within the footprint with the given
+    corners. The box is aligned with the footprint's first edge (the image's X axis), as
+    is a cutout made from the image. Computed in the plane tangent to the sky at the center.
+    """
+    poly = footprint_plane(corners, ra, dec)
+    if (poly is None):
+        return 0.0
+    half = size_deg / 2.0
+    if (half <= 0):                         # a point: covered if inside the footprint
+        return 1.0 if point_in_polygon((0.0, 0.0), poly) else 0.0
+
+    angle = math.atan2(poly[1][1] - poly[0][1], poly[1][0] - poly[0][0])
+    (cos_a, sin_a) = (math.cos(angle), math.sin(angle))
+    box = [ (half * (sx * cos_a - sy * sin_a), half * (sx * sin_a + sy * cos_a))
+            for (sx, sy) in ((-1, -1), (1, -1), (1, 1), (-1, 1)) ]
+    covered = polygon_area(clip_polygon(box, poly))
+    return min(1.0, covered / (size_deg * size_deg))
+
+
+def center_offset (corners, ra, dec):
+    """
+    Return the distance, in degrees, between the given coordinates and the center (the mean
+    of the corners) of the footprint with the given corners, or infinity if it is unknown.
+    """
+    poly = footprint_plane(corners, ra, dec)
+    if (poly is None):
+        return math.inf
+    cx = sum(pt[0] for pt in poly) / len(poly)
+    cy = sum(pt[1] for pt in poly) / len(poly)
+    return math.hypot(cx, cy)
+
+
+def clip_polygon (subject, clip):
+    """
+    Return the polygon which is the intersection of the given polygon and the given convex,
+    counter-clockwise clipping polygon (Sutherland-Hodgman), as a possibly empty list of points.
+    """
+    output = list(subject)
+    count = len(clip)
+    for idx in range(count):
+        if (not output):
+            break
+        (a, b) = (clip[idx], clip[(idx + 1) % count])
+        inputs = output
+        output = []
+        prev = inputs[-1]
+        for cur in inputs:
+            cur_in = _cross(a, b, cur) >= 0
+            prev_in = _cross(a, b, prev) >= 0
+            if (cur_in):
+                if (not prev_in):
+                    output.append(_intersection(prev, cur, a, b))
+                output.append(cur)
+            elif (prev_in):
+                output.append(_intersection(prev, cur, a, b))
+            prev = cur
+    return output
+
+
+def footprint_corners (md):
+    """
+    Return a list of the four (RA, DEC) corners of the footprint in the given image metadata,
+    or None if any of the corner fields is missing or not a finite number.
+    """
+    try:
+        values = [ float(md.get(field)) for field in FOOTPRINT_FIELDS ]
+    except (TypeError, ValueError):
+        return None
+    if (not all(math.isfinite(val) for val in values)):
+        return None
+    return list(zip(values[0::2], values[1::2]))
+
+
+def footprint_plane (corners, ra, dec):
+    """
+    Return the given footprint corners projected onto the plane tangent to the sky at the
+    given coordinates, in counter-clockwise order, or None if the corners are not given or
+    any corner is not in the hemisphere centered at the coordinates.
+    """
+    if (not corners):
+        return None
+    poly = [ tangent_project(cra, cdec, ra, dec) for (cra, cdec) in corners ]
+    if (any(pt is None for pt in poly)):
+        return None
+    if (_signed_area(poly) < 0):
+        poly.reverse()
+    return poly
+
+
+def point_in_polygon (point, poly):
+    """ Tell whether the given point is within the given convex, counter-clockwise polygon. """
+    count = len(poly)
+    return all((_cross(poly[idx], poly[(idx + 1) % count], point) >= 0) for idx in range(count))
+
+
+def polygon_area (poly):
+    """ Return the (unsigned) area of the given polygon. """
+    return abs(_signed_area(poly))
+
+
+def rank_footprints (matches, ra, dec, size_deg):
+    """
+    Return the given image metadata dictionaries sorted from best to worst candidate for
+    a cutout centered at the given coordinates, of the given width in degrees: first by the
+    fraction of the cutout covered by the image footprint (images which contain the whole
+    cutout first), then by the distance of the cutout center from the image center, and
+    finally by descending image ID. Images without footprint corners are ranked last.
+    """
+    def rank (md):
+        corners = footprint_corners(md)
+        coverage = box_coverage(corners, ra, dec, size_deg) if corners else -1.0
+        offset = center_offset(corners, ra, dec) if corners else math.inf
+        return (-round(coverage, COVERAGE_DECIMALS), offset, -(md.get('id') or 0))
+    return sorted(matches, key=rank)
+
+
+def tangent_project (ra, dec, ra0, dec0):
+    """
+    Return the gnomonic (tangent plane) projection, in degrees, of the given coordinates
+    about the given center, or None if the coordinates are not in the hemisphere of the center.
+    X increases to the east (with RA) and Y to the north (with DEC).
+    """
+    (ra, dec, ra0, dec0) = [ math.radians(val) for val in (ra, dec, ra0, dec0) ]
+    cos_c = (math.sin(dec0) * math.sin(dec) +
+             math.cos(dec0) * math.cos(dec) * math.cos(ra - ra0))
+    if (cos_c <= 0):
+        return None
+    x = math.cos(dec) * math.sin(ra - ra0) / cos_c
+    y = (math.cos(dec0) * math.sin(dec) -
+         math.sin(dec0) * math.cos(dec) * math.cos(ra - ra0)) / cos_c
+    return (math.degrees(x), math.degrees(y))
+
+
+def _cross (a, b, p):
+    """ Return the cross product of (b - a) and (p - a): positive if p is left of the line a->b. """
+    return (b[0] - a[0]) * (p[1] - a[1]) - (b[1] - a[1]) * (p[0] - a[0])
+
+
+def _intersection (p1, p2, a, b):
+    """ Return the intersection of the segment p1->p2 with the line through a and b. """
+    (d1, d2) = (_cross(a, b, p1), _cross(a, b, p2))
+    frac = d1 / (d1 - d2) if (d1 != d2) else 0.0
+    return (p1[0] + frac * (p2[0] - p1[0]), p1[1] + frac * (p2[1] - p1[1]))
+
+
+def _signed_area (poly):
+    """ Return the signed area of the given polygon: positive if it is counter-clockwise. """
+    count = len(poly)
+    return sum((poly[idx][0] * poly[(idx + 1) % count][1] -
+                poly[(idx + 1) % count][0] * poly[idx][1]) for idx in range(count)) / 2.0
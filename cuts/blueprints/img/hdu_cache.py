@@ -0,0 +1,245 @@
+#
+# Class implementing a bounded, process-wide cache of opened FITS images and their parsed WCS.
+#   Last Modified: Read scaled extensions of memory mapped images from an unmapped copy of the file.
+#
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+
+# Default maximum number of opened images (and so open file descriptors) held by the cache
+DEFAULT_MAX_ENTRIES = 16
+
+
+class _ImageEntry ():
+    """ Record holding an opened FITS image, its parsed WCS, and its current users. """
+    __slots__ = ('key', 'hdus', 'hdu', 'wcs', 'users', 'cached', 'memmap', 'unmapped_hdus',
+                 '_extensions', '_ext_lock')
+
+    def __init__ (self, key, hdus, memmap=False):
+        self.key = key
+        self.hdus = hdus
+        self.memmap = memmap                # true if the data of the image is memory mapped
+        self.unmapped_hdus = None           # the image, opened unmapped, for its scaled extensions
+        self.hdu = hdus[0]
+        self.wcs = WCS(self.hdu.header) if (self.hdu.header.get('NAXIS')) else None  # not if empty
+        self.users = 0
+        self.cached = False                 # true while the entry is held by the cache
+        self._extensions = dict()           # extension name or index => (HDU, WCS)
+        self._ext_lock = threading.Lock()
+
+
+    def extension (self, ext):
+        """
+        Return an (HDU, WCS) pair for the given extension (name or index) of this image: the
+        primary HDU and its WCS for None or 0. An extension is loaded on its first use, and
+        then kept: only the headers preceding it and its own header and data are read. The
+        WCS is None for an extension which holds no image data (e.g., a table). An extension
+        whose data is scaled (e.g., unsigned integer data quality flags, stored with BZERO),
+        which astropy cannot memory map, is read from a copy of the image opened unmapped.
+        :raises: KeyError or IndexError if the image has no such extension, or any error
+            raised by astropy while reading the extension or parsing its WCS.
+        """
+        if (ext in (None, 0)):
+            return (self.hdu, self.wcs)
+        with self._ext_lock:                # HDU lists are not safe for concurrent loading
+            selected = self._extensions.get(ext)
+            if (selected is None):
+                hdu = self.hdus[ext]
+                wcs = None
+                if (hdu.is_image and hdu.header.get('NAXIS')):
+                    try:
+                        _preload(hdu)
+                    except ValueError:
+                        if (not self.memmap):
+                            raise
+                        if (self.unmapped_hdus is None):
+                            self.unmapped_hdus = fits.open(self.hdus.filename(), memmap=False)
+                        hdu = self.unmapped_hdus[ext]
+                        _preload(hdu)
+                    wcs = WCS(hdu.header)
+                selected = (hdu, wcs)
+                self._extensions[ext] = selected
+            return selected
+
+
+class HDUCache ():
+    """
+    Bounded, least-recently-used cache of memory-mapped FITS images and their parsed WCS,
+    keyed by image path, size, and modification time, so a replaced image is reopened.
+    Entries are reference counted: an evicted entry is closed when its last user releases
+    it. When every cached entry is in use, a newly opened image is not cached, so that the
+    number of files held open by the cache never exceeds its maximum number of entries.
+
+    Users must treat the cached HDU, header, data, and WCS as read-only.
+    """
+
+    def __init__ (self, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        Constructor for a cache of at most the given number of opened images.
+        A maximum of zero (or None) disables caching: each image is opened for each use.
+        """
+        self.max_entries = max_entries or 0
+
+        self._entries = OrderedDict()       # key => entry: least recently used first
+        self._lock = threading.Lock()
+        self._pid = os.getpid()             # process which opened the cached images
+
+        # usage statistics
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+
+    def clear (self):
+        """ Remove all entries from the cache, closing those which are not in use. """
+        with self._lock:
+            while (self._entries):
+                self._evict_lru()
+
+
+    @contextmanager
+    def image (self, ipath):
+        """
+        Context manager which yields an opened, cached image entry for the FITS file at the
+        given path, with 'hdus', 'hdu' (the primary HDU), and 'wcs' (parsed from the primary
+        header, or None if the primary HDU holds no data, as when the image is held in its
+        extensions) attributes, and an 'extension' method selecting another HDU and its WCS.
+        :raises: any error raised by astropy while opening the image file or parsing its WCS.
+        """
+        entry = self._acquire(ipath)
+        try:
+            yield entry
+        finally:
+            self._release(entry)
+
+
+    def stats (self):
+        """ Return a dictionary of current cache contents and usage statistics. """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'in_use': len([ entry for entry in self._entries.values() if entry.users ]),
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions
+            }
+
+
+    def _acquire (self, ipath):
+        """ Return a cached or newly opened entry for the given image path, registering a user. """
+        stat = os.stat(ipath)
+        key = (ipath, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            self._check_pid()
+            entry = self._entries.get(key)
+            if (entry is not None):
+                self._entries.move_to_end(key)
+                entry.users += 1
+                self._hits += 1
+                return entry
+            self._misses += 1
+
+        entry = self._open(key)             # open the image outside of the lock
+
+        with self._lock:
+            cached = self._entries.get(key)
+            if (cached is not None):        # opened concurrently by another user: share it
+                self._close(entry)
+                entry = cached
+                self._entries.move_to_end(key)
+            elif (self._make_room()):
+                entry.cached = True
+                self._entries[key] = entry
+            entry.users += 1
+            return entry
+
+
+    def _check_pid (self):
+        """ Forget, without closing, any entries opened by a parent process before a fork. """
+        if (self._pid != os.getpid()):
+            self._entries = OrderedDict()
+            self._pid = os.getpid()
+
+
+    def _close (self, entry):
+        """ Close the image file (and any unmapped copy of it) held by the given entry. """
+        for hdus in (entry.hdus, entry.unmapped_hdus):
+            try:
+                if (hdus is not None):
+                    hdus.close()
+            except Exception:
+                pass                        # closing is best effort
+
+
+    def _evict_lru (self):
+        """ Remove the least recently used entry from the cache, closing it if it is not in use. """
+        (key, entry) = self._entries.popitem(last=False)
+        entry.cached = False
+        self._evictions += 1
+        if (entry.users <= 0):
+            self._close(entry)
+
+
+    def _make_room (self):
+        """
+        Evict unused entries until there is room for another entry. Tell whether there is
+        room: there is none if caching is disabled or every cached entry is in use.
+        """
+        if (self.max_entries <= 0):
+            return False
+        while (len(self._entries) >= self.max_entries):
+            unused = next((key for key, entry in self._entries.items() if (entry.users <= 0)), None)
+            if (unused is None):
+                return False
+            self._entries.move_to_end(unused, last=False)
+            self._evict_lru()
+        return True
+
+
+    def _open (self, key):
+        """
+        Open the image file for the given key and parse its WCS. The image data is memory
+        mapped unless it is scaled (by BZERO/BSCALE/BLANK), which astropy cannot memory map:
+        the file of a scaled image is then read by sections (see _preload), so the data of
+        an image is never loaded whole. Scaled extensions of a mapped image are read from
+        an unmapped copy (see _ImageEntry.extension).
+        """
+        for memmap in (True, False):
+            hdus = fits.open(key[0], memmap=memmap)
+            try:
+                _preload(hdus[0])
+                return _ImageEntry(key, hdus, memmap=memmap)
+            except ValueError:
+                hdus.close()
+                if (not memmap):
+                    raise
+            except Exception:
+                hdus.close()
+                raise
+
+
+    def _release (self, entry):
+        """ Unregister a user of the given entry, closing the entry if it is no longer cached. """
+        with self._lock:
+            entry.users -= 1
+            if ((entry.users <= 0) and (not entry.cached)):
+                self._close(entry)
+
+
+def _preload (hdu):
+    """
+    Check that the data of the given image HDU can be read through its section, by reading
+    a single pixel, which raises the same errors as loading the data would (e.g., for scaled
+    data which is memory mapped). The data itself is not loaded: only sections of it are
+    read, through the HDU's section, since the (scaled) data of an image may not fit in
+    memory. An HDU without data is not read.
+    """
+    naxis = hdu.header.get('NAXIS', 0)
+    if (naxis > 0):
+        hdu.section[(0,) * naxis]
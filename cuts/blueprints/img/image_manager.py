@@ -3,33 +3,71 @@
 # FITS image files found locally on disk.
 #
 #   Written by: Tom Hicks. 11/14/2019.
-#   Last Modified: Update deprecated parameter name to "download_name".
+#   Last Modified: Reflow long docstrings.
 #
+import json
 import os
 import sys
 import pathlib as pl
+from collections import defaultdict
 
-from flask import current_app, request, send_from_directory
+from flask import current_app, request
 
 from astropy import units as u
 from astropy.io import fits
 from astropy.coordinates import SkyCoord
-from astropy.nddata import Cutout2D
-from astropy.nddata.utils import NoOverlapError, PartialOverlapError
-from astropy.wcs import WCS
 
-from config.settings import DEBUG, DATA_ROOT
+from config.settings import DEBUG, DATA_ROOT, LIST_CACHE_NOTIFY_CHANNEL, LIST_CACHE_TTL
+from config.settings import CO_CACHE_MAX_BYTES, CO_CACHE_MAX_ENTRIES, CO_CACHE_SWEEP_INTERVAL
+from config.settings import CO_CACHE_LOCK_TIMEOUT, CO_KEY_PIXEL_FRACTION, HDU_CACHE_MAX_ENTRIES
+from config.settings import CO_POOL_MAX_WORKERS, CO_GZIP_ENCODING, CO_GZIP_LEVEL
+from config.settings import FILE_DELIVERY_LOCATIONS, FILE_DELIVERY_MODE
+from config.settings import DECOMPRESSED_CACHE_MAX_BYTES, DECOMPRESSED_CACHE_MAX_ENTRIES
 import cuts.blueprints.img.exceptions as exceptions
-from cuts.blueprints.img.fits_utils import fits_file_exists, FITS_MIME_TYPE
+from cuts.blueprints.img.array_utils import ARRAY_EXTENSIONS, ARRAY_MIME_TYPES, WCS_HEADER_NAME
+from cuts.blueprints.img.array_utils import wcs_metadata
+from cuts.blueprints.img.cutout_cache import CutoutCache
+from cuts.blueprints.img.cutout_keys import canonical_cutout_params, cutout_filename
+from cuts.blueprints.img.cutout_keys import quantized_cutout_args, compressed_cutout_filename
+from cuts.blueprints.img.cutout_keys import gzip_cutout_filename, is_compressed_cutout_filename
+from cuts.blueprints.img.cutout_keys import binned_cutout_filename, binned_image_filename, preview_filename
+from cuts.blueprints.img.cutout_keys import converted_cutout_filename, decompressed_image_filename
+from cuts.blueprints.img.cutout_keys import array_filename
+from cuts.blueprints.img.cutout_pool import CutoutPool
+from cuts.blueprints.img.cutout_worker import DEFAULT_CUTOUTS_MODE, cut_image, cutout_hdu
+from cuts.blueprints.img.cutout_worker import init_worker, make_cutout_file, write_hdu_file
+from cuts.blueprints.img.cutout_worker import compress_cutout_file, gzip_cutout_file
+from cuts.blueprints.img.cutout_worker import bin_cutout_file, convert_cutout_file, render_preview_file
+from cuts.blueprints.img.cutout_worker import decompress_image_file, write_array_file
+from cuts.blueprints.img.cutout_worker import cut_filter_extension, cut_position, cut_positions
+from cuts.blueprints.img.file_utils import validate_file_path
+from cuts.blueprints.img.fits_utils import fits_file_exists, is_gzipped_fits_filename
+from cuts.blueprints.img.fits_utils import FITS_EXTENTS, FITS_MIME_TYPE
+from cuts.blueprints.img.footprint_utils import FOOTPRINT_FIELDS, rank_footprints
+from cuts.blueprints.img.hdu_cache import HDUCache
+from cuts.blueprints.img.pg_listener import PostgreSQLListener
 from cuts.blueprints.img.pg_sql import PostgreSQLManager
+from cuts.blueprints.img.position_utils import DEFAULT_POSITIONS_CHUNK_SIZE, gen_chunks
+from cuts.blueprints.img.preview_utils import PREVIEW_EXTENSIONS, PREVIEW_MIME_TYPES
+from cuts.blueprints.img.response_utils import FILE_DELIVERY_MODES, accepts_encoding, is_range_request
+from cuts.blueprints.img.response_utils import offload_file_response, send_file_response
+from cuts.blueprints.img.ttl_cache import TTLCache
 
 
 DEFAULT_CO_CACHE_DIR = f"{DATA_ROOT}/cutouts"
-DEFAULT_CUTOUTS_MODE = 'trim'
+
+# directory of the decompressed copies of gzipped images, from which cutouts are made
+DEFAULT_DECOMPRESSED_CACHE_DIR = f"{DATA_ROOT}/decompressed"
+
+# filename extensions of the files in the cutouts cache: FITS cutouts, preview images, and raw arrays
+CUTOUT_EXTENTS = FITS_EXTENTS + list(PREVIEW_EXTENSIONS.values()) + list(ARRAY_EXTENSIONS.values())
 
 DEFAULT_SELECT_FIELDS = [ 'id', 's_ra', 's_dec', 'file_name', 'file_path',
                           'filter', 'obs_collection' ]
 
+# fields selected for the images which may contain a cutout: including their footprint corners
+FOOTPRINT_SELECT_FIELDS = DEFAULT_SELECT_FIELDS + FOOTPRINT_FIELDS
+
 IRODS_ZONE_NAME = '/iplant'                 # TODO: pull from irods env file LATER
 
 
@@ -43,12 +81,115 @@ class ImageManager ():
             self._DEBUG = True
         self.pgsql = PostgreSQLManager(args)  # create a DB manager
 
+        # cache for the lists of collections, filters, and image paths, which change only
+        # when images are ingested: invalidated by ingestion through a notification channel
+        self.list_cache = TTLCache(ttl=args.get('list_cache_ttl', LIST_CACHE_TTL))
+        self.list_listener = None
+        channel = args.get('list_cache_notify_channel', LIST_CACHE_NOTIFY_CHANNEL)
+        if (channel and (self.list_cache.ttl > 0)):
+            self.list_listener = PostgreSQLListener(self.pgsql.db_uri, channel,
+                                                    self.invalidate_list_caches)
+
+        # manager bounding the size of the cutouts cache directory by evicting LRU cutouts:
+        # its directory is the default directory (co_dir) of the cutout methods
+        self.co_cache = CutoutCache(args.get('co_cache_dir', DEFAULT_CO_CACHE_DIR),
+                                    max_bytes=args.get('co_cache_max_bytes', CO_CACHE_MAX_BYTES),
+                                    max_entries=args.get('co_cache_max_entries', CO_CACHE_MAX_ENTRIES),
+                                    sweep_interval=args.get('co_cache_sweep_interval',
+                                                            CO_CACHE_SWEEP_INTERVAL),
+                                    lock_timeout=args.get('co_cache_lock_timeout',
+                                                          CO_CACHE_LOCK_TIMEOUT))
+
+        # manager bounding the size of the directory of decompressed copies of gzipped images,
+        # which can be memory mapped and read at random, unlike the gzipped images themselves
+        self.dc_cache = CutoutCache(args.get('decompressed_cache_dir', DEFAULT_DECOMPRESSED_CACHE_DIR),
+                                    max_bytes=args.get('decompressed_cache_max_bytes',
+                                                       DECOMPRESSED_CACHE_MAX_BYTES),
+                                    max_entries=args.get('decompressed_cache_max_entries',
+                                                         DECOMPRESSED_CACHE_MAX_ENTRIES),
+                                    sweep_interval=args.get('co_cache_sweep_interval',
+                                                            CO_CACHE_SWEEP_INTERVAL),
+                                    lock_timeout=args.get('co_cache_lock_timeout',
+                                                          CO_CACHE_LOCK_TIMEOUT))
+
+        # fraction of a pixel to which cutout centers are quantized in cache keys (None for none)
+        self.co_key_pixel_fraction = args.get('co_key_pixel_fraction', CO_KEY_PIXEL_FRACTION)
+
+        # cache of opened (memory mapped) images and their parsed WCS, for making cutouts
+        hdu_cache_max_entries = args.get('hdu_cache_max_entries', HDU_CACHE_MAX_ENTRIES)
+        self.hdu_cache = HDUCache(hdu_cache_max_entries)
+
+        # pool of worker processes making cached cutouts, off the event loop of a gevent worker
+        self.co_pool = CutoutPool(args.get('co_pool_max_workers', CO_POOL_MAX_WORKERS),
+                                  initializer=init_worker, initargs=(hdu_cache_max_entries,))
+
+        # whether, and how much, to gzip cutouts sent to clients accepting gzip content encoding
+        self.co_gzip_encoding = args.get('co_gzip_encoding', CO_GZIP_ENCODING)
+        self.co_gzip_level = args.get('co_gzip_level', CO_GZIP_LEVEL)
+
+        # whether image and cutout files are sent by this process or handed to a front proxy
+        self.file_delivery_mode = args.get('file_delivery_mode', FILE_DELIVERY_MODE)
+        if (self.file_delivery_mode not in FILE_DELIVERY_MODES):
+            errMsg = f"File delivery mode must be one of: {', '.join(FILE_DELIVERY_MODES)}"
+            raise exceptions.ServerError(errMsg)
+        self.file_delivery_locations = args.get('file_delivery_locations', FILE_DELIVERY_LOCATIONS)
+
+
+    def array_wcs (self, co_filename, ar_filename, co_dir=None):
+        """
+        Return the WCS of the named cached cutout, as a dictionary of WCS keywords, for the
+        named array file made from it, or None if the cutout is no longer cached. The WCS is
+        recorded in the index file of the array file, when first asked for, so that the cutout
+        file need not be opened again to send the array.
+        """
+        co_dir = co_dir or self.co_cache.cache_dir
+        ar_filepath = os.path.join(co_dir, ar_filename)
+        index = self.co_cache.read_index(ar_filepath)
+        if (index and ('wcs' in index)):
+            return index['wcs']
+        try:
+            header = fits.getheader(os.path.join(co_dir, co_filename))
+        except OSError:
+            return None
+        wcs = wcs_metadata(header)
+        self.co_cache.write_index(ar_filepath, { 'wcs': wcs })
+        return wcs
+
 
     def cleanup (self):
         """ Cleanup the current session. """
         pass
 
 
+    def cached_list (self, key, loader):
+        """
+        Return a sorted copy of the list cached under the given key, calling the given loader
+        function to load the list from the database if it is not cached.
+        """
+        if (self.list_listener is not None):
+            self.list_listener.start()      # (re)started once per (forked) process
+        return list(self.list_cache.get(key, lambda: sorted(loader())))
+
+
+    def cutout_cache_stats (self):
+        """
+        Return a dictionary describing the contents and limits of the cutouts cache,
+        including the statistics of the cache of opened images ('hdu_cache'), of the cache
+        of decompressed copies of gzipped images ('decompressed'), and of the pool of cutout
+        worker processes ('pool').
+        """
+        stats = self.co_cache.stats()
+        stats['hdu_cache'] = self.hdu_cache.stats()
+        stats['decompressed'] = self.dc_cache.stats()
+        stats['pool'] = self.co_pool.stats()
+        return stats
+
+
+    def db_pool_stats (self):
+        """ Return a dictionary of usage statistics for the database connection pool. """
+        return self.pgsql.pool_stats()
+
+
     def fetch_image (self, uid, mimetype=FITS_MIME_TYPE):
         """
         Read and return the image with the specified ID or None, if no such image record found.
@@ -79,22 +220,122 @@ class ImageManager ():
         return self.return_image_at_path(ipath, mimetype=mimetype) if ipath else None
 
 
-    def get_cutout (self, ipath, co_args, collection=None, filt=None):
+    def find_cutout_image (self, co_args, collection=None, filt=None):
+        """
+        Return the path of the image from which to make the cutout specified by the given
+        cutout arguments (which must include a size) and optional collection and filter
+        arguments: of the images centered within the cutout radius, the image whose stored
+        footprint best covers the cutout (see rank_cutout_images).
+        :raises: ImageNotFound if no image matches.
+        """
+        image_matches = self.query_cone(co_args, filt=filt, collection=collection,
+                                        select=FOOTPRINT_SELECT_FIELDS)
+        if (not image_matches):
+            coll = f" in collection '{collection}'" if (collection) else ''
+            fltr = f" with filter '{filt}'" if (filt) else ''
+            errMsg = f"No matching image for coordinates (in cone){fltr}{coll} was found"
+            current_app.logger.error(errMsg)
+            raise exceptions.ImageNotFound(errMsg)
+        return self.rank_cutout_images(image_matches, co_args)[0].get('file_path')
+
+
+    def get_binned_image (self, ipath, binning, compression=None, dtype=None):
+        """
+        Return a binned copy of the entire image at the given path, made as specified by the
+        given binning arguments (see parse_binning_args) and cached in the cutouts cache,
+        converted to the given output data type, if any (see parse_dtype_arg), and then tile
+        compressed if compression arguments are given (see parse_compression_args).
+        """
+        bin_filename = self.make_binned_image(ipath, binning)
+        if (dtype):
+            bin_filename = self.make_converted_cutout(bin_filename, dtype)
+        if (compression):
+            bin_filename = self.make_compressed_cutout(bin_filename, compression)
+        return self.return_cutout_with_name(bin_filename)
+
+
+    def get_cutout (self, ipath, co_args, collection=None, filt=None, compression=None,
+                    preview=None, binning=None, dtype=None, extensions=None, planes=None,
+                    array_format=None):
         """
         Return an image cutout, specified by the given cutout arguments and optional
-        collection and filter arguments.
+        collection and filter arguments, of the given image extensions, if any (see
+        parse_extension_arg), in the planes of a data cube selected by the given plane
+        arguments, if any (see parse_plane_args), binned if binning arguments are given (see
+        parse_binning_args), and then rendered as a preview image if preview arguments are
+        given (see parse_preview_args), or else converted to the given output data type, if
+        any (see parse_dtype_arg), and then written as a raw array, if an array format is
+        given (see return_array_with_name), or else tile compressed if compression arguments
+        are given (see parse_compression_args).
         """
-        co_filename = self.make_cutout_filename(ipath, co_args, collection=collection, filt=filt)
-        if (not self.is_cutout_cached(co_filename)):
-            self.make_cutout_and_save(ipath, co_args, co_filename)
+        co_filename = self.make_cached_cutout(ipath, co_args, collection=collection, filt=filt,
+                                              extensions=extensions, planes=planes)
+        if (binning):
+            co_filename = self.make_binned_cutout(co_filename, binning)
+        if (preview):
+            pv_filename = self.make_preview(co_filename, preview)
+            return self.return_cutout_with_name(pv_filename, as_attachment=False,
+                                                mimetype=PREVIEW_MIME_TYPES[preview['format']])
+        if (dtype):
+            co_filename = self.make_converted_cutout(co_filename, dtype)
+        if (array_format):
+            return self.return_array_with_name(co_filename, array_format)
+        if (compression):
+            co_filename = self.make_compressed_cutout(co_filename, compression)
         return self.return_cutout_with_name(co_filename)  # return the actual image cutout
 
 
-    def get_image_or_cutout (self, co_args, collection=None, filt=None):
+    def get_image_or_cutout (self, co_args, collection=None, filt=None, compression=None,
+                             preview=None, binning=None, dtype=None, extensions=None,
+                             planes=None, array_format=None):
         """
         Return an entire image or a cutout, based on the given cutout arguments and
-        optional collection and filter arguments.
+        optional collection and filter arguments. An image or cutout is binned if binning
+        arguments are given, converted to the given output data type, if any, and then tile
+        compressed if compression arguments are given. A cutout is rendered as a preview
+        image if preview arguments are given, or written as a raw array if an array format is
+        given. A cutout is made of the given image extensions, if any, instead of the primary
+        HDU, and, from a data cube, in the planes selected by the given plane arguments, if any.
+        :raises: RequestException if a preview or a raw array is requested without a cutout
+            size, a data type conversion without a cutout size or binning, image extensions or
+            planes without a cutout size, binning, a preview, a conversion, or a raw array of
+            several image extensions, or a raw array of int16 data.
         """
+        if ((co_args.get('co_size') is None) and preview):
+            errMsg = "A cutout size must be specified to render a preview image"
+            current_app.logger.error(errMsg)
+            raise exceptions.RequestException(errMsg)
+
+        if ((co_args.get('co_size') is None) and array_format):
+            errMsg = "A cutout size must be specified to write a cutout as a raw array"
+            current_app.logger.error(errMsg)
+            raise exceptions.RequestException(errMsg)
+
+        if (array_format and (dtype == 'int16')):
+            errMsg = "Raw array cutouts hold unscaled values: request the float32 data type instead of int16"
+            current_app.logger.error(errMsg)
+            raise exceptions.RequestException(errMsg)
+
+        if ((co_args.get('co_size') is None) and dtype and (not binning)):
+            errMsg = "A cutout size or binning must be specified to convert the data type of an image"
+            current_app.logger.error(errMsg)
+            raise exceptions.RequestException(errMsg)
+
+        if ((co_args.get('co_size') is None) and extensions):
+            errMsg = "A cutout size must be specified to select image extensions"
+            current_app.logger.error(errMsg)
+            raise exceptions.RequestException(errMsg)
+
+        if ((co_args.get('co_size') is None) and planes):
+            errMsg = "A cutout size must be specified to select the planes of a data cube"
+            current_app.logger.error(errMsg)
+            raise exceptions.RequestException(errMsg)
+
+        if (extensions and (len(extensions) > 1) and (preview or binning or dtype or array_format)):
+            errMsg = "Cutouts of several image extensions cannot be binned, previewed, converted, or written as raw arrays"
+            current_app.logger.error(errMsg)
+            raise exceptions.RequestException(errMsg)
+
         if (co_args.get('co_size') is None):  # if no size specified, return the entire image
             image_matches = self.query_coordinates(co_args, filt=filt, collection=collection)
             if (not image_matches):
@@ -105,19 +346,17 @@ class ImageManager ():
                 raise exceptions.ImageNotFound(errMsg)
             else:                                              # found at least one matching image
                 image_path = image_matches[-1].get('file_path')  # select last matching image
+                if (binning):                                  # return binned copy of image
+                    return self.get_binned_image(image_path, binning, compression=compression,
+                                                 dtype=dtype)
                 return self.return_image_at_path(image_path)   # exit and return entire image
 
-        else:                               # cutout size given, so make cutout
-            image_matches = self.query_cone(co_args, filt=filt, collection=collection)
-            if (not image_matches):
-                coll = f" in collection '{collection}'" if (collection) else ''
-                fltr = f" with filter '{filt}'" if (filt) else ''
-                errMsg = f"No matching image for coordinates (in cone){fltr}{coll} was found"
-                current_app.logger.error(errMsg)
-                raise exceptions.ImageNotFound(errMsg)
-            else:                           # else make, cache, and return cutout
-                image_path = image_matches[-1].get('file_path')  # select last matching image
-                return self.get_cutout(image_path, co_args, filt=filt, collection=collection)
+        else:                               # cutout size given, so make, cache, and return cutout
+            image_path = self.find_cutout_image(co_args, filt=filt, collection=collection)
+            return self.get_cutout(image_path, co_args, filt=filt, collection=collection,
+                                   compression=compression, preview=preview, binning=binning,
+                                   dtype=dtype, extensions=extensions, planes=planes,
+                                   array_format=array_format)
 
 
     def image_metadata (self, uid, select=None):
@@ -130,39 +369,67 @@ class ImageManager ():
         return self.pgsql.image_metadata(uid, select=select)
 
 
-    def image_metadata_by_collection (self, collection):
+    def image_metadata_by_collection (self, collection, after_id=None, limit=None, stream=False):
         """
         Return a (possibly empty) list of image metadata dictionaries for all images in
-        the specified collection.
+        the specified collection. If streaming, return a generator of the dictionaries instead.
+        The optional after_id and limit arguments select a single page of the results.
         """
-        return self.pgsql.image_metadata_by_query(collection=collection)
+        return self.pgsql.image_metadata_by_query(collection=collection, after_id=after_id,
+                                                  limit=limit, stream=stream)
 
 
-    def image_metadata_by_path (self, ipath, collection=None):
+    def image_metadata_by_ids (self, uids, select=None):
+        """
+        Return a list of the metadata of the identified images, in the order of the given IDs:
+        a dictionary for each ID, giving the ID ('id') and the metadata dictionary of its image
+        ('metadata'), which is None if the ID has no metadata record.
+        :param uids: a list of image IDs.
+        :param select: an optional list of metadata fields to be returned (default ALL fields).
+        """
+        found = { md.get('id'): md for md in self.pgsql.image_metadata_by_ids(uids, select=select) }
+        return [ { 'id': uid, 'metadata': found.get(uid) } for uid in uids ]
+
+
+    def image_metadata_by_path (self, ipath, collection=None, after_id=None, limit=None):
         """
         Return a (possibly empty) list of image metadata dictionaries for all images with
         the specified image path (which will have different collections).
         If a collection name is specified, the listing is restricted to the named collection.
+        The optional after_id and limit arguments select a single page of the results.
         """
-        return self.pgsql.image_metadata_by_path(ipath, collection=collection)
+        return self.pgsql.image_metadata_by_path(ipath, collection=collection,
+                                                 after_id=after_id, limit=limit)
 
 
-    def image_metadata_by_filter (self, filt, collection=None):
+    def image_metadata_by_filter (self, filt, collection=None, after_id=None, limit=None,
+                                  stream=False):
         """
         Return a (possibly empty) list of image metadata dictionaries for all images with
-        the specified filter.
+        the specified filter. If streaming, return a generator of the dictionaries instead.
         If a collection name is specified, the listing is restricted to the named collection.
+        The optional after_id and limit arguments select a single page of the results.
+        """
+        return self.pgsql.image_metadata_by_query(filt=filt, collection=collection,
+                                                  after_id=after_id, limit=limit, stream=stream)
+
+
+    def invalidate_list_caches (self, payload=None):
+        """
+        Discard the cached lists of collections, filters, and image paths, so that they are
+        reloaded from the database. Called when ingestion announces new images.
         """
-        return self.pgsql.image_metadata_by_query(filt=filt, collection=collection)
+        self.list_cache.invalidate()
 
 
-    def is_cutout_cached (self, co_filename, co_dir=DEFAULT_CO_CACHE_DIR):
+    def is_cutout_cached (self, co_filename, co_dir=None):
         """
-        Tell whether the given cutout filename exists in the given (or default)
-        cutouts directory or not.
+        Tell whether the given cutout filename (of a FITS cutout or a preview image)
+        exists in the given (or default) cutouts directory or not.
         """
+        co_dir = co_dir or self.co_cache.cache_dir
         co_filepath = os.path.join(co_dir, co_filename)
-        return True if fits_file_exists(co_filepath) else False
+        return True if validate_file_path(co_filepath, CUTOUT_EXTENTS) else False
 
 
     def is_irods_file (self, filepath):
@@ -172,16 +439,15 @@ class ImageManager ():
 
     def list_collections (self):
         """ Return a list of collection name strings for all image collections. """
-        colls = self.pgsql.list_collections()
-        colls.sort()
-        return colls
+        return self.cached_list(('collections',), self.pgsql.list_collections)
 
 
-    def list_cutouts (self, co_dir=DEFAULT_CO_CACHE_DIR):
+    def list_cutouts (self, co_dir=None):
         """
         Return a list of image cutout filenames from the given (or default)
         cutouts cache directory.
         """
+        co_dir = co_dir or self.co_cache.cache_dir
         return [ fyl for fyl in os.listdir(co_dir) if os.path.isfile(os.path.join(co_dir, fyl)) ]
 
 
@@ -189,102 +455,485 @@ class ImageManager ():
         """
         Return a list of filter names for all images or those in the specified collection.
         """
-        filts = self.pgsql.list_filters(collection=collection)
-        filts.sort()
-        return filts
+        return self.cached_list(('filters', collection),
+                                lambda: self.pgsql.list_filters(collection=collection))
 
 
     def list_image_paths (self, collection=None):
         """
         Return a list of image path strings for all images or those in the specified collection.
         """
-        paths = self.pgsql.list_image_paths(collection=collection)
-        paths.sort()
-        return paths
+        return self.cached_list(('image_paths', collection),
+                                lambda: self.pgsql.list_image_paths(collection=collection))
 
 
-    def make_cutout (self, hdu, co_args, co_mode=DEFAULT_CUTOUTS_MODE):
+    def make_array (self, co_filename, fmt, co_dir=None):
         """
-        Make and return an image cutout for the image HDU, using the given cutout parameters.
+        Write the data of the given cached cutout as a raw array in the given array format
+        (see write_array_file), unless it is already cached. Return the filename of the array
+        file, which is cached alongside the cutout.
         """
-        wcs = WCS(hdu.header)
+        return self.make_cutout_variant(co_filename, array_filename(co_filename, fmt),
+                                        write_array_file, fmt, co_dir=co_dir)
 
-        # make the cutout and update its WCS info
-        try:
-            cutout = Cutout2D(hdu.data, position=co_args['center'], size=co_args['co_size'],
-                              wcs=wcs, mode=co_mode)
-        except (NoOverlapError, PartialOverlapError):
-            sky = co_args['center']
-            errMsg = f"There is no overlap between the reference image and the given center coordinate: {sky.ra.value}, {sky.dec.value} {sky.ra.unit.name} ({sky.frame.name})"
+
+    def make_binned_cutout (self, co_filename, binning, co_dir=None):
+        """
+        Make a binned variant of the given cached cutout, with the given binning arguments
+        (see parse_binning_args), unless it is already cached. Return the filename of the
+        binned cutout, which is cached alongside the cutout.
+        """
+        return self.make_cutout_variant(co_filename, binned_cutout_filename(co_filename, binning),
+                                        bin_cutout_file, binning, co_dir=co_dir)
+
+
+    def make_binned_image (self, ipath, binning, co_dir=None):
+        """
+        Make a binned copy of the entire image at the given path, with the given binning
+        arguments (see parse_binning_args), unless it is already cached. Return the filename
+        of the binned image, which is cached in the cutouts cache under a key identifying the
+        current contents of the image.
+        :raises: ImageNotFound if the image file is not found, or NotYetImplemented for an
+            iRods image.
+        """
+        if (self.is_irods_file(ipath)):
+            errMsg = "iRods connection capabilities not yet implemented."
+            raise exceptions.NotYetImplemented(errMsg)
+        if (not fits_file_exists(ipath)):
+            errMsg = f"Specified image file '{ipath}' not found"
             current_app.logger.error(errMsg)
-            raise exceptions.RequestException(errMsg)
+            raise exceptions.ImageNotFound(errMsg)
+        return self.make_cutout_variant(os.path.basename(ipath), binned_image_filename(ipath, binning),
+                                        bin_cutout_file, binning, co_dir=co_dir,
+                                        src_filepath=self.mappable_image_path(ipath))
+
+
+    def make_cached_cutout (self, ipath, co_args, collection=None, filt=None, extensions=None,
+                            planes=None):
+        """
+        Make the image cutout, specified by the given cutout arguments and optional collection
+        and filter arguments, of the given image extensions, if any (see parse_extension_arg),
+        in the planes of a data cube selected by the given plane arguments, if any (see
+        parse_plane_args), and save it in the cutouts cache, unless it is already cached.
+        Return the filename of the cached cutout. Concurrent requests for the same uncached
+        cutout are coalesced: one request makes the cutout while the others wait for it.
+        """
+        co_params = self.make_cutout_params(ipath, co_args, collection=collection, filt=filt,
+                                            extensions=extensions, planes=planes)
+        co_filename = cutout_filename(co_params)
+        if (not self.is_cutout_cached(co_filename)):
+            co_filepath = os.path.join(self.co_cache.cache_dir, co_filename)
+            with self.co_cache.producing(co_filepath):
+                if (not self.is_cutout_cached(co_filename)):  # not made while waiting
+                    if (co_params.get('quantum_deg')):        # cut at the quantized center
+                        co_args = quantized_cutout_args(co_args, co_params)
+                    self.make_cutout_and_save(ipath, co_args, co_filename, extensions=extensions,
+                                              planes=planes)
+                    self.co_cache.write_index(co_filepath, co_params)
+        return co_filename
+
+
+    def make_converted_cutout (self, co_filename, dtype, co_dir=None):
+        """
+        Make a variant of the given cached cutout with its data converted to the given output
+        data type (see parse_dtype_arg), unless it is already cached. Return the filename of
+        the converted cutout, which is cached alongside the cutout.
+        """
+        return self.make_cutout_variant(co_filename, converted_cutout_filename(co_filename, dtype),
+                                        convert_cutout_file, dtype, co_dir=co_dir)
 
-        # save cutout image in the FITS HDU and update FITS header with cutout WCS
-        hdu.data = cutout.data
-        hdu.header.update(cutout.wcs.to_header())
 
-        return cutout
+    def make_cutout (self, hdu, co_args, co_mode=DEFAULT_CUTOUTS_MODE, wcs=None):
+        """
+        Make and return an image cutout for the image HDU, using the given cutout parameters.
+        The HDU is not modified. The WCS of the HDU is parsed from its header, if not given.
+        """
+        try:
+            return cut_image(hdu, co_args, co_mode, wcs=wcs)
+        except exceptions.RequestException as rex:
+            current_app.logger.error(rex.message)
+            raise
 
 
-    def make_cutout_and_save (self, ipath, co_args, co_filename, co_dir=DEFAULT_CO_CACHE_DIR):
+    def make_cutout_and_save (self, ipath, co_args, co_filename, co_dir=None,
+                              extensions=None, planes=None):
         """
         Cut out a section of the image at the given image path, using the specifications
-        in the given cutout arguments, then save it in the cutout cache directory with
-        the given cutout filename.
+        in the given cutout arguments, from each of the given image extensions, if any (see
+        cut_extensions), and in the given planes of a data cube, if any (see cut_cube), then
+        save it in the cutout cache directory with the given cutout filename. The CPU-bound
+        work is done by the cutout pool, if it is enabled, and otherwise in this process,
+        using this manager's cache of opened images. A gzipped image is cut from its
+        decompressed copy (see mappable_image_path).
         """
-        hdu = fits.open(ipath)[0]
-        cutout = self.make_cutout(hdu, co_args)
+        co_dir = co_dir or self.co_cache.cache_dir
+        co_filepath = os.path.join(co_dir, co_filename)
+        pool_args = { 'center': co_args['center'], 'co_size': co_args['co_size'] }
+        ipath = self.mappable_image_path(ipath)
         try:
-            # write the cutout to a new FITS file in the cutouts cache dir
-            self.write_cutout(hdu, co_filename, co_dir=co_dir)
-        except Exception as ex:
-            errMsg = f"Unexpected error while writing image cutout to cache file '{co_filename}' in cache directory '{co_dir}'"
+            if (self.co_pool.is_enabled()):
+                self.co_pool.run(make_cutout_file, ipath, pool_args, co_filepath,
+                                 extensions=extensions, planes=planes)
+            else:
+                make_cutout_file(ipath, pool_args, co_filepath, hdu_cache=self.hdu_cache,
+                                 extensions=extensions, planes=planes)
+        except exceptions.ProcessingError as pe:
+            current_app.logger.error(pe.message)
+            raise
+        self.co_cache.added(co_filepath)    # sweep if over quota
+
+
+    def make_compressed_cutout (self, co_filename, compression, co_dir=None):
+        """
+        Make a tile compressed variant of the given cached cutout, with the given compression
+        arguments (see parse_compression_args), unless it is already cached. Return the
+        filename of the compressed cutout, which is cached alongside the cutout.
+        """
+        return self.make_cutout_variant(co_filename, compressed_cutout_filename(co_filename, compression),
+                                        compress_cutout_file, compression['compression_type'],
+                                        compression['quantize_level'], co_dir=co_dir)
+
+
+    def make_cutout_filename (self, ipath, co_args, collection=None, filt=None, extensions=None,
+                              planes=None):
+        """
+        Return a fixed-length filename for the image cutout: a hash of the canonical cutout
+        parameters (see make_cutout_params). The coordinate arguments must contain values
+        for 'ra', 'dec', 'size', and 'units' fields.
+        """
+        return cutout_filename(self.make_cutout_params(ipath, co_args, collection=collection,
+                                                       filt=filt, extensions=extensions,
+                                                       planes=planes))
+
+
+    def make_cutout_variant (self, co_filename, variant_filename, maker, *maker_args,
+                             co_dir=None, src_filepath=None):
+        """
+        Make the named variant (e.g., a compressed copy) of the given cached cutout, unless it
+        is already cached, by calling the given maker function, in the cutout pool, with the
+        paths of the cutout and the variant files and the given arguments. The variant is made
+        from the file at the given source path, instead of the cutout, if a path is given.
+        Concurrent requests for the same variant are coalesced. Return the filename of the
+        variant.
+        """
+        co_dir = co_dir or self.co_cache.cache_dir
+        if (not self.is_cutout_cached(variant_filename, co_dir=co_dir)):
+            co_filepath = src_filepath or os.path.join(co_dir, co_filename)
+            variant_filepath = os.path.join(co_dir, variant_filename)
+            with self.co_cache.producing(variant_filepath):
+                if (not self.is_cutout_cached(variant_filename, co_dir=co_dir)):
+                    try:
+                        self.co_pool.run(maker, co_filepath, variant_filepath, *maker_args)
+                    except exceptions.ProcessingError as pe:
+                        current_app.logger.error(pe.message)
+                        raise
+                    self.co_cache.added(variant_filepath)    # sweep if over quota
+        return variant_filename
+
+
+    def make_cutouts (self, positions, size_args, collection=None, filt=None, frame='icrs'):
+        """
+        Generator to make a cutout at each of the given positions, yielding a (position,
+        cutout HDU) pair for each position. Each position is a position dictionary (see
+        position_utils), which is updated with the path of its image ('image') and, if its
+        cutout could not be made, an error message ('error'), with a cutout HDU of None.
+
+        The image for each position is selected, as for a single cutout, by a cone search
+        (done in chunks, for many positions at once), taking the image whose stored footprint
+        best covers the position's cutout (see rank_cutout_images). Positions are then grouped
+        by image, so that each image is opened, and its WCS parsed, only once, and the cutouts
+        of each group are made by a single task in the cutout pool (see cut_positions). The
+        groups are run in waves which fill the pool, so that their cutouts are yielded as each
+        wave completes. The positions yielded with cutouts are copies of the given positions.
+
+        :param size_args: dictionary of cutout size arguments (see parse_cutout_size): the
+            'units' of the sizes and the default 'size', used for positions without a size.
+            Sizes are in arc seconds if no units are given.
+        :param collection: if specified, restrict the images to the named image collection.
+        :param filt: if specified, restrict the images to those with the named filter.
+        :param frame: the name of the coordinate frame of the positions.
+        """
+        units = size_args.get('units', u.arcsec)
+        by_size = defaultdict(list)         # positions to be cross-matched, by cutout size
+        for pos in positions:
+            if ('error' not in pos):
+                pos['size'] = pos.get('size', size_args.get('size'))
+                if (pos['size'] is None):
+                    pos['error'] = "A cutout size must be specified for the position or the request"
+                else:
+                    by_size[pos['size']].append(pos)
+            if ('error' in pos):
+                yield (pos, None)
+
+        by_image = defaultdict(list)        # positions with a matching image, by image ID
+        paths = dict()                      # image ID => path of the image
+        for (size, sized) in by_size.items():
+            co_size = u.Quantity(size, units)
+            co_args = { 'co_size': co_size }
+            for pos in self.query_cones(sized, co_args, collection=collection, filt=filt,
+                                        select=FOOTPRINT_SELECT_FIELDS):
+                image_matches = pos.pop('matches', None)
+                if (image_matches):
+                    try:
+                        center = SkyCoord(ra=pos['ra']*u.degree, dec=pos['dec']*u.degree, frame=frame)
+                    except (ValueError, TypeError) as ex:
+                        pos['error'] = f"Bad coordinates for the position: {ex}"
+                        yield (pos, None)
+                        continue
+                    pos_args = { 'co_size': co_size, 'center': center }
+                    best = self.rank_cutout_images(image_matches, pos_args)[0]  # best covering image
+                    by_image[best.get('id')].append(pos)
+                    paths[best.get('id')] = best.get('file_path')
+                else:
+                    pos['error'] = "No matching image for coordinates (in cone) was found"
+                    yield (pos, None)
+
+        for wave in gen_chunks(by_image.items(), max(1, self.co_pool.max_workers)):
+            tasks = []                      # (image ID, mappable image path, positions) of each group
+            failed = []                     # (image ID, positions) of each group whose image is unreadable
+            for (uid, matched) in wave:
+                ipath = paths.get(uid)
+                for pos in matched:
+                    pos['image'] = ipath
+                try:
+                    tasks.append((uid, self.mappable_image_path(ipath), matched))
+                except (exceptions.ProcessingError, OSError, TypeError, ValueError):
+                    failed.append((uid, matched))
+            made = self.co_pool.map(cut_positions, [ task[1] for task in tasks ],
+                                    [ task[2] for task in tasks ], [ units ] * len(tasks),
+                                    [ frame ] * len(tasks))
+            for ((uid, ipath, matched), stamps) in zip(tasks, made):
+                if (stamps is None):        # the image could not be opened
+                    failed.append((uid, matched))
+                else:
+                    yield from stamps
+            for (uid, matched) in failed:
+                for pos in matched:
+                    pos['error'] = f"Unable to read the image file for image ID {uid}"
+                    yield (pos, None)
+
+
+    def make_gzipped_cutout (self, co_filename, co_dir=None):
+        """
+        Make a gzipped copy of the given cached cutout, unless it is already cached.
+        Return the filename of the gzipped copy, which is cached alongside the cutout.
+        """
+        return self.make_cutout_variant(co_filename, gzip_cutout_filename(co_filename),
+                                        gzip_cutout_file, self.co_gzip_level, co_dir=co_dir)
+
+
+    def make_position_cutout (self, image, pos, units, frame='icrs'):
+        """
+        Make and return a cutout HDU from the given opened image (see HDUCache) centered at
+        the given position, of the position's size in the given units. Return None, setting
+        an error message in the position, if the cutout cannot be made.
+        """
+        return cut_position(image, pos, units, frame)
+
+
+    def make_cutout_hdu (self, hdu, cutout):
+        """
+        Return a new primary HDU containing the data of the given cutout of the given HDU
+        and a copy of the header of the HDU, updated with the WCS of the cutout.
+        """
+        return cutout_hdu(hdu, cutout)
+
+
+    def make_cutout_params (self, ipath, co_args, collection=None, filt=None, extensions=None,
+                            planes=None):
+        """
+        Return a dictionary of the canonical parameters of the image cutout, computed from the
+        coordinate/size arguments, the identity of the image file, and the optional collection,
+        filter, image extensions, and plane arguments. Equivalent requests (e.g., sizes in
+        different units or slightly different coordinate strings) have the same canonical
+        parameters.
+        """
+        coll = self.pgsql.clean_id(collection) if (collection is not None) else None
+        fltr = self.pgsql.clean_id(filt) if (filt is not None) else None
+        return canonical_cutout_params(ipath, co_args, collection=coll, filt=fltr,
+                                       pixel_fraction=self.co_key_pixel_fraction,
+                                       extensions=extensions, planes=planes)
+
+
+    def make_filter_cube (self, co_args, collection=None):
+        """
+        Make a cutout, specified by the given cutout arguments (which must include a size),
+        in each filter which has an image containing the cutout center within the cutout
+        radius, and return the cutouts as a multi-extension FITS HDU list: an empty primary
+        HDU followed by an image extension for each filter, named by the filter and carrying
+        its own WCS. The images are found by a single cone search, taking the image in each
+        filter which best covers the cutout, and the cutouts are made concurrently in the
+        cutout pool (see make_filter_cutouts).
+        Filters whose cutouts cannot be made are listed in the primary header.
+        :param collection: if specified, restrict the images to the named image collection.
+        :raises: ImageNotFound if no image matches, or RequestException if no cutout can be made.
+        """
+        by_filter = dict()                  # filter => metadata of the image to cut
+        image_matches = self.query_cone(co_args, collection=collection,
+                                        select=FOOTPRINT_SELECT_FIELDS)
+        for md in self.rank_cutout_images(image_matches, co_args):
+            by_filter.setdefault(md.get('filter'), md)  # select best image in each filter
+        if (not by_filter):
+            coll = f" in collection '{collection}'" if (collection) else ''
+            errMsg = f"No matching image for coordinates (in cone){coll} was found"
             current_app.logger.error(errMsg)
-            raise exceptions.ServerError(errMsg)
+            raise exceptions.ImageNotFound(errMsg)
+
+        filters = sorted(by_filter, key=lambda filt: str(filt))
+        results = self.make_filter_cutouts([ by_filter[filt] for filt in filters ], co_args)
+
+        hdus = fits.HDUList([ fits.PrimaryHDU() ])
+        errors = []
+        for (filt, (ext, error)) in zip(filters, results):
+            if (ext is not None):
+                hdus.append(ext)
+            else:
+                errors.append(f"{filt}: {error}")
+        if (len(hdus) == 1):
+            errMsg = f"No cutout could be made in any filter: {'; '.join(errors)}"
+            current_app.logger.error(errMsg)
+            raise exceptions.RequestException(errMsg)
+
+        hdus[0].header['CO_NFILT'] = (len(hdus) - 1, 'Number of filter cutout extensions')
+        for error in errors:
+            hdus[0].header.add_comment(f"No cutout in filter {error}")
+        return hdus
 
 
-    def make_cutout_filename (self, ipath, co_args, collection=None, filt=None):
+    def make_filter_cutout (self, md, co_args):
         """
-        Return a filename for the image cutout using the coordinate/size arguments and
-        the optional collection and filter arguments. The coordinate arguments must
-        contain values for 'ra', 'dec', 'size', and 'units' fields.
+        Make the cutout, specified by the given cutout arguments, of the image described by
+        the given image metadata, returning a pair of an image extension HDU, named by the
+        image's filter, and None or, if the cutout cannot be made, of None and an error message.
         """
-        basename = os.path.splitext(os.path.basename(ipath))[0]
-        ra = co_args.get('ra')
-        dec = co_args.get('dec')
-        size = co_args.get('size')
-        units = co_args.get('units').to_string()
-        coll = f"{self.pgsql.clean_id(collection)}_" if (collection is not None) else ''
-        fltr = f"{self.pgsql.clean_id(filt)}_" if (filt is not None) else ''
-        return f"{coll}{fltr}_{basename}__{ra}_{dec}_{size}{units}.fits"
+        return self.make_filter_cutouts([ md ], co_args)[0]
+
+
+    def make_filter_cutouts (self, mds, co_args):
+        """
+        Make the cutout, specified by the given cutout arguments, of each of the images
+        described by the given image metadata, concurrently in the cutout pool, one pool task
+        per image (see cut_filter_extension). Return a list of pairs, in the order of the
+        images, of an image extension HDU, named by the image's filter, and None or, if the
+        cutout cannot be made, of None and an error message.
+        """
+        results = [ None ] * len(mds)
+        tasks = []                          # (index, image path, filter) of each cutout to make
+        for (idx, md) in enumerate(mds):
+            try:
+                tasks.append((idx, self.mappable_image_path(md.get('file_path')), md.get('filter')))
+            except exceptions.ProcessingError as pe:
+                results[idx] = (None, f"Unable to make the cutout: {pe.message}")
+        made = self.co_pool.map(cut_filter_extension, [ task[1] for task in tasks ],
+                                [ co_args ] * len(tasks), [ task[2] for task in tasks ])
+        for (task, result) in zip(tasks, made):
+            results[task[0]] = result
+        return results
+
+
+    def make_preview (self, co_filename, preview, co_dir=None):
+        """
+        Render a preview image of the given cached cutout, with the given preview arguments
+        (see parse_preview_args), unless it is already cached. Return the filename of the
+        preview image, which is cached alongside the cutout under its own key.
+        """
+        return self.make_cutout_variant(co_filename, preview_filename(co_filename, preview),
+                                        render_preview_file, preview, co_dir=co_dir)
 
 
-    def query_cone (self, co_args, collection=None, filt=None, select=DEFAULT_SELECT_FIELDS):
+    def mappable_image_path (self, ipath):
+        """
+        Return the path of a file, holding the image at the given path, which can be memory
+        mapped to read a cutout without reading the whole image: the given path itself unless
+        the image is gzipped. A gzipped image cannot be read at random, so a decompressed copy
+        of it is made once, in the cache of decompressed images, unless it is already cached,
+        and its path is returned. The copy is keyed by the identity of the gzipped image, so
+        a replaced image is decompressed again. Concurrent requests for the same copy are
+        coalesced, and the least recently used copies are evicted to keep within that cache's
+        own quota.
+        """
+        if (not is_gzipped_fits_filename(ipath)):
+            return ipath
+        dc_filepath = os.path.join(self.dc_cache.cache_dir, decompressed_image_filename(ipath))
+        if (not os.path.isfile(dc_filepath)):
+            with self.dc_cache.producing(dc_filepath):
+                if (not os.path.isfile(dc_filepath)):  # not made while waiting
+                    try:
+                        self.co_pool.run(decompress_image_file, ipath, dc_filepath)
+                    except exceptions.ProcessingError as pe:
+                        current_app.logger.error(pe.message)
+                        raise
+                    self.dc_cache.added(dc_filepath)    # sweep if over quota
+                    return dc_filepath
+        self.dc_cache.touch(dc_filepath)    # a recent use delays its eviction
+        return dc_filepath
+
+
+    def query_cone (self, co_args, collection=None, filt=None, select=DEFAULT_SELECT_FIELDS,
+                    after_id=None, limit=None):
         """
         Return a list of image metadata for images which contain a given point
         within a given radius. If an image collection is specified, restrict the search
-        to the specified collection.
+        to the specified collection. The optional after_id and limit arguments select
+        a single page of the results.
         :return a possibly empty list of image metadata dictionaries
         """
         ra = co_args.get('ra')
         dec = co_args.get('dec')
         radius = co_args.get('size')
-        return self.pgsql.query_cone(ra, dec, radius, collection=collection, filt=filt, select=select)
+        return self.pgsql.query_cone(ra, dec, radius, collection=collection, filt=filt,
+                                     select=select, after_id=after_id, limit=limit)
 
 
-    def query_coordinates (self, co_args, collection=None, filt=None, select=DEFAULT_SELECT_FIELDS):
+    def query_cones (self, positions, co_args, collection=None, filt=None, select=None,
+                     chunk_size=DEFAULT_POSITIONS_CHUNK_SIZE):
+        """
+        Generator to yield, for each of the given positions, a dictionary containing the row
+        index, the coordinates, and a (possibly empty) list of the IDs of the images centered
+        within the radius given by the cutout size argument ('ids') or, if a list of fields
+        is selected, of the selected metadata of those images ('matches'). Positions are
+        cross-matched in chunks of the given size, each with a single database query.
+        A position containing an error message is passed through unchanged.
+
+        :param positions: an iterable of position dictionaries (see position_utils).
+        :param co_args: dictionary of cutout size arguments: must include 'co_size'.
+        :param collection: if specified, restrict the search to the named image collection.
+        :param filt: if specified, restrict the search to images with the named filter.
+        :param select: if specified, a list of the image metadata fields to be returned
+            for each matching image, instead of its ID.
+        """
+        radius = co_args['co_size'].to(u.deg).value
+        for chunk in gen_chunks(positions, chunk_size):
+            good = [ (pos['row'], pos['ra'], pos['dec']) for pos in chunk if ('error' not in pos) ]
+            matches = self.pgsql.query_cones(good, radius, collection=collection, filt=filt,
+                                             select=(select or ['id'])) if good else {}
+            for pos in chunk:
+                if ('error' not in pos):
+                    image_matches = matches.get(pos['row'], [])
+                    if (select):
+                        pos['matches'] = image_matches
+                    else:
+                        pos['ids'] = [ md['id'] for md in image_matches ]
+                yield pos
+
+
+    def query_coordinates (self, co_args, collection=None, filt=None, select=DEFAULT_SELECT_FIELDS,
+                           after_id=None, limit=None):
         """
         Return a list of image metadata for images which contain a specific point specified by
         the given coordiate arguments, which must include values for 'ra' and 'dec'.
         If an image collection is specified, restrict the search to the specified collection.
+        The optional after_id and limit arguments select a single page of the results.
         :return a possibly empty list of image metadata dictionaries
         """
         ra = co_args.get('ra')
         dec = co_args.get('dec')
-        return self.pgsql.query_coordinates(ra, dec, collection=collection, filt=filt, select=select)
+        return self.pgsql.query_coordinates(ra, dec, collection=collection, filt=filt,
+                                            select=select, after_id=after_id, limit=limit)
 
 
-    def query_image (self, collection=None, filt=None, select=DEFAULT_SELECT_FIELDS):
+    def query_image (self, collection=None, filt=None, select=DEFAULT_SELECT_FIELDS,
+                     after_id=None, limit=None, stream=False):
         """
         Return a list of selected image metadata fields for images which meet the
         given filter and/or collection criteria.
@@ -292,26 +941,82 @@ class ImageManager ():
         :param collection: if specified, restrict the listing to the named image collection.
         :param filt: if specified, restrict the listing to images with the named filter.
         :param select: a optional list of fields to be returned in the query (default ALL fields).
+        :param after_id: if specified, return only images whose ID is greater than this value.
+        :param limit: if specified, return metadata for at most this many images.
+        :param stream: if True, return a generator of metadata dictionaries instead of a list.
+        """
+        return self.pgsql.query_image(collection=collection, filt=filt, select=select,
+                                      after_id=after_id, limit=limit, stream=stream)
+
+
+    def rank_cutout_images (self, image_matches, co_args):
+        """
+        Return the given image metadata (which should include the footprint corner fields)
+        sorted from the best to the worst image from which to make the cutout specified by
+        the given cutout arguments: images whose footprints contain the whole cutout first,
+        then by the fraction of the cutout covered, then by the nearness of the image center.
+        No image file is read.
+        """
+        center = co_args['center'].icrs
+        return rank_footprints(image_matches, center.ra.deg, center.dec.deg,
+                               co_args['co_size'].to(u.deg).value)
+
+
+    def return_array_with_name (self, co_filename, fmt, co_dir=None):
+        """
+        Return the data of the named cached cutout as a raw array in the given array format
+        ('npy' or 'arrow'), written once and cached (see make_array), so that the array file
+        is sent as is, without a FITS header to parse. The WCS of the cutout is given, as a
+        JSON object of WCS keywords, in the 'X-Cutout-WCS' response header (a .npy file can
+        hold no metadata): an Arrow file also holds it in its schema metadata.
         """
-        return self.pgsql.query_image(collection=collection, filt=filt, select=select)
+        co_dir = co_dir or self.co_cache.cache_dir
+        ar_filename = self.make_array(co_filename, fmt, co_dir=co_dir)
+        resp = self.return_cutout_with_name(ar_filename, co_dir=co_dir, mimetype=ARRAY_MIME_TYPES[fmt])
+        wcs = self.array_wcs(co_filename, ar_filename, co_dir=co_dir)
+        if (wcs is not None):               # else the cutout was evicted: send the array alone
+            resp.headers[WCS_HEADER_NAME] = json.dumps(wcs)
+        return resp
 
 
-    def return_cutout_with_name (self, co_filename, co_dir=DEFAULT_CO_CACHE_DIR, mimetype=FITS_MIME_TYPE):
-        """ Return the named cutout file, giving it the specified MIME type. """
-        if (self.is_cutout_cached(co_filename)):
-            return send_from_directory(co_dir, co_filename, mimetype=mimetype,
-                                       as_attachment=True, download_name=co_filename)
+    def return_cutout_with_name (self, co_filename, co_dir=None, mimetype=FITS_MIME_TYPE,
+                                 as_attachment=True):
+        """
+        Return the named cutout file, giving it the specified MIME type. If gzip encoding is
+        enabled and the client accepts it, an uncompressed cutout is sent as its (cached)
+        gzipped copy, with a 'Content-Encoding: gzip' header, unless the client asks for a
+        byte range of the cutout or the cutout is delivered by a front proxy. Conditional and
+        range requests are supported (see send_file).
+        """
+        co_dir = co_dir or self.co_cache.cache_dir
+        if (self.is_cutout_cached(co_filename, co_dir=co_dir)):
+            self.co_cache.touch(os.path.join(co_dir, co_filename))  # record use for LRU eviction
+            negotiable = (self.co_gzip_encoding and (self.file_delivery_mode == 'direct') and
+                          (not is_compressed_cutout_filename(co_filename)))
+            send_filename = co_filename
+            if (negotiable and accepts_encoding('gzip') and (not is_range_request())):
+                send_filename = self.make_gzipped_cutout(co_filename, co_dir=co_dir)
+                self.co_cache.touch(os.path.join(co_dir, send_filename))
+            resp = self.send_file(os.path.join(co_dir, send_filename), mimetype,
+                                  download_name=co_filename, as_attachment=as_attachment)
+            if (send_filename != co_filename):
+                resp.headers['Content-Encoding'] = 'gzip'
+            if (negotiable):
+                resp.vary.add('Accept-Encoding')
+            return resp
         errMsg = f"Cached image cutout file '{co_filename}' not found in cutouts cache directory"
         current_app.logger.error(errMsg)
         raise exceptions.ImageNotFound(errMsg)
 
 
     def return_image_at_filepath (self, filepath, mimetype=FITS_MIME_TYPE):
-        """ Return the image file at the specified file path, giving it the specified MIME type. """
+        """
+        Return the image file at the specified file path, giving it the specified MIME type.
+        Conditional and range requests are supported (see send_file), so that a client can
+        revalidate, resume, or partially read (e.g., just the header of) an image.
+        """
         if (fits_file_exists(filepath)):
-            (imageDir, filename) = os.path.split(filepath)
-            return send_from_directory(imageDir, filename, mimetype=mimetype,
-                                       as_attachment=True, download_name=filename)
+            return self.send_file(filepath, mimetype)
         else:
             errMsg = f"Specified image file '{filepath}' not found"
             current_app.logger.error(errMsg)
@@ -331,10 +1036,29 @@ class ImageManager ():
             return self.return_image_at_filepath(ipath, mimetype=mimetype)
 
 
-    def write_cutout (self, hdu, co_filename, co_dir=DEFAULT_CO_CACHE_DIR, overwrite=True):
+    def send_file (self, filepath, mimetype, download_name=None, as_attachment=True):
+        """
+        Return a response delivering the file at the given (already authorized) path, with
+        the given MIME type. Unless the file delivery mode is 'direct', the transfer of the
+        file is handed to the front proxy (see offload_file_response), so that this process
+        does not copy the file; otherwise, or if the proxy cannot serve the file, the file is
+        sent by this process (see send_file_response).
+        """
+        if (self.file_delivery_mode != 'direct'):
+            resp = offload_file_response(filepath, mimetype, self.file_delivery_mode,
+                                         locations=self.file_delivery_locations,
+                                         download_name=download_name, as_attachment=as_attachment)
+            if (resp is not None):
+                return resp
+        return send_file_response(filepath, mimetype, download_name=download_name,
+                                  as_attachment=as_attachment)
+
+
+    def write_cutout (self, hdu, co_filename, co_dir=None, overwrite=True):
         """
         Write the contents of the given HDU to the named file in the given (or default)
-        cutouts directory.
+        cutouts directory. The contents are written to a hidden temporary file which is then
+        renamed, so that readers never see a partially written cutout file.
         """
-        co_filepath = os.path.join(co_dir, co_filename)
-        hdu.writeto(co_filepath, overwrite=True)
+        co_dir = co_dir or self.co_cache.cache_dir
+        write_hdu_file(hdu, os.path.join(co_dir, co_filename), overwrite=overwrite)
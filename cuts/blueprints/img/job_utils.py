@@ -0,0 +1,76 @@
+#
+# Utilities for submitting and tracking asynchronous cutout jobs run by the Celery workers.
+#   Last Modified: Initial creation.
+#
+import uuid
+
+from flask import current_app, url_for
+
+from cuts.blueprints.img import exceptions
+
+
+# Statuses reported for a cutout job
+JOB_QUEUED = 'QUEUED'
+JOB_RUNNING = 'RUNNING'
+JOB_DONE = 'DONE'
+JOB_FAILED = 'FAILED'
+
+# Map from Celery task states to reported job statuses. Celery reports an unknown task ID
+# (e.g., of an expired job) as PENDING, so unknown jobs are reported as queued.
+CELERY_JOB_STATUSES = {
+    'PENDING': JOB_QUEUED,
+    'RECEIVED': JOB_QUEUED,
+    'RETRY': JOB_QUEUED,
+    'STARTED': JOB_RUNNING,
+    'SUCCESS': JOB_DONE,
+    'FAILURE': JOB_FAILED,
+    'REVOKED': JOB_FAILED
+}
+
+
+def job_error (state, result):
+    """
+    Return an error dictionary (with 'error_code' and 'message' entries) describing why the
+    job with the given Celery state and result failed, or None if the job has not failed.
+    Errors found while processing the job are returned as the job's result by the worker.
+    """
+    if (isinstance(result, dict) and result.get('error')):
+        return result.get('error')
+    if (CELERY_JOB_STATUSES.get(state) == JOB_FAILED):
+        return { 'error_code': exceptions.ServerError.ERROR_CODE,
+                 'message': f"The cutout job failed unexpectedly (state {state})" }
+    return None
+
+
+def job_status (job_id, state, result=None):
+    """
+    Return a status dictionary for the job with the given ID, Celery state, and result,
+    including the URLs from which to poll the job's status and, when it is done, to fetch
+    its result. Must be called within a request context.
+    """
+    error = job_error(state, result)
+    status = JOB_FAILED if error else CELERY_JOB_STATUSES.get(state, JOB_QUEUED)
+    job = {
+        'job_id': job_id,
+        'status': status,
+        'status_url': url_for('img.co_job_status', job_id=job_id, _external=True)
+    }
+    if (error):
+        job['error'] = error
+    elif (status == JOB_DONE):
+        job['filename'] = result.get('filename')
+        job['result_url'] = url_for('img.co_job_result', job_id=job_id, _external=True)
+    return job
+
+
+def parse_job_id (job_id):
+    """
+    Return the given cutout job ID, in canonical form, if it is a valid job ID.
+    :raises: RequestException if the job ID is not valid.
+    """
+    try:
+        return str(uuid.UUID(str(job_id)))
+    except ValueError:
+        errMsg = f"A valid cutout job ID must be specified: '{job_id}' is not a job ID"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
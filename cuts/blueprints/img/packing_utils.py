@@ -0,0 +1,97 @@
+#
+# Methods to convert cutout data to smaller data types: float32, or int16 scaled by BSCALE/BZERO.
+#   Last Modified: Initial creation.
+#
+import numpy as np
+
+from astropy.io import fits
+
+
+# Output data types of cutouts, with the tags which name their cached variants
+OUTPUT_DTYPES = { 'float32': 'f32', 'int16': 'i16' }
+
+# Stored value of the blank (NaN) pixels of int16 data, and the range of the other stored values
+INT16_BLANK = -32768
+INT16_MIN = -32767
+INT16_MAX = 32767
+
+# Header keys which describe the scaling of the unconverted data
+SCALING_KEYS = [ 'BSCALE', 'BZERO', 'BLANK', 'CHECKSUM', 'DATASUM' ]
+
+
+def convert_hdu (hdu, dtype):
+    """
+    Return a new primary HDU containing the data of the given image HDU converted to the given
+    output data type ('float32' or 'int16', see pack_int16) and a copy of its header, which
+    records the original data type and the precision of the converted data.
+    """
+    data = unscaled_blanks(hdu)
+    header = hdu.header.copy()
+    for key in SCALING_KEYS:
+        header.remove(key, ignore_missing=True)
+    header['CO_ODTYP'] = (data.dtype.name, 'Data type of the unconverted cutout data')
+
+    if (dtype == 'int16'):
+        (stored, bscale, bzero) = pack_int16(data)
+        out = fits.PrimaryHDU(data=stored, header=header)
+        out.header['BSCALE'] = bscale       # set after the data: astropy writes them as is
+        out.header['BZERO'] = bzero
+        out.header['BLANK'] = INT16_BLANK
+        out.header['CO_QSTEP'] = (bscale, 'Quantization step of the packed int16 data')
+        out.header.add_history(f"Cutout data packed from {data.dtype.name} to int16: values are"
+                               f" rounded to multiples of {bscale:.6g} and blanks are BLANK")
+        return out
+
+    out = fits.PrimaryHDU(data=data.astype(np.float32), header=header)
+    out.header['CO_PREC'] = (float(np.finfo(np.float32).eps), 'Relative precision of the float32 data')
+    out.header.add_history(f"Cutout data converted from {data.dtype.name} to float32")
+    return out
+
+
+def int16_scaling (data, finite):
+    """
+    Return the (BSCALE, BZERO) pair which maps the range of the given finite values of the
+    given data onto the stored int16 values INT16_MIN to INT16_MAX. Integer data which fits
+    in that range is stored unscaled (BSCALE 1 and BZERO 0).
+    """
+    if (not finite.any()):
+        return (1.0, 0.0)
+    if (np.issubdtype(data.dtype, np.integer)):
+        (dmin, dmax) = (float(np.min(data)), float(np.max(data)))
+        if ((dmin >= INT16_MIN) and (dmax <= INT16_MAX)):
+            return (1.0, 0.0)
+    else:
+        dmin = float(np.min(data, where=finite, initial=np.inf))
+        dmax = float(np.max(data, where=finite, initial=-np.inf))
+    bscale = (dmax - dmin) / (INT16_MAX - INT16_MIN)
+    if (bscale <= 0):                       # constant data: store it all as zero
+        return (1.0, dmin)
+    return (bscale, dmin - INT16_MIN * bscale)
+
+
+def pack_int16 (data):
+    """
+    Return a (stored int16 data, BSCALE, BZERO) tuple packing the given data into int16 values,
+    scaled so that its range covers the int16 range (see int16_scaling), where each value is
+    BZERO + BSCALE * the stored value. Blank (NaN) and infinite values are stored as INT16_BLANK.
+    """
+    finite = np.isfinite(data)
+    (bscale, bzero) = int16_scaling(data, finite)
+    with np.errstate(invalid='ignore'):
+        scaled = np.rint((data - bzero) / bscale)
+    np.clip(scaled, INT16_MIN, INT16_MAX, out=scaled)
+    stored = np.full(data.shape, INT16_BLANK, dtype=np.int16)
+    np.copyto(stored, scaled, where=finite, casting='unsafe')
+    return (stored, bscale, bzero)
+
+
+def unscaled_blanks (hdu):
+    """
+    Return the data of the given image HDU, with its blank pixels as NaN: integer data which
+    was not scaled when read still holds the header's BLANK value at its blank pixels.
+    """
+    data = hdu.data
+    blank = hdu.header.get('BLANK')
+    if ((blank is not None) and np.issubdtype(data.dtype, np.integer)):
+        return np.where(data == blank, np.nan, data.astype(np.float64))
+    return data
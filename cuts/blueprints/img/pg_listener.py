@@ -0,0 +1,101 @@
+#
+# Class implementing a background listener for PostgreSQL LISTEN/NOTIFY notifications.
+#   Last Modified: Initial creation: invalidate cached metadata listings on notification.
+#
+import os
+import select
+import sys
+import threading
+
+import psycopg2
+import psycopg2.extensions
+
+from cuts.blueprints.img.misc_utils import keep_characters
+from cuts.blueprints.img.pg_sql_base import DB_ID_CHARS
+
+
+# Seconds between checks for a stop request while waiting for notifications
+DEFAULT_POLL_INTERVAL = 5
+
+# Seconds to wait before reconnecting after a database connection error
+DEFAULT_RETRY_INTERVAL = 30
+
+
+class PostgreSQLListener ():
+    """
+    Listens, in a background thread (a greenlet, under the Gunicorn gevent worker), on a
+    PostgreSQL notification channel and calls a given function with the payload of each
+    notification received. The function is also called with a payload of None whenever
+    the listener (re)connects, since notifications sent while disconnected are lost.
+    """
+
+    def __init__ (self, db_uri, channel, callback, poll_interval=DEFAULT_POLL_INTERVAL,
+                  retry_interval=DEFAULT_RETRY_INTERVAL):
+        """
+        Constructor for a listener on the given channel of the database at the given URI.
+        """
+        self.db_uri = db_uri
+        self.channel = keep_characters(channel, DB_ID_CHARS)
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+
+        self._pid = None                    # process in which the listener thread was started
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def is_running (self):
+        """ Tell whether the listener thread is running in the current process. """
+        return ((self._thread is not None) and (self._pid == os.getpid()) and
+                self._thread.is_alive())
+
+
+    def start (self):
+        """
+        Start the listener thread, if it is not already running in this process.
+        A listener inherited by a forked child process is restarted in the child.
+        """
+        if (self.is_running()):
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=f"pg-listener-{self.channel}")
+        self._thread.start()
+
+
+    def stop (self):
+        """ Ask the listener thread to stop: it stops within the polling interval. """
+        self._stop.set()
+
+
+    def _listen (self):
+        """ Connect to the database, listen on the channel, and dispatch notifications. """
+        conn = psycopg2.connect(self.db_uri)
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {self.channel};")
+            self.callback(None)             # anything might have changed while disconnected
+
+            while (not self._stop.is_set()):
+                if (select.select([conn], [], [], self.poll_interval) == ([], [], [])):
+                    continue                # timed out: check for a stop request
+                conn.poll()
+                while (conn.notifies):
+                    notify = conn.notifies.pop(0)
+                    self.callback(notify.payload)
+        finally:
+            conn.close()
+
+
+    def _run (self):
+        """ Listen for notifications until stopped, reconnecting after any errors. """
+        while (not self._stop.is_set()):
+            try:
+                self._listen()
+            except Exception as ex:
+                print(f"(PostgreSQLListener): error listening on channel '{self.channel}': {ex}",
+                      file=sys.stderr)
+                self._stop.wait(self.retry_interval)
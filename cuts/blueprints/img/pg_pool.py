@@ -0,0 +1,345 @@
+#
+# Class implementing a process-wide pool of connections to a PostgreSQL database.
+#   Last Modified: Wait for queries cooperatively under gevent; print only when debugging.
+#
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+import cuts.blueprints.img.exceptions as exceptions
+
+
+# Default pool sizing and recycling parameters: overridden by the DB configuration file
+DEFAULT_MAX_ACTIVE = 10                     # maximum connections open at once, per process
+DEFAULT_MAX_IDLE = 10                       # maximum idle connections kept in the pool
+DEFAULT_MAX_LIFETIME = 3600                 # seconds after which a connection is recycled
+DEFAULT_MAX_USES = 1000                     # checkouts after which a connection is recycled
+DEFAULT_MAX_WAIT = 30                       # seconds to wait for a free connection
+DEFAULT_VALIDATION_INTERVAL = 30            # validate connections idle longer than this
+DEFAULT_VALIDATION_QUERY = 'SELECT 1'
+DEFAULT_VALIDATION_QUERY_TIMEOUT = 2        # seconds allowed for the validation query
+
+# Connection errors which indicate that a connection is no longer usable
+BROKEN_CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+def install_wait_callback ():
+    """
+    Install the psycopg2 wait callback which waits for the database in select, if the select
+    module has been monkey patched by gevent (as by the Gunicorn gevent worker), so that a
+    query yields to the other greenlets of the worker, instead of blocking the whole worker
+    inside libpq, while it waits for the database. Return True if the callback is installed.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    if (not monkey.is_module_patched('select')):
+        return False
+    if (psycopg2.extensions.get_wait_callback() is None):
+        psycopg2.extensions.set_wait_callback(psycopg2.extras.wait_select)
+    return True
+
+
+class _PoolEntry ():
+    """ Record holding a pooled connection and its usage history. """
+    __slots__ = ('conn', 'created', 'last_used', 'uses')
+
+    def __init__ (self, conn):
+        self.conn = conn
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.uses = 0
+
+
+class PostgreSQLPool ():
+    """
+    Bounded pool of connections to a single PostgreSQL database. Connections are validated
+    before reuse and recycled after a maximum lifetime or number of uses. The pool is
+    synchronized with a threading.Condition, which the gevent monkey patching done by the
+    Gunicorn gevent worker makes greenlet-aware, and, under gevent, queries wait for the
+    database cooperatively (see install_wait_callback), so that the greenlets of a worker
+    can use several connections at once.
+    """
+
+    _pools = dict()                         # process-wide registry of pools, keyed by DB URI
+    _pools_lock = threading.Lock()
+    _pools_pid = None                       # process which owns the registered pools
+
+
+    def __init__ (self, db_uri, max_active=DEFAULT_MAX_ACTIVE, max_idle=DEFAULT_MAX_IDLE,
+                  max_lifetime=DEFAULT_MAX_LIFETIME, max_uses=DEFAULT_MAX_USES,
+                  max_wait=DEFAULT_MAX_WAIT, validation_interval=DEFAULT_VALIDATION_INTERVAL,
+                  validation_query=DEFAULT_VALIDATION_QUERY,
+                  validation_query_timeout=DEFAULT_VALIDATION_QUERY_TIMEOUT, debug=False):
+        """
+        Constructor for a pool of connections to the database at the given URI.
+        """
+        self._DEBUG = debug
+        self.db_uri = db_uri
+        self.max_active = max_active
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.max_uses = max_uses
+        self.max_wait = max_wait
+        self.validation_interval = validation_interval
+        self.validation_query = validation_query
+        self.validation_query_timeout = validation_query_timeout
+
+        self._cond = threading.Condition()
+        self._idle = deque()                # idle connection entries: most recently used last
+        self._in_use = dict()               # entries checked out, keyed by connection id
+        self._opening = 0                   # connections being opened outside of the lock
+
+        # usage statistics
+        self._checkouts = 0
+        self._opened = 0
+        self._closed = 0
+        self._waits = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._timeouts = 0
+
+
+    @classmethod
+    def get_pool (clazz, db_uri, dbconfig={}, debug=False):
+        """
+        Return the process-wide pool for the given database URI, creating it, sized by the
+        given database configuration dictionary, on first use. A forked child process
+        never shares the pools (or connections) of its parent.
+        """
+        install_wait_callback()             # the worker is monkey patched before first use
+        with clazz._pools_lock:
+            if (clazz._pools_pid != os.getpid()):  # first use or first use after a fork
+                clazz._pools = dict()
+                clazz._pools_pid = os.getpid()
+            pool = clazz._pools.get(db_uri)
+            if (pool is None):
+                pool = clazz(db_uri, debug=debug, **clazz.pool_args_from_config(dbconfig))
+                clazz._pools[db_uri] = pool
+        return pool
+
+
+    @classmethod
+    def pool_args_from_config (clazz, dbconfig):
+        """
+        Return a dictionary of pool constructor arguments from the given database
+        configuration dictionary (as loaded by PostgreSQLBase.load_sql_db_config).
+        :raises: ServerError if a pool parameter is not a valid number.
+        """
+        try:
+            max_active = int(dbconfig.get('db_max_active', DEFAULT_MAX_ACTIVE))
+            return {
+                'max_active': max_active,
+                'max_idle': int(dbconfig.get('db_max_idle', max_active)),
+                'max_lifetime': float(dbconfig.get('db_max_lifetime', DEFAULT_MAX_LIFETIME)),
+                'max_uses': int(dbconfig.get('db_max_uses', DEFAULT_MAX_USES)),
+                'max_wait': float(dbconfig.get('db_max_wait', DEFAULT_MAX_WAIT)),
+                'validation_interval': float(dbconfig.get('validation_interval',
+                                                          DEFAULT_VALIDATION_INTERVAL)),
+                'validation_query': dbconfig.get('validation_query', DEFAULT_VALIDATION_QUERY),
+                'validation_query_timeout': float(dbconfig.get('validation_query_timeout',
+                                                               DEFAULT_VALIDATION_QUERY_TIMEOUT))
+            }
+        except ValueError as ve:
+            errMsg = f"Invalid database connection pool parameter in DB configuration: {ve}"
+            raise exceptions.ServerError(errMsg)
+
+
+    @contextmanager
+    def connection (self):
+        """
+        Context manager which checks a connection out of the pool and returns it to the
+        pool on exit. A connection which raised a connection error is discarded.
+        """
+        entry = self.acquire()
+        broken = False
+        try:
+            yield entry.conn
+        except BROKEN_CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            self.release(entry, broken=broken)
+
+
+    def acquire (self):
+        """
+        Check out and return a validated pool entry, opening a new connection if the pool
+        is not at capacity or waiting for a connection to be released if it is.
+        :raises: ServerError if no connection becomes available within the maximum wait time.
+        """
+        while True:
+            entry = self._checkout()
+            if (entry.conn is None):        # a slot was reserved for a new connection
+                return self._open_reserved(entry)
+            if (self._is_valid(entry)):
+                return entry
+            self._discard(entry)            # failed validation: try again
+
+
+    def close_all (self):
+        """ Close all idle connections. Checked out connections are closed on release. """
+        with self._cond:
+            while (self._idle):
+                self._close(self._idle.pop())
+
+
+    def release (self, entry, broken=False):
+        """ Return the given entry to the pool or close it, if it is broken or expired. """
+        conn = entry.conn
+        if ((not broken) and (not conn.closed) and
+            (conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE)):
+            try:
+                conn.rollback()             # never return a connection inside a transaction
+            except BROKEN_CONNECTION_ERRORS:
+                broken = True
+
+        with self._cond:
+            self._in_use.pop(id(conn), None)
+            entry.last_used = time.monotonic()
+            if (broken or conn.closed or self._is_expired(entry) or
+                (len(self._idle) >= self.max_idle)):
+                self._close(entry)
+            else:
+                self._idle.append(entry)
+            self._cond.notify()
+
+
+    def stats (self):
+        """
+        Return a dictionary of current pool usage statistics, for sizing the pool against
+        the number of concurrent requests served by each worker process.
+        """
+        with self._cond:
+            return {
+                'pid': os.getpid(),
+                'max_active': self.max_active,
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+                'opened': self._opened,
+                'closed': self._closed,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time_total': round(self._wait_time_total, 6),
+                'wait_time_max': round(self._wait_time_max, 6),
+                'wait_time_avg': round(self._wait_time_total / self._waits, 6) if self._waits else 0.0,
+                'timeouts': self._timeouts
+            }
+
+
+    def _checkout (self):
+        """
+        Return an idle entry or an empty entry reserving a slot for a new connection,
+        waiting (up to the maximum wait time) for a connection to be released, if necessary.
+        """
+        started = None
+        with self._cond:
+            while True:
+                while (self._idle):
+                    entry = self._idle.pop()
+                    if (entry.conn.closed or self._is_expired(entry)):
+                        self._close(entry)
+                    else:
+                        return self._checked_out(entry, started)
+
+                if ((len(self._in_use) + self._opening) < self.max_active):
+                    self._opening += 1
+                    return self._checked_out(_PoolEntry(None), started)
+
+                if (started is None):
+                    started = time.monotonic()
+                    self._waits += 1
+                remaining = self.max_wait - (time.monotonic() - started)
+                if ((remaining <= 0) or (not self._cond.wait(remaining))):
+                    self._record_wait(started)
+                    self._timeouts += 1
+                    errMsg = f"No database connection became available within {self.max_wait} seconds"
+                    raise exceptions.ServerError(errMsg)
+
+
+    def _checked_out (self, entry, started):
+        """ Record the checkout of the given entry. Must be called holding the lock. """
+        if (started is not None):
+            self._record_wait(started)
+        self._checkouts += 1
+        if (entry.conn is not None):
+            entry.uses += 1
+            self._in_use[id(entry.conn)] = entry
+        return entry
+
+
+    def _close (self, entry):
+        """ Close the connection of the given entry, ignoring errors. """
+        try:
+            entry.conn.close()
+        except Exception:
+            pass
+        self._closed += 1
+
+
+    def _discard (self, entry):
+        """ Drop the given checked out entry from the pool and close its connection. """
+        with self._cond:
+            self._in_use.pop(id(entry.conn), None)
+            self._close(entry)
+            self._cond.notify()
+
+
+    def _is_expired (self, entry):
+        """ Tell whether the given entry has exceeded its maximum lifetime or number of uses. """
+        return (((time.monotonic() - entry.created) > self.max_lifetime) or
+                (entry.uses >= self.max_uses))
+
+
+    def _is_valid (self, entry):
+        """
+        Tell whether the connection of the given (checked out) entry is usable. Connections
+        idle for less than the validation interval are assumed to be good.
+        """
+        if ((time.monotonic() - entry.last_used) < self.validation_interval):
+            return True
+        try:
+            with entry.conn.cursor() as cursor:
+                timeout_ms = int(self.validation_query_timeout * 1000)
+                cursor.execute("SET LOCAL statement_timeout = %s", [timeout_ms])
+                cursor.execute(self.validation_query)
+            entry.conn.rollback()
+            return True
+        except psycopg2.Error as err:
+            if (self._DEBUG):
+                print(f"(PostgreSQLPool): discarding connection which failed validation: {err}",
+                      file=sys.stderr)
+            return False
+
+
+    def _open_reserved (self, entry):
+        """ Open a new connection for the given entry, which holds a reserved slot. """
+        try:
+            entry.conn = psycopg2.connect(self.db_uri)
+        except Exception:
+            with self._cond:
+                self._opening -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._opening -= 1
+            self._opened += 1
+            entry.uses = 1
+            self._in_use[id(entry.conn)] = entry
+        return entry
+
+
+    def _record_wait (self, started):
+        """ Accumulate the time spent waiting for a connection. Must be called holding the lock. """
+        waited = time.monotonic() - started
+        self._wait_time_total += waited
+        self._wait_time_max = max(self._wait_time_max, waited)
@@ -1,7 +1,7 @@
 #
 # Class for app to interact with a PostgreSQL database.
 #   Written by: Tom Hicks. 12/2/2020.
-#   Last Modified: Return image/data with highest ID.
+#   Last Modified: Select the metadata of the images found by a cone search for many positions.
 #
 import sys
 
@@ -73,12 +73,38 @@ class PostgreSQLManager (PostgreSQLBase):
         return imd
 
 
-    def image_metadata_by_path (self, ipath, collection=None, select=None):
+    def image_metadata_by_ids (self, uids, select=None):
+        """
+        Return a list of image metadata dictionaries for the images with the given IDs,
+        using a single query. IDs with no metadata record are simply absent from the result.
+        :param uids: a list of image IDs.
+        :param select: an optional list of metadata fields to be returned (default ALL fields).
+                       The 'id' field is always returned.
+        :return a list of metadata dictionaries, ordered by ID.
+        """
+        image_table = self.clean_table_name()
+        if ((select is not None) and ('id' not in select)):
+            select = ['id'] + list(select)
+        fields = self.sql4_selected_fields(select)
+
+        imgq = "SELECT {} FROM {} WHERE id = ANY(%s) ORDER BY id;".format(fields, image_table)
+        metadata = self.fetch_rows_2dicts(imgq, [list(uids)])
+
+        if (self._DEBUG):
+            print(f"(image_metadata_by_ids): len(metadata): {len(metadata)}", file=sys.stderr)
+
+        return metadata
+
+
+    def image_metadata_by_path (self, ipath, collection=None, select=None, after_id=None,
+                                limit=None):
         """
         Return the image metadata for the file at the given image path.
 
         :param ipath: image path of the image whose metadata is desired.
         :param collection: optional name of the image collection to use or all, if None.
+        :param after_id: if specified, return only images whose ID is greater than this value.
+        :param limit: if specified, return metadata for at most this many images.
         :return a list of dictionaries representing the records from the image metadata table.
         """
         image_table = self.clean_table_name()
@@ -91,7 +117,7 @@ class PostgreSQLManager (PostgreSQLBase):
             imgq += " AND obs_collection = (%s)"
             qargs.append(self.clean_id(collection))
 
-        imgq += " ORDER BY id;"
+        imgq = self.sql4_keyset_paging(imgq, qargs, True, after_id=after_id, limit=limit)
 
         metadata = self.fetch_rows_2dicts(imgq, qargs)
 
@@ -101,7 +127,8 @@ class PostgreSQLManager (PostgreSQLBase):
         return metadata                         # return list of dictionaries
 
 
-    def image_metadata_by_query (self, collection=None, filt=None, select=None):
+    def image_metadata_by_query (self, collection=None, filt=None, select=None, after_id=None,
+                                 limit=None, stream=False):
         """
         Return a list of selected image metadata fields for images which meet the
         given filter and/or collection criteria.
@@ -109,6 +136,10 @@ class PostgreSQLManager (PostgreSQLBase):
         :param collection: if specified, restrict the listing to the named image collection.
         :param filt: if specified, restrict the listing to images with the named filter.
         :param select: an optional list of fields to be returned in the query (default ALL fields).
+        :param after_id: if specified, return only images whose ID is greater than this value.
+        :param limit: if specified, return metadata for at most this many images.
+        :param stream: if True, return a generator of metadata dictionaries, read from the
+                       database in batches, instead of a list.
 
         :return a list of metadata dictionaries for images which contain the specified point.
         """
@@ -133,7 +164,10 @@ class PostgreSQLManager (PostgreSQLBase):
             imgq += " filter = (%s)"
             qargs.append(self.clean_id(filt))
 
-        imgq += " ORDER BY id;"
+        imgq = self.sql4_keyset_paging(imgq, qargs, where, after_id=after_id, limit=limit)
+
+        if (stream):
+            return self.gen_rows_2dicts(imgq, qargs)
 
         metadata = self.fetch_rows_2dicts(imgq, qargs)
 
@@ -276,13 +310,16 @@ class PostgreSQLManager (PostgreSQLBase):
         return tables
 
 
-    def query_cone (self, pt_ra, pt_dec, radius, collection=None, filt=None, select=None):
+    def query_cone (self, pt_ra, pt_dec, radius, collection=None, filt=None, select=None,
+                    after_id=None, limit=None):
         """
         List metadata for images containing the given point within the given radius.
 
         :param collection: if specified, restrict the listing to the named image collection.
         :param filt: if specified, restrict the listing to images with the named filter.
         :param select: an optional list of fields to be returned in the query (default ALL fields).
+        :param after_id: if specified, return only images whose ID is greater than this value.
+        :param limit: if specified, return metadata for at most this many images.
 
         :return a list of metadata dictionaries for images which contain the specified point.
         """
@@ -309,10 +346,10 @@ class PostgreSQLManager (PostgreSQLBase):
 
         imgq += " AND" if where else " WHERE"
         imgq += " q3c_radial_query(s_ra, s_dec, (%s), (%s), (%s))"
-        imgq += " ORDER BY id;"
-
         qargs.extend([pt_ra, pt_dec, radius])
 
+        imgq = self.sql4_keyset_paging(imgq, qargs, True, after_id=after_id, limit=limit)
+
         if (self._DEBUG):
             print(f"(query_cone): query='{imgq}'", file=sys.stderr)
 
@@ -324,7 +361,58 @@ class PostgreSQLManager (PostgreSQLBase):
         return metadata
 
 
-    def query_coordinates (self, pt_ra, pt_dec, collection=None, filt=None, select=None):
+    def query_cones (self, positions, radius, collection=None, filt=None, select=None):
+        """
+        Cross-match the given positions against the image centers, with a single query,
+        returning the metadata of the images found within the given radius of each position.
+
+        :param positions: a list of (row index, RA, DEC) tuples, with coordinates in degrees.
+        :param radius: the search radius, in degrees.
+        :param collection: if specified, restrict the search to the named image collection.
+        :param filt: if specified, restrict the search to images with the named filter.
+        :param select: an optional list of fields to be returned in the query (default ALL fields).
+
+        :return a dictionary mapping row indices to lists of metadata dictionaries of the
+                matching images (in ID order). Rows without any matching images are absent
+                from the dictionary.
+        """
+        image_table = self.clean_table_name()
+        if (select is not None):
+            fields = ','.join([f"img.{self.clean_id(fld)}" for fld in select])
+        else:
+            fields = 'img.*'
+
+        imgq = """
+            SELECT p.idx AS match_idx, {}
+            FROM unnest((%s)::integer[], (%s)::double precision[], (%s)::double precision[])
+                 AS p(idx, ra, dec)
+            JOIN {} img ON q3c_join(p.ra, p.dec, img.s_ra, img.s_dec, (%s))
+        """.format(fields, image_table)
+        qargs = [ [pos[0] for pos in positions], [pos[1] for pos in positions],
+                  [pos[2] for pos in positions], radius ]
+
+        if (collection is not None):            # add collection argument to query
+            imgq += " AND img.obs_collection = (%s)"
+            qargs.append(self.clean_id(collection))
+
+        if (filt is not None):                  # add filter argument to query
+            imgq += " AND img.filter = (%s)"
+            qargs.append(self.clean_id(filt))
+
+        imgq += " ORDER BY p.idx, img.id;"
+
+        if (self._DEBUG):
+            print(f"(query_cones): query='{imgq}', positions: {len(positions)}", file=sys.stderr)
+
+        matches = dict()
+        for md in self.fetch_rows_2dicts(imgq, qargs):
+            matches.setdefault(md.pop('match_idx'), []).append(md)
+
+        return matches
+
+
+    def query_coordinates (self, pt_ra, pt_dec, collection=None, filt=None, select=None,
+                           after_id=None, limit=None):
         """
         List metadata for images containing the point specified by the given coordinates and
         the optional collection and filter arguments.
@@ -332,6 +420,8 @@ class PostgreSQLManager (PostgreSQLBase):
         :param collection: if specified, restrict the listing to the named image collection.
         :param filt: if specified, restrict the listing to images with the named filter.
         :param select: an optional list of fields to be returned in the query (default ALL fields).
+        :param after_id: if specified, return only images whose ID is greater than this value.
+        :param limit: if specified, return metadata for at most this many images.
 
         :return a list of metadata dictionaries for images which contain the specified point.
         """
@@ -359,10 +449,10 @@ class PostgreSQLManager (PostgreSQLBase):
         imgq += " AND" if where else " WHERE"
         imgq += " q3c_poly_query((%s), (%s),"
         imgq += " ARRAY[im_ra1, im_dec1, im_ra2, im_dec2, im_ra3, im_dec3, im_ra4, im_dec4])"
-        imgq += " ORDER BY id;"
-
         qargs.extend([pt_ra, pt_dec])
 
+        imgq = self.sql4_keyset_paging(imgq, qargs, True, after_id=after_id, limit=limit)
+
         if (self._DEBUG):
             print(f"(query_coordinates): query='{imgq}'", file=sys.stderr)
 
@@ -374,18 +464,23 @@ class PostgreSQLManager (PostgreSQLBase):
         return metadata
 
 
-    def query_image (self, collection=None, filt=None, select=None):
+    def query_image (self, collection=None, filt=None, select=None, after_id=None, limit=None,
+                     stream=False):
         """
         List metadata for images which meet the given filter and/or collection criteria
 
         :param collection: if specified, restrict the listing to the named image collection.
         :param filt: if specified, restrict the listing to images with the named filter.
         :param select: an optional list of fields to be returned in the query (default ALL fields).
+        :param after_id: if specified, return only images whose ID is greater than this value.
+        :param limit: if specified, return metadata for at most this many images.
+        :param stream: if True, return a generator of metadata dictionaries, read from the
+                       database in batches, instead of a list.
 
         :return a list of metadata dictionaries for images which meet the query criteria.
         """
         if (collection is None and (filt is None)):  # sanity check
-            return []
+            return iter([]) if stream else []
 
         image_table = self.clean_table_name()
         fields = self.sql4_selected_fields(select=select)
@@ -408,11 +503,14 @@ class PostgreSQLManager (PostgreSQLBase):
             imgq += " filter = (%s)"
             qargs.append(self.clean_id(filt))
 
-        imgq += " ORDER BY id;"
+        imgq = self.sql4_keyset_paging(imgq, qargs, where, after_id=after_id, limit=limit)
 
         if (self._DEBUG):
             print(f"(query_image): query='{imgq}'", file=sys.stderr)
 
+        if (stream):
+            return self.gen_rows_2dicts(imgq, qargs)
+
         metadata = self.fetch_rows_2dicts(imgq, qargs)
 
         if (self._DEBUG):
@@ -1,10 +1,12 @@
 #
 # Base class for common methods to interact with a PostgreSQL database.
 #   Written by: Tom Hicks. 12/2/2020.
-#   Last Modified: Rename class.
+#   Last Modified: Pass the debug flag to the connection pool.
 #
 import configparser
 import sys
+import uuid
+from contextlib import contextmanager
 from string import ascii_letters, digits
 
 import psycopg2
@@ -13,11 +15,15 @@ import psycopg2.extras
 from config.settings import DEFAULT_DBCONFIG_FILEPATH
 import cuts.blueprints.img.exceptions as exceptions
 from cuts.blueprints.img.misc_utils import keep_characters
+from cuts.blueprints.img.pg_pool import PostgreSQLPool
 
 
 # Restricted set of characters allowed for database identifiers by cleaning function
 DB_ID_CHARS = set(ascii_letters + digits + '_')
 
+# Number of rows transferred from a server-side cursor in each round trip
+DEFAULT_STREAM_BATCH_SIZE = 1000
+
 
 class PostgreSQLBase ():
     """
@@ -38,6 +44,15 @@ class PostgreSQLBase ():
         self.db_uri = dbconfig.get('db_uri')
 
 
+    @property
+    def pool (self):
+        """
+        The process-wide connection pool for this database, created on first use and
+        sized from the database configuration.
+        """
+        return PostgreSQLPool.get_pool(self.db_uri, self.dbconfig, debug=self._DEBUG)
+
+
     @classmethod
     def load_sql_db_config (clazz, dbconfig_file):
         """
@@ -80,9 +95,19 @@ class PostgreSQLBase ():
             raise exceptions.ServerError(errMsg)
 
 
+    @contextmanager
+    def connection (self):
+        """
+        Context manager which borrows a database connection from the connection pool
+        and returns it to the pool on exit.
+        """
+        with self.pool.connection() as conn:
+            yield conn
+
+
     def execute_sql (self, sql_query_string, sql_values):
         """
-        Open a database connection execute the given SQL format string with
+        Borrow a pooled database connection and execute the given SQL format string with
         the given SQL values list FOR SIDE EFFECT (i.e. no values are returned).
 
         :param sql_query_string: a valid Psycopg2 query string. This is similar to a
@@ -90,18 +115,15 @@ class PostgreSQLBase ():
            https://www.psycopg.org/docs/usage.html#passing-parameters-to-sql-queries
         :param sql_values: a list of values to substitute into the query string.
         """
-        conn = psycopg2.connect(self.db_uri)
-        try:
+        with self.connection() as conn:
             with conn:
                 with conn.cursor() as cursor:
                     cursor.execute(sql_query_string, sql_values)
-        finally:
-            conn.close()
 
 
     def fetch_row (self, sql_query_string, sql_values):
         """
-        Open a database connection and execute the given SQL format string with
+        Borrow a pooled database connection and execute the given SQL format string with
         the given SQL values, returning a single query result (a tuple) or None.
 
         :param sql_query_string: a valid Psycopg2 query string. This is similar to a
@@ -109,21 +131,18 @@ class PostgreSQLBase ():
             https://www.psycopg.org/docs/usage.html#passing-parameters-to-sql-queries
         :param sql_value: a list of values to substitute into the query string.
         """
-        conn = psycopg2.connect(self.db_uri)
-        try:
+        with self.connection() as conn:
             with conn:
                 with conn.cursor() as cursor:
                     cursor.execute(sql_query_string, sql_values)
                     row = cursor.fetchone()
-        finally:
-            conn.close()
 
         return row
 
 
     def fetch_rows (self, sql_query_string, sql_values):
         """
-        Open a database connection and execute the given SQL format string with
+        Borrow a pooled database connection and execute the given SQL format string with
         the given SQL values, returning a list of tuples, which are the rows of
         the query result.
 
@@ -132,21 +151,18 @@ class PostgreSQLBase ():
             https://www.psycopg.org/docs/usage.html#passing-parameters-to-sql-queries
         :param sql_value: a list of values to substitute into the query string.
         """
-        conn = psycopg2.connect(self.db_uri)
-        try:
+        with self.connection() as conn:
             with conn:
                 with conn.cursor() as cursor:
                     cursor.execute(sql_query_string, sql_values)
                     rows = cursor.fetchall()
-        finally:
-            conn.close()
 
         return rows
 
 
     def fetch_rows_2dicts (self, sql_query_string, sql_values):
         """
-        Open a database connection and execute the given SQL format string with the
+        Borrow a pooled database connection and execute the given SQL format string with the
         given SQL values, returning a dictionary of attributes, which are the rows of
         the query result.
 
@@ -156,19 +172,78 @@ class PostgreSQLBase ():
         :param sql_value: a list of values to substitute into the query string.
         :return a list of dictionaries, one for each result row.
         """
-        conn = psycopg2.connect(self.db_uri, cursor_factory=psycopg2.extras.DictCursor)
-        try:
+        with self.connection() as conn:
             with conn:
-                with conn.cursor() as cursor:
+                with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
                     cursor.execute(sql_query_string, sql_values)
                     rows = cursor.fetchall()
                     rowdicts = [dict(row) for row in rows]  # make array of dictionaries
-        finally:
-            conn.close()
 
         return rowdicts
 
 
+    def gen_rows_2dicts (self, sql_query_string, sql_values, batch_size=DEFAULT_STREAM_BATCH_SIZE):
+        """
+        Generator which borrows a pooled database connection and executes the given SQL
+        format string with the given SQL values in a named (server-side) cursor, yielding a
+        dictionary of attributes for each row of the query result. Rows are transferred from
+        the server in batches of the given size, so memory use does not grow with the size of
+        the result. The connection is held until the generator is exhausted or closed.
+
+        :param sql_query_string: a valid Psycopg2 query string. This is similar to a
+            standard python template string, BUT NOT THE SAME. See:
+            https://www.psycopg.org/docs/usage.html#passing-parameters-to-sql-queries
+        :param sql_value: a list of values to substitute into the query string.
+        :param batch_size: the number of rows to fetch from the server at a time.
+        """
+        cursor_name = f"cuts_{uuid.uuid4().hex}"
+        with self.connection() as conn:
+            with conn:                      # named cursors must run inside a transaction
+                with conn.cursor(name=cursor_name,
+                                 cursor_factory=psycopg2.extras.DictCursor) as cursor:
+                    cursor.itersize = batch_size
+                    cursor.execute(sql_query_string, sql_values)
+                    while True:
+                        rows = cursor.fetchmany(batch_size)
+                        if (not rows):
+                            break
+                        for row in rows:
+                            yield dict(row)
+
+
+    def pool_stats (self):
+        """ Return a dictionary of usage statistics for the database connection pool. """
+        return self.pool.stats()
+
+
+    def sql4_keyset_paging (self, sql_query_string, sql_values, where, after_id=None,
+                            limit=None, key='id'):
+        """
+        Complete the given SQL query string by adding an optional keyset condition (selecting
+        only rows whose key is greater than the given after_id), ordering by the key, and an
+        optional limit on the number of rows. Any values needed for the added clauses are
+        appended to the given list of SQL values. Returns the completed query string.
+
+        :param where: True if the given query string already contains a WHERE clause.
+        :param after_id: if specified, return only rows whose key is greater than this value.
+        :param limit: if specified, return at most this many rows.
+        :param key: the name of a unique, indexed column to page by (default: 'id').
+        """
+        key_clean = self.clean_id(key)
+        if (after_id is not None):
+            sql_query_string += " AND" if where else " WHERE"
+            sql_query_string += f" {key_clean} > (%s)"
+            sql_values.append(after_id)
+
+        sql_query_string += f" ORDER BY {key_clean}"
+
+        if (limit is not None):
+            sql_query_string += " LIMIT (%s)"
+            sql_values.append(limit)
+
+        return sql_query_string + ';'
+
+
     def sql4_selected_fields (self, select=None):
         """
         Format the given list of field names to and return a string to select fields
@@ -0,0 +1,189 @@
+#
+# Utilities for reading lists of sky positions from requests and uploaded tables.
+#   Last Modified: Allow an optional size for each position.
+#
+import csv
+import io
+import math
+
+from flask import current_app
+
+from astropy.io import fits
+
+from cuts.blueprints.img import exceptions
+from cuts.blueprints.img.fits_utils import has_catalog_data
+
+
+# Column names (compared case-insensitively) recognized for the coordinates of a position
+RA_COLUMN_NAMES = [ 'ra', 's_ra', 'raj2000', 'ra_deg' ]
+DEC_COLUMN_NAMES = [ 'dec', 's_dec', 'dej2000', 'decj2000', 'dec_deg' ]
+
+# Column names (compared case-insensitively) recognized for the optional (cutout) size of a position
+SIZE_COLUMN_NAMES = [ 'size' ]
+
+# Number of positions processed together (e.g., in a single database query)
+DEFAULT_POSITIONS_CHUNK_SIZE = 1000
+
+
+def find_column (names, candidates):
+    """
+    Return the first of the given column names which matches (case-insensitively)
+    one of the given candidate names, or None if no column name matches.
+    """
+    lowered = { name.strip().lower(): name for name in names if name }
+    for cand in candidates:
+        if (cand in lowered):
+            return lowered[cand]
+    return None
+
+
+def gen_chunks (items, chunk_size=DEFAULT_POSITIONS_CHUNK_SIZE):
+    """ Generator to yield lists of (at most) chunk_size items from the given iterable. """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if (len(chunk) >= chunk_size):
+            yield chunk
+            chunk = []
+    if (chunk):
+        yield chunk
+
+
+def gen_positions (args, files=None):
+    """
+    Return a generator of positions read from the request: either from a table file uploaded
+    as the 'file' field (CSV or FITS) or from a 'positions' argument containing a list.
+    Each position is a dictionary with the row index ('row') and either the coordinates
+    ('ra' and 'dec') or an error message ('error') for a row which could not be read.
+    A position may also have a size ('size'), if one is given for it.
+    :raises: RequestException if no positions are given or the table columns are not found.
+    """
+    upload = files.get('file') if files else None
+    if (upload):
+        filename = (upload.filename or '').lower()
+        if (filename.endswith(('.fits', '.fit', '.fits.gz')) or
+            (upload.mimetype in ('image/fits', 'application/fits'))):
+            return gen_positions_from_fits(upload.stream)
+        return gen_positions_from_csv(upload.stream)
+
+    positions = args.get('positions')
+    if (not positions):
+        errMsg = "A list of positions must be specified, via the 'positions' argument or an uploaded table 'file'"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+    if (not isinstance(positions, (list, tuple))):
+        errMsg = "The 'positions' argument must be a list of [ra, dec] pairs or of {ra, dec} objects"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+    return gen_positions_from_list(positions)
+
+
+def gen_positions_from_csv (stream, encoding='utf-8'):
+    """
+    Return a generator of positions read, one row at a time, from the CSV data in the given
+    binary stream. The first line must name the columns, which must include RA and DEC columns.
+    :raises: RequestException if the RA and DEC columns are not found.
+    """
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding=encoding, newline=''))
+    ra_col = find_column(reader.fieldnames or [], RA_COLUMN_NAMES)
+    dec_col = find_column(reader.fieldnames or [], DEC_COLUMN_NAMES)
+    size_col = find_column(reader.fieldnames or [], SIZE_COLUMN_NAMES)
+    _check_columns(ra_col, dec_col)
+    return (make_position(idx, row.get(ra_col), row.get(dec_col),
+                          row.get(size_col) if size_col else None)
+            for idx, row in enumerate(reader))
+
+
+def gen_positions_from_fits (stream, chunk_size=DEFAULT_POSITIONS_CHUNK_SIZE):
+    """
+    Return a generator of positions read from the table in the first extension of the FITS
+    data in the given binary stream. Rows are read in chunks of the given size.
+    :raises: RequestException if the data is not a FITS table with RA and DEC columns.
+    """
+    try:
+        hdus = fits.open(stream, memmap=True)
+    except Exception:
+        errMsg = "The uploaded file could not be read as a FITS file"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+
+    if (not has_catalog_data(hdus)):
+        hdus.close()
+        errMsg = "The uploaded FITS file does not contain a table in its first extension"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+
+    table = hdus[1]
+    ra_col = find_column(table.columns.names, RA_COLUMN_NAMES)
+    dec_col = find_column(table.columns.names, DEC_COLUMN_NAMES)
+    size_col = find_column(table.columns.names, SIZE_COLUMN_NAMES)
+    try:
+        _check_columns(ra_col, dec_col)
+    except exceptions.RequestException:
+        hdus.close()
+        raise
+
+    def gen_rows ():
+        try:
+            nrows = table.header.get('NAXIS2', 0)
+            for start in range(0, nrows, chunk_size):
+                chunk = table.data[start:start + chunk_size]
+                sizes = chunk[size_col] if size_col else [None] * len(chunk)
+                for offset, (ra, dec, size) in enumerate(zip(chunk[ra_col], chunk[dec_col], sizes)):
+                    yield make_position(start + offset, ra, dec, size)
+        finally:
+            hdus.close()
+
+    return gen_rows()
+
+
+def gen_positions_from_list (positions):
+    """
+    Return a generator of positions from the given list of [ra, dec] pairs (or [ra, dec, size]
+    triples) or of dictionaries with 'ra' and 'dec' (or 's_ra' and 's_dec') and optional
+    'size' entries.
+    """
+    for idx, pos in enumerate(positions):
+        if (isinstance(pos, dict)):
+            yield make_position(idx, pos.get('ra', pos.get('s_ra')), pos.get('dec', pos.get('s_dec')),
+                                pos.get('size'))
+        elif (isinstance(pos, (list, tuple)) and (len(pos) >= 2)):
+            yield make_position(idx, pos[0], pos[1], pos[2] if (len(pos) > 2) else None)
+        else:
+            yield { 'row': idx, 'error': "Position must be an [ra, dec] pair or an {ra, dec} object" }
+
+
+def make_position (idx, ra, dec, size=None):
+    """
+    Return a position dictionary for the given row index, coordinates, and optional size or,
+    if the coordinates are not valid numbers of degrees or a given size is not a positive
+    number, a dictionary containing an error message. An empty (or NaN) size is ignored.
+    """
+    try:
+        ra = float(ra)
+        dec = float(dec)
+    except (TypeError, ValueError):
+        return { 'row': idx, 'error': "RA and DEC must be numbers" }
+    if (not (math.isfinite(ra) and math.isfinite(dec) and (-90.0 <= dec <= 90.0))):
+        return { 'row': idx, 'error': "RA and DEC must be finite and DEC must be in [-90, 90]" }
+    position = { 'row': idx, 'ra': ra % 360.0, 'dec': dec }
+
+    if ((size is not None) and (str(size).strip() != '')):
+        try:
+            size = float(size)
+        except (TypeError, ValueError):
+            size = -1.0
+        if (math.isnan(size)):              # e.g., a blank value in a FITS table column
+            return position
+        if (not (math.isfinite(size) and (size > 0))):
+            return { 'row': idx, 'error': "A position's size must be a positive number" }
+        position['size'] = size
+    return position
+
+
+def _check_columns (ra_col, dec_col):
+    """ Raise a RequestException if either of the given RA or DEC column names is missing. """
+    if ((ra_col is None) or (dec_col is None)):
+        errMsg = f"The uploaded table must contain RA and DEC columns, named one of {RA_COLUMN_NAMES} and {DEC_COLUMN_NAMES}"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
@@ -0,0 +1,101 @@
+#
+# Methods to render PNG and JPEG preview images of cutouts, with vectorized intensity stretches.
+#   Last Modified: Initial creation.
+#
+import io
+import math
+
+import numpy as np
+
+from astropy.visualization import AsinhStretch, LinearStretch, LogStretch
+from astropy.visualization import AsymmetricPercentileInterval, ZScaleInterval
+
+import cuts.blueprints.img.exceptions as exceptions
+
+
+# MIME types of the preview image formats
+PREVIEW_MIME_TYPES = { 'png': 'image/png', 'jpeg': 'image/jpeg' }
+
+# Filename extensions of the preview image formats
+PREVIEW_EXTENSIONS = { 'png': '.png', 'jpeg': '.jpg' }
+
+# Names of the intensity stretches of preview images
+PREVIEW_STRETCHES = [ 'linear', 'log', 'asinh', 'zscale' ]
+
+# Quality (1 to 95) of JPEG preview images
+JPEG_QUALITY = 85
+
+
+def downsample (data, max_dim):
+    """
+    Return the given 2D image data reduced, by averaging square blocks of pixels, so that
+    neither dimension exceeds the given maximum. Blank (NaN) pixels are ignored when averaging.
+    """
+    factor = math.ceil(max(data.shape) / max_dim) if (max_dim) else 1
+    if (factor <= 1):
+        return data
+    ny = math.ceil(data.shape[0] / factor) * factor
+    nx = math.ceil(data.shape[1] / factor) * factor
+    padded = np.full((ny, nx), np.nan, dtype=np.float32)
+    padded[:data.shape[0], :data.shape[1]] = data
+    blocks = padded.reshape(ny // factor, factor, nx // factor, factor)
+    counts = np.sum(np.isfinite(blocks), axis=(1, 3))
+    sums = np.nansum(blocks, axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def encode_preview (pixels, fmt):
+    """
+    Return the bytes of the given 8-bit grayscale image array encoded in the given preview
+    format ('png' or 'jpeg').
+    :raises: ServerError if the Pillow imaging package is not installed.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        errMsg = "Rendering preview images requires the Pillow package, which is not installed"
+        raise exceptions.ServerError(errMsg)
+
+    buf = io.BytesIO()
+    img = Image.fromarray(pixels, mode='L')
+    if (fmt == 'jpeg'):
+        img.save(buf, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+    else:
+        img.save(buf, format='PNG', optimize=True)
+    return buf.getvalue()
+
+
+def render_preview (data, preview):
+    """
+    Return an 8-bit grayscale image array rendering the given 2D image data with the given
+    preview arguments (see parse_preview_args): the data is reduced to at most 'max_dim'
+    pixels on a side, clipped to the 'min_percent' to 'max_percent' percentile interval
+    (or to the zscale interval), and stretched. The image is flipped, so that north is up,
+    as in the FITS convention. Blank (NaN) pixels are rendered black.
+    """
+    data = downsample(np.asarray(data, dtype=np.float32), preview.get('max_dim'))
+    finite = np.isfinite(data)
+    if (not finite.any()):
+        return np.zeros(data.shape, dtype=np.uint8)[::-1]
+
+    stretch = preview.get('stretch', 'linear')
+    if (stretch == 'zscale'):
+        (vmin, vmax) = ZScaleInterval().get_limits(data[finite])
+    else:
+        (vmin, vmax) = AsymmetricPercentileInterval(preview.get('min_percent', 0.0),
+                                                    preview.get('max_percent', 100.0)).get_limits(data[finite])
+    scaled = np.zeros(data.shape, dtype=np.float32)
+    if (vmax > vmin):
+        np.clip((data - vmin) / (vmax - vmin), 0.0, 1.0, out=scaled, where=finite)
+
+    if (stretch == 'log'):
+        scaled = LogStretch()(scaled, clip=True)
+    elif (stretch == 'asinh'):
+        scaled = AsinhStretch()(scaled, clip=True)
+    else:
+        scaled = LinearStretch()(scaled, clip=True)
+
+    pixels = np.round(scaled * 255.0).astype(np.uint8)
+    pixels[~finite] = 0
+    return np.ascontiguousarray(pixels[::-1])
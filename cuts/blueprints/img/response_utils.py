@@ -0,0 +1,211 @@
+#
+# Utilities for building HTTP responses.
+#   Last Modified: Add delivery of files by a front proxy.
+#
+import hashlib
+import os
+from urllib.parse import quote, urlencode
+
+from flask import Response, json, jsonify, request, send_from_directory, stream_with_context
+
+
+# Modes of delivering files: by the web worker or by a front proxy (see offload_file_response)
+FILE_DELIVERY_MODES = [ 'direct', 'x-accel', 'x-sendfile' ]
+
+# MIME types for JSON and newline-delimited JSON results
+JSON_MIME_TYPE = 'application/json'
+NDJSON_MIME_TYPE = 'application/x-ndjson'
+
+# Response header containing the keyset paging cursor for the next page of results
+NEXT_PAGE_HEADER = 'X-Next-After-Id'
+
+# Number of rows serialized into each chunk written to a streamed response
+STREAM_CHUNK_ROWS = 100
+
+
+def gen_json_array (rows, chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    Generator to yield chunks of a JSON array string containing the items
+    produced by the given iterable.
+    """
+    chunk = [ '[' ]
+    sep = ''
+    for row in rows:
+        chunk.append(sep)
+        chunk.append(json.dumps(row))
+        sep = ','
+        if (len(chunk) >= (2 * chunk_rows)):
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+def gen_ndjson (rows, chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    Generator to yield chunks of newline-delimited JSON: one line for each of the items
+    produced by the given iterable.
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(row))
+        chunk.append('\n')
+        if (len(chunk) >= (2 * chunk_rows)):
+            yield ''.join(chunk)
+            chunk = []
+    if (chunk):
+        yield ''.join(chunk)
+
+
+def accepts_encoding (encoding, req=None):
+    """ Tell whether the given (or current) request accepts the named content encoding. """
+    req = req or request
+    return (req.accept_encodings[encoding] > 0)
+
+
+def etagged_json_response (data):
+    """
+    Return a JSON response for the given data, tagged with an ETag computed from the
+    response body. If the request's If-None-Match header matches the ETag, the response is
+    converted to an empty '304 Not Modified' response. Clients are told to revalidate
+    before reusing a stored response.
+    """
+    resp = jsonify(data)
+    resp.add_etag()
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+
+def file_etag (filepath):
+    """
+    Return a strong entity tag for the file at the given path, derived from its absolute
+    path, size, and modification time, so that it changes whenever the file is rewritten.
+    """
+    stat = os.stat(filepath)
+    ident = f"{os.path.abspath(filepath)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+
+def internal_redirect_uri (filepath, locations):
+    """
+    Return the (URL encoded) URI of the given file within the internal location of the front
+    proxy which serves the most specific of the given directories containing the file, given
+    a dictionary of directories and locations. Return None if no directory contains the file.
+    """
+    realpath = os.path.realpath(filepath)
+    for directory in sorted((locations or {}), key=len, reverse=True):
+        root = os.path.realpath(directory)
+        if (realpath.startswith(root + os.sep)):
+            relpath = os.path.relpath(realpath, root)
+            return f"{locations[directory].rstrip('/')}/{quote(relpath)}"
+    return None
+
+
+def is_range_request (req=None):
+    """ Tell whether the given (or current) request asks for a byte range of its resource. """
+    req = req or request
+    return (req.range is not None)
+
+
+def next_page_url (after_id):
+    """
+    Return the URL of the current request with its 'after_id' (keyset paging cursor)
+    argument replaced by the given value.
+    """
+    args = request.args.copy()
+    args['after_id'] = after_id
+    return f"{request.base_url}?{urlencode(list(args.items(multi=True)))}"
+
+
+def paged_json_response (rows, limit=None, key='id'):
+    """
+    Return a JSON response containing the given list of rows. If a limit is given and the
+    rows fill the page, the response carries the cursor for the next page (the key of the
+    last row) in an X-Next-After-Id header and the URL of the next page in a Link header.
+    """
+    resp = jsonify(rows)
+    if ((limit is not None) and rows and (len(rows) >= limit)):
+        next_id = rows[-1].get(key)
+        if (next_id is not None):
+            resp.headers[NEXT_PAGE_HEADER] = str(next_id)
+            resp.headers['Link'] = f"<{next_page_url(next_id)}>; rel=\"next\""
+    return resp
+
+
+def offload_file_response (filepath, mimetype, mode, locations=None, download_name=None,
+                           as_attachment=True):
+    """
+    Return an empty response which hands the transfer of the file at the given path to the
+    front proxy, with the given MIME type: with an X-Accel-Redirect header, naming the file
+    within an internal location of the proxy (see internal_redirect_uri), in mode 'x-accel',
+    or with an X-Sendfile header, naming the absolute path of the file, in mode 'x-sendfile'.
+    The proxy handles conditional and range requests for the file. Return None if the file
+    cannot be handed to the proxy.
+    """
+    if (mode == 'x-sendfile'):
+        (header, value) = ('X-Sendfile', os.path.abspath(filepath))
+    elif (mode == 'x-accel'):
+        (header, value) = ('X-Accel-Redirect', internal_redirect_uri(filepath, locations))
+    else:
+        return None
+    if (value is None):
+        return None
+
+    resp = Response(mimetype=mimetype)
+    resp.headers[header] = value
+    if (as_attachment):
+        resp.headers.set('Content-Disposition', 'attachment',
+                         filename=(download_name or os.path.basename(filepath)))
+    return resp
+
+
+def send_file_response (filepath, mimetype, download_name=None, as_attachment=True):
+    """
+    Return a response sending the file at the given path, with the given MIME type, which
+    supports conditional and range requests. The response carries a strong ETag (see
+    file_etag) and a Last-Modified header: a request whose If-None-Match (or If-Modified-Since)
+    header matches gets an empty '304 Not Modified' response, and a request with a Range header
+    gets a '206 Partial Content' response with just the requested bytes (e.g., a FITS header).
+    """
+    (directory, filename) = os.path.split(filepath)
+    try:
+        etag = file_etag(filepath)
+    except OSError:
+        etag = False                        # the file is gone: not found when sent
+    return send_from_directory(directory, filename, mimetype=mimetype,
+                               as_attachment=as_attachment,
+                               download_name=(download_name or filename),
+                               conditional=True, etag=etag)
+
+
+def stream_json_rows (rows, fmt='json'):
+    """
+    Return a Flask response which streams the items produced by the given iterable
+    as either a JSON array (format 'json') or as newline-delimited JSON (format 'ndjson').
+    The first item is produced before the response is returned, so that errors raised
+    while starting the underlying query are still reported with an error status.
+    """
+    rows = iter(rows)
+    try:
+        first = [ next(rows) ]
+    except StopIteration:
+        first = []
+    items = _chain(first, rows)
+
+    if (fmt == 'ndjson'):
+        return Response(stream_with_context(gen_ndjson(items)), mimetype=NDJSON_MIME_TYPE)
+    return Response(stream_with_context(gen_json_array(items)), mimetype=JSON_MIME_TYPE)
+
+
+def _chain (first, rest):
+    """
+    Generator to yield the items of the first list and then the items of the rest iterator.
+    Closing this generator also closes the rest iterator (releasing any resources it holds).
+    """
+    try:
+        yield from first
+        yield from rest
+    finally:
+        close = getattr(rest, 'close', None)
+        if (close is not None):
+            close()
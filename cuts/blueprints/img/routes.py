@@ -2,11 +2,12 @@
 # Top-level Flask routing module: answers requests or spawns Celery task to do it.
 #
 #   Written by: Tom Hicks. 11/14/2019.
-#   Last Modified: Some renames for consistency. Add query_coordinates.
+#   Last Modified: Add multi-filter cutout cubes.
 #
 from flask import Blueprint, jsonify, request
 # from flask_cors import CORS
 from cuts.blueprints.img import exceptions
+from cuts.blueprints.img.arg_utils import request_args
 
 
 # Instantiate the image blueprint
@@ -41,12 +42,12 @@ def img_fetch_by_path ():
 
 #############################################################
 
-@img.route('/img/metadata')
+@img.route('/img/metadata', methods=['GET', 'POST'])
 def img_metadata ():
-    """ Return image metadata for a specific image by ID. """
+    """ Return image metadata for a specific image by ID or for a list of IDs. """
     # required to avoid circular imports
     from cuts.blueprints.img.tasks import image_metadata
-    return image_metadata(request.args)
+    return image_metadata(request_args())
 
 
 @img.route('/img/metadata_by_collection')
@@ -106,6 +107,14 @@ def query_cone ():
     return query_cone(request.args)
 
 
+@img.route('/img/query_cones', methods=['POST'])
+def query_cones ():
+    """ For each of a list of positions, list images which are centered within a given radius. """
+    # required to avoid circular imports
+    from cuts.blueprints.img.tasks import query_cones
+    return query_cones(request_args(), request.files)
+
+
 @img.route('/img/query_coordinates')
 def query_coordinates ():
     """ List images which contain the given point. """
@@ -135,6 +144,14 @@ def co_list ():
     return list_cutouts(request.args)
 
 
+@img.route('/co/cache_stats')
+def co_cache_stats ():
+    """ Return the current size and the limits of the cutouts (cache) directory. """
+    # required to avoid circular imports
+    from cuts.blueprints.img.tasks import cutout_cache_stats
+    return cutout_cache_stats(request.args)
+
+
 @img.route('/co/cutout')
 def co_cutout ():
     """ Make and return an image cutout. """
@@ -151,6 +168,22 @@ def co_cutout_by_filter ():
     return fetch_cutout_by_filter(request.args)
 
 
+@img.route('/co/cutout_cube')
+def co_cutout_cube ():
+    """ Make and return image cutouts at one position in every filter, as a single FITS file. """
+    # required to avoid circular imports
+    from cuts.blueprints.img.tasks import fetch_cutout_cube
+    return fetch_cutout_cube(request.args)
+
+
+@img.route('/co/cutouts', methods=['POST'])
+def co_cutouts ():
+    """ Make image cutouts at a list of positions, returned in a single archive or FITS file. """
+    # required to avoid circular imports
+    from cuts.blueprints.img.tasks import fetch_cutouts
+    return fetch_cutouts(request_args(), request.files)
+
+
 @img.route('/co/fetch_from_cache')
 def co_fetch_from_cache ():
     """ Fetch a specific image cutout from the cutout cache, by filename. """
@@ -159,6 +192,38 @@ def co_fetch_from_cache ():
     return fetch_cutout_from_cache(request.args)
 
 
+@img.route('/co/jobs', methods=['POST'])
+def co_jobs ():
+    """ Submit a job to make an image cutout asynchronously, returning the job status. """
+    # required to avoid circular imports
+    from cuts.blueprints.img.tasks import submit_cutout_job
+    return submit_cutout_job(request_args())
+
+
+@img.route('/co/jobs/<job_id>')
+def co_job_status (job_id):
+    """ Return the status of a cutout job. """
+    # required to avoid circular imports
+    from cuts.blueprints.img.tasks import cutout_job_status
+    return cutout_job_status(job_id)
+
+
+@img.route('/co/jobs/<job_id>/result')
+def co_job_result (job_id):
+    """ Return the image cutout made by a cutout job, once the job is done. """
+    # required to avoid circular imports
+    from cuts.blueprints.img.tasks import fetch_cutout_job_result
+    return fetch_cutout_job_result(job_id)
+
+
+@img.route('/db_stats')
+def db_stats ():
+    """ Return usage statistics for this worker's database connection pool. """
+    # required to avoid circular imports
+    from cuts.blueprints.img.tasks import db_stats
+    return db_stats(request.args)
+
+
 @img.route('/echo')
 def echo ():
     """ Echo the Request arguments as a JSON data structure. """
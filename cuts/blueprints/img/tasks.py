@@ -2,16 +2,27 @@
 # Module containing spawnable Celery tasks for the application.
 #
 #   Written by: Tom Hicks. 11/14/2019.
-#   Last Modified: Refactor common cutout logic to image manager. Add query_coordinates.
+#   Last Modified: Return the metadata of a list of image IDs as a list, in request order.
 #
+import io
 import os
+from itertools import islice
 
-from flask import current_app, jsonify, request
+from flask import current_app, jsonify, request, send_file
 
+from astropy import units as u
+
+from config.settings import MAX_BATCH_CUTOUTS
 import cuts.blueprints.img.arg_utils as au
 from cuts.app import create_celery_app
+from cuts.blueprints.img.archive_utils import ARCHIVE_EXTENSIONS, ARCHIVE_MIME_TYPES, write_archive
 from cuts.blueprints.img import exceptions
+from cuts.blueprints.img.fits_utils import FITS_MIME_TYPE
 from cuts.blueprints.img.image_manager import ImageManager
+from cuts.blueprints.img.job_utils import JOB_DONE, JOB_FAILED, job_status, parse_job_id
+from cuts.blueprints.img.position_utils import gen_positions
+from cuts.blueprints.img.response_utils import etagged_json_response, paged_json_response
+from cuts.blueprints.img.response_utils import stream_json_rows
 
 
 # Instantiate the Celery client application
@@ -70,7 +81,14 @@ def fetch_image_by_path (args):
 
 @celery.task()
 def image_metadata (args):
-    """ Return image metadata for a specific image by ID. """
+    """
+    Return image metadata for a specific image by ID or, if a list of IDs is given, a list
+    of { id, metadata } objects in the order of the IDs (with null metadata for unknown IDs).
+    """
+    uids = au.parse_ids_arg(args)                 # optional list of IDs
+    if (uids is not None):
+        return jsonify(imgr.image_metadata_by_ids(uids))
+
     uid = au.parse_id_arg(args)                   # get required ID or error
     md = imgr.image_metadata(uid)
     if (md is not None):
@@ -85,7 +103,13 @@ def image_metadata (args):
 def image_metadata_by_collection (args):
     """ Return image metadata for all images in a specific collection. """
     collection = au.parse_collection_arg(args, required=True)  # get required collection or error
-    return jsonify(imgr.image_metadata_by_collection(collection))
+    paging = au.parse_paging_args(args)                        # optional after_id and limit
+    stream = au.parse_stream_arg(args)                         # optional streaming format
+    if (stream):
+        return stream_json_rows(
+            imgr.image_metadata_by_collection(collection, stream=True, **paging), fmt=stream)
+    return paged_json_response(imgr.image_metadata_by_collection(collection, **paging),
+                               limit=paging['limit'])
 
 
 @celery.task()
@@ -93,7 +117,15 @@ def image_metadata_by_filter (args):
     """ Return image metadata for all images with a specific filter/collection. """
     filt = au.parse_filter_arg(args, required=True)  # get required filter or error
     collection = au.parse_collection_arg(args)       # optional collection restriction
-    return jsonify(imgr.image_metadata_by_filter(filt, collection=collection))
+    paging = au.parse_paging_args(args)              # optional after_id and limit
+    stream = au.parse_stream_arg(args)               # optional streaming format
+    if (stream):
+        return stream_json_rows(
+            imgr.image_metadata_by_filter(filt, collection=collection, stream=True, **paging),
+            fmt=stream)
+    return paged_json_response(
+        imgr.image_metadata_by_filter(filt, collection=collection, **paging),
+        limit=paging['limit'])
 
 
 @celery.task()
@@ -101,7 +133,10 @@ def image_metadata_by_path (args):
     """ Return image metadata for all images with a specific image path. """
     ipath = au.parse_ipath_arg(args, required=True)  # get required image path or error
     collection = au.parse_collection_arg(args)       # optional collection restriction
-    return jsonify(imgr.image_metadata_by_path(ipath, collection=collection))
+    paging = au.parse_paging_args(args)              # optional after_id and limit
+    return paged_json_response(
+        imgr.image_metadata_by_path(ipath, collection=collection, **paging),
+        limit=paging['limit'])
 
 
 #############################################################
@@ -109,21 +144,21 @@ def image_metadata_by_path (args):
 @celery.task()
 def list_collections (args):
     """ List image collections found in the image metadata table. """
-    return jsonify(imgr.list_collections())
+    return etagged_json_response(imgr.list_collections())
 
 
 @celery.task()
 def list_filters (args):
     """ List image filters found in the image metadata table. """
     collection = au.parse_collection_arg(args)    # optional collection restriction
-    return jsonify(imgr.list_filters(collection=collection))
+    return etagged_json_response(imgr.list_filters(collection=collection))
 
 
 @celery.task()
 def list_image_paths (args):
     """ List paths to FITS images from the image metadata table. """
     collection = au.parse_collection_arg(args)    # optional collection restriction
-    return jsonify(imgr.list_image_paths(collection=collection))
+    return etagged_json_response(imgr.list_image_paths(collection=collection))
 
 
 @celery.task()
@@ -134,7 +169,25 @@ def query_cone (args):
     co_args = au.parse_cutout_args(args, required=True)  # get coordinates and radius
     collection = au.parse_collection_arg(args)           # optional collection restriction
     filt = au.parse_filter_arg(args)                     # optional filter restriction
-    return jsonify(imgr.query_cone(co_args, collection=collection, filt=filt))
+    paging = au.parse_paging_args(args)                  # optional after_id and limit
+    return paged_json_response(
+        imgr.query_cone(co_args, collection=collection, filt=filt, **paging),
+        limit=paging['limit'])
+
+
+@celery.task()
+def query_cones (args, files=None):
+    """
+    Cross-match a list of positions, given as a list or as an uploaded CSV or FITS table,
+    against the image centers, returning a stream of the matching image IDs for each position.
+    """
+    co_args = au.parse_cutout_size(args, required=True)  # get required search radius
+    collection = au.parse_collection_arg(args)           # optional collection restriction
+    filt = au.parse_filter_arg(args)                     # optional filter restriction
+    stream = au.parse_stream_arg(args) or 'json'         # optional streaming format
+    positions = gen_positions(args, files)
+    return stream_json_rows(imgr.query_cones(positions, co_args, collection=collection,
+                                             filt=filt), fmt=stream)
 
 
 @celery.task()
@@ -145,7 +198,10 @@ def query_coordinates (args):
     co_args = au.parse_cutout_args(args)        # get coordinates
     collection = au.parse_collection_arg(args)  # optional collection restriction
     filt = au.parse_filter_arg(args)            # optional filter restriction
-    return jsonify(imgr.query_coordinates(co_args, collection=collection, filt=filt))
+    paging = au.parse_paging_args(args)         # optional after_id and limit
+    return paged_json_response(
+        imgr.query_coordinates(co_args, collection=collection, filt=filt, **paging),
+        limit=paging['limit'])
 
 
 @celery.task()
@@ -153,7 +209,14 @@ def query_image (args):
     """ List images which meet the given filter and collection criteria. """
     collection = au.parse_collection_arg(args)    # optional collection restriction
     filt = au.parse_filter_arg(args)              # optional filter restriction
-    return jsonify(imgr.query_image(collection=collection, filt=filt))
+    paging = au.parse_paging_args(args)           # optional after_id and limit
+    stream = au.parse_stream_arg(args)            # optional streaming format
+    if (stream):
+        return stream_json_rows(
+            imgr.query_image(collection=collection, filt=filt, stream=True, **paging),
+            fmt=stream)
+    return paged_json_response(imgr.query_image(collection=collection, filt=filt, **paging),
+                               limit=paging['limit'])
 
 
 
@@ -170,13 +233,28 @@ def list_cutouts (args):
 @celery.task()
 def fetch_cutout (args):
     """
-    Return an image cutout. if cutout size is not specified, return the entire image.
+    Return an image cutout, of the image extensions given by an 'ext' argument, if any, in
+    the planes of a data cube given by plane range arguments, if any, binned if a binning
+    argument is given, and then rendered as a PNG or JPEG preview if a preview format is
+    given, or else converted if a data type is given and then written as a raw array if an
+    array format (npy or arrow) is given, or else tile compressed if a compression argument
+    is given. If cutout size is not specified, return the entire (possibly binned) image.
     """
     # parse the parameters for the cutout
     co_args = au.parse_cutout_args(args)
     collection = au.parse_collection_arg(args)
     filt = au.parse_filter_arg(args)
-    return imgr.get_image_or_cutout(co_args, filt=filt, collection=collection)
+    compression = au.parse_compression_args(args)
+    preview = au.parse_preview_args(args)
+    binning = au.parse_binning_args(args)
+    dtype = au.parse_dtype_arg(args)
+    extensions = au.parse_extension_arg(args)
+    planes = au.parse_plane_args(args)
+    array_format = au.parse_array_format_arg(args)
+    return imgr.get_image_or_cutout(co_args, filt=filt, collection=collection,
+                                    compression=compression, preview=preview,
+                                    binning=binning, dtype=dtype, extensions=extensions,
+                                    planes=planes, array_format=array_format)
 
 
 @celery.task()
@@ -188,7 +266,61 @@ def fetch_cutout_by_filter (args):
     co_args = au.parse_cutout_args(args)
     filt = au.parse_filter_arg(args, required=True)  # test for required filter
     collection = au.parse_collection_arg(args)
-    return imgr.get_image_or_cutout(co_args, filt=filt, collection=collection)
+    compression = au.parse_compression_args(args)
+    preview = au.parse_preview_args(args)
+    binning = au.parse_binning_args(args)
+    dtype = au.parse_dtype_arg(args)
+    extensions = au.parse_extension_arg(args)
+    planes = au.parse_plane_args(args)
+    array_format = au.parse_array_format_arg(args)
+    return imgr.get_image_or_cutout(co_args, filt=filt, collection=collection,
+                                    compression=compression, preview=preview,
+                                    binning=binning, dtype=dtype, extensions=extensions,
+                                    planes=planes, array_format=array_format)
+
+
+@celery.task()
+def fetch_cutout_cube (args):
+    """
+    Make and return a multi-extension FITS file containing a cutout, at the same position
+    and of the same size, in each filter: one image extension, named by filter, per filter.
+    """
+    co_args = au.parse_cutout_args(args, required=True)  # position and required size
+    collection = au.parse_collection_arg(args)           # optional collection restriction
+    hdus = imgr.make_filter_cube(co_args, collection=collection)
+    buf = io.BytesIO()
+    hdus.writeto(buf)
+    buf.seek(0)
+    return send_file(buf, mimetype=FITS_MIME_TYPE, as_attachment=True,
+                     download_name='cutout_cube.fits')
+
+
+@celery.task()
+def fetch_cutouts (args, files=None):
+    """
+    Make a cutout at each of a list of positions, given as a list or as an uploaded CSV or
+    FITS table, and return all the cutouts in a single zip or tar archive or multi-extension
+    FITS file, or stacked into a single raw array (an npy stack, in a .npz archive, or an
+    Arrow tensor), with a manifest listing the positions and any errors. Each position may
+    give its own size, in the units of the request's size argument (default arc seconds).
+    """
+    size_args = au.parse_cutout_size(args)      # optional default size and units
+    size_args.setdefault('units', u.arcsec)
+    collection = au.parse_collection_arg(args)  # optional collection restriction
+    filt = au.parse_filter_arg(args)            # optional filter restriction
+    fmt = au.parse_archive_format_arg(args)     # optional archive format
+    frame = au.parse_frame_arg(args)            # optional coordinate reference system
+
+    positions = list(islice(gen_positions(args, files), MAX_BATCH_CUTOUTS + 1))
+    if (len(positions) > MAX_BATCH_CUTOUTS):
+        errMsg = f"Too many cutout positions specified: the maximum is {MAX_BATCH_CUTOUTS}"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+
+    stamps = imgr.make_cutouts(positions, size_args, collection=collection, filt=filt, frame=frame)
+    archive = write_archive(stamps, fmt, units=size_args['units'])
+    return send_file(archive, mimetype=ARCHIVE_MIME_TYPES[fmt], as_attachment=True,
+                     download_name=f"cutouts{ARCHIVE_EXTENSIONS[fmt]}")
 
 
 @celery.task()
@@ -200,3 +332,143 @@ def fetch_cutout_from_cache (args):
         current_app.logger.error(errMsg)
         raise exceptions.RequestException(errMsg)
     return imgr.return_cutout_with_name(filename)
+
+
+#
+# Cutout job methods
+#
+
+@celery.task()
+def make_cutout_job (args):
+    """
+    Worker task to find the image for, and make (or reuse), the cutout specified by the given
+    arguments, saving it in the cutouts cache, binned if binning arguments are given, converted
+    to the given output data type, if any, and then tile compressed if compression arguments
+    are given, as for a single cutout (see get_cutout).
+    Return a dictionary containing the filename of the cached cutout ('filename') or, if the
+    cutout cannot be made, an error dictionary ('error'), since the result must be serialized
+    as JSON.
+    """
+    try:
+        job_args = parse_cutout_job_args(args)
+        co_args = job_args['co_args']
+        filt = job_args['filt']
+        collection = job_args['collection']
+        ipath = imgr.find_cutout_image(co_args, filt=filt, collection=collection)
+        co_filename = imgr.make_cached_cutout(ipath, co_args, filt=filt, collection=collection,
+                                              extensions=job_args['extensions'],
+                                              planes=job_args['planes'])
+        if (job_args['binning']):
+            co_filename = imgr.make_binned_cutout(co_filename, job_args['binning'])
+        if (job_args['dtype']):
+            co_filename = imgr.make_converted_cutout(co_filename, job_args['dtype'])
+        if (job_args['compression']):
+            co_filename = imgr.make_compressed_cutout(co_filename, job_args['compression'])
+        return { 'filename': co_filename }
+    except exceptions.ProcessingError as pe:
+        return { 'error': pe.to_dict() }
+
+
+@celery.task()
+def submit_cutout_job (args):
+    """
+    Submit a job to make the cutout specified by the given arguments on a Celery worker,
+    after checking the arguments. Return a '202 Accepted' response with the job status,
+    whose URL is also given in the 'Location' header.
+    """
+    parse_cutout_job_args(args)                 # reject bad arguments before submitting
+    try:
+        result = make_cutout_job.delay(dict(args))
+    except Exception as ex:
+        errMsg = f"Unable to submit the cutout job to the job queue: {ex}"
+        current_app.logger.error(errMsg)
+        raise exceptions.ServerError(errMsg)
+
+    job = job_status(result.id, 'PENDING')
+    resp = jsonify(job)
+    resp.status_code = 202
+    resp.headers['Location'] = job['status_url']
+    return resp
+
+
+@celery.task()
+def cutout_job_status (job_id):
+    """ Return the status of the identified cutout job. """
+    return jsonify(get_job_status(job_id))
+
+
+@celery.task()
+def fetch_cutout_job_result (job_id):
+    """
+    Return the cutout made by the identified cutout job, if the job is done, or the job
+    status, with a '202 Accepted' status code, if the job has not finished.
+    :raises: an exception for the error which caused the job to fail.
+    """
+    job = get_job_status(job_id)
+    if (job['status'] == JOB_DONE):
+        return imgr.return_cutout_with_name(job['filename'])
+    if (job['status'] == JOB_FAILED):
+        error = job['error']
+        raise exceptions.ProcessingError(error.get('message'), error.get('error_code'))
+    return (jsonify(job), 202)
+
+
+def parse_cutout_job_args (args):
+    """
+    Parse and check the arguments of a cutout job, returning a dictionary of its cutout
+    arguments ('co_args') and its optional filter, collection, compression, extension, plane,
+    binning, and output data type arguments ('filt', 'collection', 'compression', 'extensions',
+    'planes', 'binning', and 'dtype').
+    :raises: RequestException if any argument is not valid, or a preview image or a raw array
+        is requested: a job makes a FITS cutout, which is fetched from the job's result URL.
+    """
+    job_args = {
+        'co_args': au.parse_cutout_args(args, required=True),
+        'filt': au.parse_filter_arg(args),
+        'collection': au.parse_collection_arg(args),
+        'compression': au.parse_compression_args(args),
+        'extensions': au.parse_extension_arg(args),
+        'planes': au.parse_plane_args(args),
+        'binning': au.parse_binning_args(args),
+        'dtype': au.parse_dtype_arg(args)
+    }
+    if (au.parse_preview_args(args)):
+        errMsg = "Cutout jobs make FITS cutouts: request a preview image ('format' png or jpeg) from /co/cutout"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+    if (au.parse_array_format_arg(args)):
+        errMsg = "Cutout jobs make FITS cutouts: request a raw array ('format' npy or arrow) from /co/cutout"
+        current_app.logger.error(errMsg)
+        raise exceptions.RequestException(errMsg)
+    return job_args
+
+
+def get_job_status (job_id):
+    """ Return a status dictionary for the identified cutout job, read from the result backend. """
+    job_id = parse_job_id(job_id)
+    try:
+        result = celery.AsyncResult(job_id)
+        state = result.state
+        return job_status(job_id, state, result.result if result.ready() else None)
+    except exceptions.ProcessingError:
+        raise
+    except Exception as ex:
+        errMsg = f"Unable to read the status of cutout job '{job_id}': {ex}"
+        current_app.logger.error(errMsg)
+        raise exceptions.ServerError(errMsg)
+
+
+#
+# Service methods
+#
+
+@celery.task()
+def cutout_cache_stats (args):
+    """ Return the current size and the limits of the cutouts (cache) directory. """
+    return jsonify(imgr.cutout_cache_stats())
+
+
+@celery.task()
+def db_stats (args):
+    """ Return usage statistics for this worker's database connection pool. """
+    return jsonify(imgr.db_pool_stats())
@@ -0,0 +1,62 @@
+#
+# Class implementing a small, in-process cache of values which expire after a time-to-live.
+#   Last Modified: Initial creation: cache image metadata listings.
+#
+import threading
+import time
+
+
+class TTLCache ():
+    """
+    Thread (and greenlet) safe cache of computed values, each of which expires a fixed
+    number of seconds after it was computed. Entries may also be invalidated explicitly.
+    """
+
+    def __init__ (self, ttl=300):
+        """
+        Constructor for a cache whose entries expire after the given number of seconds.
+        A time-to-live of zero (or less) disables caching.
+        """
+        self.ttl = ttl
+        self._entries = dict()              # key => (expiration time, value)
+        self._generation = 0                # incremented by each invalidation
+        self._lock = threading.Lock()
+
+
+    def get (self, key, loader):
+        """
+        Return the cached value for the given key or, if there is no unexpired value, call
+        the given loader function to compute the value, cache it, and return it. A value
+        computed while the cache was being invalidated is returned but not cached.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if ((entry is not None) and (entry[0] > now)):
+                return entry[1]
+            generation = self._generation
+
+        value = loader()                    # compute value outside of the lock
+
+        if (self.ttl > 0):
+            with self._lock:
+                if (generation == self._generation):
+                    self._entries[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+
+    def invalidate (self, key=None):
+        """ Remove the entry for the given key or, if no key is given, remove all entries. """
+        with self._lock:
+            self._generation += 1
+            if (key is None):
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+    def __len__ (self):
+        """ Return the number of unexpired entries in this cache. """
+        now = time.monotonic()
+        with self._lock:
+            return len([ entry for entry in self._entries.values() if (entry[0] > now) ])
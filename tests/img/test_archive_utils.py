@@ -0,0 +1,130 @@
+# Tests for the cutout archive utilities module.
+#   Last Modified: Import the required pyarrow package at the module level.
+#
+import io
+import json
+import tarfile
+import zipfile
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from astropy import units as u
+from astropy.io import fits
+
+import cuts.blueprints.img.archive_utils as arch
+
+
+class TestArchiveUtils(object):
+
+    def stamps(self):
+        hdu = fits.PrimaryHDU(data=np.arange(16, dtype='f4').reshape(4, 4))
+        return [ ({ 'row': 0, 'ra': 1.0, 'dec': 2.0, 'size': 10.0, 'image': '/a.fits' }, hdu),
+                 ({ 'row': 1, 'ra': 3.0, 'dec': 4.0, 'error': 'No matching image' }, None),
+                 ({ 'row': 2, 'ra': 5.0, 'dec': 6.0, 'size': 10.0, 'image': '/b.fits' }, hdu) ]
+
+
+    def test_stamp_name(self):
+        assert arch.stamp_name({ 'row': 12 }) == 'cutout_000012.fits'
+
+
+    def test_manifest_entry(self):
+        pos = { 'row': 3, 'ra': 1.0, 'dec': 2.0, 'ids': [1, 2] }
+        assert arch.manifest_entry(pos) == { 'row': 3, 'ra': 1.0, 'dec': 2.0 }
+        assert arch.manifest_entry(pos, 'x.fits')['name'] == 'x.fits'
+
+
+    def test_manifest_table_hdu(self):
+        hdu = arch.manifest_table_hdu([ { 'row': 0, 'ra': 1.0, 'dec': 2.0, 'name': 'CUTOUT_0' },
+                                        { 'row': 1, 'error': 'bad' } ])
+        assert hdu.name == 'MANIFEST'
+        assert list(hdu.data['row']) == [0, 1]
+        assert np.isnan(hdu.data['ra'][1])
+        assert hdu.data['error'][1] == 'bad'
+
+
+    def test_write_zip(self):
+        out = arch.write_archive(self.stamps(), 'zip', units=u.arcsec)
+        with zipfile.ZipFile(out) as zfile:
+            names = zfile.namelist()
+            assert names == [ 'cutout_000000.fits', 'cutout_000002.fits', arch.MANIFEST_NAME ]
+            with fits.open(io.BytesIO(zfile.read(names[0]))) as hdus:
+                assert hdus[0].data.shape == (4, 4)
+            manifest = json.loads(zfile.read(arch.MANIFEST_NAME))
+        assert manifest['units'] == 'arcsec'
+        assert len(manifest['cutouts']) == 3
+        assert manifest['cutouts'][0]['name'] == 'cutout_000000.fits'
+        assert manifest['cutouts'][1]['error'] == 'No matching image'
+        assert 'name' not in manifest['cutouts'][1]
+
+
+    def test_write_tar(self):
+        out = arch.write_archive(self.stamps(), 'tar')
+        with tarfile.open(fileobj=out) as tar:
+            names = tar.getnames()
+            assert names == [ 'cutout_000000.fits', 'cutout_000002.fits', arch.MANIFEST_NAME ]
+            manifest = json.load(tar.extractfile(arch.MANIFEST_NAME))
+        assert manifest['units'] is None
+        assert len(manifest['cutouts']) == 3
+
+
+    def test_write_mef(self):
+        out = arch.write_archive(self.stamps(), 'fits', units=u.arcsec)
+        with fits.open(out) as hdus:
+            assert len(hdus) == 4
+            assert hdus[0].header['CO_COUNT'] == 2
+            assert hdus[0].header['CO_UNITS'] == 'arcsec'
+            assert hdus['CUTOUT_2'].header['CO_ROW'] == 2
+            manifest = hdus['MANIFEST'].data
+            assert list(manifest['extname']) == [ 'CUTOUT_0', '', 'CUTOUT_2' ]
+
+
+    def test_stack_layout(self):
+        small = fits.PrimaryHDU(data=np.ones((3, 2), dtype='>i2'))
+        cube = fits.PrimaryHDU(data=np.ones((2, 2, 2), dtype='f4'))
+        stamps = self.stamps() + [ ({ 'row': 3 }, small), ({ 'row': 4 }, cube) ]
+        (stamps, shape, dtype) = arch.stack_layout(stamps)
+        assert shape == (4, 4)
+        assert dtype == np.dtype('=f4')
+        assert stamps[4][1] is None
+        assert 'unlike the 2 dimensions' in stamps[4][0]['error']
+
+
+    def test_stack_plane(self):
+        hdu = fits.PrimaryHDU(data=np.ones((3, 2), dtype='>i2'))
+        plane = arch.stack_plane(hdu, (4, 4), np.dtype('f4'))
+        assert plane[:3, :2].tolist() == [[1, 1], [1, 1], [1, 1]]
+        assert np.isnan(plane[3]).all() and np.isnan(plane[:, 2:]).all()
+        assert np.isnan(arch.stack_plane(None, (4, 4), np.dtype('f4'))).all()
+
+
+    def test_write_npz(self):
+        out = arch.write_archive(self.stamps(), 'npy', units=u.arcsec)
+        with np.load(out, allow_pickle=False) as npz:
+            stack = npz['cutouts']
+            manifest = json.loads(npz['manifest.json'])
+        assert stack.shape == (3, 4, 4)
+        assert np.array_equal(stack[2], np.arange(16, dtype='f4').reshape(4, 4))
+        assert np.isnan(stack[1]).all()
+        assert manifest['units'] == 'arcsec'
+        assert manifest['cutouts'][0]['shape'] == [4, 4]
+        assert manifest['cutouts'][1]['error'] == 'No matching image'
+        assert 'wcs' not in manifest['cutouts'][1]
+
+
+    def test_write_arrow_stack(self):
+        out = arch.write_archive(self.stamps(), 'arrow', units=u.arcsec)
+        table = pa.ipc.open_file(out).read_all()
+        assert table.column('row').to_pylist() == [0, 1, 2]
+        assert table.column('error').to_pylist()[1] == 'No matching image'
+        stack = table.column('cutout').combine_chunks().to_numpy_ndarray()
+        assert stack.shape == (3, 4, 4)
+        assert np.isnan(stack[1]).all()
+
+
+    def test_write_empty(self):
+        out = arch.write_archive([], 'fits')
+        with fits.open(out) as hdus:
+            assert hdus[0].header['CO_COUNT'] == 0
+            assert len(hdus['MANIFEST'].data) == 0
@@ -11,6 +11,7 @@ class TestArgUtils(object):
 
     coll_emsg = "A collection name must be specified"
     filt_emsg = "An image filter must be specified"
+    frame_emsg = "is not a known frame of RA and DEC coordinates"
     id_emsg = "A record ID must be specified"
     path_emsg = "A valid image path must be specified"
     ra_emsg = "Right ascension must be specified, via the 'ra' argument"
@@ -19,6 +20,13 @@ class TestArgUtils(object):
     dec_convert_emsg = "Error trying to convert the specified DEC to a number."
     size_emsg = "A radius size .* must be specified."
     size_convert_emsg = "Error trying to convert the given size specification to a number."
+    stream_emsg = "The 'stream' argument must be one of"
+    after_id_emsg = "A paging cursor \\('after_id'\\) must be an integer >= 0"
+    limit_emsg = "A result 'limit' must be an integer > 0"
+    ids_emsg = "Record IDs must be positive integers"
+    ids_empty_emsg = "A list of record IDs must be specified"
+    ids_max_emsg = "Too many record IDs specified"
+    json_emsg = "The request body does not contain valid JSON"
 
 
 
@@ -259,6 +267,23 @@ class TestArgUtils(object):
 
 
 
+    def test_parse_frame_arg(self):
+        """ The frame defaults to ICRS and must be a frame of RA and DEC coordinates. """
+        assert autils.parse_frame_arg({}) == 'icrs'
+        assert autils.parse_frame_arg({'frame': ' FK5 '}) == 'fk5'
+
+
+    def test_parse_frame_arg_bad(self):
+        """ An unknown frame, or a frame with other coordinates, is rejected. """
+        with pytest.raises(RequestException, match=self.frame_emsg):
+            autils.parse_frame_arg({'frame': 'icsr'})
+        with pytest.raises(RequestException, match=self.frame_emsg):
+            autils.parse_frame_arg({'frame': 'galactic'})
+        with pytest.raises(RequestException, match=self.frame_emsg):
+            autils.parse_coordinate_args({'ra': '1.0', 'dec': '2.0', 'frame': 'galactic'})
+
+
+
     def test_parse_id_arg_noid(self):
         """ No id given, but not required. """
         uid = autils.parse_id_arg({}, required=False)
@@ -352,3 +377,316 @@ class TestArgUtils(object):
         path = autils.parse_ipath_arg({'path': 'shhh'}, required=True)
         assert path is not None
         assert path == 'shhh'
+
+
+
+    def test_parse_stream_arg_nostream(self):
+        """ No stream argument given. """
+        assert autils.parse_stream_arg({}) is None
+        assert autils.parse_stream_arg({'stream': None}) is None
+        assert autils.parse_stream_arg({'stream': '  '}) is None
+
+
+    def test_parse_stream_arg_bad(self):
+        """ Unsupported stream format given. """
+        with pytest.raises(RequestException, match=self.stream_emsg) as reqex:
+            autils.parse_stream_arg({'stream': 'xml'})
+
+
+    def test_parse_stream_arg(self):
+        """ Valid stream formats given. """
+        assert autils.parse_stream_arg({'stream': 'json'}) == 'json'
+        assert autils.parse_stream_arg({'stream': 'ndjson'}) == 'ndjson'
+        assert autils.parse_stream_arg({'stream': ' NDJSON '}) == 'ndjson'
+        assert autils.parse_stream_arg({'stream': 'true'}) == 'json'
+        assert autils.parse_stream_arg({'stream': '1'}) == 'json'
+
+
+
+    def test_parse_compression_args_none(self):
+        """ No compression argument given, or no compression requested. """
+        assert autils.parse_compression_args({}) is None
+        assert autils.parse_compression_args({'compression': ' '}) is None
+        assert autils.parse_compression_args({'compression': 'none'}) is None
+        assert autils.parse_compression_args({'compression': 'False', 'quantize': 'x'}) is None
+
+
+    def test_parse_compression_args(self):
+        """ Valid compression and quantization arguments given. """
+        comp = autils.parse_compression_args({'compression': 'RICE'})
+        assert comp == { 'compression_type': 'RICE_1', 'quantize_level': 16.0 }
+        comp = autils.parse_compression_args({'compression': 'gzip2', 'quantize': '0'})
+        assert comp == { 'compression_type': 'GZIP_2', 'quantize_level': 0.0 }
+        comp = autils.parse_compression_args({'compression': 'rice_1', 'quantize': '4.5'})
+        assert comp['quantize_level'] == 4.5
+
+
+    def test_parse_compression_args_bad(self, app):
+        """ Unsupported compression or bad quantization arguments given. """
+        with pytest.raises(RequestException, match="The 'compression' argument must be one of"):
+            autils.parse_compression_args({'compression': 'hcompress'})
+        with pytest.raises(RequestException, match="The 'quantize' argument must be"):
+            autils.parse_compression_args({'compression': 'rice', 'quantize': 'lots'})
+        with pytest.raises(RequestException, match="The 'quantize' argument must be"):
+            autils.parse_compression_args({'compression': 'rice', 'quantize': '0'})
+        with pytest.raises(RequestException, match="The 'quantize' argument must be"):
+            autils.parse_compression_args({'compression': 'gzip2', 'quantize': 'nan'})
+
+
+    def test_parse_binning_args(self):
+        """ No, default, and valid binning arguments given. """
+        assert autils.parse_binning_args({}) is None
+        assert autils.parse_binning_args({'bin': ' '}) is None
+        assert autils.parse_binning_args({'bin': '1'}) is None
+        assert autils.parse_binning_args({'bin': '4'}) == { 'factor': 4 }
+        assert autils.parse_binning_args({'maxPixels': '512'}) == { 'max_pixels': 512 }
+
+
+    def test_parse_binning_args_bad(self, app):
+        """ Bad or conflicting binning arguments given. """
+        with pytest.raises(RequestException, match="The 'bin' argument must be an integer"):
+            autils.parse_binning_args({'bin': '0'})
+        with pytest.raises(RequestException, match="The 'bin' argument must be an integer"):
+            autils.parse_binning_args({'bin': '2.5'})
+        with pytest.raises(RequestException, match="The 'bin' argument must be an integer"):
+            autils.parse_binning_args({'bin': '1000'})
+        with pytest.raises(RequestException, match="The 'maxPixels' argument must be"):
+            autils.parse_binning_args({'maxPixels': '-3'})
+        with pytest.raises(RequestException, match="Only one of the 'bin' and 'maxPixels'"):
+            autils.parse_binning_args({'bin': '2', 'maxPixels': '100'})
+
+
+    def test_parse_dtype_arg(self):
+        """ No, native, valid, and unsupported output data types given. """
+        assert autils.parse_dtype_arg({}) is None
+        assert autils.parse_dtype_arg({'dtype': ' '}) is None
+        assert autils.parse_dtype_arg({'dtype': 'Native'}) is None
+        assert autils.parse_dtype_arg({'dtype': 'FLOAT32'}) == 'float32'
+        assert autils.parse_dtype_arg({'dtype': 'int16'}) == 'int16'
+
+
+    def test_parse_dtype_arg_bad(self, app):
+        with pytest.raises(RequestException, match="The 'dtype' argument must be one of"):
+            autils.parse_dtype_arg({'dtype': 'uint8'})
+
+
+    def test_parse_extension_arg(self):
+        """ No, primary, named, indexed, and repeated image extensions given. """
+        assert autils.parse_extension_arg({}) is None
+        assert autils.parse_extension_arg({'ext': ' '}) is None
+        assert autils.parse_extension_arg({'ext': '0'}) is None
+        assert autils.parse_extension_arg({'ext': 'primary'}) is None
+        assert autils.parse_extension_arg({'ext': 'sci'}) == ['SCI']
+        assert autils.parse_extension_arg({'ext': '1'}) == [1]
+        assert autils.parse_extension_arg({'ext': 'SCI, err,DQ,sci,,'}) == ['SCI', 'ERR', 'DQ']
+
+
+    def test_parse_plane_args(self):
+        """ No, plane index, and world coordinate ranges given. """
+        assert autils.parse_plane_args({}) is None
+        assert autils.parse_plane_args({'planeMin': ' ', 'zMax': ''}) is None
+        assert autils.parse_plane_args({'planeMin': '3', 'planeMax': '7'}) == {'planes': (3, 7)}
+        assert autils.parse_plane_args({'planeMax': '0'}) == {'planes': (None, 0)}
+        assert autils.parse_plane_args({'zMin': '2.1e-6'}) == {'world': (2.1e-6, None)}
+        assert autils.parse_plane_args({'zMin': '1', 'zMax': '1'}) == {'world': (1.0, 1.0)}
+
+
+    def test_parse_plane_args_bad(self, app):
+        with pytest.raises(RequestException, match="The 'planeMin' and 'planeMax' arguments"):
+            autils.parse_plane_args({'planeMin': '-1'})
+        with pytest.raises(RequestException, match="The 'planeMin' and 'planeMax' arguments"):
+            autils.parse_plane_args({'planeMin': '5', 'planeMax': '4'})
+        with pytest.raises(RequestException, match="The 'zMin' and 'zMax' arguments"):
+            autils.parse_plane_args({'zMin': 'red'})
+        with pytest.raises(RequestException, match="The 'zMin' and 'zMax' arguments"):
+            autils.parse_plane_args({'zMin': '2', 'zMax': '1'})
+        with pytest.raises(RequestException, match="The 'zMin' and 'zMax' arguments"):
+            autils.parse_plane_args({'zMax': 'nan'})
+        with pytest.raises(RequestException, match="Only one of the plane"):
+            autils.parse_plane_args({'planeMin': '1', 'zMax': '1'})
+
+
+    def test_parse_extension_arg_bad(self, app):
+        with pytest.raises(RequestException, match="The 'ext' argument must list"):
+            autils.parse_extension_arg({'ext': '-1'})
+        with pytest.raises(RequestException, match="The 'ext' argument must list"):
+            autils.parse_extension_arg({'ext': 'SCI;DROP'})
+        with pytest.raises(RequestException, match="image extensions may be specified"):
+            autils.parse_extension_arg({'ext': ','.join(str(idx) for idx in range(1, 20))})
+
+
+    def test_parse_preview_args_none(self):
+        """ No preview format given, or a FITS cutout requested. """
+        assert autils.parse_preview_args({}) is None
+        assert autils.parse_preview_args({'format': ' '}) is None
+        assert autils.parse_preview_args({'format': 'FITS', 'stretch': 'bogus'}) is None
+        assert autils.parse_preview_args({'format': 'npy', 'stretch': 'bogus'}) is None
+
+
+    def test_parse_array_format_arg(self):
+        """ Raw array formats, and other or no formats, given. """
+        assert autils.parse_array_format_arg({}) is None
+        assert autils.parse_array_format_arg({'format': 'fits'}) is None
+        assert autils.parse_array_format_arg({'format': 'png'}) is None
+        assert autils.parse_array_format_arg({'format': ' NPY '}) == 'npy'
+        assert autils.parse_array_format_arg({'format': 'arrow'}) == 'arrow'
+
+
+    def test_parse_preview_args(self):
+        """ Default and valid preview arguments given. """
+        pv = autils.parse_preview_args({'format': 'PNG'})
+        assert pv == { 'format': 'png', 'stretch': 'linear', 'min_percent': 0.5,
+                       'max_percent': 99.5, 'max_dim': 512 }
+        pv = autils.parse_preview_args({'format': 'jpg', 'stretch': 'Asinh', 'minPercent': '1',
+                                        'maxPercent': '99', 'maxDim': '128'})
+        assert pv == { 'format': 'jpeg', 'stretch': 'asinh', 'min_percent': 1.0,
+                       'max_percent': 99.0, 'max_dim': 128 }
+
+
+    def test_parse_preview_args_bad(self, app):
+        """ Unsupported preview format or bad preview arguments given. """
+        with pytest.raises(RequestException, match="The 'format' argument must be one of"):
+            autils.parse_preview_args({'format': 'gif'})
+        with pytest.raises(RequestException, match="The 'stretch' argument must be one of"):
+            autils.parse_preview_args({'format': 'png', 'stretch': 'sqrt'})
+        with pytest.raises(RequestException, match="The 'minPercent' and 'maxPercent' arguments"):
+            autils.parse_preview_args({'format': 'png', 'minPercent': '90', 'maxPercent': '10'})
+        with pytest.raises(RequestException, match="The 'minPercent' and 'maxPercent' arguments"):
+            autils.parse_preview_args({'format': 'png', 'maxPercent': 'most'})
+        with pytest.raises(RequestException, match="The 'maxDim' argument must be"):
+            autils.parse_preview_args({'format': 'png', 'maxDim': '0'})
+        with pytest.raises(RequestException, match="The 'maxDim' argument must be"):
+            autils.parse_preview_args({'format': 'png', 'maxDim': '100000'})
+
+
+    def test_parse_archive_format_arg(self):
+        """ Default, valid, and unsupported archive formats given. """
+        assert autils.parse_archive_format_arg({}) == 'zip'
+        assert autils.parse_archive_format_arg({'format': ' '}) == 'zip'
+        assert autils.parse_archive_format_arg({}, default='tar') == 'tar'
+        assert autils.parse_archive_format_arg({'format': 'TAR'}) == 'tar'
+        assert autils.parse_archive_format_arg({'format': 'fits'}) == 'fits'
+        assert autils.parse_archive_format_arg({'format': 'npy'}) == 'npy'
+        with pytest.raises(RequestException, match="The 'format' argument must be one of"):
+            autils.parse_archive_format_arg({'format': 'rar'})
+
+
+
+    def test_parse_after_id_arg_none(self):
+        """ No after_id argument given. """
+        assert autils.parse_after_id_arg({}) is None
+        assert autils.parse_after_id_arg({'after_id': None}) is None
+        assert autils.parse_after_id_arg({'after_id': ' '}) is None
+
+
+    def test_parse_after_id_arg_bad(self):
+        """ Bad after_id arguments given. """
+        with pytest.raises(RequestException, match=self.after_id_emsg) as reqex:
+            autils.parse_after_id_arg({'after_id': 'abc'})
+        with pytest.raises(RequestException, match=self.after_id_emsg) as reqex:
+            autils.parse_after_id_arg({'after_id': '-1'})
+
+
+    def test_parse_after_id_arg(self):
+        assert autils.parse_after_id_arg({'after_id': '0'}) == 0
+        assert autils.parse_after_id_arg({'after_id': '42'}) == 42
+
+
+    def test_parse_limit_arg_none(self):
+        """ No limit argument given. """
+        assert autils.parse_limit_arg({}) is None
+        assert autils.parse_limit_arg({'limit': ''}) is None
+
+
+    def test_parse_limit_arg_bad(self):
+        """ Bad limit arguments given. """
+        with pytest.raises(RequestException, match=self.limit_emsg) as reqex:
+            autils.parse_limit_arg({'limit': '1.5'})
+        with pytest.raises(RequestException, match=self.limit_emsg) as reqex:
+            autils.parse_limit_arg({'limit': '0'})
+
+
+    def test_parse_limit_arg(self):
+        assert autils.parse_limit_arg({'limit': '1'}) == 1
+        assert autils.parse_limit_arg({'limit': '100'}) == 100
+
+
+    def test_parse_paging_args(self):
+        assert autils.parse_paging_args({}) == { 'after_id': None, 'limit': None }
+        paging = autils.parse_paging_args({'after_id': '7', 'limit': '20'})
+        assert paging == { 'after_id': 7, 'limit': 20 }
+
+
+
+    def test_parse_ids_arg_single(self):
+        """ No list of IDs given. """
+        assert autils.parse_ids_arg({}) is None
+        assert autils.parse_ids_arg({'id': '5'}) is None
+        assert autils.parse_ids_arg({'id': 5}) is None
+
+
+    def test_parse_ids_arg_bad(self):
+        """ Bad IDs in list. """
+        with pytest.raises(RequestException, match=self.ids_emsg) as reqex:
+            autils.parse_ids_arg({'ids': '1,two,3'})
+        with pytest.raises(RequestException, match=self.ids_emsg) as reqex:
+            autils.parse_ids_arg({'id': '1,-2'})
+        with pytest.raises(RequestException, match=self.ids_emsg) as reqex:
+            autils.parse_ids_arg({'ids': [1, 2.5]})
+        with pytest.raises(RequestException, match=self.ids_emsg) as reqex:
+            autils.parse_ids_arg({'ids': [True]})
+        with pytest.raises(RequestException, match=self.ids_emsg) as reqex:
+            autils.parse_ids_arg({'ids': [None]})
+
+
+    def test_parse_ids_arg_empty(self):
+        with pytest.raises(RequestException, match=self.ids_empty_emsg) as reqex:
+            autils.parse_ids_arg({'ids': ''})
+        with pytest.raises(RequestException, match=self.ids_empty_emsg) as reqex:
+            autils.parse_ids_arg({'ids': []})
+
+
+    def test_parse_ids_arg_max(self):
+        with pytest.raises(RequestException, match=self.ids_max_emsg) as reqex:
+            autils.parse_ids_arg({'ids': '1,2,3,4'}, max_ids=3)
+
+
+    def test_parse_ids_arg(self):
+        assert autils.parse_ids_arg({'ids': '7'}) == [7]
+        assert autils.parse_ids_arg({'ids': 7}) == [7]
+        assert autils.parse_ids_arg({'ids': '3, 1,2,'}) == [3, 1, 2]
+        assert autils.parse_ids_arg({'id': '3,1,3,2,1'}) == [3, 1, 2]
+        assert autils.parse_ids_arg({'ids': [9, '8', 9]}) == [9, 8]
+        assert autils.parse_ids_arg({'id': [4, 5]}) == [4, 5]
+
+
+    def test_request_args_get(self, app):
+        with app.test_request_context('/img/metadata?id=1&collection=DC20'):
+            args = autils.request_args()
+            assert args == {'id': '1', 'collection': 'DC20'}
+
+
+    def test_request_args_json_list(self, app):
+        with app.test_request_context('/img/metadata', method='POST', json=[1, 2, 3]):
+            args = autils.request_args()
+            assert args == {'ids': [1, 2, 3]}
+
+
+    def test_request_args_json_dict(self, app):
+        with app.test_request_context('/img/metadata?select=x', method='POST',
+                                      json={'ids': [4, 5]}):
+            args = autils.request_args()
+            assert args == {'select': 'x', 'ids': [4, 5]}
+
+
+    def test_request_args_json_bad(self, app):
+        with app.test_request_context('/img/metadata', method='POST', data='[1,',
+                                      content_type='application/json'):
+            with pytest.raises(RequestException, match=self.json_emsg) as reqex:
+                autils.request_args()
+
+
+    def test_request_args_form(self, app):
+        with app.test_request_context('/img/metadata', method='POST', data={'ids': '1,2'}):
+            args = autils.request_args()
+            assert args == {'ids': '1,2'}
@@ -0,0 +1,70 @@
+#
+# Tests for the raw array cutout module.
+#   Last Modified: Import the required pyarrow package at the module level.
+#
+import io
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+import cuts.blueprints.img.array_utils as au
+
+
+class TestArrayUtils(object):
+
+    def wcs_header(self):
+        wcs = WCS(naxis=2)
+        wcs.wcs.ctype = [ 'RA---TAN', 'DEC--TAN' ]
+        wcs.wcs.crval = [ 10.0, 20.0 ]
+        wcs.wcs.crpix = [ 5.0, 6.0 ]
+        wcs.wcs.cdelt = [ -1.0e-4, 1.0e-4 ]
+        return wcs.to_header()
+
+
+    def test_array_data(self):
+        data = np.arange(6, dtype='>f4').reshape(2, 3)
+        native = au.array_data(fits.PrimaryHDU(data=data))
+        assert native.dtype == np.dtype('=f4')
+        assert np.array_equal(native, data)
+        already = np.arange(6, dtype='=f4').reshape(2, 3)
+        assert au.array_data(fits.PrimaryHDU(data=already)) is already
+
+
+    def test_array_data_blanks(self):
+        hdu = fits.PrimaryHDU(data=np.array([[1, -99], [3, 4]], dtype=np.int16))
+        hdu.header['BLANK'] = -99
+        data = au.array_data(hdu)
+        assert np.isnan(data[0, 1])
+        assert data[1, 1] == 4
+
+
+    def test_wcs_metadata(self):
+        metadata = au.wcs_metadata(self.wcs_header())
+        assert metadata['CTYPE1'] == 'RA---TAN'
+        assert metadata['CRPIX2'] == 6.0
+        assert WCS(metadata).wcs.crval[0] == pytest.approx(10.0)
+
+
+    def test_write_npy(self):
+        data = np.arange(12, dtype='f4').reshape(3, 4)
+        buf = io.BytesIO()
+        au.write_npy(data, buf)
+        assert buf.getvalue().startswith(b'\x93NUMPY')
+        assert len(buf.getvalue()) < 2880         # no FITS header or block padding
+        buf.seek(0)
+        assert np.array_equal(np.load(buf, allow_pickle=False), data)
+
+
+    def test_encode_arrow(self):
+        stack = np.arange(24, dtype='f4').reshape(2, 3, 4)
+        table = au.encode_arrow({ 'row': [ 0, 1 ], au.TENSOR_COLUMN: stack },
+                                metadata={ au.WCS_METADATA_KEY: { 'CRPIX1': 5.0 } })
+        buf = io.BytesIO()
+        au.write_arrow(table, buf)
+        table = pa.ipc.open_file(pa.py_buffer(buf.getvalue())).read_all()
+        assert np.array_equal(table.column(au.TENSOR_COLUMN).combine_chunks().to_numpy_ndarray(), stack)
+        assert table.schema.metadata[b'wcs'] == b'{"CRPIX1": 5.0}'
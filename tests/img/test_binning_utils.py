@@ -0,0 +1,172 @@
+#
+# Tests for the image binning utilities module.
+#   Last Modified: Add tests of binning images in bands, through their sections.
+#
+import os
+import warnings
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+import cuts.blueprints.img.binning_utils as bu
+from tests import TEST_RESOURCES_DIR
+
+
+class TestBinningUtils(object):
+
+    hh_tstfyl = os.path.join(TEST_RESOURCES_DIR, 'HorseHead.fits')
+    m13_tstfyl = os.path.join(TEST_RESOURCES_DIR, 'm13.fits')
+
+
+    def cd_header(self):
+        header = fits.Header()
+        header['CTYPE1'] = 'RA---TAN'
+        header['CTYPE2'] = 'DEC--TAN'
+        header['CRPIX1'] = 50.0
+        header['CRPIX2'] = 40.0
+        header['CRVAL1'] = 10.0
+        header['CRVAL2'] = 20.0
+        header['CD1_1'] = -1.0e-4
+        header['CD1_2'] = 2.0e-5
+        header['CD2_1'] = 2.0e-5
+        header['CD2_2'] = 1.0e-4
+        return header
+
+
+    def assert_same_sky(self, header, binned_header, factor, points=((0, 0), (3, 4), (10, 7))):
+        """ Binned pixel centers must map to the centers of their unbinned blocks. """
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            (wcs, bwcs) = (WCS(header), WCS(binned_header))
+        center = (factor - 1) / 2.0
+        for (bx, by) in points:
+            sky = wcs.pixel_to_world(center + bx * factor, center + by * factor)
+            assert sky.separation(bwcs.pixel_to_world(bx, by)).arcsec < 1e-6
+
+
+    def test_bin_factor(self):
+        assert bu.bin_factor((100, 80), { 'factor': 4 }) == 4
+        assert bu.bin_factor((100, 80), { 'max_pixels': 100 }) == 1
+        assert bu.bin_factor((100, 80), { 'max_pixels': 99 }) == 2
+        assert bu.bin_factor((3, 1000, 80), { 'max_pixels': 10 }) == 100
+
+
+    def test_block_average(self):
+        data = np.arange(16, dtype=np.int16).reshape(4, 4)
+        binned = bu.block_average(data, 2)
+        assert binned.dtype == np.float32
+        assert np.allclose(binned, [[2.5, 4.5], [10.5, 12.5]])
+        assert bu.block_average(data.astype('>f8'), 2).dtype == np.float64
+        assert bu.block_average(data, 1).dtype == np.float32
+
+
+    def test_block_average_trim_and_nan(self):
+        data = np.ones((7, 5), dtype=np.float32)
+        data[0, 0] = np.nan
+        data[2:4, 2:4] = np.nan
+        binned = bu.block_average(data, 2)
+        assert binned.shape == (3, 2)
+        assert np.isnan(binned[1, 1])
+        assert np.allclose(np.delete(binned.ravel(), 3), 1.0)
+
+
+    def test_block_average_bands(self):
+        data = np.random.default_rng(3).normal(0.0, 1.0, (61, 45))
+        whole = bu.block_average(data, 3)
+        saved = bu.BLOCK_CHUNK_PIXELS
+        try:
+            bu.BLOCK_CHUNK_PIXELS = 100         # several bands of rows
+            assert np.allclose(bu.block_average(data, 3), whole)
+        finally:
+            bu.BLOCK_CHUNK_PIXELS = saved
+
+
+    def test_block_average_blank_bands(self):
+        data = np.arange(120, dtype=np.int32).reshape(10, 12)
+        data[0:2, 0:2] = -99
+        data[5, 7] = -99
+        expected = bu.block_average(np.where(data == -99, np.nan, data), 2)
+        saved = bu.BLOCK_CHUNK_PIXELS
+        try:
+            bu.BLOCK_CHUNK_PIXELS = 30          # several bands of rows
+            binned = bu.block_average(data, 2, blank=-99)
+        finally:
+            bu.BLOCK_CHUNK_PIXELS = saved
+        assert np.isnan(binned[0, 0])
+        assert np.allclose(binned, expected, equal_nan=True)
+        assert np.isnan(bu.block_average(data, 1, blank=-99)[5, 7])
+
+
+    def test_bin_hdu_section(self, tmp_path):
+        """ A scaled image with blanks is binned through its section, without loading its data. """
+        data = np.arange(96, dtype=np.int16).reshape(8, 12)
+        data[2, 3] = -1
+        hdu = fits.PrimaryHDU(data=data, header=self.cd_header())
+        hdu.header['BLANK'] = -1
+        hdu.header['BSCALE'] = 2.0
+        hdu.header['BZERO'] = 10.0
+        filepath = str(tmp_path / 'scaled.dat')
+        hdu.writeto(filepath)
+        expected = bu.block_average(np.where(data == -1, np.nan, data * 2.0 + 10.0), 4)
+        with fits.open(filepath, memmap=False) as hdus:
+            binned = bu.bin_hdu(hdus[0], 4)
+            assert hdus[0]._data_loaded is False
+        assert binned.data.shape == (2, 3)
+        assert np.allclose(binned.data, expected)
+        assert 'BSCALE' not in binned.header
+
+
+    def test_bin_header_cd(self):
+        header = self.cd_header()
+        header['BSCALE'] = 2.0
+        header['CHECKSUM'] = 'xx'
+        binned = bu.bin_header(header, 4)
+        assert binned['CD1_1'] == pytest.approx(-4.0e-4)
+        assert binned['CRPIX1'] == pytest.approx(12.875)
+        assert binned['CO_BIN'] == 4
+        assert 'BSCALE' not in binned
+        assert 'CHECKSUM' not in binned
+        assert 'CDELT1' not in binned
+        assert header['CRPIX1'] == 50.0         # original is unchanged
+        self.assert_same_sky(header, binned, 4)
+
+
+    def test_bin_header_cdelt(self):
+        header = fits.getheader(self.m13_tstfyl)
+        binned = bu.bin_header(header, 3)
+        assert binned['CDELT2'] == pytest.approx(3 * header['CDELT2'])
+        self.assert_same_sky(header, binned, 3)
+
+
+    def test_bin_header_dss(self):
+        header = fits.getheader(self.hh_tstfyl)
+        for factor in (2, 5):
+            self.assert_same_sky(header, bu.bin_header(header, factor), factor)
+
+
+    def test_bin_header_sip(self):
+        header = self.cd_header()
+        header['CTYPE1'] = 'RA---TAN-SIP'
+        header['CTYPE2'] = 'DEC--TAN-SIP'
+        header['A_ORDER'] = 2
+        header['B_ORDER'] = 2
+        header['A_2_0'] = 1.0e-4
+        header['B_0_2'] = -2.0e-4
+        header['A_1_1'] = 3.0e-5
+        binned = bu.bin_header(header, 4)
+        assert binned['A_ORDER'] == 2
+        assert binned['A_2_0'] == pytest.approx(4.0e-4)
+        self.assert_same_sky(header, binned, 4, points=((0, 0), (20, 2), (5, 17)))
+
+
+    def test_bin_hdu_blank(self):
+        data = np.array([[1, 3, -1, -1], [5, 7, -1, -1]], dtype=np.int16)
+        header = self.cd_header()
+        header['BLANK'] = -1
+        binned = bu.bin_hdu(fits.PrimaryHDU(data=data, header=header), 2)
+        assert binned.data[0, 0] == 4.0
+        assert np.isnan(binned.data[0, 1])
+        assert 'BLANK' not in binned.header
@@ -0,0 +1,83 @@
+#
+# Tests for the data cube cutout module.
+#   Last Modified: Initial creation.
+#
+import numpy as np
+import pytest
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.wcs import WCS
+
+import cuts.blueprints.img.cube_utils as cu
+from cuts.blueprints.img.exceptions import RequestException
+
+
+class TestCubeUtils(object):
+
+    co_args = { 'center': SkyCoord(10.001, 20.001, unit='deg'), 'co_size': 3.6 * u.arcsec }
+
+
+    def cube_wcs(self, cdelt3=1.0e-8):
+        wcs = WCS(naxis=3)
+        wcs.wcs.ctype = [ 'RA---TAN', 'DEC--TAN', 'WAVE' ]
+        wcs.wcs.cunit = [ 'deg', 'deg', 'um' ]
+        wcs.wcs.crval = [ 10.0, 20.0, 2.0 ]
+        wcs.wcs.crpix = [ 50.0, 40.0, 1.0 ]
+        wcs.wcs.cdelt = [ -1.0e-4, 1.0e-4, cdelt3 * 1.0e6 ]
+        return WCS(wcs.to_header())
+
+
+    def write_cube(self, tmp_path, cdelt3=1.0e-8):
+        cube_filepath = str(tmp_path / 'cube.dat')
+        data = np.arange(20 * 80 * 100, dtype=np.float32).reshape(20, 80, 100)
+        fits.PrimaryHDU(data=data, header=self.cube_wcs(cdelt3).to_header()).writeto(cube_filepath)
+        return cube_filepath
+
+
+    def test_plane_range(self):
+        wcs = self.cube_wcs()
+        assert cu.plane_range(wcs, 20) == (0, 19)
+        assert cu.plane_range(wcs, 20, { 'planes': (3, 7) }) == (3, 7)
+        assert cu.plane_range(wcs, 20, { 'planes': (None, 30) }) == (0, 19)
+        assert cu.plane_range(wcs, 20, { 'world': (2.03e-6, 2.05e-6) }) == (3, 5)
+        assert cu.plane_range(wcs, 20, { 'world': (2.035e-6, None) }) == (4, 19)
+        assert cu.plane_range(wcs, 20, { 'world': (None, 2.035e-6) }) == (0, 3)
+
+
+    def test_plane_range_descending(self):
+        wcs = self.cube_wcs(cdelt3=-1.0e-8)     # wavelength decreases along the planes
+        assert cu.plane_range(wcs, 20, { 'world': (1.95e-6, 1.97e-6) }) == (3, 5)
+        assert cu.plane_range(wcs, 20, { 'world': (1.965e-6, None) }) == (0, 3)
+
+
+    def test_plane_range_no_overlap(self):
+        with pytest.raises(RequestException, match="do not overlap the 20 planes"):
+            cu.plane_range(self.cube_wcs(), 20, { 'planes': (25, None) })
+        with pytest.raises(RequestException, match="do not overlap the 20 planes"):
+            cu.plane_range(self.cube_wcs(), 20, { 'world': (3.0e-6, 4.0e-6) })
+
+
+    def test_cut_cube(self, tmp_path):
+        """ Only the selected planes and box are read, and the WCS follows on all axes. """
+        with fits.open(self.write_cube(tmp_path), memmap=True) as hdus:
+            hdu = hdus[0]
+            wcs = WCS(hdu.header)
+            cutout = cu.cut_cube(hdu, self.co_args, wcs, planes={ 'world': (2.03e-6, 2.05e-6) })
+            assert cutout.data.shape == (3, 10, 10)
+            assert np.array_equal(cutout.data, hdu.section[cutout.slices_original])
+            (planes, rows, cols) = cutout.slices_original
+            assert np.allclose(cutout.wcs.pixel_to_world_values(0, 0, 0),
+                               wcs.pixel_to_world_values(cols.start, rows.start, planes.start))
+            assert cutout.wcs.wcs.crpix[2] == pytest.approx(-2.0)
+
+
+    def test_cut_cube_not_spectral(self):
+        header = fits.Header()
+        header['NAXIS'] = 3
+        for (axis, ctype) in enumerate([ 'LINEAR', 'LINEAR', 'LINEAR' ], start=1):
+            header[f"CTYPE{axis}"] = ctype
+        hdu = fits.PrimaryHDU(data=np.zeros((2, 3, 4), dtype=np.float32), header=header)
+        with pytest.raises(RequestException, match="Only data cubes with two celestial axes"):
+            cu.cut_cube(hdu, self.co_args, WCS(hdu.header))
@@ -0,0 +1,226 @@
+# Tests for the cutouts cache management module.
+#   Last Modified: Add tests for cutout index files.
+#
+import fcntl
+import os
+import threading
+import time
+import zlib
+
+import pytest
+
+import cuts.blueprints.img.cutout_cache as cc
+from cuts.blueprints.img.cutout_cache import CutoutCache
+from cuts.blueprints.img.exceptions import ServerError
+
+
+class TestCutoutCache(object):
+
+    def make_files(self, cache_dir, count, size=100):
+        """ Make count files of the given size, each used one second after the previous one. """
+        now = time.time()
+        paths = []
+        for idx in range(count):
+            path = os.path.join(cache_dir, f"co{idx}.dat")
+            with open(path, 'wb') as fyl:
+                fyl.write(b'x' * size)
+            os.utime(path, (now - 100 + idx, now - 100))
+            paths.append(path)
+        return paths
+
+
+    def test_entries_nodir(self, tmp_path):
+        cache = CutoutCache(str(tmp_path / 'nosuchdir'), max_entries=1)
+        assert cache.entries() == []
+        assert cache.sweep() == { 'files': 0, 'bytes': 0 }
+
+
+    def test_entries_hidden(self, tmp_path):
+        self.make_files(str(tmp_path), 2)
+        (tmp_path / '.partial.dat').write_bytes(b'x' * 50)
+        (tmp_path / 'subdir').mkdir()
+        cache = CutoutCache(str(tmp_path))
+        entries = cache.entries()
+        assert len(entries) == 2
+        assert all(os.path.basename(entry[2]).startswith('co') for entry in entries)
+
+
+    def test_is_limited(self, tmp_path):
+        assert CutoutCache(str(tmp_path)).is_limited() is False
+        assert CutoutCache(str(tmp_path), max_bytes=0, max_entries=0).is_limited() is False
+        assert CutoutCache(str(tmp_path), max_bytes=10).is_limited() is True
+        assert CutoutCache(str(tmp_path), max_entries=10).is_limited() is True
+
+
+    def test_sweep_unlimited(self, tmp_path):
+        self.make_files(str(tmp_path), 5)
+        cache = CutoutCache(str(tmp_path))
+        assert cache.sweep() == { 'files': 0, 'bytes': 0 }
+        assert len(cache.entries()) == 5
+
+
+    def test_sweep_max_entries(self, tmp_path):
+        paths = self.make_files(str(tmp_path), 5)
+        cache = CutoutCache(str(tmp_path), max_entries=3)
+        assert cache.sweep() == { 'files': 2, 'bytes': 200 }
+        assert [os.path.exists(path) for path in paths] == [False, False, True, True, True]
+
+
+    def test_sweep_max_bytes(self, tmp_path):
+        paths = self.make_files(str(tmp_path), 5)
+        cache = CutoutCache(str(tmp_path), max_bytes=250)
+        assert cache.sweep() == { 'files': 3, 'bytes': 300 }
+        assert [os.path.exists(path) for path in paths] == [False, False, False, True, True]
+
+
+    def test_sweep_lru(self, tmp_path):
+        """ A touched cutout becomes the most recently used and is not evicted. """
+        paths = self.make_files(str(tmp_path), 5)
+        cache = CutoutCache(str(tmp_path), max_entries=4)
+        cache.touch(paths[0])
+        cache.sweep()
+        assert [os.path.exists(path) for path in paths] == [True, False, True, True, True]
+
+
+    def test_touch_keeps_mtime(self, tmp_path):
+        paths = self.make_files(str(tmp_path), 1)
+        mtime = os.stat(paths[0]).st_mtime
+        CutoutCache(str(tmp_path)).touch(paths[0])
+        stat = os.stat(paths[0])
+        assert stat.st_mtime == mtime
+        assert stat.st_atime > time.time() - 10
+
+
+    def test_touch_missing(self, tmp_path):
+        CutoutCache(str(tmp_path)).touch(str(tmp_path / 'nosuchfile.dat'))
+
+
+    def test_stats(self, tmp_path):
+        self.make_files(str(tmp_path), 3)
+        cache = CutoutCache(str(tmp_path), max_bytes=1000, max_entries=2)
+        stats = cache.stats()
+        assert stats['entries'] == 3
+        assert stats['bytes'] == 300
+        assert stats['max_bytes'] == 1000
+        assert stats['max_entries'] == 2
+        cache.sweep()
+        stats = cache.stats()
+        assert stats['entries'] == 2
+        assert stats['last_sweep']['evicted_files'] == 1
+
+
+    def test_sweeper(self, tmp_path):
+        """ Adding a cutout wakes the background sweeper, which enforces the limits. """
+        paths = self.make_files(str(tmp_path), 3)
+        cache = CutoutCache(str(tmp_path), max_entries=2, sweep_interval=60)
+        try:
+            cache.added(paths[0])
+            assert cache.is_running() is True
+            for tries in range(100):
+                if (len(cache.entries()) <= 2):
+                    break
+                time.sleep(0.02)
+            assert [os.path.exists(path) for path in paths] == [True, False, True]
+        finally:
+            cache.stop_sweeper()
+
+
+    def test_sweeper_unlimited(self, tmp_path):
+        cache = CutoutCache(str(tmp_path))
+        cache.start_sweeper()
+        assert cache.is_running() is False
+
+
+    def test_sweep_stale_temps(self, tmp_path):
+        stale = tmp_path / f".co0.dat.abc{cc.TEMP_SUFFIX}"
+        fresh = tmp_path / f".co1.dat.def{cc.TEMP_SUFFIX}"
+        stale.write_bytes(b'x')
+        fresh.write_bytes(b'x')
+        old = time.time() - cc.STALE_TEMP_AGE - 10
+        os.utime(stale, (old, old))
+        CutoutCache(str(tmp_path)).sweep()
+        assert stale.exists() is False
+        assert fresh.exists() is True
+
+
+    def test_producing_coalesces(self, tmp_path):
+        """ Only one of many concurrent requests for a cutout produces it. """
+        cache = CutoutCache(str(tmp_path))
+        co_filepath = str(tmp_path / 'co.dat')
+        produced = []
+        def request():
+            if (not os.path.exists(co_filepath)):
+                with cache.producing(co_filepath):
+                    if (not os.path.exists(co_filepath)):
+                        time.sleep(0.05)
+                        with open(co_filepath, 'wb') as fyl:
+                            fyl.write(b'x')
+                        produced.append(1)
+        threads = [ threading.Thread(target=request) for idx in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert produced == [1]
+        assert cache._key_locks == {}       # unused locks are discarded
+
+
+    def test_producing_other_process(self, tmp_path):
+        """ A lock file held by another process blocks producers until the timeout. """
+        cache = CutoutCache(str(tmp_path), lock_timeout=0.2)
+        co_filepath = str(tmp_path / 'co.dat')
+        lock_dir = tmp_path / cc.LOCK_DIR_NAME
+        lock_dir.mkdir()
+        stripe = zlib.crc32(b'co.dat') % cc.LOCK_STRIPES
+        with open(lock_dir / f"{stripe:02d}.lock", 'w') as other:
+            fcntl.flock(other, fcntl.LOCK_EX)
+            with pytest.raises(ServerError, match='Timed out after 0.2 seconds'):
+                with cache.producing(co_filepath):
+                    pass
+            fcntl.flock(other, fcntl.LOCK_UN)
+        with cache.producing(co_filepath):
+            pass
+        assert cache._key_locks == {}
+
+
+    def test_producing_error(self, tmp_path):
+        """ The right to produce a cutout is released when production fails. """
+        cache = CutoutCache(str(tmp_path), lock_timeout=0.2)
+        co_filepath = str(tmp_path / 'co.dat')
+        with pytest.raises(ValueError):
+            with cache.producing(co_filepath):
+                raise ValueError('cutout failed')
+        with cache.producing(co_filepath):
+            pass
+
+
+    def test_index(self, tmp_path):
+        paths = self.make_files(str(tmp_path), 1)
+        cache = CutoutCache(str(tmp_path))
+        assert cache.index_path(paths[0]) == str(tmp_path / '.co0.dat.json')
+        assert cache.read_index(paths[0]) is None
+        assert cache.write_index(paths[0], { 'ra': 1.5, 'dec': -2.0 }) is True
+        assert cache.read_index(paths[0]) == { 'ra': 1.5, 'dec': -2.0 }
+        assert len(cache.entries()) == 1    # index files are not counted
+
+
+    def test_index_write_error(self, tmp_path):
+        cache = CutoutCache(str(tmp_path))
+        assert cache.write_index(str(tmp_path / 'nodir' / 'co.dat'), {}) is False
+
+
+    def test_sweep_removes_index(self, tmp_path):
+        paths = self.make_files(str(tmp_path), 2)
+        cache = CutoutCache(str(tmp_path), max_entries=1)
+        for path in paths:
+            cache.write_index(path, { 'path': path })
+        cache.sweep()
+        assert os.path.exists(cache.index_path(paths[0])) is False
+        assert cache.read_index(paths[1]) == { 'path': paths[1] }
+
+
+    def test_sweep_orphan_index(self, tmp_path):
+        cache = CutoutCache(str(tmp_path))
+        (tmp_path / '.gone.dat.json').write_text('{}')
+        cache.sweep()
+        assert os.listdir(tmp_path) == []
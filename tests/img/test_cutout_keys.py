@@ -0,0 +1,224 @@
+# Tests for the cutout cache keys module.
+#   Last Modified: Add tests of the filenames of cutouts compressed at exponent form quantization levels.
+#
+import os
+import shutil
+
+from astropy import units as u
+
+import cuts.blueprints.img.cutout_keys as ck
+from cuts.blueprints.img.arg_utils import parse_cutout_args
+from tests import TEST_RESOURCES_DIR
+
+
+class TestCutoutKeys(object):
+
+    m13_tstfyl = f"{TEST_RESOURCES_DIR}/m13.fits"
+    m13_scale = 0.00027770002               # degrees per pixel
+
+    co_args = { 'ra': 250.4226, 'dec': 36.4602, 'size': 12.0, 'units': u.arcsec }
+
+
+    def test_setup_app (self, app):
+        " Create an instance of the app: should be executed only once by conftest.py. "
+        assert app is not None
+
+
+    def test_canonical_cutout_params(self):
+        params = ck.canonical_cutout_params(self.m13_tstfyl, self.co_args, collection='C', filt='F')
+        assert params['version'] == ck.CUTOUT_KEY_VERSION
+        assert params['ra'] == 250.4226
+        assert params['dec'] == 36.4602
+        assert params['size_deg'] == round(12.0 / 3600, ck.DEGREE_DECIMALS)
+        assert params['frame'] == 'icrs'
+        assert params['collection'] == 'C'
+        assert params['filter'] == 'F'
+        assert params['image']['path'] == self.m13_tstfyl
+        assert params['image']['size'] == os.path.getsize(self.m13_tstfyl)
+        assert params['quantum_deg'] is None
+        assert params['extensions'] is None
+        assert params['planes'] is None
+
+
+    def test_canonical_cutout_params_extensions(self):
+        params = ck.canonical_cutout_params(self.m13_tstfyl, self.co_args, extensions=['SCI', 'ERR'])
+        assert params['extensions'] == ['SCI', 'ERR']
+        assert (ck.cutout_key(params) !=
+                ck.cutout_key(ck.canonical_cutout_params(self.m13_tstfyl, self.co_args, extensions=['SCI'])))
+
+
+    def test_canonical_cutout_params_planes(self):
+        params = ck.canonical_cutout_params(self.m13_tstfyl, self.co_args, planes={ 'planes': (3, None) })
+        assert params['planes'] == { 'planes': [3, None] }
+        assert (ck.cutout_key(params) !=
+                ck.cutout_key(ck.canonical_cutout_params(self.m13_tstfyl, self.co_args,
+                                                         planes={ 'world': (3, None) })))
+
+
+    def test_canonical_cutout_params_parsed(self, app):
+        """ Parsed arguments (with a SkyCoord center) give the same parameters as raw ones. """
+        parsed = parse_cutout_args({'ra': '250.4226', 'dec': '36.4602', 'sizeArcSec': '12'})
+        assert (ck.canonical_cutout_params(self.m13_tstfyl, parsed) ==
+                ck.canonical_cutout_params(self.m13_tstfyl, self.co_args))
+
+
+    def test_canonical_cutout_params_ra_wrap(self):
+        params = ck.canonical_cutout_params(self.m13_tstfyl, { **self.co_args, 'ra': -10 })
+        assert params['ra'] == 350.0
+
+
+    def test_cutout_key(self):
+        params = ck.canonical_cutout_params(self.m13_tstfyl, self.co_args)
+        key = ck.cutout_key(params)
+        assert len(key) == ck.CUTOUT_KEY_LENGTH
+        assert key == ck.cutout_key(dict(reversed(list(params.items()))))
+        assert key != ck.cutout_key({ **params, 'ra': 250.4227 })
+        assert ck.cutout_filename(params) == f"{key}{ck.CUTOUT_FILE_EXTENSION}"
+
+
+    def test_cutout_key_jitter(self):
+        """ Coordinates differing by less than the rounding precision share a key. """
+        key = ck.cutout_key(ck.canonical_cutout_params(self.m13_tstfyl, self.co_args))
+        jittered = { **self.co_args, 'ra': 250.4226 + 1e-12, 'dec': 36.4602 - 1e-12 }
+        assert key == ck.cutout_key(ck.canonical_cutout_params(self.m13_tstfyl, jittered))
+
+
+    def test_cutout_key_image_changed(self, tmp_path):
+        """ A modified image file gets new keys. """
+        ipath = str(tmp_path / 'image.dat')
+        shutil.copyfile(self.m13_tstfyl, ipath)
+        key = ck.cutout_key(ck.canonical_cutout_params(ipath, self.co_args))
+        os.utime(ipath, ns=(0, 0))
+        assert key != ck.cutout_key(ck.canonical_cutout_params(ipath, self.co_args))
+
+
+    def test_image_identity_missing(self):
+        assert ck.image_identity('/no/such/file.fits') == {
+            'path': '/no/such/file.fits', 'size': None, 'mtime_ns': None }
+
+
+    def test_image_pixel_scale(self):
+        assert abs(ck.image_pixel_scale(self.m13_tstfyl) - self.m13_scale) < 1e-9
+        assert ck.image_pixel_scale(f"{TEST_RESOURCES_DIR}/empty.fits") is None
+        assert ck.image_pixel_scale('/no/such/file.fits') is None
+
+
+    def test_quantize_center(self):
+        (ra, dec) = ck.quantize_center(10.04, 0.06, 0.1)
+        assert abs(ra - 10.0) < 1e-4       # RA step widened by 1/cos(dec)
+        assert abs(dec - 0.1) < 1e-9
+        (ra, dec) = ck.quantize_center(359.99, 89.99, 0.1)
+        assert 0.0 <= ra < 360.0
+        assert abs(dec - 90.0) < 1e-9
+
+
+    def test_canonical_cutout_params_quantized(self):
+        """ Centers within the same fraction of a pixel share a key. """
+        jittered = { **self.co_args, 'ra': 250.4226 + 0.1 * self.m13_scale }
+        params = ck.canonical_cutout_params(self.m13_tstfyl, self.co_args, pixel_fraction=0.5)
+        assert abs(params['quantum_deg'] - 0.5 * self.m13_scale) < 1e-9
+        assert abs(params['dec'] - 36.4602) <= 0.25 * self.m13_scale
+        assert (ck.cutout_key(params) == ck.cutout_key(
+            ck.canonical_cutout_params(self.m13_tstfyl, jittered, pixel_fraction=0.5)))
+        assert (ck.cutout_key(ck.canonical_cutout_params(self.m13_tstfyl, self.co_args)) !=
+                ck.cutout_key(ck.canonical_cutout_params(self.m13_tstfyl, jittered)))
+
+
+    def test_quantized_cutout_args(self):
+        params = ck.canonical_cutout_params(self.m13_tstfyl, self.co_args, pixel_fraction=0.5)
+        qargs = ck.quantized_cutout_args(self.co_args, params)
+        assert qargs['ra'] == params['ra']
+        assert qargs['dec'] == params['dec']
+        assert abs(qargs['center'].ra.deg - params['ra']) < 1e-9
+        assert qargs['size'] == self.co_args['size']
+        assert 'center' not in self.co_args
+
+
+    def test_compressed_cutout_filename(self):
+        key = 'a' * ck.CUTOUT_KEY_LENGTH
+        rice = { 'compression_type': 'RICE_1', 'quantize_level': 16.0 }
+        gzip2 = { 'compression_type': 'GZIP_2', 'quantize_level': 0.5 }
+        assert ck.compressed_cutout_filename(f"{key}.fits", rice) == f"{key}.rice_1_q16.fits"
+        assert ck.compressed_cutout_filename(f"{key}.fits", gzip2) == f"{key}.gzip_2_q0p5.fits"
+        assert ck.gzip_cutout_filename(f"{key}.fits") == f"{key}.fits.gz"
+
+
+    def test_compressed_cutout_filename_levels(self):
+        """ Large, small, and precise levels are encoded exactly, and recognized as compressed. """
+        key = 'a' * ck.CUTOUT_KEY_LENGTH
+        levels = { 1e6: 'q1000000', 1e16: 'q1e16', 1e-05: 'q1em05', -2.5e-07: 'qm2p5em07',
+                   16.0000001: 'q16p0000001' }
+        for (level, tag) in levels.items():
+            rice = { 'compression_type': 'RICE_1', 'quantize_level': level }
+            co_filename = ck.compressed_cutout_filename(f"{key}.fits", rice)
+            assert co_filename == f"{key}.rice_1_{tag}.fits"
+            assert ck.is_compressed_cutout_filename(co_filename) is True
+        rice = { 'compression_type': 'RICE_1', 'quantize_level': 16.0 }
+        assert ck.compressed_cutout_filename(f"{key}.fits", rice) != co_filename
+
+
+    def test_is_compressed_cutout_filename(self):
+        key = 'b' * ck.CUTOUT_KEY_LENGTH
+        assert ck.is_compressed_cutout_filename(f"{key}.fits") is False
+        assert ck.is_compressed_cutout_filename(f"{key}.rice_1_q16.fits") is True
+        assert ck.is_compressed_cutout_filename(f"{key}.gzip_2_qm2.fits") is True
+        assert ck.is_compressed_cutout_filename(f"{key}.fits.gz") is True
+
+
+    def test_binned_cutout_filename(self):
+        key = 'd' * ck.CUTOUT_KEY_LENGTH
+        assert ck.binned_cutout_filename(f"{key}.fits", { 'factor': 4 }) == f"{key}.bin4.fits"
+        assert ck.binned_cutout_filename(f"{key}.fits", { 'max_pixels': 512 }) == f"{key}.max512.fits"
+        binned = ck.binned_cutout_filename(f"{key}.fits", { 'factor': 4 })
+        assert ck.is_compressed_cutout_filename(binned) is False
+        rice = { 'compression_type': 'RICE_1', 'quantize_level': 16.0 }
+        assert ck.compressed_cutout_filename(binned, rice) == f"{key}.bin4.rice_1_q16.fits"
+
+
+    def test_converted_cutout_filename(self):
+        key = 'e' * ck.CUTOUT_KEY_LENGTH
+        assert ck.converted_cutout_filename(f"{key}.fits", 'float32') == f"{key}.f32.fits"
+        assert ck.converted_cutout_filename(f"{key}.bin2.fits", 'int16') == f"{key}.bin2.i16.fits"
+        assert ck.is_compressed_cutout_filename(f"{key}.i16.fits") is False
+
+
+    def test_array_filename(self):
+        key = 'a' * ck.CUTOUT_KEY_LENGTH
+        assert ck.array_filename(f"{key}.fits", 'npy') == f"{key}.npy"
+        assert ck.array_filename(f"{key}.bin2.f32.fits", 'arrow') == f"{key}.bin2.f32.arrow"
+        assert ck.is_compressed_cutout_filename(f"{key}.npy") is False
+
+
+    def test_binned_image_filename(self, tmp_path):
+        ipath = tmp_path / 'image.dat'
+        ipath.write_bytes(b'1234')
+        bin_filename = ck.binned_image_filename(str(ipath), { 'factor': 4 })
+        assert len(bin_filename) == ck.CUTOUT_KEY_LENGTH + len('.fits')
+        assert bin_filename == ck.binned_image_filename(str(ipath), { 'factor': 4 })
+        assert bin_filename != ck.binned_image_filename(str(ipath), { 'factor': 2 })
+        ipath.write_bytes(b'123456')        # the image changed
+        assert bin_filename != ck.binned_image_filename(str(ipath), { 'factor': 4 })
+
+
+    def test_decompressed_image_filename(self, tmp_path):
+        ipath = tmp_path / 'image.dat.gz'
+        ipath.write_bytes(b'1234')
+        dc_filename = ck.decompressed_image_filename(str(ipath))
+        assert dc_filename.endswith('.fits')
+        assert dc_filename == ck.decompressed_image_filename(str(ipath))
+        assert dc_filename != ck.binned_image_filename(str(ipath), { 'factor': 1 })
+        ipath.write_bytes(b'123456')        # the image changed
+        assert dc_filename != ck.decompressed_image_filename(str(ipath))
+
+
+    def test_preview_filename(self):
+        key = 'c' * ck.CUTOUT_KEY_LENGTH
+        png = { 'format': 'png', 'stretch': 'linear', 'min_percent': 0.5,
+                'max_percent': 99.5, 'max_dim': 512 }
+        jpeg = dict(png, format='jpeg')
+        pv_filename = ck.preview_filename(f"{key}.fits", png)
+        assert pv_filename.endswith('.png')
+        assert ck.preview_filename(f"{key}.fits", jpeg).endswith('.jpg')
+        assert pv_filename == ck.preview_filename(f"{key}.fits", dict(png))
+        assert pv_filename != ck.preview_filename(f"{key}.fits", dict(png, stretch='log'))
+        assert ck.is_compressed_cutout_filename(pv_filename) is True
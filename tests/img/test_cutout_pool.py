@@ -0,0 +1,133 @@
+# Tests for the cutout worker process pool module.
+#   Last Modified: Add tests of mapping the cutouts of batches of positions over the pool.
+#
+import os
+
+import pytest
+
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+
+from cuts.blueprints.img.cutout_pool import CutoutPool
+from cuts.blueprints.img.cutout_worker import cut_filter_extension, cut_positions, init_worker
+from cuts.blueprints.img.cutout_worker import make_cutout_file
+from cuts.blueprints.img.exceptions import RequestException
+from tests import TEST_RESOURCES_DIR
+
+
+class TestCutoutPool(object):
+
+    m13_tstfyl = f"{TEST_RESOURCES_DIR}/m13.fits"
+    m13_co_args = { 'center': SkyCoord(ra=250.4226*u.degree, dec=36.4602*u.degree, frame='icrs'),
+                    'co_size': u.Quantity(12, u.arcsec) }
+
+
+    def test_disabled(self):
+        pool = CutoutPool(0)
+        assert pool.is_enabled() is False
+        assert pool.run(os.getpid) == os.getpid()
+        stats = pool.stats()
+        assert stats['inline'] == 1
+        assert stats['started'] is False
+
+
+    def test_run(self):
+        pool = CutoutPool(1)
+        try:
+            assert pool.is_enabled() is True
+            assert pool.run(os.getpid) != os.getpid()
+            stats = pool.stats()
+            assert stats['started'] is True
+            assert stats['completed'] == 1
+            assert stats['active'] == 0
+        finally:
+            pool.shutdown()
+        assert pool.stats()['started'] is False
+
+
+    def test_map_disabled(self):
+        pool = CutoutPool(0)
+        assert pool.map(divmod, [ 7, 9 ], [ 2, 4 ]) == [ (3, 1), (2, 1) ]
+        assert pool.stats()['inline'] == 2
+
+
+    def test_map(self):
+        pool = CutoutPool(2)
+        try:
+            assert pool.map(divmod, [ 7, 9, 11 ], [ 2, 4, 3 ]) == [ (3, 1), (2, 1), (3, 2) ]
+            assert pool.map(divmod, [], []) == []
+            stats = pool.stats()
+            assert stats['completed'] == 3
+            assert stats['active'] == 0
+            with pytest.raises(ZeroDivisionError):
+                pool.map(divmod, [ 1, 2 ], [ 1, 0 ])
+            assert pool.stats()['failed'] == 1
+        finally:
+            pool.shutdown()
+
+
+    def test_map_filter_extensions(self):
+        """ The cutouts of a multi-filter cube are made, and returned, by worker processes. """
+        pool = CutoutPool(2, initializer=init_worker, initargs=(2,))
+        try:
+            results = pool.map(cut_filter_extension, [ self.m13_tstfyl, '/bad/path' ],
+                               [ self.m13_co_args ] * 2, [ 'F090W', 'F444W' ])
+        finally:
+            pool.shutdown()
+        (ext, error) = results[0]
+        assert error is None
+        assert ext.name == 'F090W'
+        assert ext.header['FILTER'] == 'F090W'
+        assert ext.data is not None
+        assert results[1][0] is None
+        assert results[1][1].startswith('Unable to make the cutout')
+
+
+    def test_map_positions(self):
+        """ The cutouts of a batch of positions are made, one task per image, by worker processes. """
+        positions = [ { 'row': 0, 'ra': 250.4226, 'dec': 36.4602, 'size': 12 },
+                      { 'row': 1, 'ra': 18.0, 'dec': 4.0, 'size': 10 } ]
+        pool = CutoutPool(2, initializer=init_worker, initargs=(2,))
+        try:
+            results = pool.map(cut_positions, [ self.m13_tstfyl, '/bad/path' ],
+                               [ positions, positions[:1] ], [ u.arcsec ] * 2, [ 'icrs' ] * 2)
+        finally:
+            pool.shutdown()
+        stamps = results[0]
+        assert len(stamps) == 2
+        assert [ pos['row'] for (pos, hdu) in stamps ] == [ 0, 1 ]
+        assert stamps[0][1].data is not None
+        assert 'CRPIX1' in stamps[0][1].header
+        assert 'error' not in stamps[0][0]
+        assert stamps[1][1] is None
+        assert 'error' in stamps[1][0]
+        assert results[1] is None           # the image could not be read
+
+
+    def test_make_cutout_file(self, tmp_path):
+        pool = CutoutPool(1, initializer=init_worker, initargs=(2,))
+        co_filepath = str(tmp_path / 'co.dat')
+        try:
+            pool.run(make_cutout_file, self.m13_tstfyl, self.m13_co_args, co_filepath)
+        finally:
+            pool.shutdown()
+        with fits.open(co_filepath) as hdus:
+            assert hdus[0].data is not None
+            assert 'CRPIX1' in hdus[0].header
+        assert os.listdir(tmp_path) == [ 'co.dat' ]
+
+
+    def test_make_cutout_file_no_overlap(self, tmp_path):
+        """ An error raised in a worker process is raised to the caller. """
+        pool = CutoutPool(1)
+        co_args = { 'center': SkyCoord(ra=18.0*u.degree, dec=4.0*u.degree, frame='icrs'),
+                    'co_size': u.Quantity(10, u.arcsec) }
+        hh_tstfyl = f"{TEST_RESOURCES_DIR}/HorseHead.fits"
+        try:
+            with pytest.raises(RequestException, match='There is no overlap'):
+                pool.run(make_cutout_file, hh_tstfyl, co_args, str(tmp_path / 'co.dat'))
+            assert pool.stats()['failed'] == 1
+        finally:
+            pool.shutdown()
+        assert os.listdir(tmp_path) == []
@@ -0,0 +1,350 @@
+# Tests for the cutout worker functions module.
+#   Last Modified: Import the required pyarrow package at the module level.
+#
+import gzip
+import os
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from astropy.io import fits
+from astropy.nddata import Cutout2D
+from astropy.wcs import WCS
+
+import cuts.blueprints.img.cutout_worker as cw
+from cuts.blueprints.img.arg_utils import parse_cutout_args
+from cuts.blueprints.img.hdu_cache import HDUCache
+from cuts.blueprints.img.exceptions import RequestException, ServerError
+from tests import TEST_RESOURCES_DIR
+
+
+class TestCutoutWorker(object):
+
+    m13_tstfyl = f"{TEST_RESOURCES_DIR}/m13.fits"
+
+    m13_co_args = { 'ra': '250.4226', 'dec': '36.4602', 'sizeArcSec': '12' }
+
+
+    def write_cutout(self, tmp_path, dtype='f4'):
+        co_filepath = str(tmp_path / 'co.dat')
+        data = np.random.default_rng(13).normal(100.0, 5.0, (64, 64)).astype(dtype)
+        cw.write_hdu_file(fits.PrimaryHDU(data=data), co_filepath)
+        return co_filepath
+
+
+    def test_write_hdu_file(self, tmp_path):
+        co_filepath = self.write_cutout(tmp_path)
+        assert os.listdir(tmp_path) == [ 'co.dat' ]
+        with pytest.raises(FileExistsError):
+            cw.write_hdu_file(fits.PrimaryHDU(), co_filepath, overwrite=False)
+
+
+    def test_compress_cutout_file(self, tmp_path):
+        co_filepath = self.write_cutout(tmp_path)
+        comp_filepath = str(tmp_path / 'co.rice.dat')
+        cw.compress_cutout_file(co_filepath, comp_filepath, 'RICE_1', 16.0)
+        with fits.open(comp_filepath) as hdus:
+            assert isinstance(hdus[1], fits.CompImageHDU)
+            assert hdus[1].compression_type == 'RICE_1'
+            assert hdus[1].data.shape == (64, 64)
+            assert np.allclose(hdus[1].data, fits.getdata(co_filepath), atol=1.0)
+        assert os.path.getsize(comp_filepath) < os.path.getsize(co_filepath)
+
+
+    def test_compress_cutout_file_int16(self, tmp_path):
+        """ Data packed into int16 is compressed as int16, keeping its scaling and blanks. """
+        co_filepath = self.write_cutout(tmp_path)
+        i16_filepath = str(tmp_path / 'co.i16.dat')
+        cw.convert_cutout_file(co_filepath, i16_filepath, 'int16')
+        comp_filepath = str(tmp_path / 'co.i16.rice.dat')
+        cw.compress_cutout_file(i16_filepath, comp_filepath, 'RICE_1', 16.0)
+        with fits.open(comp_filepath, disable_image_compression=True) as hdus:
+            assert hdus[1].header['ZBITPIX'] == 16
+            assert hdus[1].header['BSCALE'] == fits.getheader(i16_filepath)['BSCALE']
+        with fits.open(comp_filepath) as hdus:
+            assert np.array_equal(hdus[1].data, fits.getdata(i16_filepath), equal_nan=True)
+
+
+    def test_compress_cutout_file_lossless(self, tmp_path):
+        co_filepath = self.write_cutout(tmp_path)
+        comp_filepath = str(tmp_path / 'co.gzip2.dat')
+        cw.compress_cutout_file(co_filepath, comp_filepath, 'GZIP_2', 0)
+        with fits.open(comp_filepath) as hdus:
+            assert hdus[1].compression_type == 'GZIP_2'
+            assert np.array_equal(hdus[1].data, fits.getdata(co_filepath))
+
+
+    def test_compress_cutout_file_error(self, tmp_path):
+        co_filepath = self.write_cutout(tmp_path)
+        with pytest.raises(ServerError, match='Unexpected error while writing image cutout'):
+            cw.compress_cutout_file(co_filepath, str(tmp_path / 'none' / 'co.dat'), 'RICE_1', 16.0)
+
+
+    def test_gzip_cutout_file(self, tmp_path):
+        co_filepath = self.write_cutout(tmp_path)
+        gz_filepath = str(tmp_path / 'co.dat.gz')
+        cw.gzip_cutout_file(co_filepath, gz_filepath, level=1)
+        with gzip.open(gz_filepath, 'rb') as gzfile, open(co_filepath, 'rb') as cofile:
+            assert gzfile.read() == cofile.read()
+        assert oct(os.stat(gz_filepath).st_mode & 0o777) == oct(0o644)
+
+
+    def test_gzip_cutout_file_missing(self, tmp_path):
+        with pytest.raises(FileNotFoundError):
+            cw.gzip_cutout_file(str(tmp_path / 'none.dat'), str(tmp_path / 'none.dat.gz'))
+        assert os.listdir(tmp_path) == []
+
+
+    def test_render_preview_file(self, tmp_path):
+        pytest.importorskip('PIL')
+        co_filepath = self.write_cutout(tmp_path)
+        pv_filepath = str(tmp_path / 'co.png')
+        preview = { 'format': 'png', 'stretch': 'asinh', 'min_percent': 0.5,
+                    'max_percent': 99.5, 'max_dim': 32 }
+        cw.render_preview_file(co_filepath, pv_filepath, preview)
+        with open(pv_filepath, 'rb') as pv_file:
+            assert pv_file.read(4) == b'\x89PNG'
+
+
+    def test_bin_cutout_file(self, tmp_path):
+        co_filepath = self.write_cutout(tmp_path, dtype='i2')
+        bin_filepath = str(tmp_path / 'co.bin4.dat')
+        cw.bin_cutout_file(co_filepath, bin_filepath, { 'factor': 4 })
+        with fits.open(bin_filepath) as hdus:
+            assert hdus[0].data.shape == (16, 16)
+            assert hdus[0].data.dtype.kind == 'f'
+            assert hdus[0].header['CO_BIN'] == 4
+            data = fits.getdata(co_filepath).astype('f4')
+            assert hdus[0].data[0, 0] == pytest.approx(data[:4, :4].mean())
+        cw.bin_cutout_file(co_filepath, bin_filepath, { 'max_pixels': 20 })
+        assert fits.getdata(bin_filepath).shape == (16, 16)
+
+
+    def test_bin_cutout_file_too_small(self, tmp_path):
+        co_filepath = self.write_cutout(tmp_path)
+        with pytest.raises(RequestException, match="The binning factor 65 is larger than the image"):
+            cw.bin_cutout_file(co_filepath, str(tmp_path / 'bin.dat'), { 'factor': 65 })
+        cw.write_hdu_file(fits.PrimaryHDU(data=np.zeros((2, 8, 8))), co_filepath)
+        with pytest.raises(RequestException, match="Only two-dimensional images"):
+            cw.bin_cutout_file(co_filepath, str(tmp_path / 'bin.dat'), { 'factor': 2 })
+        assert sorted(os.listdir(tmp_path)) == [ 'co.dat' ]
+
+
+    def test_convert_cutout_file(self, tmp_path):
+        co_filepath = self.write_cutout(tmp_path, dtype='f8')
+        i16_filepath = str(tmp_path / 'co.i16.dat')
+        cw.convert_cutout_file(co_filepath, i16_filepath, 'int16')
+        assert os.path.getsize(i16_filepath) < os.path.getsize(co_filepath) / 3
+        with fits.open(i16_filepath) as hdus:
+            assert hdus[0].header['BITPIX'] == 16
+            assert np.allclose(hdus[0].data, fits.getdata(co_filepath), atol=hdus[0].header['CO_QSTEP'])
+
+
+    def test_convert_cutout_file_nodata(self, tmp_path):
+        co_filepath = str(tmp_path / 'co.dat')
+        cw.write_hdu_file(fits.PrimaryHDU(), co_filepath)
+        with pytest.raises(RequestException, match="The cutout contains no data"):
+            cw.convert_cutout_file(co_filepath, str(tmp_path / 'co.f32.dat'), 'float32')
+
+
+    def test_write_array_file_npy(self, tmp_path):
+        co_filepath = self.write_cutout(tmp_path, dtype='>f4')
+        npy_filepath = str(tmp_path / 'co.npy')
+        cw.write_array_file(co_filepath, npy_filepath, 'npy')
+        data = np.load(npy_filepath, allow_pickle=False)
+        assert data.dtype == np.dtype('=f4')
+        assert np.array_equal(data, fits.getdata(co_filepath))
+        assert os.path.getsize(npy_filepath) < os.path.getsize(co_filepath)
+
+
+    def test_write_array_file_arrow(self, tmp_path):
+        co_filepath = self.write_cutout(tmp_path)
+        arrow_filepath = str(tmp_path / 'co.arrow')
+        cw.write_array_file(co_filepath, arrow_filepath, 'arrow')
+        with pa.memory_map(arrow_filepath) as source:
+            table = pa.ipc.open_file(source).read_all()
+        assert np.array_equal(table.column('cutout').combine_chunks().to_numpy_ndarray()[0],
+                              fits.getdata(co_filepath))
+        assert b'wcs' in table.schema.metadata
+
+
+    def test_write_array_file_nodata(self, tmp_path):
+        co_filepath = str(tmp_path / 'co.dat')
+        cw.write_hdu_file(fits.PrimaryHDU(), co_filepath)
+        with pytest.raises(RequestException, match="The cutout contains no data"):
+            cw.write_array_file(co_filepath, str(tmp_path / 'co.npy'), 'npy')
+
+
+    def test_decompress_image_file(self, tmp_path):
+        co_filepath = self.write_cutout(tmp_path)
+        gz_filepath = str(tmp_path / 'image.dat.gz')
+        with open(co_filepath, 'rb') as src, gzip.open(gz_filepath, 'wb') as dest:
+            dest.write(src.read())
+        dc_filepath = str(tmp_path / 'image.dat')
+        cw.decompress_image_file(gz_filepath, dc_filepath)
+        with open(dc_filepath, 'rb') as dc, open(co_filepath, 'rb') as orig:
+            assert dc.read() == orig.read()
+
+
+    def test_decompress_image_file_errors(self, tmp_path):
+        with pytest.raises(FileNotFoundError):
+            cw.decompress_image_file(str(tmp_path / 'none.dat.gz'), str(tmp_path / 'none.dat'))
+        bad_filepath = tmp_path / 'bad.dat.gz'
+        bad_filepath.write_bytes(b'not gzipped')
+        with pytest.raises(ServerError):
+            cw.decompress_image_file(str(bad_filepath), str(tmp_path / 'bad.dat'))
+        assert sorted(os.listdir(tmp_path)) == [ 'bad.dat.gz' ]
+
+
+    def write_mef(self, tmp_path):
+        """ Write a multi-extension image: SCI (with the WCS), ERR, and DQ extensions. """
+        mef_filepath = str(tmp_path / 'mef.dat')
+        with fits.open(self.m13_tstfyl) as hdus:
+            sci = hdus[0].data.astype(np.float32)
+            primary = fits.PrimaryHDU()
+            primary.header['TELESCOP'] = 'JWST'
+            fits.HDUList([ primary,
+                           fits.ImageHDU(data=sci, header=hdus[0].header, name='SCI'),
+                           fits.ImageHDU(data=np.sqrt(np.abs(sci)), name='ERR'),
+                           fits.ImageHDU(data=np.arange(sci.size, dtype=np.int32).reshape(sci.shape),
+                                         name='DQ'),
+                           fits.ImageHDU(data=np.zeros((4, 4), dtype=np.float32), name='SMALL') ]
+                        ).writeto(mef_filepath)
+        return mef_filepath
+
+
+    def test_cut_extensions(self, app, tmp_path):
+        """ Several extensions are cut with the same pixel slice as the first. """
+        mef_filepath = self.write_mef(tmp_path)
+        co_args = parse_cutout_args(self.m13_co_args, required=True)
+        with HDUCache(2).image(mef_filepath) as image:
+            co_hdus = cw.cut_extensions(image, co_args, [ 'SCI', 'ERR', 'DQ' ])
+            assert [ hdu.name for hdu in co_hdus ] == [ 'PRIMARY', 'SCI', 'ERR', 'DQ' ]
+            assert co_hdus[0].header['TELESCOP'] == 'JWST'
+            assert co_hdus[0].header['CO_NEXT'] == 3
+            sci = co_hdus['SCI'].data
+            assert np.allclose(co_hdus['ERR'].data, np.sqrt(np.abs(sci)))
+            assert co_hdus['DQ'].data.shape == sci.shape
+            assert co_hdus['DQ'].header['CRPIX1'] == co_hdus['SCI'].header['CRPIX1']
+
+            single = cw.cut_extensions(image, co_args, [ 1 ])
+            assert isinstance(single, fits.PrimaryHDU)
+            assert np.array_equal(single.data, sci)
+
+
+    def test_cut_extensions_errors(self, app, tmp_path):
+        mef_filepath = self.write_mef(tmp_path)
+        co_args = parse_cutout_args(self.m13_co_args, required=True)
+        with HDUCache(2).image(mef_filepath) as image:
+            with pytest.raises(RequestException, match="The image has no extension 'WHT'"):
+                cw.cut_extensions(image, co_args, [ 'SCI', 'WHT' ])
+            with pytest.raises(RequestException, match="contains no image data"):
+                cw.cut_extensions(image, co_args, [ 'SCI', 0 ])
+            with pytest.raises(RequestException, match="Extension 'SMALL' has shape"):
+                cw.cut_extensions(image, co_args, [ 'SCI', 'SMALL' ])
+
+
+    def test_make_cutout_file_extensions(self, app, tmp_path):
+        mef_filepath = self.write_mef(tmp_path)
+        co_args = parse_cutout_args(self.m13_co_args, required=True)
+        co_filepath = str(tmp_path / 'co.dat')
+        cw.make_cutout_file(mef_filepath, co_args, co_filepath, hdu_cache=HDUCache(2),
+                            extensions=[ 'SCI', 'DQ' ])
+        with fits.open(co_filepath) as hdus:
+            assert [ hdu.name for hdu in hdus ] == [ 'PRIMARY', 'SCI', 'DQ' ]
+
+        comp_filepath = str(tmp_path / 'co.gzip2.dat')
+        cw.compress_cutout_file(co_filepath, comp_filepath, 'GZIP_2', 0)
+        with fits.open(comp_filepath) as hdus:
+            assert hdus[0].header['CO_NEXT'] == 2
+            assert [ hdu.name for hdu in hdus[1:] ] == [ 'SCI', 'DQ' ]
+            assert np.array_equal(hdus['DQ'].data, fits.getdata(co_filepath, 'DQ'))
+
+
+    def test_make_cutout_file_uint32_extension(self, app, tmp_path):
+        """ A uint32 DQ extension (stored with BZERO) of a memory mapped image is cut. """
+        mef_filepath = str(tmp_path / 'mef.dat')
+        with fits.open(self.m13_tstfyl) as hdus:
+            sci = hdus[0].data.astype(np.float32)
+            dq = (np.arange(sci.size, dtype=np.uint32) + 2**31).reshape(sci.shape)
+            fits.HDUList([ fits.PrimaryHDU(),
+                           fits.ImageHDU(data=sci, header=hdus[0].header, name='SCI'),
+                           fits.ImageHDU(data=dq, name='DQ') ]).writeto(mef_filepath)
+        assert fits.getheader(mef_filepath, 'DQ')['BZERO'] == 2**31
+        co_args = parse_cutout_args(self.m13_co_args, required=True)
+        co_filepath = str(tmp_path / 'co.dat')
+        cw.make_cutout_file(mef_filepath, co_args, co_filepath, hdu_cache=HDUCache(2),
+                            extensions=[ 'SCI', 'DQ' ])
+        with fits.open(co_filepath) as hdus:
+            assert [ hdu.name for hdu in hdus ] == [ 'PRIMARY', 'SCI', 'DQ' ]
+            assert hdus['DQ'].data.dtype == np.uint32
+            assert hdus['DQ'].data.shape == hdus['SCI'].data.shape
+            assert hdus['DQ'].data.min() >= 2**31
+
+
+    def write_cube(self, tmp_path):
+        """ Write a spectral cube, with the celestial WCS of m13, as SCI and DQ extensions. """
+        cube_filepath = str(tmp_path / 'cube.dat')
+        header = fits.getheader(self.m13_tstfyl)
+        shape = (6, header['NAXIS2'], header['NAXIS1'])
+        header['CTYPE3'] = 'FREQ'
+        header['CUNIT3'] = 'Hz'
+        (header['CRPIX3'], header['CRVAL3'], header['CDELT3']) = (1.0, 1.0e9, 1.0e6)
+        sci = np.arange(np.prod(shape), dtype=np.float32).reshape(shape)
+        fits.HDUList([ fits.PrimaryHDU(),
+                       fits.ImageHDU(data=sci, header=header, name='SCI'),
+                       fits.ImageHDU(data=(sci % 7).astype(np.int16), name='DQ') ]).writeto(cube_filepath)
+        return (cube_filepath, sci)
+
+
+    def test_make_cutout_file_cube(self, app, tmp_path):
+        (cube_filepath, sci) = self.write_cube(tmp_path)
+        co_args = parse_cutout_args(self.m13_co_args, required=True)
+        co_filepath = str(tmp_path / 'co.dat')
+        cw.make_cutout_file(cube_filepath, co_args, co_filepath, hdu_cache=HDUCache(2),
+                            extensions=[ 'SCI', 'DQ' ], planes={ 'world': (1.0015e9, 1.0035e9) })
+        with fits.open(co_filepath) as hdus:
+            cube = hdus['SCI'].data
+            assert cube.shape[0] == 2
+            assert hdus['SCI'].header['CRPIX3'] == pytest.approx(-1.0)
+            assert np.array_equal(hdus['DQ'].data, (cube % 7).astype(np.int16))
+            plane = sci[2]
+            assert np.isin(cube[0], plane).all()
+
+
+    def test_cut_image_scaled(self, app, tmp_path):
+        """ Only the pixels of a cutout of a scaled image are read, through its section. """
+        scaled_filepath = str(tmp_path / 'scaled.dat')
+        with fits.open(self.m13_tstfyl) as hdus:
+            data = hdus[0].data.astype(np.float32)
+            hdu = fits.PrimaryHDU(data=data, header=hdus[0].header)
+        hdu.scale('int16', bscale=0.5, bzero=1000)
+        hdu.writeto(scaled_filepath)
+        co_args = parse_cutout_args(self.m13_co_args, required=True)
+        with HDUCache(2).image(scaled_filepath) as image:
+            cutout = cw.cut_image(image.hdu, co_args, wcs=image.wcs)
+            assert image.hdu._data_loaded is False
+        expected = fits.getdata(scaled_filepath)[tuple(cutout.slices_original)]
+        assert cutout.data.dtype.kind == 'f'
+        assert np.array_equal(cutout.data, expected)
+
+
+    def test_cut_image_partial(self, app):
+        """ A box extending beyond the image is padded with NaN in 'partial' mode. """
+        with fits.open(self.m13_tstfyl) as hdus:
+            hdu = hdus[0]
+            co_args = { 'center': WCS(hdu.header).pixel_to_world(0, 0), 'co_size': 10 }
+            cutout = cw.cut_image(hdu, co_args, co_mode='partial')
+            expected = Cutout2D(hdu.data.astype(np.float32), co_args['center'], 10,
+                                wcs=WCS(hdu.header), mode='partial').data
+            assert cutout.data.shape == (10, 10)
+            assert np.isnan(cutout.data[0, 0])
+            assert np.array_equal(cutout.data, expected, equal_nan=True)
+
+
+    def test_cut_image_planes_not_cube(self, app):
+        co_args = parse_cutout_args(self.m13_co_args, required=True)
+        with fits.open(self.m13_tstfyl) as hdus:
+            with pytest.raises(RequestException, match="Planes can be selected only from"):
+                cw.cut_image(hdus[0], co_args, planes={ 'planes': (0, 1) })
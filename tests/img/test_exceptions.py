@@ -1,5 +1,6 @@
 import cuts.blueprints.img.exceptions as xcpt
 import os
+import pickle
 import pytest
 
 
@@ -153,3 +154,16 @@ class TestExceptions(object):
         rtup = reqex.to_tuple()
         assert rtup[0] == self.FAULT
         assert rtup[1] == 77
+
+
+    def test_pickle(self):
+        """ Exceptions survive pickling, e.g., when raised in a worker process. """
+        for xclass in [ xcpt.ProcessingError, xcpt.ImageNotFound, xcpt.NotYetImplemented,
+                        xcpt.RequestException, xcpt.ServerError, xcpt.UnsupportedType ]:
+            ex = pickle.loads(pickle.dumps(xclass(self.FAULT)))
+            assert type(ex) is xclass
+            assert ex.message == self.FAULT
+            assert ex.error_code == xclass.ERROR_CODE
+
+        ex = pickle.loads(pickle.dumps(xcpt.RequestException(self.BAD_REQUEST, 422)))
+        assert ex.to_tuple() == (self.BAD_REQUEST, 422)
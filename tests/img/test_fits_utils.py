@@ -1,10 +1,12 @@
 # Tests of the FITS specific utilities module.
 #   Written by: Tom Hicks. 4/7/2020.
-#   Last Modified: Replace bitpix_size test lost in sync.
+#   Last Modified: Add test for data cubes as image data.
 #
 import json
 import pytest
 
+import numpy as np
+
 from astropy import wcs
 from astropy.table import Table
 from astropy.time.core import Time
@@ -291,6 +293,14 @@ class TestFitsUtils(object):
             assert utils.has_image_data(hdus) is True
 
 
+    def test_has_image_data_cube(self):
+        """ Check primary of a data cube for image data. """
+        hdus = fits.HDUList([ fits.PrimaryHDU(np.zeros((2, 3, 4), dtype=np.float32)) ])
+        assert utils.has_image_data(hdus) is True
+        hdus = fits.HDUList([ fits.PrimaryHDU(np.zeros((2, 2, 3, 4), dtype=np.float32)) ])
+        assert utils.has_image_data(hdus) is False
+
+
     def test_has_image_data_bad_high_hdu(self):
         """ Check non-existant extension of image file for image data. """
         with fits.open(self.m13_tstfyl) as hdus:
@@ -338,6 +348,14 @@ class TestFitsUtils(object):
         assert utils.is_fits_filename('/usr/dummy/m13.gz') is False
 
 
+    def test_is_gzipped_fits_filename(self):
+        assert utils.is_gzipped_fits_filename('m13.fits.gz') is True
+        assert utils.is_gzipped_fits_filename('/usr/dummy/m13.fits.gz') is True
+        assert utils.is_gzipped_fits_filename('m13.fits') is False
+        assert utils.is_gzipped_fits_filename('m13.gz') is False
+        assert utils.is_gzipped_fits_filename(None) is False
+
+
 
     def test_metadata_keys(self):
         assert utils.get_metadata_keys({}) is None
@@ -0,0 +1,93 @@
+# Tests for the image footprint utilities module.
+#   Last Modified: Initial creation.
+#
+import math
+
+import pytest
+
+import cuts.blueprints.img.footprint_utils as fu
+
+
+class TestFootprintUtils(object):
+
+    def footprint_md(self, uid, ra, dec, half_deg):
+        """ Return metadata for an image with a square footprint centered at the given point. """
+        cos_dec = math.cos(math.radians(dec))
+        corners = [ (ra - half_deg / cos_dec, dec - half_deg), (ra + half_deg / cos_dec, dec - half_deg),
+                    (ra + half_deg / cos_dec, dec + half_deg), (ra - half_deg / cos_dec, dec + half_deg) ]
+        md = { 'id': uid, 'file_path': f"/images/{uid}.fits" }
+        for (idx, (cra, cdec)) in enumerate(corners, start=1):
+            md[f"im_ra{idx}"] = cra
+            md[f"im_dec{idx}"] = cdec
+        return md
+
+
+    def test_footprint_corners(self):
+        md = self.footprint_md(1, 53.0, -27.0, 0.1)
+        corners = fu.footprint_corners(md)
+        assert len(corners) == 4
+        assert corners[0] == (md['im_ra1'], md['im_dec1'])
+        md['im_dec3'] = None
+        assert fu.footprint_corners(md) is None
+        assert fu.footprint_corners({ 'id': 1 }) is None
+
+
+    def test_tangent_project(self):
+        assert fu.tangent_project(53.0, -27.0, 53.0, -27.0) == pytest.approx((0.0, 0.0))
+        (x, y) = fu.tangent_project(53.0, -26.9, 53.0, -27.0)
+        assert x == pytest.approx(0.0, abs=1e-9)
+        assert y == pytest.approx(0.1, rel=1e-3)
+        (x, y) = fu.tangent_project(53.1, -27.0, 53.0, -27.0)
+        assert x > 0
+        assert fu.tangent_project(233.0, 27.0, 53.0, -27.0) is None    # opposite hemisphere
+
+
+    def test_polygon_area_and_clip(self):
+        square = [ (0, 0), (2, 0), (2, 2), (0, 2) ]
+        assert fu.polygon_area(square) == 4
+        assert fu.polygon_area(list(reversed(square))) == 4
+        shifted = [ (1, 1), (3, 1), (3, 3), (1, 3) ]
+        assert fu.polygon_area(fu.clip_polygon(shifted, square)) == pytest.approx(1.0)
+        outside = [ (5, 5), (6, 5), (6, 6), (5, 6) ]
+        assert fu.clip_polygon(outside, square) == []
+        assert fu.point_in_polygon((1, 1), square) is True
+        assert fu.point_in_polygon((3, 1), square) is False
+
+
+    def test_box_coverage(self):
+        corners = fu.footprint_corners(self.footprint_md(1, 53.0, -27.0, 0.1))
+        assert fu.box_coverage(corners, 53.0, -27.0, 0.05) == pytest.approx(1.0)
+        # centered on the northern edge: half the box is covered
+        assert fu.box_coverage(corners, 53.0, -26.9, 0.05) == pytest.approx(0.5, abs=0.01)
+        assert fu.box_coverage(corners, 60.0, -27.0, 0.05) == 0.0
+        assert fu.box_coverage(None, 53.0, -27.0, 0.05) == 0.0
+        assert fu.box_coverage(corners, 53.0, -27.0, 0) == 1.0
+
+
+    def test_box_coverage_ra_wrap(self):
+        corners = fu.footprint_corners(self.footprint_md(1, 0.0, 10.0, 0.1))
+        assert fu.box_coverage(corners, 359.99, 10.0, 0.02) == pytest.approx(1.0)
+
+
+    def test_center_offset(self):
+        corners = fu.footprint_corners(self.footprint_md(1, 53.0, -27.0, 0.1))
+        assert fu.center_offset(corners, 53.0, -27.0) == pytest.approx(0.0, abs=1e-4)
+        assert fu.center_offset(corners, 53.0, -26.95) == pytest.approx(0.05, rel=1e-2)
+        assert fu.center_offset(None, 53.0, -27.0) == math.inf
+
+
+    def test_rank_footprints(self):
+        partial = self.footprint_md(3, 53.0, -26.9, 0.1)   # newest: covers half the cutout
+        offset = self.footprint_md(2, 53.0, -27.05, 0.1)   # contains the cutout, off center
+        central = self.footprint_md(1, 53.0, -27.0, 0.1)   # contains the cutout, centered
+        unknown = { 'id': 4, 'file_path': '/images/4.fits' }
+        ranked = fu.rank_footprints([ unknown, partial, offset, central ], 53.0, -27.0, 0.05)
+        assert [ md['id'] for md in ranked ] == [ 1, 2, 3, 4 ]
+
+
+    def test_rank_footprints_ties(self):
+        """ Equally good images are ranked newest (highest ID) first. """
+        ranked = fu.rank_footprints([ self.footprint_md(uid, 53.0, -27.0, 0.1) for uid in (1, 5, 3) ],
+                                    53.0, -27.0, 0.05)
+        assert [ md['id'] for md in ranked ] == [ 5, 3, 1 ]
+        assert fu.rank_footprints([], 53.0, -27.0, 0.05) == []
@@ -0,0 +1,193 @@
+# Tests for the opened images cache module.
+#   Last Modified: Add a test of the scaled extensions of memory mapped images.
+#
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from cuts.blueprints.img.hdu_cache import HDUCache
+from tests import TEST_RESOURCES_DIR
+
+
+class TestHDUCache(object):
+
+    m13_tstfyl = f"{TEST_RESOURCES_DIR}/m13.fits"
+    hh_tstfyl = f"{TEST_RESOURCES_DIR}/HorseHead.fits"
+
+
+    def copy_images(self, tmp_path, count):
+        paths = []
+        for idx in range(count):
+            path = str(tmp_path / f"image{idx}.dat")
+            shutil.copyfile(self.m13_tstfyl, path)
+            paths.append(path)
+        return paths
+
+
+    def test_image(self):
+        cache = HDUCache(2)
+        with cache.image(self.m13_tstfyl) as image:
+            assert image.hdu is image.hdus[0]
+            assert isinstance(image.wcs, WCS)
+            assert image.hdu.data is not None
+            assert image.users == 1
+        assert image.users == 0
+        assert cache.stats()['entries'] == 1
+
+
+    def test_image_hit(self):
+        cache = HDUCache(2)
+        with cache.image(self.m13_tstfyl) as image1:
+            pass
+        with cache.image(self.m13_tstfyl) as image2:
+            assert image2 is image1
+        stats = cache.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+
+
+    def test_image_modified(self, tmp_path):
+        """ A modified image is reopened. """
+        (path,) = self.copy_images(tmp_path, 1)
+        cache = HDUCache(2)
+        with cache.image(path) as image1:
+            pass
+        os.utime(path, ns=(0, 0))
+        with cache.image(path) as image2:
+            assert image2 is not image1
+        assert cache.stats()['misses'] == 2
+
+
+    def test_image_missing(self):
+        with pytest.raises(FileNotFoundError):
+            with HDUCache(2).image('/no/such/image.fits'):
+                pass
+
+
+    def test_image_not_fits(self):
+        cache = HDUCache(2)
+        with pytest.raises(OSError):
+            with cache.image(f"{TEST_RESOURCES_DIR}/NOT_FITS_FILE.fits"):
+                pass
+        assert cache.stats()['entries'] == 0
+
+
+    def test_image_scaled(self, tmp_path):
+        """ Images with scaled data are read by sections, neither memory mapped nor loaded. """
+        path = str(tmp_path / 'scaled.dat')
+        hdu = fits.PrimaryHDU(np.arange(16, dtype=np.float32).reshape(4, 4))
+        hdu.scale('int16', bscale=0.5, bzero=10)
+        hdu.writeto(path)
+        with HDUCache(2).image(path) as image:
+            assert image.hdu._data_loaded is False
+            assert image.hdu.section[1, 1] == 5.0
+            assert image.hdu.data[1, 1] == 5.0
+
+
+    def test_eviction(self, tmp_path):
+        paths = self.copy_images(tmp_path, 3)
+        cache = HDUCache(2)
+        for path in paths:
+            with cache.image(path) as image:
+                entry = image
+        with cache.image(paths[0]):
+            pass
+        stats = cache.stats()
+        assert stats['entries'] == 2
+        assert stats['evictions'] == 2
+        assert stats['misses'] == 4
+
+
+    def test_eviction_closes(self, tmp_path):
+        paths = self.copy_images(tmp_path, 2)
+        cache = HDUCache(1)
+        with cache.image(paths[0]) as image0:
+            pass
+        with cache.image(paths[1]):
+            pass
+        assert image0.cached is False
+        assert image0.hdus._file.closed is True
+
+
+    def test_eviction_in_use(self, tmp_path):
+        """ An image in use is not evicted and images opened meanwhile are not cached. """
+        paths = self.copy_images(tmp_path, 2)
+        cache = HDUCache(1)
+        with cache.image(paths[0]) as image0:
+            with cache.image(paths[1]) as image1:
+                assert image1.cached is False
+            assert image1.hdus._file.closed is True
+            assert image0.hdus._file.closed is False
+        assert cache.stats()['entries'] == 1
+
+
+    def test_clear_in_use(self):
+        """ An image in use when the cache is cleared is closed when released. """
+        cache = HDUCache(2)
+        with cache.image(self.m13_tstfyl) as image:
+            cache.clear()
+            assert cache.stats()['entries'] == 0
+            assert image.hdus._file.closed is False
+        assert image.hdus._file.closed is True
+
+
+    def test_disabled(self):
+        cache = HDUCache(0)
+        with cache.image(self.m13_tstfyl) as image:
+            assert image.cached is False
+        assert image.hdus._file.closed is True
+        assert cache.stats()['entries'] == 0
+
+
+    def test_extension(self, tmp_path):
+        """ Extensions are loaded on first use and then kept with the image. """
+        path = str(tmp_path / 'mef.dat')
+        header = fits.getheader(self.m13_tstfyl)
+        fits.HDUList([ fits.PrimaryHDU(),
+                       fits.ImageHDU(data=np.ones((8, 8), dtype=np.float32), header=header, name='SCI'),
+                       fits.BinTableHDU.from_columns([ fits.Column(name='A', format='J', array=[1]) ],
+                                                     name='TAB') ]).writeto(path)
+        with HDUCache(2).image(path) as image:
+            assert image.extension(None) == (image.hdu, image.wcs)
+            assert image.extension(0) == (image.hdu, image.wcs)
+            (hdu, wcs) = image.extension('SCI')
+            assert hdu.name == 'SCI'
+            assert wcs.celestial.naxis == 2
+            assert image.extension(1)[0] is hdu
+            assert image.extension('SCI')[1] is wcs        # kept
+            assert image.extension('TAB')[1] is None
+            with pytest.raises(KeyError):
+                image.extension('ERR')
+            with pytest.raises(IndexError):
+                image.extension(5)
+
+
+    def test_extension_scaled(self, tmp_path):
+        """ A scaled extension of a memory mapped image is read from an unmapped copy. """
+        path = str(tmp_path / 'mef.dat')
+        dq = np.arange(64, dtype=np.uint32).reshape(8, 8) + 2**31
+        fits.HDUList([ fits.PrimaryHDU(data=np.ones((8, 8), dtype=np.float32)),
+                       fits.ImageHDU(data=dq, name='DQ') ]).writeto(path)
+        with HDUCache(0).image(path) as image:
+            assert image.memmap is True
+            (hdu, wcs) = image.extension('DQ')
+            assert image.unmapped_hdus is not None
+            assert hdu is image.unmapped_hdus['DQ']
+            assert np.array_equal(hdu.section[2:4, 3:5], dq[2:4, 3:5])
+        assert image.unmapped_hdus._file.closed is True
+
+
+    def test_image_cube(self, tmp_path):
+        """ The (scaled) data of a cube is not loaded when the cube is opened. """
+        path = str(tmp_path / 'cube.dat')
+        hdu = fits.PrimaryHDU(np.arange(60, dtype=np.float32).reshape(3, 4, 5))
+        hdu.scale('int16', bscale=0.5, bzero=10)
+        hdu.writeto(path)
+        with HDUCache(2).image(path) as image:
+            assert image.hdu._data_loaded is False
+            assert image.hdu.section[1, 2, 3] == 33.0
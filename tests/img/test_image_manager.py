@@ -1,10 +1,15 @@
 # Tests for the image manager module.
 #   Written by: Tom Hicks. 1/9/2021.
-#   Last Modified: Load data root from test config settings.
+#   Last Modified: Decompress the gzipped images of tests into temporary directories.
 #
+import gzip
+import io
+import json
 import os
 import pytest
 
+import numpy as np
+
 from flask import current_app, request, send_from_directory
 
 from astropy import units as u
@@ -12,7 +17,8 @@ from astropy.io import fits
 from astropy.nddata import Cutout2D
 
 from cuts.blueprints.img.exceptions import ImageNotFound, RequestException, ServerError, NotYetImplemented
-from cuts.blueprints.img.image_manager import DEFAULT_CO_CACHE_DIR, IRODS_ZONE_NAME, ImageManager
+from cuts.blueprints.img.image_manager import DEFAULT_CO_CACHE_DIR, DEFAULT_DECOMPRESSED_CACHE_DIR
+from cuts.blueprints.img.image_manager import IRODS_ZONE_NAME, ImageManager
 from cuts.blueprints.img.arg_utils import parse_cutout_args
 from tests import TEST_RESOURCES_DIR, TEST_DBCONFIG_FILEPATH, TEST_DATA_ROOT
 
@@ -311,6 +317,64 @@ class TestImageManager(object):
         assert self.imgr.is_cutout_cached('m13.fits', co_dir=TEST_RESOURCES_DIR) is True
 
 
+    def test_is_cutout_cached_preview(self, tmp_path):
+        (tmp_path / 'pv.png').write_bytes(b'\x89PNG')
+        (tmp_path / 'pv.gif').write_bytes(b'GIF89a')
+        assert self.imgr.is_cutout_cached('pv.png', co_dir=str(tmp_path)) is True
+        assert self.imgr.is_cutout_cached('pv.jpg', co_dir=str(tmp_path)) is False
+        assert self.imgr.is_cutout_cached('pv.gif', co_dir=str(tmp_path)) is False
+
+
+    def test_get_image_or_cutout_preview_nosize(self, app):
+        """ A preview image requires a cutout size. """
+        with app.test_request_context('/'):
+            co_args = { 'center': None, 'co_size': None }
+            preview = { 'format': 'png', 'stretch': 'linear', 'min_percent': 0.5,
+                        'max_percent': 99.5, 'max_dim': 512 }
+            with pytest.raises(RequestException, match="A cutout size must be specified"):
+                self.imgr.get_image_or_cutout(co_args, preview=preview)
+
+
+
+    def test_get_image_or_cutout_array_bad(self, app):
+        """ A raw array requires a cutout size and cannot hold int16 data. """
+        with app.test_request_context('/'):
+            co_args = { 'center': None, 'co_size': None }
+            with pytest.raises(RequestException, match="A cutout size must be specified"):
+                self.imgr.get_image_or_cutout(co_args, array_format='npy')
+            with pytest.raises(RequestException, match="request the float32 data type"):
+                self.imgr.get_image_or_cutout(self.m13_co_args, array_format='npy', dtype='int16')
+
+
+    def test_return_array_with_name(self, app, tmp_path):
+        """ A cutout is sent as a cached .npy array, with its WCS in a response header. """
+        with fits.open(self.m13_tstfyl) as hdus:
+            hdu = fits.PrimaryHDU(data=hdus[0].data[:8, :8], header=hdus[0].header)
+        self.imgr.write_cutout(hdu, 'co.fits', co_dir=str(tmp_path))
+        with app.test_request_context('/'):
+            resp = self.imgr.return_array_with_name('co.fits', 'npy', co_dir=str(tmp_path))
+            resp.direct_passthrough = False
+            assert resp.mimetype == 'application/x-npy'
+            assert json.loads(resp.headers['X-Cutout-WCS'])['CRPIX1'] == hdu.header['CRPIX1']
+            data = np.load(io.BytesIO(resp.get_data()), allow_pickle=False)
+            assert np.array_equal(data, hdu.data)
+        assert self.imgr.is_cutout_cached('co.npy', co_dir=str(tmp_path)) is True
+
+
+    def test_return_array_with_name_wcs_index(self, app, tmp_path):
+        """ The WCS of a cached array is read from its index file, not from the cutout. """
+        with fits.open(self.m13_tstfyl) as hdus:
+            hdu = fits.PrimaryHDU(data=hdus[0].data[:8, :8], header=hdus[0].header)
+        self.imgr.write_cutout(hdu, 'co.fits', co_dir=str(tmp_path))
+        with app.test_request_context('/'):
+            self.imgr.return_array_with_name('co.fits', 'npy', co_dir=str(tmp_path))
+            index = self.imgr.co_cache.read_index(str(tmp_path / 'co.npy'))
+            assert index['wcs']['CRPIX1'] == hdu.header['CRPIX1']
+            os.remove(tmp_path / 'co.fits')      # a cached array no longer needs its cutout
+            wcs = self.imgr.array_wcs('co.fits', 'co.npy', co_dir=str(tmp_path))
+            assert wcs['CRPIX1'] == hdu.header['CRPIX1']
+            assert self.imgr.array_wcs('co.fits', 'other.npy', co_dir=str(tmp_path)) is None
+
 
     def test_is_irods_file(self):
         assert self.imgr.is_irods_file('/not/an/iRods/filepath') is False
@@ -319,6 +383,45 @@ class TestImageManager(object):
 
 
 
+    def test_cached_list(self):
+        imgr = ImageManager({ **self.test_args, 'list_cache_notify_channel': None })
+        assert imgr.list_listener is None
+        calls = []
+        def loader():
+            calls.append(1)
+            return ['b', 'c', 'a']
+        assert imgr.cached_list(('test',), loader) == ['a', 'b', 'c']
+        lst = imgr.cached_list(('test',), loader)
+        assert lst == ['a', 'b', 'c']
+        assert len(calls) == 1
+        lst.append('z')                     # callers get a copy of the cached list
+        assert imgr.cached_list(('test',), loader) == ['a', 'b', 'c']
+
+
+    def test_cached_list_invalidate(self):
+        imgr = ImageManager({ **self.test_args, 'list_cache_notify_channel': None })
+        calls = []
+        def loader():
+            calls.append(1)
+            return ['a']
+        imgr.cached_list(('test',), loader)
+        imgr.invalidate_list_caches('some payload')
+        imgr.cached_list(('test',), loader)
+        assert len(calls) == 2
+
+
+    def test_cached_list_nocache(self):
+        imgr = ImageManager({ **self.test_args, 'list_cache_ttl': 0 })
+        assert imgr.list_listener is None
+        calls = []
+        def loader():
+            calls.append(1)
+            return ['a']
+        imgr.cached_list(('test',), loader)
+        imgr.cached_list(('test',), loader)
+        assert len(calls) == 2
+
+
     def test_list_collections(self):
         lst = self.imgr.list_collections()
         print(lst)
@@ -398,6 +501,107 @@ class TestImageManager(object):
 
 
 
+    def test_make_cutout_unmodified(self, app):
+        """ Making a cutout does not modify the (cached) image HDU. """
+        with app.test_request_context('/'):
+            with fits.open(self.m13_tstfyl) as hdus:
+                shape = hdus[0].data.shape
+                crpix1 = hdus[0].header['CRPIX1']
+                cout = self.imgr.make_cutout(hdus[0], self.m13_co_args)
+                assert hdus[0].data.shape == shape
+                assert hdus[0].header['CRPIX1'] == crpix1
+
+
+    def test_make_cutout_hdu(self, app):
+        with app.test_request_context('/'):
+            with fits.open(self.m13_tstfyl) as hdus:
+                cout = self.imgr.make_cutout(hdus[0], self.m13_co_args)
+                co_hdu = self.imgr.make_cutout_hdu(hdus[0], cout)
+                assert co_hdu.data.shape == cout.data.shape
+                assert co_hdu.header['NAXIS1'] == cout.data.shape[1]
+                assert co_hdu.header['CRPIX1'] == cout.wcs.wcs.crpix[0]
+                assert co_hdu.header['EQUINOX'] == hdus[0].header['EQUINOX']
+                assert 'CHECKSUM' not in co_hdu.header
+
+
+    def test_make_position_cutout(self, app):
+        with app.test_request_context('/'):
+            with self.imgr.hdu_cache.image(self.m13_tstfyl) as image:
+                pos = { 'row': 0, 'ra': 250.4226, 'dec': 36.4602, 'size': 12 }
+                co_hdu = self.imgr.make_position_cutout(image, pos, u.arcsec)
+                assert co_hdu is not None
+                assert 'error' not in pos
+                assert co_hdu.data.shape[0] <= image.hdu.data.shape[0]
+
+
+    def test_make_position_cutout_no_overlap(self, app):
+        with app.test_request_context('/'):
+            with self.imgr.hdu_cache.image(self.m13_tstfyl) as image:
+                pos = { 'row': 1, 'ra': 18.0, 'dec': 4.0, 'size': 10 }
+                assert self.imgr.make_position_cutout(image, pos, u.arcsec) is None
+                assert 'error' in pos
+
+
+    def test_make_position_cutout_bad_frame(self, app):
+        with app.test_request_context('/'):
+            with self.imgr.hdu_cache.image(self.m13_tstfyl) as image:
+                pos = { 'row': 2, 'ra': 250.4226, 'dec': 36.4602, 'size': 12 }
+                assert self.imgr.make_position_cutout(image, pos, u.arcsec, 'galactic') is None
+                assert pos['error'].startswith('Unable to make the cutout')
+
+
+    def test_make_cutouts_no_size(self, app):
+        with app.test_request_context('/'):
+            posns = [ { 'row': 0, 'ra': 250.4226, 'dec': 36.4602 }, { 'row': 1, 'error': 'bad' } ]
+            stamps = list(self.imgr.make_cutouts(posns, { 'units': u.arcsec }))
+            assert len(stamps) == 2
+            assert all(hdu is None for (pos, hdu) in stamps)
+            assert stamps[0][0]['error'].startswith('A cutout size must be specified')
+            assert stamps[1][0]['error'] == 'bad'
+
+
+    def test_rank_cutout_images(self):
+        def md(uid, dec):
+            fields = { 'id': uid, 'file_path': f"/images/{uid}.fits" }
+            corners = [ (250.3, dec - 0.1), (250.55, dec - 0.1), (250.55, dec + 0.1), (250.3, dec + 0.1) ]
+            for (idx, (ra, cdec)) in enumerate(corners, start=1):
+                fields[f"im_ra{idx}"] = ra
+                fields[f"im_dec{idx}"] = cdec
+            return fields
+        matches = [ md(1, 36.46), md(2, 36.56) ]    # the newest image barely covers the cutout
+        ranked = self.imgr.rank_cutout_images(matches, self.m13_co_args)
+        assert [ img['id'] for img in ranked ] == [ 1, 2 ]
+
+
+    def test_make_filter_cutout(self, app):
+        with app.test_request_context('/'):
+            md = { 'filter': 'F090W', 'file_path': self.m13_tstfyl }
+            (ext, error) = self.imgr.make_filter_cutout(md, self.m13_co_args)
+            assert error is None
+            assert isinstance(ext, fits.ImageHDU)
+            assert ext.name == 'F090W'
+            assert ext.header['FILTER'] == 'F090W'
+            assert 'CRPIX1' in ext.header
+
+
+    def test_make_filter_cutout_no_overlap(self, app):
+        with app.test_request_context('/'):
+            disjoint_co_args = parse_cutout_args({'ra':'18.0', 'dec':'4.0', 'sizeArcSec':'10'},
+                                                 required=True)
+            md = { 'filter': self.hh_filter, 'file_path': self.hh_tstfyl }
+            (ext, error) = self.imgr.make_filter_cutout(md, disjoint_co_args)
+            assert ext is None
+            assert 'There is no overlap' in error
+
+
+    def test_make_filter_cutout_bad_path(self, app):
+        with app.test_request_context('/'):
+            md = { 'filter': 'F090W', 'file_path': self.bad_path }
+            (ext, error) = self.imgr.make_filter_cutout(md, self.m13_co_args)
+            assert ext is None
+            assert error.startswith('Unable to make the cutout')
+
+
     def test_make_cutout_and_save_m13(self, app):
         with app.test_request_context('/'):
             co_filename = "testMakeCutoutAndSave.fits"
@@ -422,6 +626,287 @@ class TestImageManager(object):
             assert self.imgr.is_cutout_cached(co_filename) is False  # still not cached
 
 
+    def test_write_cutout(self, tmp_path):
+        hdu = fits.PrimaryHDU(data=[[1, 2], [3, 4]])
+        self.imgr.write_cutout(hdu, 'co.fits', co_dir=str(tmp_path))
+        assert os.listdir(tmp_path) == ['co.fits']  # no temporary files left behind
+        with fits.open(tmp_path / 'co.fits') as hdus:
+            assert hdus[0].data.tolist() == [[1, 2], [3, 4]]
+
+
+    def test_co_cache_dir(self, app, tmp_path):
+        """ The cutout methods default to the configured cutouts cache directory. """
+        imgr = ImageManager({ **self.test_args, 'list_cache_notify_channel': None,
+                              'co_cache_dir': str(tmp_path) })
+        imgr.write_cutout(fits.PrimaryHDU(data=[[1, 2], [3, 4]]), 'co.fits')
+        assert os.path.exists(tmp_path / 'co.fits')
+        assert imgr.is_cutout_cached('co.fits') is True
+        assert imgr.list_cutouts() == [ 'co.fits' ]
+        with app.test_request_context('/'):
+            resp = imgr.return_cutout_with_name('co.fits')
+            assert resp.status_code == 200
+
+
+    def test_make_compressed_cutout(self, app, tmp_path):
+        with app.test_request_context('/'):
+            hdu = fits.PrimaryHDU(data=[[1, 2], [3, 4]])
+            self.imgr.write_cutout(hdu, 'co.fits', co_dir=str(tmp_path))
+            compression = { 'compression_type': 'GZIP_2', 'quantize_level': 0.0 }
+            comp_filename = self.imgr.make_compressed_cutout('co.fits', compression, co_dir=str(tmp_path))
+            assert comp_filename == 'co.gzip_2_q0.fits'
+            assert self.imgr.is_cutout_cached(comp_filename, co_dir=str(tmp_path)) is True
+            with fits.open(tmp_path / comp_filename) as hdus:
+                assert hdus[1].data.tolist() == [[1, 2], [3, 4]]
+
+
+    def test_return_cutout_with_name_gzip(self, app, tmp_path):
+        """ A client accepting gzip encoding is sent the (cached) gzipped cutout. """
+        hdu = fits.PrimaryHDU(data=[[1, 2], [3, 4]])
+        self.imgr.write_cutout(hdu, 'co.fits', co_dir=str(tmp_path))
+        with app.test_request_context('/', headers={'Accept-Encoding': 'gzip'}):
+            resp = self.imgr.return_cutout_with_name('co.fits', co_dir=str(tmp_path))
+            resp.direct_passthrough = False
+            assert resp.headers.get('Content-Encoding') == 'gzip'
+            assert 'Accept-Encoding' in resp.vary
+            assert resp.mimetype == 'image/fits'
+            assert 'co.fits' in resp.headers.get('Content-Disposition')
+            with open(tmp_path / 'co.fits', 'rb') as cofile:
+                assert gzip.decompress(resp.get_data()) == cofile.read()
+        assert os.path.exists(tmp_path / 'co.fits.gz')
+
+
+    def test_return_cutout_with_name_identity(self, app, tmp_path):
+        """ A client not accepting gzip encoding, or a compressed cutout, is sent as is. """
+        hdu = fits.PrimaryHDU(data=[[1, 2], [3, 4]])
+        self.imgr.write_cutout(hdu, 'co.fits', co_dir=str(tmp_path))
+        self.imgr.write_cutout(hdu, 'co.rice_1_q16.fits', co_dir=str(tmp_path))
+        with app.test_request_context('/'):
+            resp = self.imgr.return_cutout_with_name('co.fits', co_dir=str(tmp_path))
+            assert 'Content-Encoding' not in resp.headers
+            assert 'Accept-Encoding' in resp.vary
+        with app.test_request_context('/', headers={'Accept-Encoding': 'gzip'}):
+            resp = self.imgr.return_cutout_with_name('co.rice_1_q16.fits', co_dir=str(tmp_path))
+            assert 'Content-Encoding' not in resp.headers
+        assert not os.path.exists(tmp_path / 'co.fits.gz')
+
+
+    def test_return_cutout_with_name_range(self, app, tmp_path):
+        """ A range request is sent the requested bytes of the unencoded cutout. """
+        hdu = fits.PrimaryHDU(data=[[1, 2], [3, 4]])
+        self.imgr.write_cutout(hdu, 'co.fits', co_dir=str(tmp_path))
+        headers = { 'Accept-Encoding': 'gzip', 'Range': 'bytes=0-2879' }
+        with app.test_request_context('/', headers=headers):
+            resp = self.imgr.return_cutout_with_name('co.fits', co_dir=str(tmp_path))
+            resp.direct_passthrough = False
+            assert resp.status_code == 206
+            assert 'Content-Encoding' not in resp.headers
+            assert resp.headers.get('Content-Range').startswith('bytes 0-2879/')
+            assert resp.get_data().startswith(b'SIMPLE  =')
+        assert not os.path.exists(tmp_path / 'co.fits.gz')
+
+
+    def test_return_cutout_with_name_not_modified(self, app, tmp_path):
+        hdu = fits.PrimaryHDU(data=[[1, 2], [3, 4]])
+        self.imgr.write_cutout(hdu, 'co.fits', co_dir=str(tmp_path))
+        with app.test_request_context('/'):
+            resp = self.imgr.return_cutout_with_name('co.fits', co_dir=str(tmp_path))
+            etag = resp.headers.get('ETag')
+            assert etag and not etag.startswith('W/')
+        with app.test_request_context('/', headers={'If-None-Match': etag}):
+            resp = self.imgr.return_cutout_with_name('co.fits', co_dir=str(tmp_path))
+            assert resp.status_code == 304
+
+
+    def test_return_cutout_with_name_x_accel(self, app, tmp_path):
+        """ A cutout is handed to the front proxy, unencoded, in 'x-accel' mode. """
+        imgr = ImageManager({ **self.test_args, 'list_cache_notify_channel': None,
+                              'file_delivery_mode': 'x-accel',
+                              'file_delivery_locations': { str(tmp_path): '/internal/cutouts' } })
+        imgr.write_cutout(fits.PrimaryHDU(data=[[1, 2], [3, 4]]), 'co.fits', co_dir=str(tmp_path))
+        with app.test_request_context('/', headers={'Accept-Encoding': 'gzip'}):
+            resp = imgr.return_cutout_with_name('co.fits', co_dir=str(tmp_path))
+            assert resp.headers.get('X-Accel-Redirect') == '/internal/cutouts/co.fits'
+            assert 'Content-Encoding' not in resp.headers
+            assert resp.mimetype == 'image/fits'
+            assert 'co.fits' in resp.headers.get('Content-Disposition')
+            assert resp.get_data() == b''
+        assert not os.path.exists(tmp_path / 'co.fits.gz')
+
+
+    def test_return_image_at_filepath_x_sendfile(self, app):
+        imgr = ImageManager({ **self.test_args, 'list_cache_notify_channel': None,
+                              'file_delivery_mode': 'x-sendfile' })
+        with app.test_request_context('/'):
+            img = imgr.return_image_at_filepath(self.m13_tstfyl)
+            assert img.headers.get('X-Sendfile') == os.path.abspath(self.m13_tstfyl)
+            assert img.get_data() == b''
+
+
+    def test_return_image_at_filepath_x_accel_outside(self, app, tmp_path):
+        """ An image outside the locations of the front proxy is sent directly. """
+        imgr = ImageManager({ **self.test_args, 'list_cache_notify_channel': None,
+                              'file_delivery_mode': 'x-accel',
+                              'file_delivery_locations': { str(tmp_path): '/internal' } })
+        with app.test_request_context('/'):
+            img = imgr.return_image_at_filepath(self.m13_tstfyl)
+            assert 'X-Accel-Redirect' not in img.headers
+            assert img.status_code == 200
+            assert img.is_streamed is True
+
+
+    def test_file_delivery_mode_bad(self):
+        with pytest.raises(ServerError, match="File delivery mode must be one of"):
+            ImageManager({ **self.test_args, 'list_cache_notify_channel': None,
+                           'file_delivery_mode': 'sendfile' })
+
+
+    def test_make_binned_cutout(self, app, tmp_path):
+        hdu = fits.PrimaryHDU(data=np.arange(64, dtype='f4').reshape(8, 8))
+        self.imgr.write_cutout(hdu, 'co.fits', co_dir=str(tmp_path))
+        bin_filename = self.imgr.make_binned_cutout('co.fits', { 'factor': 2 }, co_dir=str(tmp_path))
+        assert bin_filename == 'co.bin2.fits'
+        assert fits.getdata(tmp_path / bin_filename).shape == (4, 4)
+        assert self.imgr.is_cutout_cached(bin_filename, co_dir=str(tmp_path)) is True
+
+
+    def test_make_converted_cutout(self, app, tmp_path):
+        hdu = fits.PrimaryHDU(data=np.linspace(0.0, 1.0, 64).reshape(8, 8))
+        self.imgr.write_cutout(hdu, 'co.fits', co_dir=str(tmp_path))
+        f32_filename = self.imgr.make_converted_cutout('co.fits', 'float32', co_dir=str(tmp_path))
+        assert f32_filename == 'co.f32.fits'
+        assert fits.getheader(tmp_path / f32_filename)['BITPIX'] == -32
+
+
+    def test_get_image_or_cutout_dtype_nosize(self, app):
+        """ Converting the data type of a whole image requires a size or binning. """
+        with app.test_request_context('/'):
+            co_args = { 'center': None, 'co_size': None }
+            with pytest.raises(RequestException, match="A cutout size or binning must be specified"):
+                self.imgr.get_image_or_cutout(co_args, dtype='int16')
+
+
+    def test_get_image_or_cutout_extensions_errors(self, app):
+        """ Extensions require a size, and several extensions cannot be binned or converted. """
+        with app.test_request_context('/'):
+            co_args = { 'center': None, 'co_size': None }
+            with pytest.raises(RequestException, match="A cutout size must be specified to select"):
+                self.imgr.get_image_or_cutout(co_args, extensions=['SCI'])
+            with pytest.raises(RequestException, match="select the planes of a data cube"):
+                self.imgr.get_image_or_cutout(co_args, planes={ 'planes': (1, 2) })
+            with pytest.raises(RequestException, match="Cutouts of several image extensions cannot"):
+                self.imgr.get_image_or_cutout(self.m13_co_args, extensions=['SCI', 'ERR'],
+                                              binning={ 'factor': 2 })
+
+
+    def test_make_cutout_and_save_extensions(self, app, tmp_path):
+        """ Cut the SCI and ERR extensions of a multi-extension image. """
+        mef_filepath = str(tmp_path / 'mef.dat')
+        with fits.open(self.m13_tstfyl) as hdus:
+            fits.HDUList([ fits.PrimaryHDU(),
+                           fits.ImageHDU(data=hdus[0].data, header=hdus[0].header, name='SCI'),
+                           fits.ImageHDU(data=np.ones(hdus[0].data.shape), name='ERR') ]).writeto(mef_filepath)
+        with app.test_request_context('/'):
+            self.imgr.make_cutout_and_save(mef_filepath, self.m13_co_args, 'co.fits',
+                                           co_dir=str(tmp_path), extensions=['SCI', 'ERR'])
+            self.imgr.make_cutout_and_save(self.m13_tstfyl, self.m13_co_args, 'co0.fits',
+                                           co_dir=str(tmp_path))
+            with pytest.raises(RequestException, match="The image has no extension 'DQ'"):
+                self.imgr.make_cutout_and_save(mef_filepath, self.m13_co_args, 'codq.fits',
+                                               co_dir=str(tmp_path), extensions=['DQ'])
+        with fits.open(tmp_path / 'co.fits') as hdus:
+            assert [ hdu.name for hdu in hdus ] == [ 'PRIMARY', 'SCI', 'ERR' ]
+            assert np.array_equal(hdus['SCI'].data, fits.getdata(tmp_path / 'co0.fits'))
+            assert (hdus['ERR'].data == 1).all()
+
+
+    def test_make_binned_image(self, app, tmp_path):
+        """ Bin an entire image from the test resources directory. """
+        bin_filename = self.imgr.make_binned_image(self.m13_tstfyl, { 'max_pixels': 100 },
+                                                   co_dir=str(tmp_path))
+        assert os.path.exists(tmp_path / bin_filename)
+        with fits.open(tmp_path / bin_filename) as hdus:
+            assert hdus[0].data.shape == (100, 100)
+            assert hdus[0].header['CO_BIN'] == 3
+        again = self.imgr.make_binned_image(self.m13_tstfyl, { 'max_pixels': 100 },
+                                            co_dir=str(tmp_path))
+        assert again == bin_filename
+
+
+    def test_make_binned_image_errors(self, app, tmp_path):
+        with pytest.raises(ImageNotFound, match="Specified image file"):
+            self.imgr.make_binned_image('/no/such/image.fits', { 'factor': 2 }, co_dir=str(tmp_path))
+        with pytest.raises(NotYetImplemented):
+            self.imgr.make_binned_image(self.irods_path, { 'factor': 2 }, co_dir=str(tmp_path))
+
+
+    def gzip_m13(self, tmp_path):
+        gz_filepath = str(tmp_path / 'm13.fits.gz')
+        with open(self.m13_tstfyl, 'rb') as src, gzip.open(gz_filepath, 'wb') as dest:
+            dest.write(src.read())
+        return gz_filepath
+
+
+    def dc_imgr(self, tmp_path):
+        """ Return an image manager whose decompressed images cache is under the given path. """
+        dc_dir = tmp_path / 'decompressed'
+        dc_dir.mkdir()
+        return ImageManager({ **self.test_args, 'list_cache_notify_channel': None,
+                              'decompressed_cache_dir': str(dc_dir) })
+
+
+    def test_mappable_image_path(self, app, tmp_path):
+        """ A gzipped image is decompressed once into the decompressed images cache. """
+        imgr = self.dc_imgr(tmp_path)
+        assert imgr.mappable_image_path(self.m13_tstfyl) == self.m13_tstfyl
+        gz_filepath = self.gzip_m13(tmp_path)
+        dc_filepath = imgr.mappable_image_path(gz_filepath)
+        assert os.path.dirname(dc_filepath) == str(tmp_path / 'decompressed')
+        with open(dc_filepath, 'rb') as dc, open(self.m13_tstfyl, 'rb') as orig:
+            assert dc.read() == orig.read()
+        mtime_ns = os.stat(dc_filepath).st_mtime_ns
+        assert imgr.mappable_image_path(gz_filepath) == dc_filepath
+        assert os.stat(dc_filepath).st_mtime_ns == mtime_ns         # not decompressed again
+        assert imgr.cutout_cache_stats()['decompressed']['entries'] == 1
+
+
+    def test_decompressed_cache_dir(self):
+        """ The decompressed images cache defaults to its data directory. """
+        assert self.imgr.dc_cache.cache_dir == DEFAULT_DECOMPRESSED_CACHE_DIR
+
+
+    def test_make_cutout_and_save_gzipped(self, app, tmp_path):
+        """ A cutout of a gzipped image matches the cutout of the uncompressed image. """
+        imgr = self.dc_imgr(tmp_path)
+        gz_filepath = self.gzip_m13(tmp_path)
+        with app.test_request_context('/'):
+            imgr.make_cutout_and_save(self.m13_tstfyl, self.m13_co_args, 'co.fits',
+                                      co_dir=str(tmp_path))
+            imgr.make_cutout_and_save(gz_filepath, self.m13_co_args, 'cogz.fits',
+                                      co_dir=str(tmp_path))
+        assert np.array_equal(fits.getdata(tmp_path / 'cogz.fits'), fits.getdata(tmp_path / 'co.fits'))
+        assert imgr.cutout_cache_stats()['decompressed']['entries'] == 1
+
+
+    def test_write_cutout_no_overwrite(self, tmp_path):
+        hdu = fits.PrimaryHDU(data=[[1, 2], [3, 4]])
+        self.imgr.write_cutout(hdu, 'co.fits', co_dir=str(tmp_path))
+        with pytest.raises(FileExistsError):
+            self.imgr.write_cutout(hdu, 'co.fits', co_dir=str(tmp_path), overwrite=False)
+
+
+    def test_write_cutout_error(self, tmp_path):
+        """ A failed write leaves no temporary file behind. """
+        def failing_writeto(filepath, overwrite=False):
+            with open(filepath, 'wb') as fyl:
+                fyl.write(b'partial')
+            raise OSError('disk full')
+        hdu = fits.PrimaryHDU(data=[[1, 2], [3, 4]])
+        hdu.writeto = failing_writeto
+        with pytest.raises(OSError, match='disk full'):
+            self.imgr.write_cutout(hdu, 'co.fits', co_dir=str(tmp_path))
+        assert os.listdir(tmp_path) == []
+
+
     def test_make_cutout_and_save_write_error(self, app):
         with app.test_request_context('/'):
             with pytest.raises(ServerError, match=self.write_co_emsg) as srverr:
@@ -434,24 +919,31 @@ class TestImageManager(object):
         fname = self.imgr.make_cutout_filename(self.m13_path, tst_args)
         print(fname)
         assert fname is not None
-        assert fname == '_m13__250.4226_36.4602_2.4arcmin.fits'
+        assert fname.endswith('.fits')
+        assert len(fname) == len('.fits') + 32
+        assert fname == self.imgr.make_cutout_filename(self.m13_path, tst_args)
 
 
     def test_make_cutout_filename_min2(self):
-        tst_args = { 'ra': '53.157662568', 'dec': '-27.8075199236', 'size': '10', 'units': u.arcsec }
+        """ Equivalent coordinate strings give the same filename. """
+        tst_args = { 'ra': '53.15766', 'dec': '-27.8075199236', 'size': '10', 'units': u.arcsec }
+        tst_args2 = { 'ra': '53.157660', 'dec': '-27.80751992360', 'size': '10.0', 'units': u.arcsec }
         fname = self.imgr.make_cutout_filename(self.jades_path, tst_args)
         print(fname)
-        assert fname is not None
-        assert fname == '_goods_s_F277W_2018_08_29__53.157662568_-27.8075199236_10arcsec.fits'
+        assert fname == self.imgr.make_cutout_filename(self.jades_path, tst_args2)
 
 
     def test_make_cutout_filename_min3(self):
+        """ Equivalent sizes in different units give the same filename. """
         tst_args = { 'ra': '53.155277381023', 'dec': '-27.787295217953',
                     'size': '0.5', 'units': u.deg }
+        tst_args2 = { **tst_args, 'size': '30', 'units': u.arcmin }
+        tst_args3 = { **tst_args, 'size': '1800', 'units': u.arcsec }
         fname = self.imgr.make_cutout_filename(self.dc20_path, tst_args)
         print(fname)
-        assert fname is not None
-        assert fname == '_F356W__53.155277381023_-27.787295217953_0.5deg.fits'
+        assert fname == self.imgr.make_cutout_filename(self.dc20_path, tst_args2)
+        assert fname == self.imgr.make_cutout_filename(self.dc20_path, tst_args3)
+        assert fname != self.imgr.make_cutout_filename(self.dc19_path, tst_args)
 
 
     def test_make_cutout_filename_coll(self):
@@ -459,7 +951,7 @@ class TestImageManager(object):
         fname = self.imgr.make_cutout_filename(self.m13_path, tst_args, collection='JADES')
         print(fname)
         assert fname is not None
-        assert fname == 'JADES__m13__250.4226_36.4602_2.4arcmin.fits'
+        assert fname != self.imgr.make_cutout_filename(self.m13_path, tst_args)
 
 
     def test_make_cutout_filename_filt(self):
@@ -467,7 +959,8 @@ class TestImageManager(object):
         fname = self.imgr.make_cutout_filename(self.m13_path, tst_args, filt='AFILT')
         print(fname)
         assert fname is not None
-        assert fname == 'AFILT__m13__250.4226_36.4602_2.4arcmin.fits'
+        assert fname != self.imgr.make_cutout_filename(self.m13_path, tst_args)
+        assert fname != self.imgr.make_cutout_filename(self.m13_path, tst_args, collection='AFILT')
 
 
     def test_make_cutout_filename_collNfilt(self):
@@ -475,7 +968,20 @@ class TestImageManager(object):
         fname = self.imgr.make_cutout_filename(self.m13_path, tst_args, filt='AFILT', collection='JADES')
         print(fname)
         assert fname is not None
-        assert fname == 'JADES_AFILT__m13__250.4226_36.4602_2.4arcmin.fits'
+        assert fname != self.imgr.make_cutout_filename(self.m13_path, tst_args, filt='AFILT')
+        assert fname != self.imgr.make_cutout_filename(self.m13_path, tst_args, collection='JADES')
+
+
+    def test_make_cutout_params(self):
+        tst_args = { 'ra': '250.4226', 'dec': '36.4602', 'size': '2.4', 'units': u.arcmin }
+        params = self.imgr.make_cutout_params(self.m13_path, tst_args, filt='AFILT', collection='JADES')
+        assert params['ra'] == 250.4226
+        assert params['dec'] == 36.4602
+        assert params['size_deg'] == 0.04
+        assert params['collection'] == 'JADES'
+        assert params['filter'] == 'AFILT'
+        assert params['image']['path'] == self.m13_path
+        assert params['quantum_deg'] is None
 
 
 
@@ -485,6 +991,38 @@ class TestImageManager(object):
         assert lst is not None
         assert lst == []
 
+    def test_query_cones_errors(self):
+        """ Positions with errors are passed through without querying. """
+        co_args = parse_cutout_args({'ra': '0', 'dec': '0', 'sizeArcSec': '30'})
+        posns = [ {'row': 0, 'error': 'bad'}, {'row': 1, 'error': 'worse'} ]
+        res = list(self.imgr.query_cones(iter(posns), co_args))
+        assert res == posns
+
+
+    def test_query_cones(self):
+        co_args = parse_cutout_args({'ra': '0', 'dec': '0', 'sizeArcSec': '90'})
+        posns = [ {'row': 0, 'ra': 53.157662568, 'dec': -27.8075199236},
+                  {'row': 1, 'error': 'bad'},
+                  {'row': 2, 'ra': 102.0, 'dec': 10.2} ]
+        res = list(self.imgr.query_cones(iter(posns), co_args, collection='DC20', chunk_size=2))
+        assert len(res) == 3
+        assert len(res[0]['ids']) == self.dc20_size
+        assert 'error' in res[1]
+        assert res[2]['ids'] == []
+
+
+    def test_query_cones_select(self):
+        co_args = parse_cutout_args({'ra': '0', 'dec': '0', 'sizeArcSec': '90'})
+        posns = [ {'row': 0, 'ra': 53.157662568, 'dec': -27.8075199236},
+                  {'row': 1, 'ra': 102.0, 'dec': 10.2} ]
+        res = list(self.imgr.query_cones(iter(posns), co_args, collection='DC20',
+                                         select=['id', 'file_path', 'im_ra1']))
+        assert len(res[0]['matches']) == self.dc20_size
+        assert set(res[0]['matches'][0]) == { 'id', 'file_path', 'im_ra1' }
+        assert 'ids' not in res[0]
+        assert res[1]['matches'] == []
+
+
     def test_query_cone_badcoll(self):
         """ Center point, no filter, bad collection. """
         tst_args = { 'ra': '53.157662568', 'dec': '-27.8075199236', 'size': '0.0002777' }
@@ -633,6 +1171,29 @@ class TestImageManager(object):
 
 
 
+    def test_return_image_at_filepath_range(self, app):
+        """ Read just the primary header of an image with a range request. """
+        with app.test_request_context('/', headers={'Range': 'bytes=0-2879'}):
+            img = self.imgr.return_image_at_filepath(self.m13_tstfyl)
+            img.direct_passthrough = False
+            assert img.status_code == 206
+            assert img.headers.get('Accept-Ranges') == 'bytes'
+            assert len(img.get_data()) == 2880
+            assert img.get_data().startswith(b'SIMPLE  =')
+
+
+    def test_return_image_at_filepath_conditional(self, app):
+        with app.test_request_context('/'):
+            img = self.imgr.return_image_at_filepath(self.m13_tstfyl)
+            etag = img.headers.get('ETag')
+            last_modified = img.headers.get('Last-Modified')
+            assert etag and last_modified
+        with app.test_request_context('/', headers={'If-None-Match': etag}):
+            assert self.imgr.return_image_at_filepath(self.m13_tstfyl).status_code == 304
+        with app.test_request_context('/', headers={'If-None-Match': '"stale"'}):
+            assert self.imgr.return_image_at_filepath(self.m13_tstfyl).status_code == 200
+
+
     def test_return_image_at_path_irods(self):
         """ iRods connections are not yet implemented. """
         with pytest.raises(NotYetImplemented, match=self.retimg_emsg) as nyi:
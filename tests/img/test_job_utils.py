@@ -0,0 +1,73 @@
+# Tests for the cutout job utilities module.
+#   Last Modified: Initial creation.
+#
+import pytest
+
+import cuts.blueprints.img.job_utils as ju
+from cuts.blueprints.img.exceptions import RequestException
+
+
+class TestJobUtils(object):
+
+    job_id = '0b0e8a34-9d5e-4a47-8f53-2f0b6c1d8e10'
+    job_url = f"http://localhost.localdomain:8000/co/jobs/{job_id}"
+    error = { 'error_code': 404, 'message': 'No matching image' }
+
+
+    def test_setup_app (self, app):
+        " Create an instance of the app: should be executed only once by conftest.py. "
+        assert app is not None
+
+
+    def test_parse_job_id(self, app):
+        assert ju.parse_job_id(self.job_id) == self.job_id
+        assert ju.parse_job_id(self.job_id.upper()) == self.job_id
+
+
+    def test_parse_job_id_bad(self, app):
+        for bad in [ None, '', 'nosuchjob', '../../etc/passwd', self.job_id[:-1] ]:
+            with pytest.raises(RequestException, match='A valid cutout job ID must be specified'):
+                ju.parse_job_id(bad)
+
+
+    def test_job_error(self, app):
+        assert ju.job_error('PENDING', None) is None
+        assert ju.job_error('SUCCESS', { 'filename': 'co.fits' }) is None
+        assert ju.job_error('SUCCESS', { 'error': self.error }) == self.error
+        err = ju.job_error('FAILURE', ValueError('boom'))
+        assert err['error_code'] == 500
+        assert 'failed unexpectedly' in err['message']
+        assert ju.job_error('REVOKED', None)['error_code'] == 500
+
+
+    def test_job_status_queued(self, app):
+        with app.test_request_context('/'):
+            for state in [ 'PENDING', 'RECEIVED', 'RETRY', 'UNKNOWN' ]:
+                job = ju.job_status(self.job_id, state)
+                assert job == { 'job_id': self.job_id, 'status': ju.JOB_QUEUED,
+                                'status_url': self.job_url }
+
+
+    def test_job_status_running(self, app):
+        with app.test_request_context('/'):
+            assert ju.job_status(self.job_id, 'STARTED')['status'] == ju.JOB_RUNNING
+
+
+    def test_job_status_done(self, app):
+        with app.test_request_context('/'):
+            job = ju.job_status(self.job_id, 'SUCCESS', { 'filename': 'co.fits' })
+            assert job['status'] == ju.JOB_DONE
+            assert job['filename'] == 'co.fits'
+            assert job['result_url'] == f"{self.job_url}/result"
+            assert 'error' not in job
+
+
+    def test_job_status_failed(self, app):
+        with app.test_request_context('/'):
+            job = ju.job_status(self.job_id, 'SUCCESS', { 'error': self.error })
+            assert job['status'] == ju.JOB_FAILED
+            assert job['error'] == self.error
+            assert 'result_url' not in job
+            job = ju.job_status(self.job_id, 'FAILURE', RuntimeError('worker died'))
+            assert job['status'] == ju.JOB_FAILED
+            assert job['error']['error_code'] == 500
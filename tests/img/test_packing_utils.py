@@ -0,0 +1,98 @@
+#
+# Tests for the cutout data type conversion module.
+#   Last Modified: Initial creation.
+#
+import numpy as np
+import pytest
+
+from astropy.io import fits
+
+import cuts.blueprints.img.packing_utils as pu
+
+
+class TestPackingUtils(object):
+
+    def float_data(self):
+        data = np.random.default_rng(21).normal(1000.0, 50.0, (32, 32))
+        data[3, 4] = np.nan
+        data[5, 6] = np.inf
+        return data
+
+
+    def test_int16_scaling(self):
+        data = np.array([-10.0, 0.0, 55.5])
+        (bscale, bzero) = pu.int16_scaling(data, np.isfinite(data))
+        assert bzero + bscale * pu.INT16_MIN == pytest.approx(-10.0)
+        assert bzero + bscale * pu.INT16_MAX == pytest.approx(55.5)
+
+
+    def test_int16_scaling_special(self):
+        ints = np.array([-300, 0, 2000], dtype=np.int32)
+        assert pu.int16_scaling(ints, np.isfinite(ints)) == (1.0, 0.0)
+        const = np.full(4, 7.5)
+        assert pu.int16_scaling(const, np.isfinite(const)) == (1.0, 7.5)
+        blank = np.full(4, np.nan)
+        assert pu.int16_scaling(blank, np.isfinite(blank)) == (1.0, 0.0)
+
+
+    def test_pack_int16(self):
+        data = self.float_data()
+        (stored, bscale, bzero) = pu.pack_int16(data)
+        assert stored.dtype == np.int16
+        assert stored[3, 4] == pu.INT16_BLANK
+        assert stored[5, 6] == pu.INT16_BLANK
+        finite = np.isfinite(data)
+        unpacked = bzero + bscale * stored.astype(np.float64)
+        assert np.max(np.abs(unpacked - data)[finite]) <= (bscale / 2.0) * 1.0001
+        assert stored[finite].min() == pu.INT16_MIN
+        assert stored[finite].max() == pu.INT16_MAX
+
+
+    def test_convert_hdu_int16(self, tmp_path):
+        data = self.float_data()
+        hdu = fits.PrimaryHDU(data=data)
+        hdu.header['CHECKSUM'] = 'stale'
+        co_filepath = str(tmp_path / 'co.i16.dat')
+        pu.convert_hdu(hdu, 'int16').writeto(co_filepath)
+        with fits.open(co_filepath) as hdus:
+            header = hdus[0].header
+            assert header['BITPIX'] == 16
+            assert header['BLANK'] == pu.INT16_BLANK
+            assert header['CO_ODTYP'] == 'float64'
+            assert 'CHECKSUM' not in header
+            assert np.isnan(hdus[0].data[3, 4])
+            assert np.isnan(hdus[0].data[5, 6])
+            finite = np.isfinite(data)
+            assert np.allclose(hdus[0].data[finite], data[finite], atol=header['CO_QSTEP'])
+        with fits.open(co_filepath, do_not_scale_image_data=True) as hdus:
+            assert hdus[0].data.dtype.kind == 'i'
+            assert hdus[0].header['BSCALE'] == pytest.approx(hdus[0].header['CO_QSTEP'])
+
+
+    def test_convert_hdu_int16_unscaled(self):
+        data = np.arange(-50, 50, dtype=np.int32).reshape(10, 10)
+        out = pu.convert_hdu(fits.PrimaryHDU(data=data), 'int16')
+        assert out.header['BSCALE'] == 1.0
+        assert out.header['BZERO'] == 0.0
+        assert np.array_equal(out.data, data)
+
+
+    def test_convert_hdu_float32(self, tmp_path):
+        data = self.float_data()
+        co_filepath = str(tmp_path / 'co.f32.dat')
+        pu.convert_hdu(fits.PrimaryHDU(data=data), 'float32').writeto(co_filepath)
+        with fits.open(co_filepath) as hdus:
+            assert hdus[0].header['BITPIX'] == -32
+            assert hdus[0].header['CO_ODTYP'] == 'float64'
+            assert hdus[0].header['CO_PREC'] > 0
+            assert np.allclose(hdus[0].data, data, rtol=1e-6, equal_nan=True)
+
+
+    def test_unscaled_blanks(self):
+        data = np.array([[1, -99], [3, 4]], dtype=np.int16)
+        hdu = fits.PrimaryHDU(data=data)
+        hdu.header['BLANK'] = -99
+        unscaled = pu.unscaled_blanks(hdu)
+        assert np.isnan(unscaled[0, 1])
+        assert unscaled[1, 1] == 4
+        assert pu.unscaled_blanks(fits.PrimaryHDU(data=data)) is not None
@@ -0,0 +1,123 @@
+# Tests for the PostgreSQL connection pool class.
+#   Last Modified: Add tests of the gevent wait callback and the debug flag.
+#
+import os
+import pytest
+
+import psycopg2.extensions
+
+from cuts.blueprints.img.exceptions import ServerError
+from cuts.blueprints.img.pg_pool import PostgreSQLPool, install_wait_callback
+from cuts.blueprints.img.pg_sql_base import PostgreSQLBase
+from tests import TEST_DBCONFIG_FILEPATH
+
+
+class TestPostgreSQLPool(object):
+
+    dbconfig = PostgreSQLBase.load_sql_db_config(TEST_DBCONFIG_FILEPATH)
+    db_uri = dbconfig.get('db_uri')
+
+    no_conn_emsg = "No database connection became available within .* seconds"
+    bad_param_emsg = "Invalid database connection pool parameter"
+
+
+    def test_pool_args_from_config(self):
+        pargs = PostgreSQLPool.pool_args_from_config(self.dbconfig)
+        assert pargs is not None
+        assert pargs.get('max_active') == 10
+        assert pargs.get('max_idle') == 10
+        assert pargs.get('max_lifetime') == 3600
+        assert pargs.get('max_uses') == 1000
+        assert pargs.get('max_wait') == 30
+        assert pargs.get('validation_interval') == 30
+        assert pargs.get('validation_query') == 'SELECT 1'
+        assert pargs.get('validation_query_timeout') == 2
+
+
+    def test_pool_args_from_config_defaults(self):
+        pargs = PostgreSQLPool.pool_args_from_config({'db_max_active': '4'})
+        assert pargs.get('max_active') == 4
+        assert pargs.get('max_idle') == 4    # defaults to the pool size
+        assert pargs.get('validation_query') == 'SELECT 1'
+
+
+    def test_pool_args_from_config_bad(self):
+        with pytest.raises(ServerError, match=self.bad_param_emsg):
+            PostgreSQLPool.pool_args_from_config({'db_max_active': 'many'})
+
+
+    def test_get_pool(self):
+        pool = PostgreSQLPool.get_pool(self.db_uri, self.dbconfig)
+        assert pool is not None
+        assert pool.db_uri == self.db_uri
+        assert PostgreSQLPool.get_pool(self.db_uri, self.dbconfig) is pool  # one per process
+
+
+    def test_get_pool_debug(self):
+        PostgreSQLPool._pools_pid = None    # start a new registry
+        pool = PostgreSQLPool.get_pool(self.db_uri, self.dbconfig, debug=True)
+        assert pool._DEBUG is True
+        assert PostgreSQLPool(self.db_uri)._DEBUG is False
+
+
+    def test_install_wait_callback_unpatched(self):
+        """ Without gevent monkey patching, queries block as usual: no callback is installed. """
+        assert install_wait_callback() is False
+        assert psycopg2.extensions.get_wait_callback() is None
+
+
+    def test_get_pool_after_fork(self):
+        pool = PostgreSQLPool.get_pool(self.db_uri, self.dbconfig)
+        PostgreSQLPool._pools_pid = os.getpid() + 1    # pretend registry belongs to a parent
+        pool2 = PostgreSQLPool.get_pool(self.db_uri, self.dbconfig)
+        assert pool2 is not pool
+
+
+    def test_stats_new(self):
+        pool = PostgreSQLPool(self.db_uri)
+        stats = pool.stats()
+        assert stats is not None
+        assert stats.get('pid') == os.getpid()
+        assert stats.get('max_active') == 10
+        assert stats.get('in_use') == 0
+        assert stats.get('idle') == 0
+        assert stats.get('opened') == 0
+        assert stats.get('waits') == 0
+        assert stats.get('wait_time_avg') == 0.0
+
+
+    def test_acquire_timeout(self):
+        """ A full pool times out waiting for a connection. """
+        pool = PostgreSQLPool(self.db_uri, max_active=0, max_wait=0.05)
+        with pytest.raises(ServerError, match=self.no_conn_emsg):
+            pool.acquire()
+        stats = pool.stats()
+        assert stats.get('waits') == 1
+        assert stats.get('timeouts') == 1
+        assert stats.get('wait_time_max') >= 0.05
+
+
+    def test_connection_reused(self):
+        pool = PostgreSQLPool(self.db_uri)
+        for idx in range(3):
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+        stats = pool.stats()
+        assert stats.get('opened') == 1
+        assert stats.get('checkouts') == 3
+        assert stats.get('in_use') == 0
+        assert stats.get('idle') == 1
+        pool.close_all()
+        assert pool.stats().get('idle') == 0
+
+
+    def test_connection_recycled(self):
+        pool = PostgreSQLPool(self.db_uri, max_uses=1)
+        for idx in range(2):
+            with pool.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+        stats = pool.stats()
+        assert stats.get('opened') == 2
+        assert stats.get('closed') == 2
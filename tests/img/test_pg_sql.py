@@ -1,6 +1,6 @@
 # Tests for the PostgreSQL manager class.
 #   Written by: Tom Hicks. 1/13/2021.
-#   Last Modified: Comment out test to list catalog tables in TAP schema. Update number of tables.
+#   Last Modified: Test the metadata selected by a cone search for many positions.
 #
 import pytest
 
@@ -147,6 +147,23 @@ class TestPostgreSQLManager(object):
 
 
 
+    def test_image_metadata_by_ids(self):
+        """ Some good and some bad IDs. """
+        res = self.pgmgr.image_metadata_by_ids([3, 1, 9999])
+        print(res)
+        assert res is not None
+        assert len(res) == 2
+        assert [rec.get('id') for rec in res] == [1, 3]
+
+
+    def test_image_metadata_by_ids_select(self):
+        """ The ID field is always selected. """
+        res = self.pgmgr.image_metadata_by_ids([1, 2], select=['file_name'])
+        print(res)
+        assert len(res) == 2
+        assert set(res[0].keys()) == {'id', 'file_name'}
+
+
     def test_image_metadata_by_query_badcoll(self):
         """ No image with given collection. """
         res = self.pgmgr.image_metadata_by_query(collection='BADcoll')
@@ -201,6 +218,28 @@ class TestPostgreSQLManager(object):
         assert len(res) == 0
 
 
+    def test_image_metadata_by_query_stream(self):
+        """ Good collection, streamed from a server-side cursor. """
+        res = self.pgmgr.image_metadata_by_query(collection='DC20', stream=True)
+        assert res is not None
+        assert not isinstance(res, list)
+        recs = list(res)
+        print(recs)
+        assert len(recs) == self.dc20_size
+        assert recs == self.pgmgr.image_metadata_by_query(collection='DC20')
+
+
+    def test_image_metadata_by_query_paged(self):
+        """ Good collection, read in keyset pages. """
+        allrecs = self.pgmgr.image_metadata_by_query(collection='DC20')
+        page1 = self.pgmgr.image_metadata_by_query(collection='DC20', limit=4)
+        assert len(page1) == 4
+        assert page1 == allrecs[:4]
+        page2 = self.pgmgr.image_metadata_by_query(collection='DC20', limit=4,
+                                                   after_id=page1[-1].get('id'))
+        assert page2 == allrecs[4:8]
+
+
     def test_image_metadata_by_query_goodboth(self):
         """ Good filter, good collection. """
         res = self.pgmgr.image_metadata_by_query(filt='F444W', collection='DC20')
@@ -330,6 +369,27 @@ class TestPostgreSQLManager(object):
         assert len(lst) == self.jades_size + self.dc19_size + self.dc20_size
 
 
+    def test_query_cones(self):
+        """ Many positions in one query: matches agree with single cone searches. """
+        posns = [ (0, 53.157662568, -27.8075199236), (1, 102.0, 10.2),
+                  (2, 53.157662568, -27.8075199236) ]
+        matches = self.pgmgr.query_cones(posns, 0.025, select=['id', 'file_path'])
+        print(matches)
+        assert matches is not None
+        assert 1 not in matches
+        single = [ md['id'] for md in self.pgmgr.query_cone(53.157662568, -27.8075199236, 0.025) ]
+        assert [ md['id'] for md in matches[0] ] == single
+        assert [ md['id'] for md in matches[2] ] == single
+        assert all(set(md) == { 'id', 'file_path' } for md in matches[0])
+
+
+    def test_query_cones_coll(self):
+        posns = [ (5, 53.157662568, -27.8075199236) ]
+        matches = self.pgmgr.query_cones(posns, 0.025, collection='DC20')
+        assert len(matches[5]) == self.dc20_size
+        assert self.pgmgr.query_cones(posns, 0.025, collection='BADcoll') == {}
+
+
     def test_query_cone_badcoll(self):
         """ Center point, no filter, bad collection. """
         lst = self.pgmgr.query_cone(53.157662568, -27.8075199236, 0.00027777, collection='BADcoll')
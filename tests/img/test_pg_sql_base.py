@@ -1,6 +1,6 @@
 # Tests for the PostgreSQL base class.
 #   Written by: Tom Hicks. 1/13/2021.
-#   Last Modified: Update tests to not use jtest table.
+#   Last Modified: Add tests for keyset paging.
 #
 import pytest
 
@@ -130,6 +130,52 @@ class TestPostgreSQLBase(object):
         assert rows[0].get('obs_creator_name') == 'JWST'
 
 
+    def test_pool(self):
+        pool = self.base.pool
+        assert pool is not None
+        assert pool.db_uri == self.base.db_uri
+        assert self.base.pool is pool           # shared by all users in this process
+
+
+    def test_pool_stats(self):
+        stats = self.base.pool_stats()
+        assert stats is not None
+        assert 'in_use' in stats
+        assert 'idle' in stats
+        assert 'wait_time_total' in stats
+        assert stats.get('max_active') == 10
+
+
+
+    def test_sql4_keyset_paging_none(self):
+        qargs = ['A']
+        sql = self.base.sql4_keyset_paging('SELECT * FROM t WHERE c = (%s)', qargs, True)
+        assert sql == 'SELECT * FROM t WHERE c = (%s) ORDER BY id;'
+        assert qargs == ['A']
+
+
+    def test_sql4_keyset_paging_nowhere(self):
+        qargs = []
+        sql = self.base.sql4_keyset_paging('SELECT * FROM t', qargs, False, after_id=9, limit=5)
+        assert sql == 'SELECT * FROM t WHERE id > (%s) ORDER BY id LIMIT (%s);'
+        assert qargs == [9, 5]
+
+
+    def test_sql4_keyset_paging_where(self):
+        qargs = ['A']
+        sql = self.base.sql4_keyset_paging('SELECT * FROM t WHERE c = (%s)', qargs, True,
+                                           after_id=0)
+        assert sql == 'SELECT * FROM t WHERE c = (%s) AND id > (%s) ORDER BY id;'
+        assert qargs == ['A', 0]
+
+
+    def test_sql4_keyset_paging_limit(self):
+        qargs = []
+        sql = self.base.sql4_keyset_paging('SELECT * FROM t', qargs, False, limit=10, key='k;x')
+        assert sql == 'SELECT * FROM t ORDER BY kx LIMIT (%s);'
+        assert qargs == [10]
+
+
     def test_sql4_selected_fields(self):
         assert self.base.sql4_selected_fields() == '*'
         assert self.base.sql4_selected_fields([]) == ''
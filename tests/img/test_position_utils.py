@@ -0,0 +1,173 @@
+# Tests for the position list utilities module.
+#   Last Modified: Add tests of optional position sizes.
+#
+import io
+import pytest
+
+from werkzeug.datastructures import FileStorage, MultiDict
+
+from astropy.io import fits
+from astropy.table import Table
+
+import cuts.blueprints.img.position_utils as putils
+from cuts.blueprints.img.exceptions import RequestException
+from tests import TEST_RESOURCES_DIR
+
+
+class TestPositionUtils(object):
+
+    cols_emsg = "The uploaded table must contain RA and DEC columns"
+    fits_emsg = "The uploaded file could not be read as a FITS file"
+    nopos_emsg = "A list of positions must be specified"
+    notab_emsg = "The uploaded FITS file does not contain a table"
+    poslist_emsg = "The 'positions' argument must be a list"
+
+    csv_data = b"id,RA,Dec\n1,53.16,-27.78\n2,bad,-27.79\n3,53.18,-27.80\n"
+
+
+    def fits_table_bytes(self, nrows=5, ra_name='ra', dec_name='dec'):
+        tbl = Table({ ra_name: [53.0 + idx for idx in range(nrows)],
+                      dec_name: [-27.0 - idx for idx in range(nrows)] })
+        buf = io.BytesIO()
+        tbl.write(buf, format='fits')
+        buf.seek(0)
+        return buf
+
+
+    def test_setup_app (self, app):
+        " Create an instance of the app: should be executed only once by conftest.py. "
+        assert app is not None
+
+
+    def test_find_column(self):
+        assert putils.find_column(['ID', 'RA', 'DEC'], putils.RA_COLUMN_NAMES) == 'RA'
+        assert putils.find_column(['s_ra', 's_dec'], putils.DEC_COLUMN_NAMES) == 's_dec'
+        assert putils.find_column(['x', 'y'], putils.RA_COLUMN_NAMES) is None
+        assert putils.find_column([], putils.RA_COLUMN_NAMES) is None
+
+
+    def test_gen_chunks(self):
+        assert list(putils.gen_chunks([], 2)) == []
+        assert list(putils.gen_chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+        assert list(putils.gen_chunks(iter(range(4)), 2)) == [[0, 1], [2, 3]]
+
+
+    def test_make_position(self):
+        assert putils.make_position(3, '53.5', -27) == { 'row': 3, 'ra': 53.5, 'dec': -27.0 }
+        assert putils.make_position(0, -10, 0)['ra'] == 350.0
+        assert 'error' in putils.make_position(1, 'abc', 10)
+        assert 'error' in putils.make_position(1, None, 10)
+        assert 'error' in putils.make_position(1, 10, 91)
+        assert 'error' in putils.make_position(1, float('nan'), 10)
+
+
+    def test_make_position_size(self):
+        assert putils.make_position(3, 53.5, -27, '10') == { 'row': 3, 'ra': 53.5, 'dec': -27.0, 'size': 10.0 }
+        assert putils.make_position(3, 53.5, -27, '') == { 'row': 3, 'ra': 53.5, 'dec': -27.0 }
+        assert putils.make_position(3, 53.5, -27, float('nan')) == { 'row': 3, 'ra': 53.5, 'dec': -27.0 }
+        assert 'error' in putils.make_position(3, 53.5, -27, 0)
+        assert 'error' in putils.make_position(3, 53.5, -27, -5)
+        assert 'error' in putils.make_position(3, 53.5, -27, 'big')
+        assert 'error' in putils.make_position(3, 53.5, -27, float('inf'))
+
+
+    def test_gen_positions_from_list_sizes(self):
+        posns = list(putils.gen_positions_from_list([[1, 2, 30], {'ra': 3, 'dec': 4, 'size': 5}, [5, 6]]))
+        assert posns[0] == { 'row': 0, 'ra': 1.0, 'dec': 2.0, 'size': 30.0 }
+        assert posns[1] == { 'row': 1, 'ra': 3.0, 'dec': 4.0, 'size': 5.0 }
+        assert posns[2] == { 'row': 2, 'ra': 5.0, 'dec': 6.0 }
+
+
+    def test_gen_positions_from_csv_sizes(self, app):
+        data = b"ra,dec,Size\n53.16,-27.78,12\n53.17,-27.79,\n53.18,-27.80,-1\n"
+        posns = list(putils.gen_positions_from_csv(io.BytesIO(data)))
+        assert len(posns) == 3
+        assert posns[0]['size'] == 12.0
+        assert 'size' not in posns[1] and 'error' not in posns[1]
+        assert 'error' in posns[2]
+
+
+    def test_gen_positions_from_fits_sizes(self, app):
+        tbl = Table({ 'ra': [53.0, 54.0], 'dec': [-27.0, -28.0], 'size': [20.0, float('nan')] })
+        buf = io.BytesIO()
+        tbl.write(buf, format='fits')
+        buf.seek(0)
+        posns = list(putils.gen_positions_from_fits(buf))
+        assert posns[0] == { 'row': 0, 'ra': 53.0, 'dec': -27.0, 'size': 20.0 }
+        assert posns[1] == { 'row': 1, 'ra': 54.0, 'dec': -28.0 }
+
+
+    def test_gen_positions_from_list(self):
+        posns = list(putils.gen_positions_from_list([[1, 2], {'ra': 3, 'dec': 4},
+                                                     {'s_ra': 5, 's_dec': 6}, [7], 'x']))
+        assert len(posns) == 5
+        assert posns[0] == { 'row': 0, 'ra': 1.0, 'dec': 2.0 }
+        assert posns[1] == { 'row': 1, 'ra': 3.0, 'dec': 4.0 }
+        assert posns[2] == { 'row': 2, 'ra': 5.0, 'dec': 6.0 }
+        assert posns[3]['row'] == 3 and 'error' in posns[3]
+        assert posns[4]['row'] == 4 and 'error' in posns[4]
+
+
+    def test_gen_positions_from_csv(self, app):
+        posns = list(putils.gen_positions_from_csv(io.BytesIO(self.csv_data)))
+        assert len(posns) == 3
+        assert posns[0] == { 'row': 0, 'ra': 53.16, 'dec': -27.78 }
+        assert 'error' in posns[1]
+        assert posns[2] == { 'row': 2, 'ra': 53.18, 'dec': -27.80 }
+
+
+    def test_gen_positions_from_csv_nocols(self, app):
+        with pytest.raises(RequestException, match=self.cols_emsg):
+            putils.gen_positions_from_csv(io.BytesIO(b"x,y\n1,2\n"))
+
+
+    def test_gen_positions_from_fits(self, app):
+        posns = list(putils.gen_positions_from_fits(self.fits_table_bytes(5), chunk_size=2))
+        assert len(posns) == 5
+        assert [pos['row'] for pos in posns] == [0, 1, 2, 3, 4]
+        assert posns[4] == { 'row': 4, 'ra': 57.0, 'dec': -31.0 }
+
+
+    def test_gen_positions_from_fits_nocols(self, app):
+        with pytest.raises(RequestException, match=self.cols_emsg):
+            putils.gen_positions_from_fits(self.fits_table_bytes(2, ra_name='x', dec_name='y'))
+
+
+    def test_gen_positions_from_fits_image(self, app):
+        with open(f"{TEST_RESOURCES_DIR}/m13.fits", 'rb') as m13:
+            with pytest.raises(RequestException, match=self.notab_emsg):
+                putils.gen_positions_from_fits(m13)
+
+
+    def test_gen_positions_from_fits_notfits(self, app):
+        with pytest.raises(RequestException, match=self.fits_emsg):
+            putils.gen_positions_from_fits(io.BytesIO(self.csv_data))
+
+
+    def test_gen_positions_none(self, app):
+        with pytest.raises(RequestException, match=self.nopos_emsg):
+            putils.gen_positions({})
+        with pytest.raises(RequestException, match=self.nopos_emsg):
+            putils.gen_positions({'positions': []}, MultiDict())
+
+
+    def test_gen_positions_notlist(self, app):
+        with pytest.raises(RequestException, match=self.poslist_emsg):
+            putils.gen_positions({'positions': '1,2'})
+
+
+    def test_gen_positions_list(self, app):
+        posns = list(putils.gen_positions({'positions': [[1, 2], [3, 4]]}))
+        assert [pos['ra'] for pos in posns] == [1.0, 3.0]
+
+
+    def test_gen_positions_csv_file(self, app):
+        upload = FileStorage(io.BytesIO(self.csv_data), filename='cat.csv')
+        posns = list(putils.gen_positions({}, MultiDict({'file': upload})))
+        assert len(posns) == 3
+
+
+    def test_gen_positions_fits_file(self, app):
+        upload = FileStorage(self.fits_table_bytes(3), filename='cat.fits')
+        posns = list(putils.gen_positions({}, MultiDict({'file': upload})))
+        assert len(posns) == 3
@@ -0,0 +1,99 @@
+#
+# Tests for the preview image rendering module.
+#   Last Modified: Initial creation.
+#
+import io
+
+import numpy as np
+import pytest
+
+import cuts.blueprints.img.preview_utils as pu
+
+
+class TestPreviewUtils(object):
+
+    preview = { 'format': 'png', 'stretch': 'linear', 'min_percent': 0.0,
+                'max_percent': 100.0, 'max_dim': 512 }
+
+
+    def test_downsample_small(self):
+        data = np.arange(12, dtype=np.float32).reshape(3, 4)
+        assert pu.downsample(data, 4) is data
+        assert pu.downsample(data, None) is data
+
+
+    def test_downsample(self):
+        data = np.arange(16, dtype=np.float32).reshape(4, 4)
+        small = pu.downsample(data, 2)
+        assert small.shape == (2, 2)
+        assert np.allclose(small, [[2.5, 4.5], [10.5, 12.5]])
+
+
+    def test_downsample_nan_and_ragged(self):
+        data = np.ones((5, 3), dtype=np.float32)
+        data[0, 0] = np.nan
+        data[1, :] = np.nan
+        small = pu.downsample(data, 3)
+        assert small.shape == (3, 2)
+        assert np.allclose(small, 1.0)          # blank and padding pixels are ignored
+
+        blank = pu.downsample(np.full((4, 4), np.nan, dtype=np.float32), 2)
+        assert np.isnan(blank).all()
+
+
+    def test_render_preview_linear(self):
+        data = np.tile(np.arange(10, dtype=np.float32), (4, 1))
+        pixels = pu.render_preview(data, self.preview)
+        assert pixels.dtype == np.uint8
+        assert pixels.shape == (4, 10)
+        assert pixels[0, 0] == 0
+        assert pixels[0, -1] == 255
+        assert np.all(np.diff(pixels[0].astype(int)) >= 0)
+
+
+    def test_render_preview_flipped(self):
+        data = np.zeros((4, 4), dtype=np.float32)
+        data[0, :] = 1.0                        # first FITS row is the bottom of the image
+        pixels = pu.render_preview(data, self.preview)
+        assert (pixels[-1] == 255).all()
+        assert (pixels[0] == 0).all()
+
+
+    def test_render_preview_stretches(self):
+        data = np.tile(np.linspace(0.0, 100.0, 64, dtype=np.float32), (8, 1))
+        linear = pu.render_preview(data, self.preview)
+        log = pu.render_preview(data, dict(self.preview, stretch='log'))
+        asinh = pu.render_preview(data, dict(self.preview, stretch='asinh'))
+        zscale = pu.render_preview(data, dict(self.preview, stretch='zscale'))
+        mid = data.shape[1] // 4
+        assert log[0, mid] > linear[0, mid]     # log and asinh brighten the faint pixels
+        assert asinh[0, mid] > linear[0, mid]
+        assert zscale.dtype == np.uint8
+
+
+    def test_render_preview_blank(self):
+        data = np.full((6, 6), np.nan, dtype=np.float32)
+        assert (pu.render_preview(data, self.preview) == 0).all()
+        data[2, 2] = 5.0
+        data[3, 3] = 10.0
+        pixels = pu.render_preview(data, self.preview)
+        assert pixels.max() == 255
+        assert np.count_nonzero(pixels) == 1
+
+
+    def test_render_preview_max_dim(self):
+        data = np.random.default_rng(7).normal(0.0, 1.0, (300, 200))
+        pixels = pu.render_preview(data, dict(self.preview, max_dim=100))
+        assert pixels.shape == (100, 67)
+
+
+    def test_encode_preview(self):
+        Image = pytest.importorskip('PIL.Image')
+        pixels = pu.render_preview(np.arange(64, dtype=np.float32).reshape(8, 8), self.preview)
+        png = pu.encode_preview(pixels, 'png')
+        assert png.startswith(b'\x89PNG')
+        with Image.open(io.BytesIO(png)) as img:
+            assert img.size == (8, 8)
+            assert np.array_equal(np.asarray(img), pixels)
+        jpeg = pu.encode_preview(pixels, 'jpeg')
+        assert jpeg.startswith(b'\xff\xd8')
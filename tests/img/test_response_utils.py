@@ -0,0 +1,236 @@
+# Tests for the HTTP response utilities module.
+#   Last Modified: Add tests for delivery of files by a front proxy.
+#
+import json
+import os
+import pytest
+
+import cuts.blueprints.img.response_utils as rutils
+
+
+class TestResponseUtils(object):
+
+    rows = [ {'id': idx, 'filter': f"F{idx}"} for idx in range(1, 8) ]
+
+
+    def test_setup_app (self, app):
+        " Create an instance of the app: should be executed only once by conftest.py. "
+        assert app is not None
+
+
+    def test_gen_json_array_empty(self, app):
+        res = ''.join(rutils.gen_json_array([]))
+        assert res == '[]'
+
+
+    def test_gen_json_array(self, app):
+        chunks = list(rutils.gen_json_array(self.rows, chunk_rows=3))
+        assert len(chunks) == 3
+        assert json.loads(''.join(chunks)) == self.rows
+
+
+    def test_gen_ndjson_empty(self, app):
+        assert list(rutils.gen_ndjson([])) == []
+
+
+    def test_gen_ndjson(self, app):
+        chunks = list(rutils.gen_ndjson(self.rows, chunk_rows=3))
+        assert len(chunks) == 3
+        lines = ''.join(chunks).splitlines()
+        assert len(lines) == len(self.rows)
+        assert [json.loads(line) for line in lines] == self.rows
+
+
+    def test_stream_json_rows(self, app):
+        with app.test_request_context('/'):
+            resp = rutils.stream_json_rows(iter(self.rows))
+            assert resp.status_code == 200
+            assert resp.is_streamed is True
+            assert resp.mimetype == rutils.JSON_MIME_TYPE
+            assert json.loads(resp.get_data()) == self.rows
+
+
+    def test_stream_json_rows_ndjson(self, app):
+        with app.test_request_context('/'):
+            resp = rutils.stream_json_rows(iter(self.rows), fmt='ndjson')
+            assert resp.status_code == 200
+            assert resp.mimetype == rutils.NDJSON_MIME_TYPE
+            lines = resp.get_data(as_text=True).splitlines()
+            assert [json.loads(line) for line in lines] == self.rows
+
+
+    def test_stream_json_rows_error(self, app):
+        """ Errors starting the row generator are raised before the response is made. """
+        def bad_rows():
+            raise ValueError('query failed')
+            yield {}
+        with app.test_request_context('/'):
+            with pytest.raises(ValueError, match='query failed'):
+                rutils.stream_json_rows(bad_rows())
+
+
+    def test_stream_json_rows_closes(self, app):
+        """ Closing the response closes the row generator. """
+        closed = []
+        def gen_rows():
+            try:
+                yield from self.rows
+            finally:
+                closed.append(True)
+        with app.test_request_context('/'):
+            resp = rutils.stream_json_rows(gen_rows())
+            next(iter(resp.response))
+            resp.close()
+            assert closed == [True]
+
+
+    def test_etagged_json_response(self, app):
+        with app.test_request_context('/img/collections'):
+            resp = rutils.etagged_json_response(['DC19', 'DC20'])
+            assert resp.status_code == 200
+            assert resp.get_json() == ['DC19', 'DC20']
+            assert resp.headers.get('ETag') is not None
+            assert resp.cache_control.no_cache is True
+
+
+    def test_etagged_json_response_not_modified(self, app):
+        with app.test_request_context('/img/collections'):
+            etag = rutils.etagged_json_response(['DC19', 'DC20']).headers.get('ETag')
+        with app.test_request_context('/img/collections', headers={'If-None-Match': etag}):
+            resp = rutils.etagged_json_response(['DC19', 'DC20'])
+            assert resp.status_code == 304
+
+
+    def test_etagged_json_response_modified(self, app):
+        with app.test_request_context('/img/collections'):
+            etag = rutils.etagged_json_response(['DC19', 'DC20']).headers.get('ETag')
+        with app.test_request_context('/img/collections', headers={'If-None-Match': etag}):
+            resp = rutils.etagged_json_response(['DC19', 'DC20', 'DC21'])
+            assert resp.status_code == 200
+            assert resp.headers.get('ETag') != etag
+
+
+    def test_accepts_encoding(self, app):
+        with app.test_request_context('/', headers={'Accept-Encoding': 'gzip, deflate'}):
+            assert rutils.accepts_encoding('gzip') is True
+            assert rutils.accepts_encoding('br') is False
+        with app.test_request_context('/', headers={'Accept-Encoding': 'gzip;q=0, br'}):
+            assert rutils.accepts_encoding('gzip') is False
+        with app.test_request_context('/'):
+            assert rutils.accepts_encoding('gzip') is False
+
+
+    def test_file_etag(self, tmp_path):
+        fpath = tmp_path / 'img.dat'
+        fpath.write_bytes(b'0123456789')
+        etag = rutils.file_etag(str(fpath))
+        assert etag == rutils.file_etag(str(fpath))
+        os.utime(fpath, ns=(1, 1))
+        assert rutils.file_etag(str(fpath)) != etag
+        other = tmp_path / 'other.dat'
+        other.write_bytes(b'0123456789')
+        os.utime(other, ns=(1, 1))
+        assert rutils.file_etag(str(other)) != rutils.file_etag(str(fpath))
+
+
+    def test_internal_redirect_uri(self, tmp_path):
+        images = tmp_path / 'images'
+        (images / 'deep').mkdir(parents=True)
+        fpath = images / 'deep' / 'my image.fits'
+        fpath.write_bytes(b'')
+        locations = { str(tmp_path): '/internal/', str(images): '/internal/images' }
+        assert rutils.internal_redirect_uri(str(fpath), locations) == '/internal/images/deep/my%20image.fits'
+        assert rutils.internal_redirect_uri(str(fpath), { str(tmp_path): '/x' }) == '/x/images/deep/my%20image.fits'
+        assert rutils.internal_redirect_uri(str(fpath), { str(images / 'deep2'): '/x' }) is None
+        assert rutils.internal_redirect_uri(str(images / '..' / '..' / 'etc'), locations) is None
+        assert rutils.internal_redirect_uri(str(fpath), None) is None
+
+
+    def test_offload_file_response(self, app, tmp_path):
+        fpath = tmp_path / 'img.dat'
+        fpath.write_bytes(b'0123456789')
+        locations = { str(tmp_path): '/internal' }
+        with app.test_request_context('/'):
+            resp = rutils.offload_file_response(str(fpath), 'image/fits', 'x-accel', locations)
+            assert resp.headers.get('X-Accel-Redirect') == '/internal/img.dat'
+            assert resp.mimetype == 'image/fits'
+            assert resp.headers.get('Content-Disposition') == 'attachment; filename=img.dat'
+            assert resp.get_data() == b''
+            resp = rutils.offload_file_response(str(fpath), 'image/png', 'x-sendfile',
+                                                download_name='pv.png', as_attachment=False)
+            assert resp.headers.get('X-Sendfile') == str(fpath)
+            assert 'Content-Disposition' not in resp.headers
+            assert rutils.offload_file_response(str(fpath), 'image/fits', 'x-accel', {}) is None
+            assert rutils.offload_file_response(str(fpath), 'image/fits', 'direct') is None
+
+
+    def test_is_range_request(self, app):
+        with app.test_request_context('/', headers={'Range': 'bytes=0-99'}):
+            assert rutils.is_range_request() is True
+        with app.test_request_context('/'):
+            assert rutils.is_range_request() is False
+
+
+    def test_send_file_response(self, app, tmp_path):
+        fpath = tmp_path / 'img.dat'
+        fpath.write_bytes(bytes(range(256)) * 4)
+        with app.test_request_context('/'):
+            resp = rutils.send_file_response(str(fpath), 'image/fits')
+            assert resp.status_code == 200
+            assert resp.headers.get('ETag') == f"\"{rutils.file_etag(str(fpath))}\""
+            assert resp.headers.get('Last-Modified') is not None
+            assert resp.headers.get('Accept-Ranges') == 'bytes'
+            assert 'img.dat' in resp.headers.get('Content-Disposition')
+            etag = resp.headers.get('ETag')
+        with app.test_request_context('/', headers={'If-None-Match': etag}):
+            assert rutils.send_file_response(str(fpath), 'image/fits').status_code == 304
+        with app.test_request_context('/', headers={'Range': 'bytes=16-31'}):
+            resp = rutils.send_file_response(str(fpath), 'image/fits', download_name='x.fits')
+            resp.direct_passthrough = False
+            assert resp.status_code == 206
+            assert resp.headers.get('Content-Range') == 'bytes 16-31/1024'
+            assert resp.get_data() == bytes(range(16, 32))
+
+
+    def test_next_page_url(self, app):
+        with app.test_request_context('/img/query_image?collection=DC20&limit=3&after_id=2'):
+            url = rutils.next_page_url(9)
+            assert url.startswith('http://localhost.localdomain:8000/img/query_image?')
+            assert 'collection=DC20' in url
+            assert 'limit=3' in url
+            assert 'after_id=9' in url
+            assert 'after_id=2' not in url
+
+
+    def test_paged_json_response_nolimit(self, app):
+        with app.test_request_context('/img/query_image'):
+            resp = rutils.paged_json_response(self.rows)
+            assert resp.status_code == 200
+            assert resp.get_json() == self.rows
+            assert rutils.NEXT_PAGE_HEADER not in resp.headers
+            assert 'Link' not in resp.headers
+
+
+    def test_paged_json_response_partial(self, app):
+        """ A partial page is the last page. """
+        with app.test_request_context('/img/query_image?limit=10'):
+            resp = rutils.paged_json_response(self.rows, limit=10)
+            assert rutils.NEXT_PAGE_HEADER not in resp.headers
+
+
+    def test_paged_json_response_empty(self, app):
+        with app.test_request_context('/img/query_image?limit=10'):
+            resp = rutils.paged_json_response([], limit=10)
+            assert resp.get_json() == []
+            assert rutils.NEXT_PAGE_HEADER not in resp.headers
+
+
+    def test_paged_json_response(self, app):
+        """ A full page carries the cursor for the next page. """
+        with app.test_request_context('/img/query_image?limit=7'):
+            resp = rutils.paged_json_response(self.rows, limit=7)
+            assert resp.get_json() == self.rows
+            assert resp.headers.get(rutils.NEXT_PAGE_HEADER) == '7'
+            link = resp.headers.get('Link')
+            assert 'after_id=7' in link
+            assert link.endswith('; rel="next"')
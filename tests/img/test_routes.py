@@ -1,12 +1,17 @@
 # Tests for the image manager module.
 #   Written by: Tom Hicks. 12/28/2020.
-#   Last Modified: Load data root from test config settings.
+#   Last Modified: Expect the metadata of a list of image IDs as a list, in request order.
 #
+import io
+import json
 import os
 import pytest
+import zipfile
 
 from flask import request, jsonify
 
+from astropy.io import fits
+
 from cuts.blueprints.img import routes
 from cuts.blueprints.img import tasks
 from cuts.blueprints.img.exceptions import ImageNotFound, RequestException, ServerError
@@ -192,6 +197,31 @@ class TestRoutes(object):
 
 
 
+    def test_img_metadata_ids(self, client):
+        """ Comma-separated list of IDs, one unknown. """
+        resp = client.get('/img/metadata?ids=2,1,99999')
+        print(resp)
+        assert resp is not None
+        assert resp.status_code == 200
+        mds = resp.get_json()
+        assert [ md['id'] for md in mds ] == [2, 1, 99999]
+        assert mds[0]['metadata'].get('id') == 2
+        assert mds[1]['metadata'].get('id') == 1
+        assert mds[2]['metadata'] is None
+
+
+    def test_img_metadata_ids_post(self, client):
+        """ POSTed JSON list of IDs. """
+        resp = client.post('/img/metadata', json=[1, 99999])
+        print(resp)
+        assert resp is not None
+        assert resp.status_code == 200
+        mds = resp.get_json()
+        assert [ md['id'] for md in mds ] == [1, 99999]
+        assert mds[0]['metadata'].get('id') == 1
+        assert mds[1]['metadata'] is None
+
+
     def test_img_metadata_by_collection_nocoll(self, client):
         """ No collection argument. """
         resp = client.get('/img/metadata_by_collection')
@@ -227,6 +257,29 @@ class TestRoutes(object):
 
 
 
+    def test_img_metadata_by_collection_stream(self, client):
+        """ Collection metadata streamed as a JSON array. """
+        resp = client.get("/img/metadata_by_collection?collection=DC20&stream=json")
+        print(resp)
+        assert resp is not None
+        assert resp.status_code == 200
+        assert resp.is_streamed is True
+        recs = resp.get_json()
+        assert len(recs) == self.dc20_size
+
+
+    def test_img_metadata_by_collection_ndjson(self, client):
+        """ Collection metadata streamed as newline-delimited JSON. """
+        resp = client.get("/img/metadata_by_collection?collection=DC20&stream=ndjson")
+        print(resp)
+        assert resp is not None
+        assert resp.status_code == 200
+        assert resp.mimetype == 'application/x-ndjson'
+        lines = str(resp.data, encoding='UTF-8').splitlines()
+        assert len(lines) == self.dc20_size
+
+
+
     def test_img_metadata_by_filter_nofilt(self, client):
         """ No filter argument. """
         resp = client.get('/img/metadata_by_filter')
@@ -383,6 +436,41 @@ class TestRoutes(object):
 
 
 
+    def test_query_cones_nosize(self, client):
+        """ No search radius given. """
+        resp = client.post("/img/query_cones", json={'positions': [[53.1577, -27.8075]]})
+        assert resp.status_code == RequestException.ERROR_CODE
+        resp_msg = str(resp.data, encoding='UTF-8') or ''
+        assert self.size_emsg in resp_msg
+
+
+    def test_query_cones(self, client):
+        """ JSON list of positions. """
+        resp = client.post("/img/query_cones",
+                           json={'positions': [[53.157662568, -27.8075199236], [102.0, 10.2]],
+                                 'sizeArcSec': 90, 'collection': 'DC20'})
+        print(resp)
+        assert resp.status_code == 200
+        res = resp.get_json()
+        assert len(res) == 2
+        assert res[0]['row'] == 0
+        assert len(res[0]['ids']) == self.dc20_size
+        assert res[1]['ids'] == []
+
+
+    def test_query_cones_csv(self, client):
+        """ Uploaded CSV table of positions, newline-delimited JSON results. """
+        csv_data = b"ra,dec\n53.157662568,-27.8075199236\n"
+        resp = client.post("/img/query_cones?stream=ndjson",
+                           data={'sizeArcSec': '90', 'collection': 'DC20',
+                                 'file': (io.BytesIO(csv_data), 'positions.csv')})
+        print(resp)
+        assert resp.status_code == 200
+        lines = str(resp.data, encoding='UTF-8').splitlines()
+        assert len(lines) == 1
+        assert len(json.loads(lines[0])['ids']) == self.dc20_size
+
+
     def test_query_cone_noargs(self, client):
         """ No CO arguments, size or coordinates, given. """
         resp = client.get(f"/img/query_cone")
@@ -540,6 +628,89 @@ class TestRoutes(object):
         assert '[]' in str(resp.data)
 
 
+    def test_co_cache_stats(self, client):
+        resp = client.get("/co/cache_stats")
+        assert resp.status_code == 200
+        jdata = resp.get_json()
+        assert 'entries' in jdata
+        assert 'bytes' in jdata
+        assert 'max_bytes' in jdata
+        assert 'max_entries' in jdata
+        assert 'max_workers' in jdata['pool']
+
+
+
+    def test_co_jobs_badargs(self, client):
+        resp = client.post("/co/jobs", json={'ra': 53.16, 'dec': -27.78})
+        assert resp.status_code == 400
+        assert 'radius size' in resp.get_data(as_text=True)
+
+
+    def test_co_jobs_get(self, client):
+        resp = client.get("/co/jobs?ra=53.16&dec=-27.78&sizeArcSec=10")
+        assert resp.status_code == 405
+
+
+    def test_co_job_status_badid(self, client):
+        resp = client.get("/co/jobs/nosuchjob")
+        assert resp.status_code == 400
+        resp = client.get("/co/jobs/nosuchjob/result")
+        assert resp.status_code == 400
+
+
+
+    def test_co_cutout_cube(self, client):
+        """ Cube: m13 center point, all filters, no collection. """
+        resp = client.get("/co/cutout_cube?ra=250.4226&dec=36.4602&sizeArcSec=12")
+        assert resp.status_code == 200
+        assert resp.mimetype == FITS_MIME_TYPE
+        with fits.open(io.BytesIO(resp.data)) as hdus:
+            assert hdus[0].header['CO_NFILT'] == len(hdus) - 1
+            assert all(('FILTER' in hdu.header) for hdu in hdus[1:])
+
+
+    def test_co_cutout_cube_nosize(self, client):
+        resp = client.get("/co/cutout_cube?ra=250.4226&dec=36.4602")
+        assert resp.status_code == 400
+
+
+    def test_co_cutout_cube_nomatch(self, client):
+        resp = client.get("/co/cutout_cube?ra=18.0&dec=-80.0&sizeArcSec=12")
+        assert resp.status_code == 404
+
+
+    def test_co_cutouts(self, client):
+        """ Batch of cutouts: m13 center point and a position without an image, as a zip file. """
+        resp = client.post("/co/cutouts", json={ 'sizeArcSec': 12,
+                           'positions': [[250.4226, 36.4602], [18.0, -80.0]] })
+        assert resp.status_code == 200
+        assert resp.mimetype == 'application/zip'
+        with zipfile.ZipFile(io.BytesIO(resp.data)) as zfile:
+            names = zfile.namelist()
+            assert 'cutout_000000.fits' in names
+            manifest = json.loads(zfile.read('manifest.json'))
+            assert len(manifest['cutouts']) == 2
+            assert 'error' in manifest['cutouts'][1]
+
+
+    def test_co_cutouts_fits(self, client):
+        resp = client.post("/co/cutouts", json={ 'sizeArcSec': 12, 'format': 'fits',
+                           'positions': [[250.4226, 36.4602]] })
+        assert resp.status_code == 200
+        assert resp.mimetype == FITS_MIME_TYPE
+
+
+    def test_co_cutouts_badformat(self, client):
+        resp = client.post("/co/cutouts", json={ 'sizeArcSec': 12, 'format': 'rar',
+                           'positions': [[250.4226, 36.4602]] })
+        assert resp.status_code == 400
+
+
+    def test_co_cutouts_nopositions(self, client):
+        resp = client.post("/co/cutouts", json={ 'sizeArcSec': 12 })
+        assert resp.status_code == 400
+
+
 
     def test_query_image_coll(self, client):
         """ No filter, good collection. """
@@ -583,6 +754,91 @@ class TestRoutes(object):
 
 
 
+    def test_co_cutout_compressed(self, client):
+        """ Tile compressed cutout: m13 center point, no filter, no collection. """
+        resp = client.get("/co/cutout?ra=250.4226&dec=36.4602&sizeArcSec=12&compression=rice")
+        assert resp.status_code == 200
+        assert resp.mimetype == FITS_MIME_TYPE
+        with fits.open(io.BytesIO(resp.data)) as hdus:
+            assert isinstance(hdus[1], fits.CompImageHDU)
+
+
+    def test_co_cutout_compressed_badarg(self, client):
+        resp = client.get("/co/cutout?ra=250.4226&dec=36.4602&sizeArcSec=12&compression=lzw")
+        assert resp.status_code == 400
+
+
+    def test_co_cutout_binned(self, client):
+        """ Binned cutout: m13 center point, no filter, no collection. """
+        resp = client.get("/co/cutout?ra=250.4226&dec=36.4602&sizeArcSec=60&bin=3")
+        assert resp.status_code == 200
+        assert resp.mimetype == FITS_MIME_TYPE
+        with fits.open(io.BytesIO(resp.data)) as hdus:
+            assert hdus[0].header['CO_BIN'] == 3
+
+
+    def test_co_cutout_binned_badarg(self, client):
+        resp = client.get("/co/cutout?ra=250.4226&dec=36.4602&sizeArcSec=60&bin=2&maxPixels=10")
+        assert resp.status_code == 400
+
+
+    def test_co_cutout_int16(self, client):
+        """ Cutout packed into int16: m13 center point, no filter, no collection. """
+        resp = client.get("/co/cutout?ra=250.4226&dec=36.4602&sizeArcSec=60&dtype=int16")
+        assert resp.status_code == 200
+        with fits.open(io.BytesIO(resp.data)) as hdus:
+            assert hdus[0].header['BITPIX'] == 16
+            assert 'CO_ODTYP' in hdus[0].header
+
+
+    def test_co_cutout_dtype_badarg(self, client):
+        resp = client.get("/co/cutout?ra=250.4226&dec=36.4602&sizeArcSec=60&dtype=complex")
+        assert resp.status_code == 400
+
+
+    def test_co_cutout_primary_ext(self, client):
+        """ Selecting the primary HDU by name: m13 center point, no filter, no collection. """
+        resp = client.get("/co/cutout?ra=250.4226&dec=36.4602&sizeArcSec=60&ext=PRIMARY")
+        assert resp.status_code == 200
+        with fits.open(io.BytesIO(resp.data)) as hdus:
+            assert hdus[0].data is not None
+
+
+    def test_co_cutout_ext_badarg(self, client):
+        resp = client.get("/co/cutout?ra=250.4226&dec=36.4602&sizeArcSec=60&ext=SCI;1")
+        assert resp.status_code == 400
+        resp = client.get("/co/cutout?ra=250.4226&dec=36.4602&sizeArcSec=60&ext=SCI")
+        assert resp.status_code == 400          # no SCI extension
+
+
+    def test_co_cutout_planes_badarg(self, client):
+        resp = client.get("/co/cutout?ra=250.4226&dec=36.4602&sizeArcSec=60&planeMin=3&zMax=2")
+        assert resp.status_code == 400
+        resp = client.get("/co/cutout?ra=250.4226&dec=36.4602&sizeArcSec=60&planeMin=1")
+        assert resp.status_code == 400          # not a data cube
+
+
+    def test_co_cutout_preview(self, client):
+        """ PNG preview of a cutout: m13 center point, no filter, no collection. """
+        resp = client.get("/co/cutout?ra=250.4226&dec=36.4602&sizeArcSec=12&format=png&stretch=asinh")
+        assert resp.status_code == 200
+        assert resp.mimetype == 'image/png'
+        assert resp.data.startswith(b'\x89PNG')
+
+
+    def test_co_cutout_preview_nosize(self, client):
+        resp = client.get("/co/cutout?ra=250.4226&dec=36.4602&format=png")
+        assert resp.status_code == 400
+
+
+    def test_co_cutout_gzip(self, client):
+        resp = client.get("/co/cutout?ra=250.4226&dec=36.4602&sizeArcSec=12",
+                          headers={'Accept-Encoding': 'gzip'})
+        assert resp.status_code == 200
+        assert resp.headers.get('Content-Encoding') == 'gzip'
+
+
+
     def test_co_cutout_by_filter_badfilt(self, client):
         """ Cutout: m13 center point, bad filter, no collection. """
         resp = client.get("/co/cutout_by_filter?ra=250.4226&dec=36.4602&sizeArcSec=12&filter=BADfilt")
@@ -640,6 +896,19 @@ class TestRoutes(object):
 
 
 
+    def test_db_stats(self, client):
+        resp = client.get("/db_stats")
+        print(resp)
+        assert resp is not None
+        assert resp.status_code == 200
+        stats = resp.get_json()
+        assert stats is not None
+        assert 'in_use' in stats
+        assert 'idle' in stats
+        assert 'wait_time_avg' in stats
+
+
+
     def test_echo_empty(self, client):
         resp = client.get("/echo")
         print(resp)
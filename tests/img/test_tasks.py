@@ -47,3 +47,64 @@ class TestTasks(object):
             tasks.fetch_image_by_filter({})
         with pytest.raises(RequestException, match=emsg) as reqex:
             tasks.fetch_image_by_filter({'filt': '  '})
+
+
+    def test_make_cutout_job_nosize(self, app):
+        """ Errors are returned as the result of a job, not raised. """
+        res = tasks.make_cutout_job({'ra': '53.16', 'dec': '-27.78'})
+        assert res['error']['error_code'] == 400
+        assert 'radius size' in res['error']['message']
+
+
+    def test_make_cutout_job_noimage(self, app):
+        res = tasks.make_cutout_job({'ra': '1.0', 'dec': '1.0', 'sizeArcSec': '10'})
+        assert res['error']['error_code'] == 404
+
+
+    def test_submit_cutout_job_badargs(self, app):
+        """ Bad arguments are rejected before a job is submitted. """
+        with app.test_request_context('/'):
+            with pytest.raises(RequestException, match='radius size'):
+                tasks.submit_cutout_job({'ra': '53.16', 'dec': '-27.78'})
+            with pytest.raises(RequestException, match='Right ascension must be specified'):
+                tasks.submit_cutout_job({'sizeArcSec': '10'})
+
+
+    def test_submit_cutout_job_preview(self, app):
+        """ Cutout jobs make FITS cutouts, not preview images. """
+        args = {'ra': '53.16', 'dec': '-27.78', 'sizeArcSec': '10', 'format': 'png'}
+        with app.test_request_context('/'):
+            with pytest.raises(RequestException, match='Cutout jobs make FITS cutouts'):
+                tasks.submit_cutout_job(args)
+        res = tasks.make_cutout_job(args)
+        assert res['error']['error_code'] == 400
+
+
+    def test_submit_cutout_job_array(self, app):
+        """ Cutout jobs make FITS cutouts, not raw arrays. """
+        args = {'ra': '53.16', 'dec': '-27.78', 'sizeArcSec': '10', 'format': 'arrow'}
+        with app.test_request_context('/'):
+            with pytest.raises(RequestException, match="raw array"):
+                tasks.submit_cutout_job(args)
+        res = tasks.make_cutout_job(args)
+        assert res['error']['error_code'] == 400
+
+
+    def test_submit_cutout_job_badbin(self, app):
+        args = {'ra': '53.16', 'dec': '-27.78', 'sizeArcSec': '10', 'bin': '4', 'maxPixels': '64'}
+        with app.test_request_context('/'):
+            with pytest.raises(RequestException, match="Only one of the 'bin' and 'maxPixels'"):
+                tasks.submit_cutout_job(args)
+
+
+    def test_submit_cutout_job_baddtype(self, app):
+        args = {'ra': '53.16', 'dec': '-27.78', 'sizeArcSec': '10', 'dtype': 'uint8'}
+        with app.test_request_context('/'):
+            with pytest.raises(RequestException, match="The 'dtype' argument must be one of"):
+                tasks.submit_cutout_job(args)
+
+
+    def test_cutout_job_status_badid(self, app):
+        with app.test_request_context('/'):
+            with pytest.raises(RequestException, match='A valid cutout job ID must be specified'):
+                tasks.cutout_job_status('nosuchjob')
@@ -0,0 +1,74 @@
+# Tests for the time-to-live cache module.
+#   Last Modified: Initial creation.
+#
+import time
+
+from cuts.blueprints.img.ttl_cache import TTLCache
+
+
+class TestTTLCache(object):
+
+    def counting_loader(self, calls, value):
+        def loader():
+            calls.append(value)
+            return value
+        return loader
+
+
+    def test_get_cached(self):
+        cache = TTLCache(ttl=60)
+        calls = []
+        assert cache.get('k', self.counting_loader(calls, 1)) == 1
+        assert cache.get('k', self.counting_loader(calls, 2)) == 1
+        assert calls == [1]
+        assert len(cache) == 1
+
+
+    def test_get_expired(self):
+        cache = TTLCache(ttl=0.01)
+        calls = []
+        assert cache.get('k', self.counting_loader(calls, 1)) == 1
+        time.sleep(0.02)
+        assert cache.get('k', self.counting_loader(calls, 2)) == 2
+        assert calls == [1, 2]
+
+
+    def test_get_disabled(self):
+        cache = TTLCache(ttl=0)
+        calls = []
+        cache.get('k', self.counting_loader(calls, 1))
+        cache.get('k', self.counting_loader(calls, 2))
+        assert calls == [1, 2]
+        assert len(cache) == 0
+
+
+    def test_invalidate_key(self):
+        cache = TTLCache(ttl=60)
+        calls = []
+        cache.get('a', self.counting_loader(calls, 1))
+        cache.get('b', self.counting_loader(calls, 2))
+        cache.invalidate('a')
+        assert len(cache) == 1
+        assert cache.get('a', self.counting_loader(calls, 3)) == 3
+        assert cache.get('b', self.counting_loader(calls, 4)) == 2
+        cache.invalidate('nosuchkey')
+
+
+    def test_invalidate_all(self):
+        cache = TTLCache(ttl=60)
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.invalidate()
+        assert len(cache) == 0
+
+
+    def test_invalidate_during_load(self):
+        """ A value loaded while the cache is invalidated is returned but not cached. """
+        cache = TTLCache(ttl=60)
+        def loader():
+            cache.invalidate()
+            return 'stale'
+        assert cache.get('k', loader) == 'stale'
+        assert len(cache) == 0
+        assert cache.get('k', lambda: 'fresh') == 'fresh'
+        assert len(cache) == 1